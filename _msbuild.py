@@ -1,4 +1,5 @@
 import os
+import sys
 from pymsbuild import *
 from pymsbuild.cython import *
 
@@ -55,11 +56,132 @@ PYD_OPTS = [
 ]
 
 
+if sys.platform == "win32":
+    PYDS = [
+        PydFile(
+            '_etwtrace',
+            *PYD_OPTS,
+            ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
+            # Disable incremental linking because _etwtrace.c needs
+            # a real pointer to its _thunk function
+            ItemDefinition('Link', LinkIncremental='false'),
+            CSourceFile('etwtrace/_etwtrace.c', ControlFlowGuard=""),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            CSourceFile('etwtrace/_trace.cpp'),
+            CSourceFile('etwtrace/_filesink.c'),
+            IncludeFile('etwtrace/_trace.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+        PydFile(
+            '_etwinstrument',
+            *PYD_OPTS,
+            ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
+            CSourceFile('etwtrace/_etwinstrument.c'),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            CSourceFile('etwtrace/_trace.cpp'),
+            CSourceFile('etwtrace/_filesink.c'),
+            IncludeFile('etwtrace/_trace.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+        PydFile(
+            '_etwsample',
+            *PYD_OPTS,
+            ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
+            CSourceFile('etwtrace/_etwsample.c'),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            CSourceFile('etwtrace/_trace.cpp'),
+            CSourceFile('etwtrace/_filesink.c'),
+            IncludeFile('etwtrace/_trace.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+        PydFile(
+            '_vsinstrument',
+            *PYD_OPTS,
+            CSourceFile('etwtrace/_vsinstrument.c'),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+    ]
+else:
+    # Stack sampling is supported elsewhere by publishing thunks to perf in
+    # /tmp/perf-<pid>.map. All tracers can also write to the file sink.
+    PYDS = [
+        PydFile(
+            '_etwtrace',
+            ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
+            CSourceFile('etwtrace/_etwtrace.c'),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            CSourceFile('etwtrace/_perfmap.c'),
+            CSourceFile('etwtrace/_filesink.c'),
+            IncludeFile('etwtrace/_trace.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+        PydFile(
+            '_etwinstrument',
+            ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
+            CSourceFile('etwtrace/_etwinstrument.c'),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            CSourceFile('etwtrace/_nullsink.c'),
+            CSourceFile('etwtrace/_filesink.c'),
+            IncludeFile('etwtrace/_trace.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+        PydFile(
+            '_etwsample',
+            ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
+            CSourceFile('etwtrace/_etwsample.c'),
+            CSourceFile('etwtrace/_etwcommon.c'),
+            IncludeFile('etwtrace/_etwcommon.h'),
+            IncludeFile('etwtrace/_platform.h'),
+            CSourceFile('etwtrace/_nullsink.c'),
+            CSourceFile('etwtrace/_filesink.c'),
+            IncludeFile('etwtrace/_trace.h'),
+            IncludeFile('etwtrace/_func_id.h'),
+        ),
+    ]
+
+
 PACKAGE = Package(
     'etwtrace',
     PyFile("etwtrace/__main__.py"),
     PyFile("etwtrace/__init__.py"),
+    PyFile("etwtrace/_activities.py"),
+    PyFile("etwtrace/_activitytrace.py"),
+    PyFile("etwtrace/_allocations.py"),
+    PyFile("etwtrace/_asynctrace.py"),
+    PyFile("etwtrace/_bench.py"),
+    PyFile("etwtrace/_calltree.py"),
     PyFile("etwtrace/_cli.py"),
+    PyFile("etwtrace/_diff.py"),
+    PyFile("etwtrace/_etlparallel.py"),
+    PyFile("etwtrace/_etlreader.py"),
+    PyFile("etwtrace/_exceptions.py"),
+    PyFile("etwtrace/_exceptiontrace.py"),
+    PyFile("etwtrace/_export.py"),
+    PyFile("etwtrace/_gc.py"),
+    PyFile("etwtrace/_imports.py"),
+    PyFile("etwtrace/_importtrace.py"),
+    PyFile("etwtrace/_index.py"),
+    PyFile("etwtrace/_listener.py"),
+    PyFile("etwtrace/_metrics.py"),
+    PyFile("etwtrace/_metrictrace.py"),
+    PyFile("etwtrace/_pprof.py"),
+    PyFile("etwtrace/_sqlite.py"),
+    PyFile("etwtrace/_symbolize.py"),
+    PyFile("etwtrace/_tasks.py"),
+    PyFile("etwtrace/_tracefile.py"),
     PyFile("etwtrace/_version.py", IncludeInLayout=False),
 
     Package(
@@ -68,39 +190,7 @@ PACKAGE = Package(
         File("../python.stacktags"),
     ),
 
-    PydFile(
-        '_etwtrace',
-        *PYD_OPTS,
-        ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
-        # Disable incremental linking because _etwtrace.c needs
-        # a real pointer to its _thunk function
-        ItemDefinition('Link', LinkIncremental='false'),
-        CSourceFile('etwtrace/_etwtrace.c', ControlFlowGuard=""),
-        CSourceFile('etwtrace/_etwcommon.c'),
-        IncludeFile('etwtrace/_etwcommon.h'),
-        CSourceFile('etwtrace/_trace.cpp'),
-        IncludeFile('etwtrace/_trace.h'),
-        IncludeFile('etwtrace/_func_id.h'),
-    ),
-    PydFile(
-        '_etwinstrument',
-        *PYD_OPTS,
-        ItemDefinition("ClCompile", PreprocessorDefinitions=Prepend("WITH_TRACELOGGING;")),
-        CSourceFile('etwtrace/_etwinstrument.c'),
-        CSourceFile('etwtrace/_etwcommon.c'),
-        IncludeFile('etwtrace/_etwcommon.h'),
-        CSourceFile('etwtrace/_trace.cpp'),
-        IncludeFile('etwtrace/_trace.h'),
-        IncludeFile('etwtrace/_func_id.h'),
-    ),
-    PydFile(
-        '_vsinstrument',
-        *PYD_OPTS,
-        CSourceFile('etwtrace/_vsinstrument.c'),
-        CSourceFile('etwtrace/_etwcommon.c'),
-        IncludeFile('etwtrace/_etwcommon.h'),
-        IncludeFile('etwtrace/_func_id.h'),
-    ),
+    *PYDS,
     source='src',
 )
 
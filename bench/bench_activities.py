@@ -0,0 +1,143 @@
+"""Measures the cost of activities.
+
+Entering and exiting an activity is timed against an empty with statement,
+and ThreadPoolExecutor submissions and asyncio callbacks are timed with and
+without a current activity once the hooks are installed. Costs are reported
+per operation, taking the fastest of several repeats.
+
+Activities are written by the tracer module directly, without enabling a
+tracer, so only the cost of the activity is measured. Where etwtrace has not
+been built for this platform, _etwinstrument.c is compiled with the null
+sink as for the "null" engine in bench_tracers.py.
+
+    python bench/bench_activities.py [--repeat N] [--scale N] [--json FILE]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(ROOT / "bench"))
+
+from etwtrace._activitytrace import ActivityHooks
+
+
+def _load_module(build_dir):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        from bench_tracers import build_nullsink
+        build_nullsink(build_dir)
+        sys.path.insert(0, str(build_dir))
+        import _etwinstrument
+    return _etwinstrument
+
+
+def _best(run, ops, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        run()
+        elapsed.append(time.perf_counter_ns() - start)
+    return min(elapsed) / ops
+
+
+def _enter_exit(hooks, n):
+    def empty():
+        for _ in range(n):
+            with contextlib.nullcontext():
+                pass
+
+    def activity():
+        for _ in range(n):
+            with hooks.activity("request"):
+                pass
+    return empty, activity
+
+
+def _submit(hooks, n):
+    ex = ThreadPoolExecutor(1)
+
+    def run():
+        for _ in range(n):
+            ex.submit(int).result()
+
+    def in_activity():
+        with hooks.activity("request"):
+            run()
+    return ex, run, in_activity
+
+
+def _callbacks(hooks, n):
+    async def run():
+        for _ in range(n):
+            await asyncio.sleep(0)
+
+    async def in_activity():
+        with hooks.activity("request"):
+            await run()
+    return lambda: asyncio.run(run()), lambda: asyncio.run(in_activity())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="write results to this file")
+    args = parser.parse_args()
+
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "scale": args.scale,
+        "results": {},
+    }
+    results = report["results"]
+    with tempfile.TemporaryDirectory() as tmp:
+        hooks = ActivityHooks(_load_module(tmp))
+        n = 100_000 * args.scale
+        empty, activity = _enter_exit(hooks, n)
+        results["with_empty_ns"] = _best(empty, n, args.repeat)
+        results["with_activity_ns"] = _best(activity, n, args.repeat)
+
+        n = 5_000 * args.scale
+        ex, submit, submit_in_activity = _submit(hooks, n)
+        callbacks, callbacks_in_activity = _callbacks(hooks, n)
+        with ex:
+            results["submit_untraced_ns"] = _best(submit, n, args.repeat)
+            results["callback_untraced_ns"] = _best(callbacks, n, args.repeat)
+            hooks.install()
+            try:
+                results["submit_ns"] = _best(submit, n, args.repeat)
+                results["submit_in_activity_ns"] = _best(submit_in_activity, n, args.repeat)
+                results["callback_ns"] = _best(callbacks, n, args.repeat)
+                results["callback_in_activity_ns"] = _best(callbacks_in_activity, n, args.repeat)
+            finally:
+                hooks.uninstall()
+
+    print(f"enter/exit:  {results['with_activity_ns'] - results['with_empty_ns']:>10.0f} ns")
+    for name in ("submit", "callback"):
+        untraced = results[f"{name}_untraced_ns"]
+        print(f"{name + ':':<12} {results[f'{name}_ns'] - untraced:>10.0f} ns outside an activity, "
+              f"{results[f'{name}_in_activity_ns'] - untraced:.0f} ns inside")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Measures decoder throughput and memory on synthetic traces.
+
+For each trace size, writes a trace with synthetic_trace.py (or reuses one
+from --trace-dir) and runs each scenario in a new process:
+
+iterate
+    Decodes and counts every event.
+filter
+    Reads only PythonMark events from the first process, which the reader
+    must still scan the whole file to find.
+columns
+    Builds a sidecar index with per-event columns (etwtrace index --columns).
+    This always uses the portable reader.
+calltree
+    Reconstructs call trees from PythonFunctionPush/Pop events.
+
+Throughput is reported against the total number of events and bytes in the
+trace, and peak memory is the peak resident set size of the process.
+
+    python bench/bench_decode.py [--events 1M,10M,100M] [--mode M]
+        [--decoder portable|native] [--scenarios a,b] [--trace-dir DIR]
+        [--json FILE]
+
+Synthetic events average about 170 bytes, so 100M events need about 17 GiB
+of disk space. Pass --trace-dir to keep traces between runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(Path(__file__).absolute().parent))
+
+import synthetic_trace
+
+SCENARIOS = ["iterate", "filter", "columns", "calltree"]
+
+
+def _peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _open(path, decoder, **filters):
+    if decoder == "native":
+        from etwtrace._decoder import EtlReader
+        return EtlReader(path, **filters)
+    from etwtrace import _etlreader
+    return _etlreader.open(path, **filters)
+
+
+def _iterate(path, decoder):
+    n = 0
+    with _open(path, decoder) as reader:
+        for _ in reader:
+            n += 1
+    return n
+
+
+def _filter(path, decoder):
+    n = 0
+    with _open(path, decoder, process_ids=[synthetic_trace.FIRST_PID], event_names=["PythonMark"]) as reader:
+        for _ in reader:
+            n += 1
+    return n
+
+
+def _columns(path, decoder):
+    from etwtrace import _index
+    with _index.build(path, columns=True) as index:
+        n = sum(c[2] for c in index.counts())
+    os.unlink(_index.index_path(path))
+    return n
+
+
+def _calltree(path, decoder):
+    from etwtrace import _calltree
+    with _open(path, decoder, event_names=["PythonFunctionPush", "PythonFunctionPop"]) as reader:
+        a = _calltree.analyze(reader)
+    return sum(f.calls for f in a.functions.values())
+
+
+RUNNERS = {
+    "iterate": _iterate,
+    "filter": _filter,
+    "columns": _columns,
+    "calltree": _calltree,
+}
+
+
+def child_main(scenario, path, decoder):
+    try:
+        start = time.perf_counter()
+        n = RUNNERS[scenario](path, decoder)
+        elapsed = time.perf_counter() - start
+    except ImportError as ex:
+        return {"error": f"{type(ex).__name__}: {ex}"}
+    return {"output": n, "seconds": elapsed, "peak_rss": _peak_rss()}
+
+
+def run_scenario(scenario, path, decoder):
+    p = subprocess.run(
+        [sys.executable, __file__, "--child", scenario, "--decoder", decoder, str(path)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    if p.returncode:
+        return {"error": f"exited with code {p.returncode}"}
+    return json.loads(p.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=lambda s: [synthetic_trace.parse_count(v) for v in s.split(",")],
+                        default=[10 ** 6, 10 ** 7, 10 ** 8])
+    parser.add_argument("--mode", choices=synthetic_trace.MODES, default="mixed")
+    parser.add_argument("--decoder", choices=["portable", "native"], default="portable")
+    parser.add_argument("--scenarios", type=lambda s: s.split(","), default=SCENARIOS)
+    parser.add_argument("--trace-dir", type=Path, help="keep generated traces in this directory")
+    parser.add_argument("--json", type=Path, help="write results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("path", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(child_main(args.child, args.path, args.decoder), sys.stdout)
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "decoder": args.decoder,
+        "mode": args.mode,
+        "traces": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        trace_dir = args.trace_dir or Path(tmp)
+        trace_dir.mkdir(parents=True, exist_ok=True)
+        for events in args.events:
+            path = trace_dir / f"synthetic-{args.mode}-{events}.etl"
+            if not path.is_file():
+                print(f"Writing {path}...", file=sys.stderr)
+                synthetic_trace.write(path, events, mode=args.mode)
+            results = {s: run_scenario(s, path, args.decoder) for s in args.scenarios}
+            # Avoid decoding the whole trace again when possible
+            if "output" in results.get("iterate", {}):
+                total = results["iterate"]["output"]
+            else:
+                total = sum(1 for _ in _open(path, "portable"))
+            size = path.stat().st_size
+            trace = {"events": total, "bytes": size, "scenarios": results}
+            report["traces"].append(trace)
+            print(f"{path.name}: {total} events, {size / 2**20:.1f} MiB")
+            print(f"  {'':<12}{'output':>12}{'time':>10}{'events/s':>12}{'MiB/s':>10}{'peak MiB':>10}")
+            for scenario, r in results.items():
+                if "error" in r:
+                    print(f"  {scenario:<12}unavailable ({r['error']})")
+                    continue
+                r["events_per_sec"] = total / r["seconds"]
+                r["bytes_per_sec"] = size / r["seconds"]
+                peak = f"{r['peak_rss'] / 2**20:.0f}" if r["peak_rss"] else "-"
+                print(f"  {scenario:<12}{r['output']:>12}{r['seconds']:>9.2f}s{r['events_per_sec']:>12.0f}"
+                      f"{r['bytes_per_sec'] / 2**20:>10.1f}{peak:>10}")
+            if not args.trace_dir:
+                path.unlink()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", args.json)
+
+
+if __name__ == "__main__":
+    main()
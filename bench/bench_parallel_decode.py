@@ -0,0 +1,92 @@
+"""Measures decoding throughput of the portable ETL reader by worker count.
+
+Writes a synthetic trace with the test writer, then decodes it with the
+sequential reader and with ParallelEtlReader for 1..N workers, both as an
+ordered stream and using map() to count events in the workers.
+
+    python bench/bench_parallel_decode.py [--samples N] [--cpus N] [--workers N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT / "tests"))
+sys.path.insert(0, str(ROOT / "src"))
+
+import etlwriter
+from etwtrace import _etlparallel, _etlreader
+
+
+def write_trace(path, samples, cpus):
+    with etlwriter.EtlWriter(path, cpus=cpus, buffer_size=0x10000) as w:
+        w.process(1, 1000, 900, 'python.exe', 'python.exe bench.py', ts=1)
+        for cpu in range(cpus):
+            w.thread(1, 1000, 1100 + cpu, ts=2, cpu=cpu)
+        for i, (func_id, thunk, line, source, name) in enumerate(etlwriter.FUNCTIONS):
+            w.python_event(
+                'PythonFunction', func_id, thunk, thunk + etlwriter.THUNK_SIZE, line, source, name, 1,
+                ts=10 + i, pid=1000, tid=1100,
+            )
+        for i in range(samples):
+            t = 100 + i * 10
+            cpu = i % cpus
+            stack = [etlwriter.EVAL_FRAME + 0x10]
+            for thunk in etlwriter.THUNKS[:1 + i % 3]:
+                stack[:0] = [thunk + 0x8, etlwriter.EVAL_FRAME + 0x20]
+            w.sample(1100 + cpu, stack[0], ts=t, cpu=cpu)
+            w.stackwalk(1000, 1100 + cpu, stack, event_ts=t, ts=t + 1, cpu=cpu)
+            if i % 16 == 0:
+                w.python_event('PythonMark', f'mark {i}', ts=t + 2, pid=1000, tid=1100 + cpu, cpu=cpu)
+
+
+def count(reader):
+    return sum(1 for _ in reader)
+
+
+def measure(label, func, size):
+    start = time.perf_counter()
+    n = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24}{n:>10}{elapsed:>10.2f}s{size / elapsed / 2**20:>10.1f} MiB/s")
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=200_000)
+    parser.add_argument("--cpus", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--trace", type=Path, help="use an existing trace instead")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.trace
+        if not path:
+            path = Path(tmp) / "bench.etl"
+            write_trace(path, args.samples, args.cpus)
+        size = path.stat().st_size
+        print(f"{path} ({size / 2**20:.1f} MiB)")
+        print(f"{'':<24}{'events':>10}{'time':>11}{'throughput':>14}")
+
+        expected = measure("sequential", lambda: count(_etlreader.open(path)), size)
+        workers = 1
+        while True:
+            reader = _etlparallel.open(path, workers=workers)
+            n = measure(f"ordered, {workers} workers", lambda: count(reader), size)
+            assert n == expected, (n, expected)
+            reader = _etlparallel.open(path, workers=workers)
+            n = measure(f"map, {workers} workers", lambda: sum(reader.map(count)), size)
+            assert n == expected, (n, expected)
+            if workers >= args.workers:
+                break
+            workers = min(workers * 2, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Measures the overhead of SamplingTracer at a range of sampling rates.
+
+A CPU-bound workload is timed untraced and then with the sampler enabled at
+each rate, taking the fastest of several repeats. Samples are written to the
+file sink in a temporary directory, and the achieved sampling rate and the
+size of the file per sample are reported alongside the overhead.
+
+Where etwtrace has not been built for this platform, _etwsample.c is compiled
+with the null sink as for the "null" engine in bench_tracers.py.
+
+    python bench/bench_sampling.py [--rates 100,1000,...] [--repeat N]
+                                   [--scale N] [--json FILE]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(ROOT / "bench"))
+
+import etwtrace
+
+RATES = [100, 500, 1000, 2000, 5000, 10000]
+
+
+def _workload(scale):
+    def fib(n):
+        return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+    def run():
+        for _ in range(scale):
+            fib(22)
+            json.loads(json.dumps([{"a": i, "b": str(i)} for i in range(2000)]))
+    return run
+
+
+def _time(scale):
+    run = _workload(scale)
+    start = time.perf_counter_ns()
+    run()
+    return time.perf_counter_ns() - start
+
+
+def _load_module(build_dir):
+    try:
+        from etwtrace import _etwsample
+    except ImportError:
+        from bench_tracers import build_nullsink
+        build_nullsink(build_dir, "_etwsample")
+        sys.path.insert(0, str(build_dir))
+        import _etwsample
+        # SamplingTracer imports its module from the package
+        sys.modules["etwtrace._etwsample"] = _etwsample
+
+
+def measure(rate, repeat, scale, tmp):
+    output = Path(tmp) / f"{rate}.pytrace"
+    tracer = etwtrace.SamplingTracer(rate=rate, output=output)
+    elapsed = []
+    samples = last = 0
+    enabled_ns = 0
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        with tracer:
+            elapsed.append(_time(scale))
+            last = tracer.samples
+        samples += last
+        enabled_ns += time.perf_counter_ns() - start
+    # Each enable overwrites the file, so its size is that of the last run
+    size = output.stat().st_size
+    output.unlink()
+    best = min(elapsed)
+    return {
+        "traced_ns": best,
+        "samples": samples,
+        "samples_per_sec": samples / (enabled_ns / 1e9),
+        "bytes_per_sample": size / max(last, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rates", type=lambda s: [int(r) for r in s.split(",")], default=RATES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=5)
+    parser.add_argument("--json", type=Path, help="write results to this file")
+    args = parser.parse_args()
+
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "scale": args.scale,
+        "rates": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        _load_module(tmp)
+        # Warm up before taking the baseline
+        _time(args.scale)
+        baseline = min(_time(args.scale) for _ in range(args.repeat))
+        report["baseline_ns"] = baseline
+        print(f"baseline: {baseline / 1e6:.2f} ms")
+        print(f"  {'rate':>8}{'traced ms':>12}{'overhead':>10}{'samples/s':>12}{'bytes/sample':>14}")
+        for rate in args.rates:
+            report["rates"][rate] = r = measure(rate, args.repeat, args.scale, tmp)
+            r["overhead_ratio"] = r["traced_ns"] / baseline
+            print(f"  {rate:>8}{r['traced_ns'] / 1e6:>12.2f}{(r['overhead_ratio'] - 1) * 100:>9.1f}%"
+                  f"{r['samples_per_sec']:>12.0f}{r['bytes_per_sample']:>14.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""Measures the overhead of each tracer against an untraced baseline.
+
+Each engine runs in its own process. Every workload is timed with tracing
+disabled and then enabled, taking the fastest of several repeats, and the
+difference is reported per operation (a call, a generator resume, or one
+iteration of a macro workload).
+
+Engines that cannot be loaded on this machine, such as the ETW tracers on
+other platforms, are reported as unavailable. The "null" engine is
+_etwinstrument.c and _etwcommon.c linked with _nullsink.c instead of
+_trace.cpp. It is compiled on demand with the compiler Python was built with,
+and measures the cost of the profile hook and function ID lookups without
+writing any events. It is not built on Windows, where the real engines can
+be measured directly.
+
+The "file" engine is the instrumented tracer writing to the file sink
+instead of ETW (using the null sink build where ETW is unavailable), and
+also reports the size of the file per event. The "tasks" engine is the same
+with asyncio task events enabled, and its cost per task step is shown by the
+asyncio_steps workload. The "gc" engine is the same with GC events enabled,
+and its cost per collection is shown by the gc_collections workload. The
+"exceptions" engine is the same with exception events enabled, and its cost
+per exception is shown by the caught_exceptions workload.
+
+The "allocations" engine is the in-process sampling tracer at one sample
+per second, so that nearly all of its cost is in the allocation hooks, with
+allocation sampling at the default interval, writing to the file sink. Its
+cost per allocation is shown by the small_allocations workload.
+
+    python bench/bench_tracers.py [--engines a,b] [--workloads a,b]
+                                  [--repeat N] [--scale N] [--json FILE]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import re
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+SRC = ROOT / "src"
+sys.path.insert(0, str(SRC))
+
+import etwtrace
+
+ENGINES = ["stack", "instrumented", "diaghub", "null", "file", "tasks", "gc", "exceptions", "allocations", "profile"]
+
+
+# Workloads return (run, ops) where run() is timed and performs ops operations.
+# They are created again for each repeat so that nothing is cached between them.
+
+def _empty(scale):
+    def f():
+        pass
+
+    def run():
+        for _ in range(n):
+            f()
+    n = 100_000 * scale
+    return run, n
+
+
+def _builtin(scale):
+    def run():
+        for _ in range(n):
+            len(s)
+    s = "abc"
+    n = 100_000 * scale
+    return run, n
+
+
+def _recursion(scale):
+    def recurse(depth):
+        if depth:
+            recurse(depth - 1)
+
+    def run():
+        for _ in range(n):
+            recurse(depth)
+    depth = 500
+    n = 20 * scale
+    return run, n * (depth + 1)
+
+
+def _generator(scale):
+    def gen():
+        for i in range(n):
+            yield i
+
+    def run():
+        for _ in gen():
+            pass
+    n = 100_000 * scale
+    return run, n
+
+
+_generation = 0
+
+
+def _many_functions(scale):
+    # Each function has a new code object and filename, so the tracers must
+    # register every one of them
+    global _generation
+    _generation += 1
+    n = 2_000 * scale
+    source = "\n".join(f"def f{i}(): pass" for i in range(n))
+    namespace = {}
+    exec(compile(source, f"<many_functions {_generation}>", "exec"), namespace)
+    functions = [namespace[f"f{i}"] for i in range(n)]
+
+    def run():
+        for f in functions:
+            f()
+    return run, n
+
+
+def _json(scale):
+    import json
+    doc = {
+        "items": [{"id": i, "name": f"item {i}", "tags": ["a", "b"], "value": i / 3} for i in range(100)],
+        "total": 100,
+    }
+
+    def run():
+        for _ in range(n):
+            json.loads(json.dumps(doc))
+    n = 100 * scale
+    return run, n
+
+
+def _regex(scale):
+    pattern = re.compile(r"(\w+)@(\w+)\.(com|org)")
+    text = " ".join(f"user{i}@example.com other{i}@test.org" for i in range(50))
+
+    def run():
+        for _ in range(n):
+            for m in pattern.finditer(text):
+                m.group(1)
+    n = 200 * scale
+    return run, n
+
+
+def _threaded(scale):
+    def f(x):
+        return x + 1
+
+    def work():
+        for i in range(n):
+            f(i)
+
+    def run():
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    n = 25_000 * scale
+    return run, 4 * n
+
+
+def _asyncio_steps(scale):
+    # Each task takes two steps, around a bare yield
+    async def task():
+        await asyncio.sleep(0)
+
+    async def main():
+        await asyncio.gather(*(task() for _ in range(n)))
+
+    def run():
+        asyncio.run(main())
+    n = 5_000 * scale
+    return run, 2 * n
+
+
+def _gc_collections(scale):
+    # Youngest generation collections of a few live objects
+    def run():
+        for _ in range(n):
+            gc.collect(0)
+    live = [[] for _ in range(100)]
+    n = 2_000 * scale
+    return run, n
+
+
+def _caught_exceptions(scale):
+    # A failed lookup that is caught in the same function
+    def run():
+        for i in range(n):
+            try:
+                d[i]
+            except KeyError:
+                pass
+    d = {}
+    n = 50_000 * scale
+    return run, n
+
+
+def _small_allocations(scale):
+    # Each list is two allocations, for the object and for its items
+    def run():
+        for _ in range(n):
+            [None] * 8
+    n = 100_000 * scale
+    return run, 2 * n
+
+
+WORKLOADS = {
+    "empty_call": _empty,
+    "builtin_call": _builtin,
+    "deep_recursion": _recursion,
+    "generator_resume": _generator,
+    "many_functions": _many_functions,
+    "json_roundtrip": _json,
+    "regex": _regex,
+    "threaded": _threaded,
+    "asyncio_steps": _asyncio_steps,
+    "gc_collections": _gc_collections,
+    "caught_exceptions": _caught_exceptions,
+    "small_allocations": _small_allocations,
+}
+
+
+def build_nullsink(build_dir, module="_etwinstrument"):
+    """Compiles the null sink build of a tracer module into build_dir."""
+    if sys.platform == "win32":
+        raise RuntimeError("the null sink is not built on Windows")
+    src = SRC / "etwtrace"
+    cc = sysconfig.get_config_var("LDSHARED").split()
+    cflags = sysconfig.get_config_var("CCSHARED").split()
+    output = Path(build_dir) / (module + sysconfig.get_config_var("EXT_SUFFIX"))
+    subprocess.run([
+        *cc, *cflags, "-O2", "-DWITH_TRACELOGGING",
+        "-I" + sysconfig.get_paths()["include"],
+        str(src / f"{module}.c"), str(src / "_etwcommon.c"), str(src / "_nullsink.c"),
+        str(src / "_filesink.c"), "-o", str(output),
+    ], check=True)
+    return output
+
+
+def _null_tracer(build_dir, output=None):
+    sys.path.insert(0, str(build_dir))
+    import _etwinstrument
+
+    class NullSinkTracer(etwtrace._TracingMixin):
+        _module = _etwinstrument
+
+    tracer = NullSinkTracer()
+    tracer.output = output
+    return tracer
+
+
+def _file_tracer(build_dir):
+    output = Path(tempfile.mkdtemp()) / "bench.pytrace"
+    if build_dir:
+        return _null_tracer(build_dir, output)
+    return etwtrace.InstrumentedTracer(output=output)
+
+
+def _allocation_tracer(build_dir):
+    output = Path(tempfile.mkdtemp()) / "bench.pytrace"
+    if build_dir:
+        # SamplingTracer imports its module from the package, so the null
+        # sink build is put in its place
+        sys.path.insert(0, str(build_dir))
+        import _etwsample
+        sys.modules["etwtrace._etwsample"] = _etwsample
+    return etwtrace.SamplingTracer(rate=1, output=output, allocations=True)
+
+
+def create_tracer(engine, build_dir=None):
+    if engine == "stack":
+        return etwtrace.StackSamplingTracer()
+    if engine == "instrumented":
+        return etwtrace.InstrumentedTracer()
+    if engine == "diaghub":
+        return etwtrace.DiagnosticsHubTracer()
+    if engine == "null":
+        return _null_tracer(build_dir)
+    if engine == "file":
+        return _file_tracer(build_dir)
+    if engine == "tasks":
+        tracer = _file_tracer(build_dir)
+        tracer.tasks = True
+        return tracer
+    if engine == "gc":
+        tracer = _file_tracer(build_dir)
+        tracer.gc = True
+        return tracer
+    if engine == "exceptions":
+        tracer = _file_tracer(build_dir)
+        tracer.exceptions = True
+        return tracer
+    if engine == "allocations":
+        return _allocation_tracer(build_dir)
+    if engine == "profile":
+        from etwtrace._bench import BenchTracer
+        return BenchTracer()
+    raise ValueError(f"unknown engine {engine}")
+
+
+def _time(workload, scale):
+    run, ops = workload(scale)
+    start = time.perf_counter_ns()
+    run()
+    return time.perf_counter_ns() - start, ops
+
+
+def child_main(engine, workloads, repeat, scale, build_dir):
+    try:
+        tracer = create_tracer(engine, build_dir)
+    except Exception as ex:
+        return {"error": f"{type(ex).__name__}: {ex}"}
+    # Only trace the workloads, as a user would with include()
+    tracer.include(__file__)
+    baseline = {
+        name: min(_time(WORKLOADS[name], scale)[0] for _ in range(repeat))
+        for name in workloads
+    }
+    # Tracing is enabled once, as the native tracers release their ignored
+    # files and include prefixes when disabled
+    traced = {}
+    with tracer:
+        for name in workloads:
+            traced[name] = min(_time(WORKLOADS[name], scale) for _ in range(repeat))
+    results = {}
+    for name in workloads:
+        base = baseline[name]
+        elapsed, ops = traced[name]
+        results[name] = {
+            "ops": ops,
+            "baseline_ns": base,
+            "traced_ns": elapsed,
+            "overhead_ns_per_op": (elapsed - base) / ops,
+            "overhead_ratio": elapsed / base,
+        }
+    report = {"results": results, "info": tracer._get_technical_info()}
+    if tracer.output:
+        with etwtrace.open_trace(tracer.output) as trace:
+            events = sum(1 for _ in trace)
+        size = tracer.output.stat().st_size
+        report["file"] = {"bytes": size, "events": events, "bytes_per_event": size / max(events, 1)}
+        tracer.output.unlink()
+        tracer.output.parent.rmdir()
+    return report
+
+
+def run_engine(engine, args, build_dir):
+    cmd = [
+        sys.executable, __file__, "--child", engine,
+        "--workloads", ",".join(args.workloads),
+        "--repeat", str(args.repeat), "--scale", str(args.scale),
+    ]
+    if build_dir:
+        cmd.extend(["--build-dir", str(build_dir)])
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+    if p.returncode:
+        return {"error": f"exited with code {p.returncode}"}
+    return json.loads(p.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", type=lambda s: s.split(","), default=ENGINES)
+    parser.add_argument("--workloads", type=lambda s: s.split(","), default=list(WORKLOADS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="write results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--build-dir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    if args.child:
+        json.dump(child_main(args.child, args.workloads, args.repeat, args.scale, args.build_dir), sys.stdout)
+        return
+
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "scale": args.scale,
+        "engines": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        build_dir = None
+        if {"null", "file", "tasks", "gc", "exceptions", "allocations"} & set(args.engines) and sys.platform != "win32":
+            build_nullsink(tmp)
+            if "allocations" in args.engines:
+                build_nullsink(tmp, "_etwsample")
+            build_dir = tmp
+        for engine in args.engines:
+            report["engines"][engine] = r = run_engine(engine, args, build_dir)
+            if "error" in r:
+                print(f"{engine}: unavailable ({r['error']})")
+                continue
+            print(f"{engine}: {r['info']}")
+            print(f"  {'':<20}{'baseline ms':>12}{'traced ms':>12}{'ns/op':>10}{'ratio':>8}")
+            for name, w in r["results"].items():
+                print(f"  {name:<20}{w['baseline_ns'] / 1e6:>12.2f}{w['traced_ns'] / 1e6:>12.2f}"
+                      f"{w['overhead_ns_per_op']:>10.1f}{w['overhead_ratio']:>7.2f}x")
+            if "file" in r:
+                f = r["file"]
+                print(f"  {f['events']} events in {f['bytes']} bytes ({f['bytes_per_event']:.1f} bytes/event)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", args.json)
+
+
+if __name__ == "__main__":
+    main()
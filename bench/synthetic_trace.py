@@ -0,0 +1,228 @@
+"""Generates large synthetic ETL traces from the Python provider.
+
+Each thread performs a random walk over a call graph of functions, where
+each function has up to fanout callees and the first callees are called most
+often. Stacks are at most depth frames deep. This produces:
+
+* a burst of PythonFunction events as functions are first called, with
+  further bursts when new "modules" of functions are imported
+* PythonFunctionPush/Pop events for every call (instrumented mode)
+* periodic sampled profile and stack walk events with the current stack
+  of function thunks (stack mode)
+* mark_range start/stop pairs around every few thousand events
+
+The output uses tests/etlwriter.py, so it can be read by the portable
+reader and, on Windows, by the native decoder.
+
+    python bench/synthetic_trace.py OUTPUT.etl [--events N] [--mode M]
+        [--threads N] [--processes N] [--functions N] [--depth N]
+        [--fanout N] [--seed N]
+"""
+
+import argparse
+import random
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT / "tests"))
+
+import etlwriter
+
+MODES = ("instrumented", "stack", "mixed")
+
+FIRST_PID = 1000
+FIRST_FUNCTION_ID = 0x100
+
+
+def parse_count(value):
+    """Parses counts such as 1000, 10K or 1M."""
+    value = value.strip().upper()
+    scale = {"K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9}.get(value[-1:], 1)
+    if scale != 1:
+        value = value[:-1]
+    return int(float(value) * scale)
+
+
+class _Thread:
+    def __init__(self, pid, tid, cpu):
+        self.pid = pid
+        self.tid = tid
+        self.cpu = cpu
+        self.stack = []
+        self.next_sample = 0
+        self.mark = None
+
+
+class SyntheticTrace:
+    """Writes a synthetic trace of approximately events events."""
+
+    def __init__(self, path, *, events, mode="instrumented", threads=4, processes=1,
+                 functions=5_000, depth=24, fanout=4, sample_interval=10_000,
+                 mark_every=5_000, import_every=100_000, seed=0):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        self.path = path
+        self.events = events
+        self.mode = mode
+        self.depth = depth
+        self.fanout = fanout
+        self.sample_interval = sample_interval
+        self.mark_every = mark_every
+        self.import_every = import_every
+        self.rng = random.Random(seed)
+        # Functions only call functions with higher numbers, so there is no
+        # recursion and the last functions are leaves
+        self.callees = [
+            [self.rng.randrange(f + 1, functions) for _ in range(fanout)] if f + 1 < functions else []
+            for f in range(functions)
+        ]
+        self.next_import = functions
+        self.cpus = min(threads * processes, 8)
+        self.threads = [
+            _Thread(FIRST_PID + p, FIRST_PID + 100 + p * threads + t, (p * threads + t) % self.cpus)
+            for p in range(processes) for t in range(threads)
+        ]
+        self.registered = {}
+        self.written = 0
+        self.ts = 1000
+
+    def _thunk(self, function):
+        return etlwriter.ETWTRACE_PYD + 0x1000 + function * etlwriter.THUNK_SIZE
+
+    def _event(self, name, *values, thread, **kwargs):
+        self.writer.python_event(name, *values, ts=self.ts, pid=thread.pid, tid=thread.tid,
+                                 cpu=thread.cpu, **kwargs)
+        self.written += 1
+
+    def _register(self, thread, function):
+        key = thread.pid, function
+        if key in self.registered:
+            return
+        self.registered[key] = None
+        thunk = self._thunk(function)
+        self._event(
+            'PythonFunction', FIRST_FUNCTION_ID + function, thunk, thunk + etlwriter.THUNK_SIZE,
+            1 + function % 50 * 10, rf'C:\app\module{function // 50}.py', f'function{function}', 1,
+            thread=thread,
+        )
+
+    def _import(self, thread):
+        # Register a module of functions that are never called, as happens
+        # when a module is imported
+        for f in range(self.next_import, self.next_import + 50):
+            self._register(thread, f)
+        self.next_import += 50
+
+    def _push(self, thread):
+        parent = thread.stack[-1] if thread.stack else 0
+        if thread.stack:
+            callees = self.callees[parent]
+            function = callees[min(int(self.rng.expovariate(1.0)), len(callees) - 1)]
+        else:
+            function = 0
+        self._register(thread, function)
+        thread.stack.append(function)
+        if self.mode != "stack":
+            caller = FIRST_FUNCTION_ID + parent if len(thread.stack) > 1 else 0
+            self._event('PythonFunctionPush', FIRST_FUNCTION_ID + function, caller,
+                        1 + self.rng.randrange(100), thread=thread)
+
+    def _pop(self, thread):
+        function = thread.stack.pop()
+        if self.mode != "stack":
+            self._event('PythonFunctionPop', FIRST_FUNCTION_ID + function, thread=thread)
+
+    def _sample(self, thread):
+        stack = [etlwriter.EVAL_FRAME + 0x10]
+        for function in thread.stack:
+            stack[:0] = [self._thunk(function) + 0x8, etlwriter.EVAL_FRAME + 0x20]
+        self.writer.sample(thread.tid, stack[0], ts=self.ts, cpu=thread.cpu)
+        self.writer.stackwalk(thread.pid, thread.tid, stack, event_ts=self.ts, ts=self.ts + 1, cpu=thread.cpu)
+        self.written += 2
+
+    def _step(self, thread):
+        depth = len(thread.stack)
+        # Bias towards calls near the root and returns near the leaves
+        if depth == 0 or (depth < self.depth and self.callees[thread.stack[-1]]
+                          and self.rng.random() < 0.5 + 0.3 / depth):
+            self._push(thread)
+        else:
+            self._pop(thread)
+        if self.mode != "instrumented" and thread.stack and self.ts >= thread.next_sample:
+            self._sample(thread)
+            thread.next_sample = self.ts + self.sample_interval
+
+    def write(self):
+        w = self.writer = etlwriter.EtlWriter(self.path, cpus=self.cpus, buffer_size=0x10000)
+        try:
+            for pid in sorted({t.pid for t in self.threads}):
+                w.process(1, pid, 900, 'python.exe', 'python.exe app.py', ts=self.ts)
+                w.image(10, pid, etlwriter.PYTHON_DLL, 0x60_0000, r'C:\Python\python313.dll', ts=self.ts)
+                w.image(10, pid, etlwriter.ETWTRACE_PYD, 0x10_0000,
+                        r'C:\Python\Lib\etwtrace\_etwtrace.pyd', ts=self.ts)
+                self.written += 3
+            for t in self.threads:
+                w.thread(1, t.pid, t.tid, ts=self.ts, cpu=t.cpu)
+                self._event('PythonEvalFunction', etlwriter.EVAL_FRAME, thread=t)
+                self._event('PythonThread', t.tid, opcode=1, thread=t)
+                self.written += 1
+
+            threads = self.threads
+            rng = self.rng
+            next_mark = self.mark_every
+            next_import = self.import_every
+            while self.written < self.events:
+                self.ts += rng.randrange(1, 20)
+                thread = threads[rng.randrange(len(threads))]
+                self._step(thread)
+                if self.written >= next_mark:
+                    next_mark += self.mark_every
+                    if thread.mark:
+                        self._event('PythonMark', thread.mark, opcode=2, thread=thread)
+                    thread.mark = f"request {self.written}"
+                    self._event('PythonMark', thread.mark, opcode=1, thread=thread)
+                if self.written >= next_import:
+                    next_import += self.import_every
+                    self._import(thread)
+
+            for t in threads:
+                self.ts += 1
+                while t.stack:
+                    self._pop(t)
+                if t.mark:
+                    self._event('PythonMark', t.mark, opcode=2, thread=t)
+                self._event('PythonThread', t.tid, opcode=2, thread=t)
+            for pid in sorted({t.pid for t in self.threads}):
+                w.process(2, pid, 900, 'python.exe', 'python.exe app.py', ts=self.ts + 1)
+                self.written += 1
+        finally:
+            w.close()
+        return self.written
+
+
+def write(path, events, **options):
+    """Writes a synthetic trace and returns the number of events written."""
+    return SyntheticTrace(path, events=events, **options).write()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--events", type=parse_count, default=1_000_000)
+    parser.add_argument("--mode", choices=MODES, default="instrumented")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--functions", type=int, default=5_000)
+    parser.add_argument("--depth", type=int, default=24)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    n = write(args.output, args.events, mode=args.mode, threads=args.threads, processes=args.processes,
+              functions=args.functions, depth=args.depth, fanout=args.fanout, seed=args.seed)
+    print(f"Wrote {n} events to {args.output} ({args.output.stat().st_size / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
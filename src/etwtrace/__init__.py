@@ -7,18 +7,35 @@ or another ETW logging tool.
 
 StackSamplingTracer will inject Python frames into stack samples
 captured by ETW. InstrumentedTracer will emit function entry and
-exit events. Both emit a detailed event the first time a function
-is called and later refer to it by ID.
+exit events. SamplingTracer samples Python stacks itself at a fixed
+rate, and works without ETW stack walks. All emit a detailed event
+the first time a function is called and later refer to it by ID.
+Pass tasks=True to any of them to also emit events for asyncio tasks,
+gc=True to emit events for garbage collections, imports=True to emit
+events for module imports, allocations=True to emit events for a sample
+of memory allocations, and exceptions=True to emit events for raised
+exceptions.
 
 The mark() function and mark_range() context manager emit an event
 (or start/stop pair) with custom text. These are useful for identifying
-spans of interest during analysis.
+spans of interest during analysis. The activity() context manager tags
+every event raised by its body with an activity ID, including work it
+hands to other threads or executors, so that the work done for each
+request can be found across threads. The counter(), gauge() and
+histogram() functions return metrics that aggregate numeric values, such as
+queue lengths or latencies, and write a summary of them to the trace every
+metrics_interval seconds (an attribute of the tracer) while tracing.
+The subscribe() function passes events to a callback in the traced process
+as they are recorded, in batches from a background thread.
 
 with etwtrace.StackSamplingTracer():
     # Code to trace
     etwtrace.mark("marker event")
     with etwtrace.mark_range("start/stop span"):
         # Code to trace
+    with etwtrace.activity("request"):
+        # Code to trace
+        etwtrace.counter("requests").add()
 """
 
 __author__ = "Microsoft Corporation <python@microsoft.com>"
@@ -41,8 +58,29 @@ class _range_mark:
 
 
 class _TracingMixin:
-    def __init__(self):
+    # Seconds between summaries of counters, gauges and histograms
+    metrics_interval = 1.0
+    # Seconds between deliveries to subscribers, and the bytes of events
+    # queued for them before events are dropped
+    listener_interval = 0.1
+    listener_buffer_size = 16 * 1024 * 1024
+
+    def __init__(self, output=None, tasks=False, gc=False, imports=False, allocations=False,
+                 exceptions=False):
+        self.output = output
+        self.tasks = tasks
+        self.gc = gc
+        self.imports = imports
+        self.allocations = allocations
+        self.exceptions = exceptions
         self.__context = None
+        self.__task_hooks = None
+        self.__activity_hooks = None
+        self.__import_hooks = None
+        self.__exception_hooks = None
+        self.__metric_writer = None
+        self.__listener = None
+        self.__sampling_allocations = False
 
     def __enter__(self):
         self.enable()
@@ -59,12 +97,132 @@ class _TracingMixin:
         self.ignore(self._module.enable.__module__)
         import threading
         self.ignore(threading.__file__)
+        if self.output:
+            self._module.set_output(self.output)
+        self._enable_listener()
         self.__context = self._module.enable(True)
+        # Import the metric writer before hooks can see it being imported
+        self._enable_metrics()
+        self._enable_tasks()
+        self._enable_gc()
+        self._enable_imports()
+        self._enable_exceptions()
+        self._enable_allocations()
 
     def disable(self):
         global _tracer
         _tracer = None
-        self._module.disable(self.__context)
+        self._disable_allocations()
+        self._disable_exceptions()
+        self._disable_imports()
+        self._disable_gc()
+        self._disable_activities()
+        self._disable_tasks()
+        self._disable_metrics()
+        try:
+            self._module.disable(self.__context)
+        finally:
+            self._disable_listener()
+            if self.output:
+                self._module.set_output(None)
+
+    def _enable_tasks(self):
+        if self.tasks:
+            from . import _asynctrace
+            self.ignore(_asynctrace.__file__)
+            self.__task_hooks = _asynctrace.TaskHooks(self._module)
+            self.__task_hooks.install()
+
+    def _disable_tasks(self):
+        if self.__task_hooks:
+            self.__task_hooks.uninstall()
+            self.__task_hooks = None
+
+    def _enable_gc(self):
+        if self.gc:
+            import gc
+            gc.callbacks.append(self._module.gc_callback)
+
+    def _disable_gc(self):
+        if self.gc:
+            import gc
+            try:
+                gc.callbacks.remove(self._module.gc_callback)
+            except ValueError:
+                pass
+
+    def _enable_imports(self):
+        if self.imports:
+            from . import _importtrace
+            self.ignore(_importtrace.__file__)
+            self.__import_hooks = _importtrace.ImportHooks(self._module)
+            self.__import_hooks.install()
+
+    def _disable_imports(self):
+        if self.__import_hooks:
+            self.__import_hooks.uninstall()
+            self.__import_hooks = None
+
+    def _enable_exceptions(self):
+        if self.exceptions:
+            from . import _exceptiontrace
+            self.ignore(_exceptiontrace.__file__)
+            self.__exception_hooks = _exceptiontrace.ExceptionHooks(self._module)
+            self.__exception_hooks.install()
+
+    def _disable_exceptions(self):
+        if self.__exception_hooks:
+            self.__exception_hooks.uninstall()
+            self.__exception_hooks = None
+
+    def _enable_allocations(self):
+        if self.allocations:
+            import atexit
+            if self.allocations is True:
+                self._module.enable_allocations()
+            else:
+                self._module.enable_allocations(self.allocations)
+            self.__sampling_allocations = True
+            # Sampling must stop before the interpreter finalizes
+            atexit.register(self._disable_allocations)
+
+    def _disable_allocations(self):
+        if self.__sampling_allocations:
+            import atexit
+            atexit.unregister(self._disable_allocations)
+            self.__sampling_allocations = False
+            self._module.disable_allocations()
+
+    def _enable_metrics(self):
+        if hasattr(self._module, "create_metric"):
+            from . import _metrictrace
+            self.ignore(_metrictrace.__file__)
+            self.__metric_writer = _metrictrace.MetricWriter(self._module, self.metrics_interval)
+            self.__metric_writer.start()
+
+    def _disable_metrics(self):
+        if self.__metric_writer:
+            self.__metric_writer.stop()
+            self.__metric_writer = None
+
+    def _enable_listener(self):
+        from . import _listener
+        if _listener.has_subscriptions() and hasattr(self._module, "start_listener"):
+            from . import _etlreader, _tracefile
+            self.ignore(_listener.__file__, _tracefile.__file__, _etlreader.__file__)
+            self.__listener = _listener.Listener(self._module, self.listener_interval,
+                                                 self.listener_buffer_size)
+            self.__listener.start()
+
+    def _disable_listener(self):
+        if self.__listener:
+            listener, self.__listener = self.__listener, None
+            listener.stop()
+
+    def _disable_activities(self):
+        if self.__activity_hooks:
+            self.__activity_hooks.uninstall()
+            self.__activity_hooks = None
 
     def ignore(self, *files):
         self._module.get_ignored_files().update(files)
@@ -78,6 +236,16 @@ class _TracingMixin:
     def mark_range(self, mark):
         return _range_mark(mark, self._module)
 
+    def activity(self, name):
+        hooks = self.__activity_hooks
+        if hooks is None:
+            # Only hook threads and executors once activities are used
+            from . import _activitytrace
+            self.ignore(_activitytrace.__file__)
+            hooks = self.__activity_hooks = _activitytrace.ActivityHooks(self._module)
+            hooks.install()
+        return hooks.activity(name)
+
     def _mark_stack(self, mark):
         self._module.write_mark(mark, 3)
 
@@ -86,19 +254,96 @@ class _TracingMixin:
 
 
 class StackSamplingTracer(_TracingMixin):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         from . import _etwtrace as mod
         self._module = mod
 
 
 class InstrumentedTracer(_TracingMixin):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         from . import _etwinstrument as mod
         self._module = mod
 
 
+class SamplingTracer(_TracingMixin):
+    """Samples the Python stack of every thread at a fixed rate.
+
+Samples are taken by a native thread, which needs the GIL to read other
+threads' stacks. While enabled, the interpreter's switch interval is
+lowered to the sampling interval so that a busy thread releases the GIL
+often enough to be sampled at the requested rate.
+
+Threads are sampled whether they are running or blocked, so samples
+measure wall-clock time, and idle worker threads are sampled where they
+wait. Frames in the threading module are left out, and etwtrace's own
+threads are never sampled.
+"""
+    def __init__(self, rate=1000, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        from . import _etwsample as mod
+        self._module = mod
+        self.rate = rate
+        self._switch_interval = None
+
+    def enable(self):
+        global _tracer
+        import atexit, sys
+        interval = 1 / self.rate
+        self.ignore(__file__)
+        import threading
+        self.ignore(threading.__file__)
+        if self.output:
+            self._module.set_output(self.output)
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(interval, self._switch_interval))
+        try:
+            self._enable_listener()
+            self._module.enable(interval)
+        except BaseException:
+            sys.setswitchinterval(self._switch_interval)
+            self._disable_listener()
+            if self.output:
+                self._module.set_output(None)
+            raise
+        _tracer = self
+        # Import the metric writer before hooks can see it being imported
+        self._enable_metrics()
+        self._enable_tasks()
+        self._enable_gc()
+        self._enable_imports()
+        self._enable_exceptions()
+        self._enable_allocations()
+        # The sampler thread must stop before the interpreter finalizes
+        atexit.register(self.disable)
+
+    def disable(self):
+        global _tracer
+        import atexit, sys
+        atexit.unregister(self.disable)
+        _tracer = None
+        self._disable_allocations()
+        self._disable_exceptions()
+        self._disable_imports()
+        self._disable_gc()
+        self._disable_activities()
+        self._disable_tasks()
+        self._disable_metrics()
+        try:
+            self._module.disable()
+        finally:
+            sys.setswitchinterval(self._switch_interval)
+            self._disable_listener()
+            if self.output:
+                self._module.set_output(None)
+
+    @property
+    def samples(self):
+        """The number of samples written since the tracer was enabled."""
+        return self._module.get_sample_count()
+
+
 class DiagnosticsHubTracer(_TracingMixin):
     def __init__(self, stub=False):
         self._data = None
@@ -127,6 +372,10 @@ class DiagnosticsHubTracer(_TracingMixin):
         from . import _vsinstrument as mod
         self._module = mod
 
+    def activity(self, name):
+        # The diagnostics hub does not record activity IDs
+        return _NullRange()
+
     def _on_event(self, *args):
         from threading import get_native_id
         self._data.append((*args, get_native_id()))
@@ -153,8 +402,19 @@ def enable_if(enable_var, type_var):
         return
 
     trace_type = getenv(type_var, "").lower() if type_var else ""
+    # Events for allocations, exceptions, imports, tasks or gc may follow
+    # the type, as in "stack,imports"
+    trace_type, *options = [t.strip() for t in trace_type.split(",")]
+    unknown = set(options) - {"allocations", "exceptions", "imports", "tasks", "gc"}
+    if unknown:
+        raise ValueError(
+            f"'{', '.join(sorted(unknown))}' is not a supported trace option. " +
+            "Use 'allocations', 'exceptions', 'imports', 'tasks' or 'gc'."
+        )
     if trace_type in ("stack", ""):
         tracer = StackSamplingTracer()
+    elif trace_type in ("sample", "sampling"):
+        tracer = SamplingTracer()
     elif trace_type in ("diaghub",):
         tracer = DiagnosticsHubTracer()
     elif trace_type in ("diaghubtest",):
@@ -164,8 +424,12 @@ def enable_if(enable_var, type_var):
     else:
         raise ValueError(
             f"'{trace_type}' is not a supported trace type. " +
-            "Use 'stack' or 'instrumented'."
+            "Use 'stack', 'sample' or 'instrumented'."
         )
+    if options and isinstance(tracer, DiagnosticsHubTracer):
+        raise ValueError("Trace options cannot be used with 'diaghub'.")
+    for option in options:
+        setattr(tracer, option, True)
     tracer.enable()
 
 
@@ -198,6 +462,67 @@ def mark_range(name):
         return _NullRange()
 
 
+def activity(name):
+    """Context manager that tags events raised by its body with a new
+    activity ID.
+
+    The activity follows the current context into asyncio tasks, executor
+    submissions and new threads. Activities started inside another activity
+    are related to it. When tracing is not active, nothing is done."""
+    if _tracer:
+        return _tracer.activity(name)
+    return _NullRange()
+
+
+def counter(name):
+    """Returns the counter with the provided name, creating it if needed.
+
+    Call add(value=1) on the counter to count events or total amounts. A
+    summary of the values added is written every metrics_interval seconds
+    (see the tracer) and when tracing is disabled. When tracing is not
+    active, nothing is recorded."""
+    from ._metrictrace import get_metric, Counter
+    return get_metric(Counter, name)
+
+
+def gauge(name):
+    """Returns the gauge with the provided name, creating it if needed.
+
+    Call set(value) on the gauge to replace its value, or add(value=1) to
+    change it. Summaries have the value at the time and its range since
+    the previous summary. When tracing is not active, nothing is recorded."""
+    from ._metrictrace import get_metric, Gauge
+    return get_metric(Gauge, name)
+
+
+def histogram(name):
+    """Returns the histogram with the provided name, creating it if needed.
+
+    Call record(value) on the histogram with each value, such as a latency.
+    Summaries have the count, sum and range of the values and a log-linear
+    histogram of them, so that percentiles can be estimated from the trace.
+    When tracing is not active, nothing is recorded."""
+    from ._metrictrace import get_metric, Histogram
+    return get_metric(Histogram, name)
+
+
+def subscribe(callback, keywords=0, batch_size=1000):
+    """Calls callback with lists of events recorded in this process.
+
+    Events are the same objects returned by open_trace(), and are delivered
+    from a background thread every listener_interval seconds (see the
+    tracer) and when tracing is disabled, in lists of at most batch_size
+    events. keywords selects events by the Python provider keywords, or
+    every event when zero. Events still go to the tracer's output file, or
+    to ETW when it has none. Subscriptions made while a tracer is enabled
+    without any take effect when the next one is enabled.
+
+    Returns a subscription with close() and counts of the events delivered
+    and dropped because the callbacks fell behind."""
+    from ._listener import subscribe
+    return subscribe(callback, keywords, batch_size)
+
+
 def _mark_stack(mark):
     if _tracer:
         return _tracer._mark_stack(mark)
@@ -254,3 +579,188 @@ In some circumstances, this may involve copying the file to a temporary
 location and returning that path.
 """
     return _get_content_path("python.stacktags")
+
+
+def open_trace(path, *, workers=None, **filters):
+    """Opens an ETL file and returns an iterable reader of its events.
+
+The file is decoded directly rather than through the Windows trace decoding
+APIs, so this works on any platform. Supported filters are providers,
+provider_names, event_names, process_ids, include_child_process_ids,
+keyword_mask_all, keyword_mask_any, start_time, end_time, property_filters
+and intern_stacks.
+
+Pass workers to decode using a pool of that many processes. Events are
+still returned in timestamp order, and the reader's map() method may be
+used to aggregate in the worker processes instead.
+
+If an up to date index has been created with index_trace() (or
+'python -m etwtrace index'), it is used to skip parts of the file that
+cannot contain events matching the process, name and time filters.
+
+Files written by a tracer's output option rather than ETW are also
+accepted, and are always read in the current process.
+"""
+    from ._tracefile import is_trace_file
+    if is_trace_file(path):
+        from ._tracefile import open
+        return open(path, **filters)
+    if workers:
+        from ._etlparallel import open
+        return open(path, workers=workers, **filters)
+    from ._index import open
+    return open(path, **filters)
+
+
+def index_trace(path, *, columns=False):
+    """Decodes an ETL file and writes a sidecar index next to it.
+
+The index records event counts and time ranges by process and event, the
+process, thread and Python function tables, and which parts of the file
+contain each process and event. Pass columns=True to also store the
+timestamp, process, thread and event of every event for analysis without
+decoding. The index is ignored if the ETL file is later modified.
+
+Returns the loaded index, which should be closed when no longer needed.
+"""
+    from ._index import build
+    return build(path, columns=columns)
+
+
+def symbolize(events, *, native=True):
+    """Yields (event, frames) for every event in events that has a stack.
+
+Events are typically from open_trace(). Python frames are identified from
+the thunk ranges in PythonFunction events and native frames from image load
+events (pass native=False to leave those as unknown). Addresses that are
+reused after tracing is disabled and re-enabled are resolved against the
+definitions in effect at the time of each sample.
+"""
+    from ._symbolize import Symbolizer
+    return Symbolizer(native=native).symbolize_events(events)
+
+
+def analyze_calls(events, *, tree=True):
+    """Returns call statistics for PythonFunctionPush/Pop events.
+
+The result has functions and call_sites mappings with call counts, inclusive
+and exclusive times (in timestamp units), and a call tree for each thread
+unless tree=False. Truncated traces are handled: calls already running when
+the trace started, or still running at its end, are counted up to the
+first or last event on their thread.
+"""
+    from ._calltree import analyze
+    return analyze(events, tree=tree)
+
+
+def analyze_tasks(events):
+    """Returns asyncio task timelines from a trace captured with tasks=True.
+
+The result has a tasks list, in order of creation, with the steps, CPU and
+wall time (in timestamp units) and a timeline of running, waiting and ready
+segments for each task, and callbacks with totals for other event loop
+callbacks. Tasks are linked to the task that created them, and roots()
+returns the top-level tasks (typically requests) by the total CPU time of
+the tasks they created.
+"""
+    from ._tasks import analyze
+    return analyze(events)
+
+
+def analyze_activities(events):
+    """Returns the work done for each activity from a trace that used
+activity().
+
+The result has an activities list, in order of starting, with the latency,
+the time each thread spent on it and the stack samples taken while a thread
+was working on it (in timestamp units). Activities are linked to the
+activity they were started in, and roots() returns the top-level activities
+by latency.
+"""
+    from ._activities import analyze
+    return analyze(events)
+
+
+def analyze_gc(events, *, symbolize=True):
+    """Returns garbage collection pauses from a trace captured with gc=True.
+
+The result has a pauses list with the generation, duration (in timestamp
+units) and counts of each collection, generations with the totals for each
+generation, and marks with the pause time inside each mark_range() name.
+Stack samples taken during a pause are counted against it, by their
+innermost Python frame unless symbolize=False.
+"""
+    from ._gc import analyze
+    return analyze(events, symbolize=symbolize)
+
+
+def analyze_imports(events):
+    """Returns the tree of imports from a trace captured with imports=True.
+
+The result has an imports list, in order of starting, with the module name,
+importer, origin, cumulative and self time (in timestamp units) and the
+stack samples taken during each import. roots() returns the imports that
+were not nested in another.
+"""
+    from ._imports import analyze
+    return analyze(events)
+
+
+def analyze_allocations(events, *, symbolize=True):
+    """Returns estimated allocations from a trace captured with
+allocations=True.
+
+The result has functions and paths mappings with the estimated bytes
+allocated by each function and call path, and freed again if frees were
+tracked, along with the totals for the trace. Each sampled allocation
+stands for about the number of bytes between samples, so these are
+estimates. Without symbolize, allocations are not attributed to functions.
+"""
+    from ._allocations import analyze
+    return analyze(events, symbolize=symbolize)
+
+
+def analyze_exceptions(events):
+    """Returns where exceptions were raised and handled from a trace captured
+with exceptions=True.
+
+The result has a sites mapping with the exceptions raised, reraised,
+handled and unwound at each line of each function, by exception type, and
+the frames unwound and time spent propagating (in timestamp units) the
+exceptions raised at each site. top_sites() and by_type() summarize them.
+"""
+    from ._exceptions import analyze
+    return analyze(events)
+
+
+def analyze_metrics(events):
+    """Returns the time series of each counter, gauge and histogram in a
+trace.
+
+The result has a metrics list with the summaries written for each metric
+every metrics_interval seconds as points, along with the totals, range
+and estimated percentiles for the whole trace. find(name) returns one
+metric by name.
+"""
+    from ._metrics import analyze
+    return analyze(events)
+
+
+def export(events, file, format, *, native=False, **options):
+    """Writes events to an open file in another tool's format.
+
+Supported formats are 'collapsed', for flame graph tools such as
+flamegraph.pl and speedscope, 'chrome' (or 'perfetto') for the Chrome
+Trace Event JSON format, 'pprof', and 'sqlite'. Output is written as events
+are read, so large traces do not need to fit in memory, except for 'pprof'
+which is written at the end. The file should be opened in binary mode for
+'pprof' and text mode otherwise. Native frames are omitted from stacks
+unless native=True.
+
+For 'sqlite', file is the path of the database or a sqlite3.Connection.
+Pass append=True to add the trace to an existing database under a new
+trace ID (or trace_id=N) rather than replacing it. The returned exporter
+has trace_id, events and elapsed attributes.
+"""
+    from ._export import export
+    return export(events, file, format, native=native, **options)
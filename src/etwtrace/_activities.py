@@ -0,0 +1,183 @@
+"""Aggregates the work done for each activity across threads.
+
+etwtrace.activity() raises a PythonActivity start event with the activity's
+name and the ID of the activity it was started in (as its related activity
+ID), and a stop event when it ends. Threads that pick up work for an
+activity, such as executor workers and event loop callbacks, raise resume
+and suspend events as they switch between activities (see
+_activitytrace.py). ActivityAnalyzer follows these switches and tracks which
+activity each thread is working on, so the time each thread spent on an
+activity can be totalled along with its latency.
+
+Stack samples (from ETW or SamplingTracer) are attributed to the activity
+that the sampled thread was working on at the time, and other events are
+counted against the activity ID they were raised with. Activities that were
+already running when the trace started are created when a thread first
+resumes them, with no name or parent.
+"""
+
+START = 1
+STOP = 2
+RESUME = 7
+SUSPEND = 8
+
+
+class ActivityInfo:
+    """The totals for one activity.
+
+    threads maps each thread ID to the time it spent on this activity."""
+    __slots__ = ('process_id', 'activity_id', 'name', 'parent', 'children', 'start',
+                 'end', 'last_seen', 'threads', 'samples', 'events')
+
+    def __init__(self, process_id, activity_id, name, parent, timestamp):
+        self.process_id = process_id
+        self.activity_id = activity_id
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.start = timestamp
+        self.end = None
+        self.last_seen = timestamp
+        self.threads = {}
+        self.samples = 0
+        self.events = 0
+        if parent:
+            parent.children.append(self)
+
+    @property
+    def display_name(self):
+        return self.name or f"<activity {self.activity_id}>"
+
+    @property
+    def latency(self):
+        return (self.end if self.end is not None else self.last_seen) - self.start
+
+    @property
+    def thread_time(self):
+        return sum(self.threads.values())
+
+    @property
+    def inclusive_thread_time(self):
+        """Thread time of this activity and every activity started in it."""
+        return self.thread_time + sum(c.inclusive_thread_time for c in self.children)
+
+    @property
+    def inclusive_samples(self):
+        return self.samples + sum(c.inclusive_samples for c in self.children)
+
+    def __repr__(self):
+        return f"<ActivityInfo({self.display_name!r}, latency={self.latency})>"
+
+
+class ActivityAnalyzer:
+    """Accumulates per-activity totals from PythonActivity events.
+
+    activities lists every activity seen in the order it started, including
+    those that never stopped during the trace.
+    """
+
+    def __init__(self):
+        self.activities = []
+        self.unmatched_stops = 0
+        self._by_id = {}
+        # (ActivityInfo, since) for each thread that is working on one
+        self._running = {}
+        self._finished = False
+
+    def _get(self, pid, activity_id, timestamp):
+        a = self._by_id.get((pid, activity_id))
+        if a is None:
+            a = self._start(pid, activity_id, None, None, timestamp)
+        return a
+
+    def _start(self, pid, activity_id, name, parent_id, timestamp):
+        parent = self._by_id.get((pid, parent_id)) if parent_id else None
+        a = ActivityInfo(pid, activity_id, name, parent, timestamp)
+        self.activities.append(a)
+        self._by_id[pid, activity_id] = a
+        return a
+
+    def _switch(self, thread_id, activity, timestamp):
+        running = self._running.pop(thread_id, None)
+        if running is not None:
+            a, since = running
+            a.threads[thread_id] = a.threads.get(thread_id, 0) + timestamp - since
+            a.last_seen = timestamp
+        if activity is not None:
+            self._running[thread_id] = activity, timestamp
+
+    def add(self, event):
+        if event.event_name == 'PythonActivity':
+            pid = event.process_id
+            ts = event.timestamp
+            opcode = event.opcode
+            if opcode == START:
+                a = self._start(pid, event.activity_id, event['Name'].value,
+                                event.related_activity_id, ts)
+                self._switch(event.thread_id, a, ts)
+            elif opcode == STOP:
+                a = self._by_id.get((pid, event.activity_id))
+                if a is None:
+                    self.unmatched_stops += 1
+                    restore = None
+                else:
+                    restore = self._by_id.get((pid, event.related_activity_id))
+                self._switch(event.thread_id, restore, ts)
+                if a is not None:
+                    a.end = a.last_seen = ts
+            elif opcode == RESUME:
+                self._switch(event.thread_id, self._get(pid, event.activity_id, ts), ts)
+            elif opcode == SUSPEND:
+                self._switch(event.thread_id, None, ts)
+            return
+
+        if event.is_stack_sample:
+            thread_id = event.thread_id
+        elif event.event_name == 'PythonSample':
+            thread_id = event['ThreadID'].value
+        else:
+            if event.activity_id is not None:
+                a = self._by_id.get((event.process_id, event.activity_id))
+                if a is not None:
+                    a.events += 1
+            return
+        running = self._running.get(thread_id)
+        if running is not None:
+            running[0].samples += 1
+
+    def finish(self, timestamp=None):
+        """Ends time on activities that threads are still working on at the
+        end of the trace."""
+        if self._finished:
+            return
+        self._finished = True
+        for thread_id, (a, since) in list(self._running.items()):
+            self._switch(thread_id, None, timestamp if timestamp is not None else since)
+
+    def roots(self):
+        """Returns activities without a parent, by latency."""
+        roots = [a for a in self.activities if a.parent is None]
+        roots.sort(key=lambda a: a.latency, reverse=True)
+        return roots
+
+    def top_activities(self, key='latency', count=None):
+        activities = sorted(self.activities, key=lambda a: getattr(a, key), reverse=True)
+        return activities[:count] if count else activities
+
+    def by_name(self):
+        """Returns a dict mapping each name to its activities."""
+        names = {}
+        for a in self.activities:
+            names.setdefault(a.display_name, []).append(a)
+        return names
+
+
+def analyze(events):
+    """Returns a finished ActivityAnalyzer for events."""
+    a = ActivityAnalyzer()
+    last = None
+    for e in events:
+        a.add(e)
+        last = e.timestamp
+    a.finish(last)
+    return a
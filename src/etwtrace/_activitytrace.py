@@ -0,0 +1,130 @@
+"""Tracks the current activity and carries it to other threads.
+
+An activity is a unit of work, such as handling a request, that may run on
+more than one thread. While a thread works on an activity, every event it
+raises is tagged with the activity's ID (the ETW sink sets the thread's
+activity ID, and the file reader tracks it from PythonActivity events).
+
+The current activity is held in a context variable, so it follows the code
+that started it through asyncio tasks and callbacks, which always run in a
+copy of the context they were scheduled from. When a tracer first starts an
+activity, events.Handle._run is replaced to switch the thread to the
+activity of each callback's context, and ThreadPoolExecutor.submit and
+Thread.start are replaced to copy the caller's context to the worker so it
+runs under the same activity. Work submitted outside of any activity runs
+unchanged.
+
+Switching threads between activities raises PythonActivity resume and
+suspend events, which is how time on each thread is attributed to an
+activity. Activities started within another activity have its ID as their
+related activity ID.
+"""
+
+import contextvars
+import threading
+import uuid
+
+from asyncio import events
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+_current = contextvars.ContextVar("etwtrace_activity", default=None)
+
+
+def current_activity():
+    """Returns the Activity for the current context, or None."""
+    return _current.get()
+
+
+class Activity:
+    """Context manager that runs its body under a new activity.
+
+    The activity ID is only assigned when the activity is entered. id is the
+    raw GUID as bytes, and uuid is the same value as a uuid.UUID."""
+    __slots__ = ('name', 'id', 'parent', '_module', '_token')
+
+    def __init__(self, name, module):
+        self.name = name
+        self.id = None
+        self.parent = None
+        self._module = module
+        self._token = None
+
+    @property
+    def uuid(self):
+        return uuid.UUID(bytes_le=self.id) if self.id else None
+
+    def __enter__(self):
+        parent = self.parent = _current.get()
+        self.id = self._module.start_activity(self.name, parent.id if parent else None)
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        _current.reset(self._token)
+        self._token = None
+        parent = self.parent
+        self._module.stop_activity(self.id, parent.id if parent else None)
+
+    def __repr__(self):
+        return f"<Activity({self.name!r}, {self.uuid})>"
+
+
+class ActivityHooks:
+    """Carries the current activity into event loop callbacks, executor
+    jobs and new threads, switching the tracer to it while they run."""
+
+    def __init__(self, module):
+        self._module = module
+        self._run = None
+        self._submit = None
+        self._start = None
+
+    def activity(self, name):
+        return Activity(name, self._module)
+
+    def install(self):
+        switch = self._module.switch_activity
+        current = _current
+        copy_context = contextvars.copy_context
+        run = self._run = events.Handle._run
+        submit = self._submit = ThreadPoolExecutor.submit
+        start = self._start = threading.Thread.start
+
+        def run_as(activity_id, fn, *args, **kwargs):
+            previous = switch(activity_id)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                switch(previous)
+
+        def traced_run(self):
+            activity = self._context.get(current)
+            previous = switch(activity.id if activity else None)
+            try:
+                return run(self)
+            finally:
+                switch(previous)
+
+        def traced_submit(self, fn, /, *args, **kwargs):
+            activity = current.get()
+            if activity is None:
+                return submit(self, fn, *args, **kwargs)
+            return submit(self, copy_context().run, run_as, activity.id, fn, *args, **kwargs)
+
+        def traced_start(self):
+            activity = current.get()
+            if activity is not None:
+                self.run = partial(copy_context().run, run_as, activity.id, self.run)
+            return start(self)
+
+        events.Handle._run = traced_run
+        ThreadPoolExecutor.submit = traced_submit
+        threading.Thread.start = traced_start
+
+    def uninstall(self):
+        if self._run is not None:
+            events.Handle._run = self._run
+            ThreadPoolExecutor.submit = self._submit
+            threading.Thread.start = self._start
+            self._run = self._submit = self._start = None
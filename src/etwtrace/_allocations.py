@@ -0,0 +1,155 @@
+"""Estimates the memory allocated by each function from allocation samples.
+
+Tracers enabled with allocations=True wrap the Python memory allocators and
+sample about one allocation for every interval bytes allocated (512 KiB by
+default). Samples are taken on a Poisson schedule, so every byte is equally
+likely to be sampled, and a PythonAllocation start event is raised with the
+size of the sampled allocation, its Weight, which is the number of bytes the
+sample stands for, and the StackID of the PythonSampledStack that allocated
+it. The sum of the weights is an unbiased estimate of the bytes allocated.
+When frees are tracked, a stop event is raised when a sampled block is
+freed, so the estimate of live memory can be followed over time.
+
+AllocationAnalyzer totals the estimates for the function that made each
+allocation (its innermost Python frame), every function on its stack
+(inclusive) and each call path.
+"""
+
+from . import _symbolize
+
+
+class AllocationSite:
+    """Estimated allocations made by a function or call path.
+
+    key is the function's name and location, or the tuple of functions on
+    the call path, outermost first. It is None for allocations made with no
+    Python code on the stack. allocated and freed are estimated bytes, and
+    inclusive also counts allocations made by the functions it called."""
+    __slots__ = ('key', 'samples', 'allocated', 'freed', 'inclusive')
+
+    def __init__(self, key):
+        self.key = key
+        self.samples = 0
+        self.allocated = 0
+        self.freed = 0
+        self.inclusive = 0
+
+    @property
+    def live(self):
+        return self.allocated - self.freed
+
+    def __repr__(self):
+        return f"<AllocationSite({self.key!r}, allocated={self.allocated})>"
+
+
+class AllocationAnalyzer:
+    """Accumulates estimated allocations from PythonAllocation events.
+
+    Allocations are attributed using the frames passed to add() with each
+    symbolized event. timeline has (timestamp, allocated, freed) after each
+    allocation event, with running totals in estimated bytes.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.allocated = 0
+        self.freed = 0
+        self.unmatched_frees = 0
+        self.functions = {}
+        self.paths = {}
+        self.timeline = []
+        # The sites of each sampled block that has not been freed, by
+        # process and address
+        self._live = {}
+
+    def _site(self, table, key):
+        site = table.get(key)
+        if site is None:
+            site = table[key] = AllocationSite(key)
+        return site
+
+    def add(self, event, frames=None):
+        if event.event_name != 'PythonAllocation':
+            return
+        key = event.process_id, event['Address'].value
+        if event.opcode == 1:
+            weight = event['Weight'].value
+            python = [str(f) for f in frames or () if f.kind == 'python']
+            function = self._site(self.functions, python[0] if python else None)
+            path = self._site(self.paths, tuple(reversed(python)) if python else None)
+            for site in (function, path):
+                site.samples += 1
+                site.allocated += weight
+            path.inclusive += weight
+            if not python:
+                function.inclusive += weight
+            # Recursive functions are only counted once for each allocation
+            for name in set(python):
+                self._site(self.functions, name).inclusive += weight
+            self.samples += 1
+            self.allocated += weight
+            self._live[key] = weight, function, path
+        elif event.opcode == 2:
+            live = self._live.pop(key, None)
+            if live is None:
+                self.unmatched_frees += 1
+                return
+            weight, function, path = live
+            function.freed += weight
+            path.freed += weight
+            self.freed += weight
+        else:
+            return
+        self.timeline.append((event.timestamp, self.allocated, self.freed))
+
+    def finish(self):
+        """Discards the record of blocks that were not freed."""
+        self._live.clear()
+
+    @property
+    def live(self):
+        """The estimated bytes allocated and not freed by the end of the trace.
+
+        This only includes frees when they were tracked."""
+        return self.allocated - self.freed
+
+    def top_functions(self, key='allocated', count=None):
+        sites = sorted(self.functions.values(), key=lambda s: getattr(s, key), reverse=True)
+        return sites[:count] if count else sites
+
+    def top_paths(self, key='allocated', count=None):
+        sites = sorted(self.paths.values(), key=lambda s: getattr(s, key), reverse=True)
+        return sites[:count] if count else sites
+
+    def growth(self, buckets=20):
+        """Returns (timestamp, allocated, freed) at the end of each of buckets
+        equal periods of the trace, leaving out periods with no events."""
+        if not self.timeline:
+            return []
+        start = self.timeline[0][0]
+        width = (self.timeline[-1][0] - start) / buckets or 1
+        result = []
+        for point in self.timeline:
+            bucket = min(int((point[0] - start) / width), buckets - 1)
+            if result and result[-1][0] == bucket:
+                result[-1] = bucket, point
+            else:
+                result.append((bucket, point))
+        return [point for _, point in result]
+
+
+def analyze(events, *, symbolize=True):
+    """Returns a finished AllocationAnalyzer for events.
+
+    Allocations are attributed to Python functions unless symbolize is
+    False."""
+    a = AllocationAnalyzer()
+    if symbolize:
+        symbolizer = _symbolize.Symbolizer(native=False)
+        for event, frames in symbolizer.symbolize_events(events, all_events=True):
+            a.add(event, frames)
+    else:
+        for event in events:
+            a.add(event)
+    a.finish()
+    return a
@@ -0,0 +1,116 @@
+"""Raises events for asyncio tasks and event loop callbacks.
+
+Every task step and callback is run by events.Handle._run, so this is
+replaced while tracing to raise a PythonTaskStep start/stop pair around
+steps and a PythonCallback pair around other callbacks. A task's steps are
+scheduled with its step or wakeup method, so the task is the callback's
+__self__. When a step stops, the future the task is now waiting on (if any)
+is recorded, which links a task to the task it awaits.
+
+BaseEventLoop.create_task is also replaced to raise PythonTaskCreate with
+the task that created it, which is how work is attributed to the request
+that started it. Tasks created before tracing was enabled, or by loops
+that do not derive from BaseEventLoop, are reported when they first run
+with no parent. Loops that do not use Handle (such as uvloop) are not
+traced.
+
+asyncio.create_task and TaskGroup name the task after creating it (before
+Python 3.13), so if a task's name has changed when it first runs, a second
+PythonTaskCreate with the new name is raised. Task IDs are the id() of the
+task, which may be reused once a task is done. Every use is preceded by a
+new PythonTaskCreate event. Names longer than 255 characters are truncated.
+"""
+
+from asyncio import base_events, events, tasks
+
+_TASK_TYPES = tuple({tasks.Task, tasks._PyTask})
+_UNKNOWN = object()
+
+
+def _task_name(task):
+    name = task.get_name()
+    coro = task.get_coro()
+    qualname = getattr(coro, "__qualname__", None)
+    if qualname and qualname not in name:
+        name = f"{name} ({qualname})"
+    return name
+
+
+def _callback_name(callback):
+    while hasattr(callback, "func"):
+        # functools.partial
+        callback = callback.func
+    return getattr(callback, "__qualname__", None) or type(callback).__qualname__
+
+
+class TaskHooks:
+    """Wraps task creation and event loop callbacks to write task events
+    to module, until uninstalled."""
+
+    def __init__(self, module):
+        self._module = module
+        self._run = None
+        self._create_task = None
+
+    def install(self):
+        write_create = self._module.write_task_create
+        write_step = self._module.write_task_step
+        write_callback = self._module.write_callback
+        current_task = tasks.current_task
+        task_types = _TASK_TYPES
+        run = self._run = events.Handle._run
+        create_task = self._create_task = base_events.BaseEventLoop.create_task
+        # (parent ID, name) of tasks that we raised PythonTaskCreate for and
+        # have not yet run, or None once they have run
+        known = {}
+
+        def traced_create_task(self, coro, *args, **kwargs):
+            task = create_task(self, coro, *args, **kwargs)
+            parent = current_task(self)
+            task_id = id(task)
+            parent_id = id(parent) if parent is not None else 0
+            name = _task_name(task)
+            known[task_id] = parent_id, name
+            write_create(task_id, parent_id, name)
+            return task
+
+        def traced_run(self):
+            callback = self._callback
+            task = getattr(callback, "__self__", None)
+            if isinstance(task, task_types):
+                task_id = id(task)
+                created = known.get(task_id, _UNKNOWN)
+                if created is not None:
+                    known[task_id] = None
+                    if created is _UNKNOWN:
+                        write_create(task_id, 0, _task_name(task))
+                    else:
+                        # The name is often set after the task is created
+                        parent_id, name = created
+                        new_name = _task_name(task)
+                        if new_name != name:
+                            write_create(task_id, parent_id, new_name)
+                write_step(task_id, 1)
+                try:
+                    return run(self)
+                finally:
+                    waiter = task._fut_waiter
+                    done = task.done()
+                    if done:
+                        known.pop(task_id, None)
+                    write_step(task_id, 2, id(waiter) if waiter is not None else 0, done)
+            name = _callback_name(callback)
+            write_callback(name, 1)
+            try:
+                return run(self)
+            finally:
+                write_callback(name, 2)
+
+        events.Handle._run = traced_run
+        base_events.BaseEventLoop.create_task = traced_create_task
+
+    def uninstall(self):
+        if self._run is not None:
+            events.Handle._run = self._run
+            base_events.BaseEventLoop.create_task = self._create_task
+            self._run = self._create_task = None
@@ -0,0 +1,303 @@
+"""Runs a script repeatedly and reports timing statistics.
+
+Each run happens in a new process that enables BenchTracer, a pure Python
+tracer with the same interface as the native tracer modules. It records
+the inclusive time and call count of every Python function via
+sys.setprofile, and the time spent in each mark_range(). Results are
+written to a JSON file for the parent process to collect.
+
+Function timings include the overhead of the profile hook, which affects
+small, frequently called functions the most. They are intended for
+comparing runs with each other rather than as absolute measurements. Pass
+functions=False (--marks-only) to measure only mark ranges and wall time.
+"""
+
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+
+from time import perf_counter_ns
+
+from . import _TracingMixin
+
+# Two-sided 95% critical values of Student's t distribution by degrees of
+# freedom. Larger samples use the normal approximation.
+_T95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+
+_ignored_files = set()
+_include_prefixes = []
+_state = None
+
+
+class _State:
+    def __init__(self, functions):
+        self.functions = {}
+        self.marks = {}
+        self.open_marks = {}
+        self.record_functions = functions
+        self.keys = {}
+        self.threads = threading.local()
+        self.lock = threading.Lock()
+
+    def key(self, code):
+        key = self.keys.get(code)
+        if key is None:
+            filename = code.co_filename
+            if filename in _ignored_files or (
+                _include_prefixes and not filename.startswith(tuple(_include_prefixes))
+            ):
+                key = False
+            else:
+                name = getattr(code, 'co_qualname', code.co_name)
+                key = f"{name} ({filename}:{code.co_firstlineno})"
+            self.keys[code] = key
+        return key
+
+    def profile(self, frame, event, arg):
+        if event == 'call':
+            key = self.key(frame.f_code)
+            t = self.threads
+            try:
+                stack = t.stack
+            except AttributeError:
+                stack = t.stack = []
+                t.active = {}
+            stack.append((key, perf_counter_ns()))
+            if key:
+                t.active[key] = t.active.get(key, 0) + 1
+        elif event == 'return':
+            end = perf_counter_ns()
+            stack = getattr(self.threads, 'stack', None)
+            if not stack:
+                # Returning from a frame entered before tracing started
+                return
+            key, start = stack.pop()
+            if not key:
+                return
+            active = self.threads.active
+            n = active[key] - 1
+            if n:
+                active[key] = n
+            with self.lock:
+                totals = self.functions.get(key)
+                if totals is None:
+                    totals = self.functions[key] = [0, 0]
+                totals[0] += 1
+                if not n:
+                    # Only the outermost call of a recursive function counts
+                    del active[key]
+                    totals[1] += end - start
+
+
+def get_ignored_files():
+    return _ignored_files
+
+
+def get_include_prefixes():
+    return _include_prefixes
+
+
+def enable(functions=True):
+    global _state
+    _state = _State(functions)
+    if functions:
+        threading.setprofile(_state.profile)
+        sys.setprofile(_state.profile)
+    return _state
+
+
+def disable(state):
+    global _state
+    if state.record_functions:
+        sys.setprofile(None)
+        threading.setprofile(None)
+    _state = None
+
+
+def write_mark(mark, opcode=0):
+    state = _state
+    if state is None:
+        return
+    now = perf_counter_ns()
+    key = threading.get_ident(), mark
+    if opcode == 1:
+        state.open_marks.setdefault(key, []).append(now)
+    elif opcode == 2:
+        starts = state.open_marks.get(key)
+        if starts:
+            totals = state.marks.setdefault(mark, [0, 0])
+            totals[0] += 1
+            totals[1] += now - starts.pop()
+    elif opcode == 0:
+        state.marks.setdefault(mark, [0, 0])[0] += 1
+
+
+def _get_technical_info():
+    return "BenchTracer (sys.setprofile)"
+
+
+class BenchTracer(_TracingMixin):
+    """Records function and mark_range timings in this process."""
+
+    def __init__(self, functions=True):
+        super().__init__()
+        self._module = sys.modules[__name__]
+        self._functions = functions
+        self._state = None
+
+    def enable(self):
+        import etwtrace
+        etwtrace._tracer = self
+        self.ignore(etwtrace.__file__, __file__, threading.__file__)
+        self._state = enable(self._functions)
+
+    def disable(self):
+        import etwtrace
+        etwtrace._tracer = None
+        disable(self._state)
+
+    def results(self):
+        """Returns a dict of function and mark totals, in nanoseconds."""
+        state = self._state
+        return {
+            "functions": {k: {"calls": v[0], "time": v[1]} for k, v in state.functions.items()},
+            "marks": {k: {"count": v[0], "time": v[1]} for k, v in state.marks.items()},
+        }
+
+
+def _child_main(args):
+    import runpy
+    output = args.pop(0)
+    functions = True
+    if args and args[0] == "--marks-only":
+        functions = False
+        args.pop(0)
+    sys.argv[:] = args
+    tracer = BenchTracer(functions)
+    # runpy is frozen in recent versions, so its code has a different filename
+    tracer.ignore(runpy.__file__, "<frozen runpy>")
+    start = perf_counter_ns()
+    with tracer:
+        if sys.argv[0] == "-m" and len(sys.argv) >= 2:
+            runpy.run_module(sys.argv.pop(1), run_name="__main__", alter_sys=True)
+        else:
+            runpy.run_path(sys.argv[0], run_name="__main__")
+    wall = perf_counter_ns() - start
+    results = tracer.results()
+    results["wall"] = wall
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+
+
+def run(args, *, runs=10, warmup=1, functions=True, on_run=None):
+    """Runs a script (or '-m module') with args in new processes.
+
+    Returns a list with the results of each run after the warm-up runs.
+    on_run is called with the run number (negative for warm-up) after each
+    run completes."""
+    env = dict(os.environ)
+    # Ensure the children use this copy of etwtrace
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (root, env.get("PYTHONPATH")) if p)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "run.json")
+        for i in range(-warmup, runs):
+            cmd = [sys.executable, "-m", __name__, output]
+            if not functions:
+                cmd.append("--marks-only")
+            subprocess.run([*cmd, *args], env=env, check=True)
+            if i >= 0:
+                with open(output, "r", encoding="utf-8") as f:
+                    results.append(json.load(f))
+            if on_run:
+                on_run(i)
+    return results
+
+
+def describe(values):
+    """Returns summary statistics for a list of values.
+
+    The confidence interval is for the mean, using Student's t
+    distribution."""
+    n = len(values)
+    mean = statistics.fmean(values)
+    if n > 1:
+        stdev = statistics.stdev(values)
+        p95 = statistics.quantiles(values, n=20, method='inclusive')[-1]
+        t = _T95[n - 2] if n - 2 < len(_T95) else 1.96
+        half = t * stdev / math.sqrt(n)
+    else:
+        stdev = 0.0
+        p95 = values[0]
+        half = 0.0
+    return {
+        "n": n,
+        "mean": mean,
+        "median": statistics.median(values),
+        "stdev": stdev,
+        "p95": p95,
+        "ci95": [mean - half, mean + half],
+    }
+
+
+def summarize(results):
+    """Returns statistics for wall time, each function and each mark."""
+    def collect(section):
+        keys = {}
+        for r in results:
+            for k in r[section]:
+                keys[k] = None
+        # Functions and marks not seen in a run took no time in that run
+        return {
+            k: describe([r[section].get(k, {}).get("time", 0) for r in results])
+            for k in keys
+        }
+
+    return {
+        "wall": describe([r["wall"] for r in results]),
+        "functions": collect("functions"),
+        "marks": collect("marks"),
+    }
+
+
+def compare(base, new):
+    """Compares summaries from two results files.
+
+    Returns a list of (section, name, base stats, new stats, change, t)
+    where t is Welch's t statistic for the difference in means. The wall
+    time comes first, then marks by name, then functions ordered by the
+    magnitude of t."""
+    result = []
+    for section in ("wall", "marks", "functions"):
+        if section == "wall":
+            pairs = [("Wall time", base["wall"], new["wall"])]
+        else:
+            b, n = base[section], new[section]
+            pairs = [(k, b.get(k), n.get(k)) for k in sorted(b.keys() | n.keys())]
+        rows = []
+        for name, b, n in pairs:
+            if not b or not n:
+                rows.append((section, name, b, n, None, None))
+                continue
+            change = (n["mean"] - b["mean"]) / b["mean"] if b["mean"] else None
+            se = math.sqrt(b["stdev"] ** 2 / b["n"] + n["stdev"] ** 2 / n["n"])
+            t = (n["mean"] - b["mean"]) / se if se else None
+            rows.append((section, name, b, n, change, t))
+        if section == "functions":
+            rows.sort(key=lambda r: -abs(r[5] or 0))
+        result.extend(rows)
+    return result
+
+
+if __name__ == "__main__":
+    _child_main(sys.argv[1:])
@@ -0,0 +1,267 @@
+"""Reconstructs call trees from instrumented traces.
+
+InstrumentedTracer raises PythonFunctionPush when a function is entered and
+PythonFunctionPop when it returns. CallTreeAnalyzer consumes these events in
+a single pass, keeping one stack per thread, and accumulates inclusive and
+exclusive time per function, per call site (caller and line) and per node
+of the call tree.
+
+Traces are often truncated. A pop with no matching push means the function
+was already running when the trace started, so it is treated as having
+started with the thread's first event and becomes the parent of everything
+seen on that thread so far. Functions still running at the end of the trace
+are closed at the last event seen for their thread.
+"""
+
+
+class FunctionInfo:
+    """Totals for a single function.
+
+    inclusive time counts each outermost activation only, so recursion does
+    not count the same time more than once."""
+    __slots__ = ('process_id', 'function_id', 'name', 'source_file', 'line',
+                 'calls', 'inclusive', 'exclusive')
+
+    def __init__(self, process_id, function_id):
+        self.process_id = process_id
+        self.function_id = function_id
+        self.name = None
+        self.source_file = None
+        self.line = None
+        self.calls = 0
+        self.inclusive = 0
+        self.exclusive = 0
+
+    @property
+    def display_name(self):
+        if self.name is None:
+            return f"<function 0x{self.function_id:X}>"
+        if self.source_file:
+            return f"{self.name} ({self.source_file}:{self.line})"
+        return self.name
+
+    def __repr__(self):
+        return f"<FunctionInfo({self.display_name!r}, calls={self.calls})>"
+
+
+class CallSiteInfo:
+    """Totals for calls from one line of a caller to a callee."""
+    __slots__ = ('caller', 'line', 'callee', 'calls', 'inclusive')
+
+    def __init__(self, caller, line, callee):
+        self.caller = caller
+        self.line = line
+        self.callee = callee
+        self.calls = 0
+        self.inclusive = 0
+
+    def __repr__(self):
+        return (f"<CallSiteInfo({self.caller.display_name!r}:{self.line} -> "
+                f"{self.callee.display_name!r}, calls={self.calls})>")
+
+
+class CallNode:
+    """A node in the call tree. The root of each thread has no function."""
+    __slots__ = ('function', 'children', 'calls', 'inclusive', 'exclusive')
+
+    def __init__(self, function):
+        self.function = function
+        self.children = {}
+        self.calls = 0
+        self.inclusive = 0
+        self.exclusive = 0
+
+    def child(self, function):
+        node = self.children.get(function)
+        if node is None:
+            node = self.children[function] = CallNode(function)
+        return node
+
+    def walk(self, depth=0):
+        """Yields (depth, node) for this node and its descendants."""
+        yield depth, self
+        for c in sorted(self.children.values(), key=lambda n: -n.inclusive):
+            yield from c.walk(depth + 1)
+
+    def __repr__(self):
+        name = self.function.display_name if self.function else None
+        return f"<CallNode({name!r}, calls={self.calls}, children={len(self.children)})>"
+
+
+class _Frame:
+    __slots__ = ('function', 'site', 'start', 'child_time', 'node')
+
+    def __init__(self, function, site, start, node):
+        self.function = function
+        self.site = site
+        self.start = start
+        self.child_time = 0
+        self.node = node
+
+
+class _Thread:
+    __slots__ = ('process_id', 'thread_id', 'stack', 'active', 'start', 'last', 'top_time', 'root')
+
+    def __init__(self, process_id, thread_id, timestamp, tree):
+        self.process_id = process_id
+        self.thread_id = thread_id
+        self.stack = []
+        # Number of open calls to each function, to detect recursion
+        self.active = {}
+        self.start = timestamp
+        self.last = timestamp
+        # Time spent in completed top-level calls
+        self.top_time = 0
+        self.root = CallNode(None) if tree else None
+
+
+class CallTreeAnalyzer:
+    """Accumulates call statistics from PythonFunctionPush/Pop events.
+
+    Events must be added in timestamp order. Memory use is bounded by stack
+    depth and the number of distinct functions and call sites, plus the call
+    tree unless tree=False is passed.
+    """
+
+    def __init__(self, *, tree=True):
+        self.tree = tree
+        self.functions = {}
+        self.call_sites = {}
+        self.threads = {}
+        self.unmatched_pops = 0
+        self.unfinished_calls = 0
+        self._finished = False
+
+    def _function(self, pid, func_id):
+        key = pid, func_id
+        f = self.functions.get(key)
+        if f is None:
+            f = self.functions[key] = FunctionInfo(pid, func_id)
+        return f
+
+    def _thread(self, event):
+        key = event.process_id, event.thread_id
+        t = self.threads.get(key)
+        if t is None:
+            t = self.threads[key] = _Thread(*key, event.timestamp, self.tree)
+        t.last = event.timestamp
+        return t
+
+    def add(self, event):
+        name = event.event_name
+        if name == 'PythonFunctionPush':
+            t = self._thread(event)
+            self._push(t, event)
+        elif name == 'PythonFunctionPop':
+            t = self._thread(event)
+            self._pop(t, event['FunctionID'].value, event.timestamp)
+        elif name == 'PythonFunction':
+            f = self._function(event.process_id, event['FunctionID'].value)
+            f.name = event['Name'].value
+            f.source_file = event['SourceFile'].value
+            f.line = event['LineNumber'].value
+
+    def _push(self, t, event):
+        pid = t.process_id
+        f = self._function(pid, event['FunctionID'].value)
+        caller_id = event['Caller'].value
+        site = None
+        if caller_id:
+            caller = self._function(pid, caller_id)
+            line = event['CallerLine'].value
+            key = pid, caller_id, line, f.function_id
+            site = self.call_sites.get(key)
+            if site is None:
+                site = self.call_sites[key] = CallSiteInfo(caller, line, f)
+        node = None
+        if self.tree:
+            parent = t.stack[-1].node if t.stack else t.root
+            node = parent.child(f)
+        f.calls += 1
+        t.active[f] = t.active.get(f, 0) + 1
+        if site:
+            site.calls += 1
+        if node:
+            node.calls += 1
+        t.stack.append(_Frame(f, site, event.timestamp, node))
+
+    def _close(self, t, frame, timestamp):
+        elapsed = timestamp - frame.start
+        f = frame.function
+        n = t.active.pop(f) - 1
+        if n:
+            t.active[f] = n
+        else:
+            f.inclusive += elapsed
+        f.exclusive += elapsed - frame.child_time
+        if frame.site:
+            frame.site.inclusive += elapsed
+        if frame.node:
+            frame.node.inclusive += elapsed
+            frame.node.exclusive += elapsed - frame.child_time
+        if t.stack:
+            t.stack[-1].child_time += elapsed
+        else:
+            t.top_time += elapsed
+
+    def _pop(self, t, func_id, timestamp):
+        stack = t.stack
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].function.function_id == func_id:
+                # Anything above the match lost its pop, so it ends now too
+                while len(stack) > i:
+                    self._close(t, stack.pop(), timestamp)
+                return
+        self.unmatched_pops += 1
+        if stack:
+            # Cannot be a caller of the open frames, so it is ignored
+            return
+        # Already running when the trace started, so it is the caller of
+        # everything seen on this thread so far.
+        f = self._function(t.process_id, func_id)
+        elapsed = timestamp - t.start
+        f.calls += 1
+        if f not in t.active:
+            f.inclusive += elapsed
+        f.exclusive += elapsed - t.top_time
+        t.top_time = elapsed
+        if self.tree:
+            node = CallNode(f)
+            node.calls = 1
+            node.inclusive = elapsed
+            node.exclusive = elapsed - sum(c.inclusive for c in t.root.children.values())
+            node.children = t.root.children
+            t.root.children = {f: node}
+
+    def finish(self, timestamp=None):
+        """Closes calls that are still open at the end of the trace.
+
+        Open calls end at the last event seen on their thread, unless a
+        timestamp is provided."""
+        if self._finished:
+            return
+        self._finished = True
+        for t in self.threads.values():
+            end = timestamp if timestamp is not None else t.last
+            while t.stack:
+                self.unfinished_calls += 1
+                self._close(t, t.stack.pop(), end)
+            if t.root:
+                t.root.inclusive = sum(c.inclusive for c in t.root.children.values())
+
+    def top_functions(self, key='inclusive', count=None):
+        funcs = sorted(self.functions.values(), key=lambda f: getattr(f, key), reverse=True)
+        return funcs[:count] if count else funcs
+
+    def top_call_sites(self, count=None):
+        sites = sorted(self.call_sites.values(), key=lambda s: s.inclusive, reverse=True)
+        return sites[:count] if count else sites
+
+
+def analyze(events, *, tree=True):
+    """Returns a finished CallTreeAnalyzer for events."""
+    a = CallTreeAnalyzer(tree=tree)
+    for e in events:
+        a.add(e)
+    a.finish()
+    return a
@@ -11,15 +11,28 @@ HELP_TEXT = """Copyright (c) Microsoft Corporation. All rights reserved.
     Launches a script with tracing enabled.
     --stack             Select ETW stack sampling (default)
     --instrument        Select ETW instrumentation
+    --sample[:RATE]     Select in-process sampling at RATE Hz (default: 1000)
     --capture <FILE>    Capture ETW events to specified file
                         (Requires elevation; will overwrite FILE)
+    --output <FILE>     Write events to FILE instead of ETW
+                        (No elevation needed; defaults to --instrument)
+    --tasks             Also trace asyncio tasks and event loop callbacks
+    --gc                Also trace garbage collections
+    --imports           Also trace module imports
+    --exceptions        Also trace exceptions (Python 3.12 or later,
+                        or --instrument)
+    --allocations[:BYTES]
+                        Also sample memory allocations about once every
+                        BYTES allocated (default: 524288)
 
     Usage: python -m etwtrace --enable [ENABLE_VAR] [TYPE_VAR]
 
     Configures tracing to automatically start when Python is launched.
     ENABLE_VAR          Environment variable to check (default: none)
     TYPE_VAR            Environment variable specifying trace type
-                        (Valid types: stack, instrument)
+                        (Valid types: stack, sample, instrument, each
+                        optionally followed by ,allocations
+                        ,exceptions ,imports ,tasks or ,gc)
 
     Usage: python -m etwtrace --disable
 
@@ -30,13 +43,130 @@ HELP_TEXT = """Copyright (c) Microsoft Corporation. All rights reserved.
     --info              Display technical info for bug reports
     --profile           Display path to WPR profile file
     --stacktags         Display path to WPA stacktags file
+
+    Usage: python -m etwtrace calltree [options] TRACE
+
+    Reports function and call site times from an instrumented trace.
+    --pid <PID>         Only include the specified process
+    --top <N>           Number of functions to display (default: 20)
+    --tree              Display the call tree
+    --depth <N>         Maximum depth of the call tree to display
+
+    Usage: python -m etwtrace tasks [options] TRACE
+
+    Reports CPU and wall time of asyncio tasks from a trace captured
+    with --tasks, grouped by the top-level task that created them.
+    --pid <PID>         Only include the specified process
+    --top <N>           Number of tasks to display (default: 20)
+    --timeline          Display when each displayed task was running
+                        and what it was waiting on
+
+    Usage: python -m etwtrace imports [options] TRACE
+
+    Displays the tree of imports from a trace captured with --imports,
+    with the self and cumulative time and stack samples of each import.
+    --pid <PID>         Only include the specified process
+    --min <MS>          Hide imports with less cumulative time
+    --top <N>           Number of slowest imports to display (default: 20)
+
+    Usage: python -m etwtrace allocations [options] TRACE
+
+    Reports the estimated memory allocated by each function from a trace
+    captured with --allocations, and how much of it was freed.
+    --pid <PID>         Only include the specified process
+    --top <N>           Number of functions and paths to display
+                        (default: 20)
+    --paths             Display the call paths that allocated the most
+    --timeline          Display the estimated live memory over time
+
+    Usage: python -m etwtrace exceptions [options] TRACE
+
+    Reports where exceptions were raised and handled from a trace captured
+    with --exceptions, with the frames and time spent unwinding each.
+    --pid <PID>         Only include the specified process
+    --top <N>           Number of sites to display (default: 20)
+
+    Usage: python -m etwtrace gc [options] TRACE
+
+    Reports garbage collection pause times by generation from a trace
+    captured with --gc, and the stack samples and mark ranges that
+    overlapped the longest pauses.
+    --pid <PID>         Only include the specified process
+    --top <N>           Number of pauses to display (default: 10)
+
+    Usage: python -m etwtrace activities [options] TRACE
+
+    Reports the latency of each activity started with etwtrace.activity()
+    and the time each thread spent working on it, grouped by name.
+    --pid <PID>         Only include the specified process
+    --top <N>           Number of activities to display (default: 20)
+    --threads           Display the time on each thread for each activity
+
+    Usage: python -m etwtrace metrics [options] TRACE
+
+    Reports the counters, gauges and histograms recorded with
+    etwtrace.counter(), gauge() and histogram() while tracing.
+    --pid <PID>         Only include the specified process
+    --series            Display every summary of each metric over time
+
+    Usage: python -m etwtrace export --format <FORMAT> [options] TRACE [OUTPUT]
+
+    Converts a trace for use with other tools.
+    --format <FORMAT>   collapsed (flame graphs), chrome, perfetto, pprof
+                        or sqlite
+    --output <FILE>     File to write (default: TRACE with a new suffix,
+                        or - for standard output)
+    --pid <PID>         Only include the specified process
+    --native            Include native modules in stacks
+    --append            Add to an existing sqlite database
+    --trace-id <N>      Trace ID in the sqlite database (default: next)
+
+    Usage: python -m etwtrace index [options] TRACE
+
+    Writes an index next to TRACE that speeds up later commands and
+    displays a summary of the trace.
+    --columns           Also store the decoded columns of every event
+
+    Usage: python -m etwtrace diff [options] BASE NEW
+
+    Compares two traces of the same workload and reports the functions
+    that changed the most.
+    --metric <METRIC>   exclusive (default) or inclusive
+    --top <N>           Number of regressions and improvements to display
+                        (default: 10)
+    --threshold <PCT>   Exit with code 3 if a function regressed by more
+                        than PCT percent beyond the noise estimate
+    --flamegraph <FILE> Write stacks for a differential flame graph
+
+    Usage: python -m etwtrace bench [options] -- script.py ...
+
+    Runs a script repeatedly in new processes and reports statistics for
+    its wall time, Python functions and mark ranges.
+    -n <N>              Number of measured runs (default: 10)
+    --warmup <N>        Number of runs to discard first (default: 1)
+    --output <FILE>     Results file to write (default: bench.json)
+    --marks-only        Do not time individual functions
+    --top <N>           Number of functions to display (default: 20)
+
+    Usage: python -m etwtrace bench --compare BASE.json NEW.json
+
+    Compares two results files. --top limits the functions displayed.
 """
 
 def main(args=sys.argv[1:]):
     args = ["-?"] if not args else list(args)
+    command = COMMANDS.get(args[0].lower())
+    if command:
+        return command(args[1:])
     unused_args = []
     tracer = None
     capture = None
+    output = None
+    tasks = False
+    gc = False
+    imports = False
+    exceptions = False
+    allocations = False
     show_info = False
 
     while args:
@@ -47,8 +177,26 @@ def main(args=sys.argv[1:]):
             import runpy
             # Use the remainder as the real argv and run the specified script or module
             sys.argv[:] = args
+            if output:
+                tracer = tracer or etwtrace.InstrumentedTracer()
+            tracer = tracer or etwtrace.StackSamplingTracer()
+            options = {
+                "output": output,
+                "tasks": tasks,
+                "gc": gc,
+                "imports": imports,
+                "exceptions": exceptions,
+                "allocations": allocations,
+            }
+            for name, value in options.items():
+                if not value:
+                    continue
+                if isinstance(tracer, etwtrace.DiagnosticsHubTracer):
+                    print(f"--{name} cannot be used with --diaghub", file=sys.stderr)
+                    return 1
+                setattr(tracer, name, value)
             with (capture or NullContext()):
-                with (tracer or etwtrace.StackSamplingTracer()):
+                with tracer:
                     if sys.argv[0] == "-m" and len(sys.argv) >= 2:
                         runpy.run_module(sys.argv.pop(1), run_name="__main__")
                     else:
@@ -65,6 +213,15 @@ def main(args=sys.argv[1:]):
             tracer = etwtrace.StackSamplingTracer()
         elif arg in ("--instrument", "--instrumented", "/instrument", "/instrumented"):
             tracer = etwtrace.InstrumentedTracer()
+        elif arg in ("--sample", "/sample") or arg.startswith(("--sample:", "/sample:")):
+            try:
+                rate = int(arg.partition(":")[-1] or 1000)
+                if rate <= 0:
+                    raise ValueError
+            except ValueError:
+                print("RATE must be a positive whole number of samples per second", file=sys.stderr)
+                return 1
+            tracer = etwtrace.SamplingTracer(rate)
         elif arg in ("--diaghub", "/diaghub"):
             tracer = etwtrace.DiagnosticsHubTracer()
         elif arg in ("--diaghubtest", "/diaghubtest"):
@@ -84,6 +241,34 @@ def main(args=sys.argv[1:]):
                 print("Unable to locate wpr.exe. Set WPR_EXE to override.", file=sys.stderr)
                 return 2
 
+        elif arg in ("--output", "/output") or arg.startswith(("--output:", "/output:")):
+            try:
+                output = orig_arg.partition(":")[-1] or args.pop(0)
+            except IndexError:
+                output = None
+            # Unlike --capture, absolute POSIX paths are allowed here
+            if not output or output.startswith("-"):
+                print("FILE argument required with --output", file=sys.stderr)
+                return 1
+
+        elif arg in ("--tasks", "/tasks"):
+            tasks = True
+        elif arg in ("--gc", "/gc"):
+            gc = True
+        elif arg in ("--imports", "/imports"):
+            imports = True
+        elif arg in ("--exceptions", "/exceptions"):
+            exceptions = True
+        elif arg in ("--allocations", "/allocations") or arg.startswith(("--allocations:", "/allocations:")):
+            try:
+                value = arg.partition(":")[-1]
+                allocations = int(value) if value else True
+                if allocations is not True and allocations <= 0:
+                    raise ValueError
+            except ValueError:
+                print("BYTES must be a positive whole number of bytes", file=sys.stderr)
+                return 1
+
         elif arg in ("--profile", "/profile"):
             try:
                 print(etwtrace.get_profile_path())
@@ -116,6 +301,9 @@ def main(args=sys.argv[1:]):
             if v1:
                 print(f"Set %{v1}% to activate")
             print(f"Set %{v2}% to to 'instrumented' to use instrumented events rather than stacks")
+            print(f"Add ',imports' to %{v2}% to also trace imports, such as 'stack,imports'")
+            print(f"Add ',allocations' to %{v2}% to also sample memory allocations")
+            print(f"Add ',exceptions' to %{v2}% to also trace exceptions")
             unused_args.extend(args)
             break
 
@@ -146,6 +334,741 @@ def main(args=sys.argv[1:]):
     return 0
 
 
+def _parse_options(args, flags=(), options=()):
+    """Parses subcommand arguments.
+
+    flags are names of options without values, and options maps names to
+    a function that converts the value (or list, to collect every value).
+    Returns a dict of the provided options (by name without prefix) and a
+    list of the remaining positional arguments. Raises ValueError for
+    unknown options or missing values.
+    """
+    values = {}
+    positional = []
+    args = list(args)
+    while args:
+        orig_arg = args.pop(0)
+        name, sep, value = orig_arg.lstrip("-/").partition(":")
+        name = name.lower()
+        if orig_arg == "-" or not orig_arg.startswith(("-", "/")):
+            positional.append(orig_arg)
+        elif name in flags and not sep:
+            values[name] = True
+        elif name in options:
+            if not sep:
+                if not args:
+                    raise ValueError(f"value required with {orig_arg}")
+                value = args.pop(0)
+            convert = options[name]
+            if convert is list:
+                values.setdefault(name, []).append(value)
+                continue
+            try:
+                values[name] = convert(value)
+            except ValueError:
+                raise ValueError(f"invalid value for {orig_arg}: {value}") from None
+        elif orig_arg.startswith("/"):
+            # Not a known option, so assume it is an absolute path
+            positional.append(orig_arg)
+        else:
+            raise ValueError(f"unknown option {orig_arg}")
+    return values, positional
+
+
+def _format_time(value):
+    # Timestamps are in 100ns units
+    return f"{value / 10000:.3f}"
+
+
+def calltree_main(args):
+    try:
+        opts, files = _parse_options(args, ("tree",), {"pid": int, "top": int, "depth": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _calltree
+    filters = dict(
+        provider_names=["Python"],
+        event_names=["PythonFunction", "PythonFunctionPush", "PythonFunctionPop"],
+    )
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _calltree.analyze(trace, tree=opts.get("tree", False))
+
+    if not any(f.calls for f in result.functions.values()):
+        print("No function calls found. Was the trace captured with --instrument?", file=sys.stderr)
+        return 2
+
+    top = opts.get("top", 20)
+    print(f"{'Calls':>10} {'Inclusive ms':>14} {'Exclusive ms':>14}  Function")
+    for f in result.top_functions(count=top):
+        if not f.calls:
+            break
+        print(f"{f.calls:>10} {_format_time(f.inclusive):>14} {_format_time(f.exclusive):>14}  {f.display_name}")
+    print()
+    print(f"{'Calls':>10} {'Inclusive ms':>14}  Call site")
+    for s in result.top_call_sites(count=top):
+        print(f"{s.calls:>10} {_format_time(s.inclusive):>14}  "
+              f"{s.caller.display_name}:{s.line} -> {s.callee.name or s.callee.display_name}")
+
+    if opts.get("tree"):
+        max_depth = opts.get("depth")
+        for (pid, tid), t in sorted(result.threads.items()):
+            print()
+            print(f"Process {pid} thread {tid}: {_format_time(t.root.inclusive)} ms")
+            for depth, node in t.root.walk():
+                if not node.function:
+                    continue
+                if max_depth is not None and depth > max_depth:
+                    continue
+                print(f"{'  ' * depth}{_format_time(node.inclusive)} ms {node.calls}x {node.function.display_name}")
+
+    if result.unmatched_pops or result.unfinished_calls:
+        print()
+        print(f"Trace was truncated: {result.unmatched_pops} calls started before the trace "
+              f"and {result.unfinished_calls} were still running at the end")
+    return 0
+
+
+def tasks_main(args):
+    try:
+        opts, files = _parse_options(args, ("timeline",), {"pid": int, "top": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _tasks
+    filters = dict(
+        provider_names=["Python"],
+        event_names=["PythonTaskCreate", "PythonTaskStep", "PythonCallback"],
+    )
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _tasks.analyze(trace)
+
+    if not result.tasks and not result.callbacks:
+        print("No asyncio tasks found. Was the trace captured with --tasks?", file=sys.stderr)
+        return 2
+
+    top = opts.get("top", 20)
+    roots = result.roots()
+    print(f"{'Tasks':>8} {'CPU ms':>12} {'Wall ms':>12}  Top-level task")
+    for t in roots[:top]:
+        count = sum(1 for _ in _walk_tasks(t))
+        print(f"{count:>8} {_format_time(t.inclusive_cpu):>12} {_format_time(t.wall):>12}  {t.display_name}")
+    print()
+    print(f"{'Steps':>8} {'CPU ms':>12} {'Wall ms':>12}  Task")
+    shown = result.top_tasks(count=top)
+    for t in shown:
+        print(f"{t.steps:>8} {_format_time(t.cpu):>12} {_format_time(t.wall):>12}  "
+              f"{' > '.join(p.display_name for p in t.logical_stack())}")
+    if result.callbacks:
+        print()
+        print(f"{'Calls':>8} {'Total ms':>12} {'Longest ms':>12}  Callback")
+        for c in result.top_callbacks(count=top):
+            print(f"{c.calls:>8} {_format_time(c.total):>12} {_format_time(c.longest):>12}  {c.name}")
+
+    if opts.get("timeline"):
+        origin = min((t.created for t in result.tasks), default=0)
+        for t in shown:
+            print()
+            print(f"Process {t.process_id} task {t.display_name}: created at {_format_time(t.created - origin)} ms")
+            for start, end, state, detail in t.segments:
+                if state == _tasks.RUNNING:
+                    detail = f"on thread {detail}"
+                elif state == _tasks.WAITING:
+                    detail = f"on {detail.display_name}" if detail else "on a future"
+                else:
+                    detail = "to run"
+                print(f"  {_format_time(start - t.created):>12} {_format_time(end - start):>10} ms  {state} {detail}")
+            if t.finished is not None:
+                print(f"  {_format_time(t.finished - t.created):>12} {'':>10}     done")
+    return 0
+
+
+def _walk_tasks(task):
+    yield task
+    for c in task.children:
+        yield from _walk_tasks(c)
+
+
+def imports_main(args):
+    try:
+        opts, files = _parse_options(args, (), {"pid": int, "min": float, "top": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _imports
+    # Stack samples from any provider are attributed to imports
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _imports.analyze(trace)
+
+    if not result.imports:
+        print("No imports found. Was the trace captured with --imports?", file=sys.stderr)
+        return 2
+
+    # Timestamps are in 100ns units
+    minimum = opts.get("min", 0) * 10000
+    print(f"{'Self ms':>12} {'Cumulative ms':>14} {'Samples':>8} {'Origin':<10} Module")
+    for i, depth in _walk_imports(result.roots(), minimum):
+        print(f"{_format_time(i.self_time):>12} {_format_time(i.cumulative):>14} "
+              f"{i.inclusive_samples:>8} {i.origin or '':<10} {'  ' * depth}{i.name}")
+
+    print()
+    print(f"{'Self ms':>12} {'Samples':>8}  Slowest imports")
+    for i in result.top_imports(count=opts.get("top", 20)):
+        print(f"{_format_time(i.self_time):>12} {i.samples:>8}  {i.name} (imported by {i.importer or '?'})")
+
+    print()
+    print(f"{'Imports':>8} {'Self ms':>12}  Origin")
+    for origin, (count, total) in sorted(result.by_origin().items(), key=lambda i: i[1][1], reverse=True):
+        print(f"{count:>8} {_format_time(total):>12}  {origin or 'unknown'}")
+    return 0
+
+
+def _walk_imports(imports, minimum, depth=0):
+    for i in imports:
+        if i.cumulative < minimum:
+            continue
+        yield i, depth
+        yield from _walk_imports(i.children, minimum, depth + 1)
+
+
+def allocations_main(args):
+    try:
+        opts, files = _parse_options(args, ("paths", "timeline"), {"pid": int, "top": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _allocations
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _allocations.analyze(trace)
+
+    if not result.samples:
+        print("No allocations found. Was the trace captured with --allocations?", file=sys.stderr)
+        return 2
+
+    top = opts.get("top", 20)
+    print(f"{result.samples} samples, an estimated {_format_bytes(result.allocated)} allocated, "
+          f"{_format_bytes(result.freed)} freed and {_format_bytes(result.live)} still live")
+    print()
+    print(f"{'Self':>10} {'Inclusive':>10} {'Live':>10} {'Samples':>8}  Function")
+    for f in result.top_functions(count=top):
+        print(f"{_format_bytes(f.allocated):>10} {_format_bytes(f.inclusive):>10} "
+              f"{_format_bytes(f.live):>10} {f.samples:>8}  {f.key or '(no Python code)'}")
+
+    if opts.get("paths"):
+        print()
+        print(f"{'Allocated':>10} {'Live':>10} {'Samples':>8}  Call path, innermost first")
+        for p in result.top_paths(count=top):
+            frames = list(reversed(p.key)) if p.key else ['(no Python code)']
+            print(f"{_format_bytes(p.allocated):>10} {_format_bytes(p.live):>10} {p.samples:>8}  {frames[0]}")
+            for frame in frames[1:]:
+                print(f"{'':>32}{frame}")
+
+    if opts.get("timeline"):
+        origin = result.timeline[0][0]
+        print()
+        print(f"{'At ms':>12} {'Allocated':>10} {'Freed':>10} {'Live':>10}")
+        for timestamp, allocated, freed in result.growth():
+            print(f"{_format_time(timestamp - origin):>12} {_format_bytes(allocated):>10} "
+                  f"{_format_bytes(freed):>10} {_format_bytes(allocated - freed):>10}")
+    return 0
+
+
+def _format_bytes(value):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(value) < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+
+def exceptions_main(args):
+    try:
+        opts, files = _parse_options(args, (), {"pid": int, "top": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _exceptions
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _exceptions.analyze(trace)
+
+    if not result.sites:
+        print("No exceptions found. Was the trace captured with --exceptions?", file=sys.stderr)
+        return 2
+
+    top = opts.get("top", 20)
+    print(f"{result.raised} exceptions raised, {result.handled} handled")
+    print()
+    print(f"{'Raised':>8} {'Frames':>8} {'Time ms':>12}  Type and location")
+    for s in result.top_sites(count=top):
+        print(f"{s.raised:>8} {s.frames:>8} {_format_time(s.time):>12}  {s.type} at {s.location}")
+
+    handlers = result.top_sites('handled', count=top)
+    if handlers:
+        print()
+        print(f"{'Handled':>8}  Type and handler")
+        for s in handlers:
+            print(f"{s.handled:>8}  {s.type} at {s.location}")
+
+    print()
+    print(f"{'Raised':>8} {'Handled':>8} {'Time ms':>12}  Type")
+    for name, (raised, handled, time) in sorted(result.by_type().items(), key=lambda i: i[1][0], reverse=True):
+        print(f"{raised:>8} {handled:>8} {_format_time(time):>12}  {name}")
+    return 0
+
+
+def gc_main(args):
+    try:
+        opts, files = _parse_options(args, (), {"pid": int, "top": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _gc
+    # Stack samples from any provider are attributed to pauses
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _gc.analyze(trace)
+
+    if not result.pauses:
+        print("No garbage collections found. Was the trace captured with --gc?", file=sys.stderr)
+        return 2
+
+    print(f"{'Gen':>4} {'Count':>8} {'Total ms':>12} {'Mean ms':>12} {'Longest ms':>12} "
+          f"{'Collected':>10} {'Uncollectable':>14}")
+    for g in sorted(result.generations.values(), key=lambda g: g.generation):
+        print(f"{g.generation:>4} {g.count:>8} {_format_time(g.total):>12} "
+              f"{_format_time(g.total / g.count):>12} {_format_time(g.longest):>12} "
+              f"{g.collected:>10} {g.uncollectable:>14}")
+
+    top = opts.get("top", 10)
+    origin = min(p.start for p in result.pauses)
+    print()
+    print(f"{'At ms':>12} {'Pause ms':>12} {'Gen':>4} {'Samples':>8}  Thread and open ranges")
+    for p in result.longest_pauses(top):
+        marks = f", in {', '.join(p.marks)}" if p.marks else ""
+        print(f"{_format_time(p.start - origin):>12} {_format_time(p.duration):>12} "
+              f"{p.generation:>4} {p.samples:>8}  thread {p.thread_id}{marks}")
+        for key, n in sorted(p.functions.items(), key=lambda i: i[1], reverse=True)[:3]:
+            print(f"{'':>39}{n:>4}  {key}")
+
+    affected = sorted((m for m in result.marks.values() if m.pauses), key=lambda m: m.pause_time, reverse=True)
+    if affected:
+        print()
+        print(f"{'Ranges':>8} {'With GC':>8} {'Pauses':>8} {'Pause ms':>12}  Range")
+        for m in affected[:top]:
+            print(f"{m.count:>8} {m.affected:>8} {m.pauses:>8} {_format_time(m.pause_time):>12}  {m.name}")
+    return 0
+
+
+def activities_main(args):
+    try:
+        opts, files = _parse_options(args, ("threads",), {"pid": int, "top": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _activities
+    # Stack samples from any provider are attributed to activities
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _activities.analyze(trace)
+
+    if not result.activities:
+        print("No activities found. Was etwtrace.activity() used while tracing?", file=sys.stderr)
+        return 2
+
+    top = opts.get("top", 20)
+    names = sorted(result.by_name().items(), key=lambda i: sum(a.latency for a in i[1]), reverse=True)
+    print(f"{'Count':>8} {'Mean ms':>12} {'Max ms':>12} {'Thread ms':>12} {'Samples':>8}  Name")
+    for name, activities in names[:top]:
+        latency = [a.latency for a in activities]
+        print(f"{len(activities):>8} {_format_time(sum(latency) / len(latency)):>12} "
+              f"{_format_time(max(latency)):>12} "
+              f"{_format_time(sum(a.inclusive_thread_time for a in activities)):>12} "
+              f"{sum(a.inclusive_samples for a in activities):>8}  {name}")
+    print()
+    print(f"{'Latency ms':>12} {'Thread ms':>12} {'Threads':>8} {'Samples':>8}  Activity")
+    for a in result.top_activities(count=top):
+        path = []
+        p = a
+        while p:
+            path.append(p.display_name)
+            p = p.parent
+        print(f"{_format_time(a.latency):>12} {_format_time(a.inclusive_thread_time):>12} "
+              f"{len(a.threads):>8} {a.inclusive_samples:>8}  {' > '.join(reversed(path))}")
+        if opts.get("threads"):
+            for tid, elapsed in sorted(a.threads.items(), key=lambda i: i[1], reverse=True):
+                print(f"{'':>12} {_format_time(elapsed):>12}  thread {tid}")
+    return 0
+
+
+def metrics_main(args):
+    try:
+        opts, files = _parse_options(args, ("series",), {"pid": int})
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _metrics
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        result = _metrics.analyze(trace)
+
+    if not result.metrics:
+        print("No metrics found. Were counters, gauges or histograms used while tracing?", file=sys.stderr)
+        return 2
+
+    # The value is the total for counters, the last value for gauges and the
+    # mean for histograms
+    print(f"{'Kind':<10} {'Updates':>8} {'Value':>12} {'Min':>12} {'Max':>12} {'P50':>12} {'P99':>12}  Name")
+    for m in result.metrics:
+        if m.kind == _metrics.COUNTER:
+            value = m.sum
+        elif m.kind == _metrics.GAUGE:
+            value = m.value
+        else:
+            value = m.mean
+        print(f"{m.kind_name:<10} {m.count:>8} {_format_number(value):>12} {_format_number(m.min):>12} "
+              f"{_format_number(m.max):>12} {_format_number(m.percentile(50)):>12} "
+              f"{_format_number(m.percentile(99)):>12}  {m.name}")
+
+    if opts.get("series"):
+        origin = min((m.points[0].timestamp for m in result.metrics if m.points), default=0)
+        for m in result.metrics:
+            print()
+            print(f"{m.name} ({m.kind_name})")
+            if m.kind == _metrics.HISTOGRAM:
+                print(f"{'At ms':>12} {'Count':>8} {'Mean':>12} {'P50':>12} {'P99':>12} {'Max':>12}")
+                for p in m.points:
+                    print(f"{_format_time(p.timestamp - origin):>12} {p.count:>8} {_format_number(p.mean):>12} "
+                          f"{_format_number(p.percentile(50)):>12} {_format_number(p.percentile(99)):>12} "
+                          f"{_format_number(p.max):>12}")
+            else:
+                print(f"{'At ms':>12} {'Updates':>8} {'Value':>12}")
+                for (timestamp, value), p in zip(m.series(), m.points):
+                    print(f"{_format_time(timestamp - origin):>12} {p.count:>8} {_format_number(value):>12}")
+    return 0
+
+
+def _format_number(value):
+    return "" if value is None else f"{value:.6g}"
+
+
+def export_main(args):
+    from . import _export
+    try:
+        opts, files = _parse_options(args, ("native", "append"), {
+            "format": str.lower, "output": str, "pid": int, "trace-id": int,
+        })
+        if len(files) == 2 and not opts.get("output"):
+            opts["output"] = files.pop()
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+        if opts.get("format") not in _export.EXPORTERS:
+            raise ValueError(f"--format must be one of {', '.join(_export.EXPORTERS)}")
+        mode = _export.EXPORTERS[opts["format"]][2]
+        if mode is None and opts.get("output") == "-":
+            raise ValueError(f"{opts['format']} cannot be written to standard output")
+        if mode is not None and ("append" in opts or "trace-id" in opts):
+            raise ValueError("--append and --trace-id are only supported for sqlite")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    _, suffix, mode = _export.EXPORTERS[opts["format"]]
+    output = opts.get("output") or Path(files[0]).with_suffix(suffix)
+    filters = {}
+    if "pid" in opts:
+        filters["process_ids"] = [opts["pid"]]
+    if mode is None:
+        with etwtrace.open_trace(files[0], **filters) as trace:
+            try:
+                exporter = etwtrace.export(
+                    trace, output, opts["format"], native=opts.get("native", False),
+                    append=opts.get("append", False), trace_id=opts.get("trace-id"), source=files[0],
+                )
+            except ValueError as ex:
+                print(ex, file=sys.stderr)
+                return 1
+        rate = exporter.events / exporter.elapsed if exporter.elapsed else 0
+        print(f"Loaded {exporter.events} events as trace {exporter.trace_id} into {output} "
+              f"in {exporter.elapsed:.2f}s ({rate:.0f} events/s)", file=sys.stderr)
+        return 0
+    with etwtrace.open_trace(files[0], **filters) as trace:
+        if output == "-":
+            f_out = sys.stdout.buffer if "b" in mode else sys.stdout
+            etwtrace.export(trace, f_out, opts["format"], native=opts.get("native", False))
+            return 0
+        if "b" in mode:
+            f_out = open(output, mode)
+        else:
+            f_out = open(output, mode, encoding="utf-8", newline="\n")
+        with f_out:
+            etwtrace.export(trace, f_out, opts["format"], native=opts.get("native", False))
+    print("Exported to", output, file=sys.stderr)
+    return 0
+
+
+def index_main(args):
+    try:
+        opts, files = _parse_options(args, ("columns",))
+        if len(files) != 1:
+            raise ValueError("one TRACE file is required")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    with etwtrace.index_trace(files[0], columns=opts.get("columns", False)) as index:
+        first, last = index.time_range()
+        counts = {}
+        for pid, (provider, _, _), count, _, _ in index.counts():
+            counts[pid, provider] = counts.get((pid, provider), 0) + count
+        images = {p["process_id"]: p["image"] for p in index.processes}
+        print("Created", index.path)
+        if first is not None:
+            print(f"Duration: {_format_time(last - first)} ms")
+        print(f"{len(index.functions)} Python functions")
+        print()
+        print(f"{'Events':>10} {'PID':>8}  Provider")
+        for (pid, provider), count in sorted(counts.items(), key=lambda i: -i[1]):
+            image = images.get(pid)
+            print(f"{count:>10} {pid:>8}  {provider}" + (f" ({image})" if image else ""))
+    return 0
+
+
+def _format_change(change):
+    if change == float("inf"):
+        return "new"
+    return f"{change:+.1%}"
+
+
+def diff_main(args):
+    try:
+        opts, files = _parse_options(args, (), {
+            "metric": str.lower, "top": int, "threshold": float, "flamegraph": str,
+        })
+        if len(files) != 2:
+            raise ValueError("BASE and NEW trace files are required")
+        metric = opts.get("metric", "exclusive")
+        if metric not in ("exclusive", "inclusive"):
+            raise ValueError("--metric must be exclusive or inclusive")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    from . import _diff
+    profiles = []
+    for file in files:
+        with etwtrace.open_trace(file) as trace:
+            profiles.append(_diff.profile(trace))
+    base, new = profiles
+    try:
+        diffs = _diff.compare(base, new, metric)
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 2
+
+    unit = "samples" if base.kind == "samples" else "seconds"
+    for label, file, p in [("Base", files[0], base), ("New", files[1], new)]:
+        total = f"{p.samples} samples" if p.kind == "samples" else f"{len(p.functions)} functions"
+        print(f"{label + ':':<6}{file} ({total} over {_format_time(p.duration)} ms)")
+    print(f"Comparing {metric} {unit} per second of trace")
+
+    top = opts.get("top", 10)
+    regressions = [d for d in diffs if d.significant and d.new > d.base]
+    improvements = [d for d in diffs if d.significant and d.new < d.base]
+    for title, items in [("Regressions", regressions), ("Improvements", improvements)]:
+        print()
+        print(title)
+        if not items:
+            print("  None beyond the noise estimate")
+            continue
+        print(f"{'Change':>10} {'Base':>12} {'New':>12} {'Noise':>12}  Function")
+        for d in items[:top]:
+            noise = f"±{d.noise:.2g}"
+            print(f"{_format_change(d.change):>10} {d.base:>12.4g} {d.new:>12.4g} {noise:>12}  {d.display_name}")
+
+    if opts.get("flamegraph"):
+        with open(opts["flamegraph"], "w", encoding="utf-8", newline="\n") as f_out:
+            _diff.write_diff_stacks(base, new, f_out)
+        print()
+        print("Differential stacks written to", opts["flamegraph"])
+
+    threshold = opts.get("threshold")
+    if threshold is not None:
+        exceeded = [d for d in regressions if d.change * 100 > threshold]
+        if exceeded:
+            print(file=sys.stderr)
+            print(f"{len(exceeded)} function(s) regressed by more than {threshold}%, "
+                  f"including {exceeded[0].display_name} ({_format_change(exceeded[0].change)})",
+                  file=sys.stderr)
+            return 3
+    return 0
+
+
+def _format_stats(stats):
+    lo, hi = stats["ci95"]
+    ci = f"{_format_ns(lo)}-{_format_ns(hi)}"
+    return (f"{_format_ns(stats['mean']):>10} {_format_ns(stats['median']):>10} "
+            f"{_format_ns(stats['p95']):>10} {ci:>21}")
+
+
+def _format_ns(value):
+    return f"{value / 1e6:.3f}"
+
+
+def bench_main(args):
+    from . import _bench
+    script = []
+    if "--" in args:
+        i = args.index("--")
+        args, script = args[:i], args[i + 1:]
+    try:
+        opts, files = _parse_options(args, ("marks-only",), {
+            "n": int, "warmup": int, "output": str, "top": int, "compare": str,
+        })
+        if "compare" in opts:
+            files.insert(0, opts["compare"])
+            if len(files) != 2:
+                raise ValueError("--compare requires BASE and NEW results files")
+        elif not script:
+            raise ValueError("script to run is required after --")
+        elif files:
+            raise ValueError(f"unexpected argument {files[0]}")
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        return 1
+
+    import json
+    if "compare" in opts:
+        summaries = []
+        for file in files:
+            with open(file, "r", encoding="utf-8") as f:
+                summaries.append(json.load(f)["summary"])
+        print(f"{'Base ms':>10} {'New ms':>10} {'Change':>8} {'t':>6}  Name")
+        functions = 0
+        for section, name, b, n, change, t in _bench.compare(*summaries):
+            if section == "functions":
+                functions += 1
+                if functions > opts.get("top", 20):
+                    continue
+            b_mean = _format_ns(b["mean"]) if b else "-"
+            n_mean = _format_ns(n["mean"]) if n else "-"
+            change = f"{change:+.1%}" if change is not None else ""
+            t = f"{t:.1f}" if t is not None else ""
+            label = f"[{name}]" if section == "marks" else name
+            print(f"{b_mean:>10} {n_mean:>10} {change:>8} {t:>6}  {label}")
+        print()
+        print("Differences with |t| above about 2 are unlikely to be noise")
+        return 0
+
+    runs = opts.get("n", 10)
+    warmup = opts.get("warmup", 1)
+    if runs < 1 or warmup < 0:
+        print("-n must be at least 1 and --warmup cannot be negative", file=sys.stderr)
+        return 1
+
+    def on_run(i):
+        label = "Warm-up run" if i < 0 else f"Run {i + 1} of {runs}"
+        print(f"{label} complete", file=sys.stderr)
+
+    import subprocess
+    try:
+        results = _bench.run(script, runs=runs, warmup=warmup,
+                             functions=not opts.get("marks-only"), on_run=on_run)
+    except subprocess.CalledProcessError as ex:
+        print(f"Script exited with code {ex.returncode}", file=sys.stderr)
+        return 2
+
+    summary = _bench.summarize(results)
+    output = opts.get("output", "bench.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "command": script,
+            "python": sys.version,
+            "runs": runs,
+            "warmup": warmup,
+            "results": results,
+            "summary": summary,
+        }, f, indent=1)
+
+    header = f"{'Mean ms':>10} {'Median ms':>10} {'P95 ms':>10} {'95% CI ms':>21}  "
+    print(f"{runs} runs ({warmup} warm-up runs discarded)")
+    print()
+    print(header + "Wall time")
+    print(_format_stats(summary["wall"]))
+    if summary["marks"]:
+        print()
+        print(header + "Mark range")
+        for name, stats in sorted(summary["marks"].items(), key=lambda i: -i[1]["mean"]):
+            print(f"{_format_stats(stats)}  {name}")
+    if summary["functions"]:
+        print()
+        print(header + "Function (inclusive)")
+        functions = sorted(summary["functions"].items(), key=lambda i: -i[1]["mean"])
+        for name, stats in functions[:opts.get("top", 20)]:
+            print(f"{_format_stats(stats)}  {name}")
+    print()
+    print("Results saved to", output)
+    return 0
+
+
+COMMANDS = {
+    "activities": activities_main,
+    "allocations": allocations_main,
+    "bench": bench_main,
+    "calltree": calltree_main,
+    "diff": diff_main,
+    "exceptions": exceptions_main,
+    "export": export_main,
+    "gc": gc_main,
+    "imports": imports_main,
+    "index": index_main,
+    "metrics": metrics_main,
+    "tasks": tasks_main,
+}
+
+
 class NullContext:
     def __enter__(self):
         return self
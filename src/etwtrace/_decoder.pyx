@@ -1,6 +1,7 @@
 # cython: language_level=3, language=c, binding=True, embedsignature=True, c_string_encoding=ascii
 
 from ._windows cimport *
+from cpython cimport array
 
 cdef extern from "src/etwtrace/_tdhreader.h" nogil:
     ctypedef struct TraceHandle:
@@ -24,6 +25,11 @@ cdef extern from "src/etwtrace/_tdhreader.h" nogil:
     int AddTraceProcessIdFilter(TraceHandle *handle, const ULONG process_id)
     int SetTraceProcessIdChildrenFilter(TraceHandle *handle, int trace_children)
     int SetTraceKeywordFilter(TraceHandle *handle, ULONGLONG allMask, ULONGLONG anyMask)
+    int SetTraceTimeFilter(TraceHandle *handle, LONGLONG start_time, LONGLONG end_time)
+    int AddTracePropertyFilter(TraceHandle *handle, const wchar_t *name, int op, ULONGLONG low, ULONGLONG high, const ULONGLONG *values, int count)
+
+    int TRACE_PROPERTY_FILTER_IN
+    int TRACE_PROPERTY_FILTER_RANGE
 
 
 cdef winerror(int err, const char *dll):
@@ -57,6 +63,7 @@ cdef winerror(int err, const char *dll):
     return exc
 
 
+import array
 import os
 import uuid
 
@@ -79,6 +86,7 @@ cdef class EventData:
 
     cdef readonly int thread_id
     cdef readonly int process_id
+    cdef readonly long long timestamp
 
     cdef readonly str provider_name
     cdef readonly str channel_name
@@ -93,6 +101,10 @@ cdef class EventData:
     cdef readonly str provider_message
 
     cdef readonly object stack
+    cdef readonly int stack_id
+
+    cdef readonly object activity_id
+    cdef readonly object related_activity_id
 
     cdef readonly dict _properties
     cdef int _property_count
@@ -111,6 +123,9 @@ cdef class EventData:
         self.provider_message = None
         self._properties = {}
         self.stack = None
+        self.stack_id = -1
+        self.activity_id = None
+        self.related_activity_id = None
 
     def __repr__(self):
         ev = self.event_name or self.opcode_name or self.task_name
@@ -181,16 +196,62 @@ cdef class EventPropertyData:
         return f"{self.name}={self.formatted_value}"
 
 
+cdef class StackTable:
+    """Shared storage for the distinct stacks read from a trace.
+
+    Stack IDs are indexes into the table, and each stack is an array('Q')
+    of addresses. Events with identical stacks share the same array."""
+    cdef dict _ids
+    cdef list _stacks
+
+    def __init__(self):
+        self._ids = {}
+        self._stacks = []
+
+    def __len__(self):
+        return len(self._stacks)
+
+    def __getitem__(self, int stack_id):
+        return self._stacks[stack_id]
+
+    def __iter__(self):
+        return iter(self._stacks)
+
+    cdef int intern(self, EventData ed, bytes key, array.array stack):
+        cdef object stack_id = self._ids.get(key)
+        if stack_id is None:
+            if stack is None:
+                stack = array.array('Q')
+                stack.frombytes(key)
+            stack_id = len(self._stacks)
+            self._stacks.append(stack)
+            self._ids[key] = stack_id
+        ed.stack_id = stack_id
+        ed.stack = self._stacks[stack_id]
+        return 0
+
+    def _get_size(self):
+        import sys
+        cb = sys.getsizeof(self._ids) + sys.getsizeof(self._stacks)
+        for k in self._ids:
+            cb += sys.getsizeof(k)
+        for s in self._stacks:
+            cb += sys.getsizeof(s)
+        return cb
+
+
 cdef class ReadContext:
     cdef list buffer
     cdef int limit
     cdef dict memo
+    cdef StackTable stacks
     cdef object exception
 
-    def __init__(self, int limit, dict memo):
+    def __init__(self, int limit, dict memo, StackTable stacks):
         self.limit = limit
         self.buffer = []
         self.memo = memo
+        self.stacks = stacks
         self.exception = None
 
     cdef str read_str(self, void *base, size_t length, size_t offset):
@@ -397,21 +458,44 @@ cdef object _Read1PropertyValue(int in_type, int length, int ptrsize, UserDataRe
     raise TypeError(f"Could not decode {in_type}")
 
 
-cdef object ReadStack32(void *ptr, int cbData):
-    n = (cbData - sizeof(ULONG64)) // sizeof(ULONG)
-    p = (<EVENT_EXTENDED_ITEM_STACK_TRACE32*>ptr).Address
-    r = []
-    for i in range(n):
-        r.append(p[i])
-    return r
+cdef array.array _STACK_TEMPLATE = array.array('Q')
+
 
-cdef object ReadStack64(void *ptr, int cbData):
-    n = (cbData - sizeof(ULONG64)) // sizeof(ULONG64)
-    p = (<EVENT_EXTENDED_ITEM_STACK_TRACE64*>ptr).Address
-    r = []
+cdef int ReadStack32(ReadContext ctxt, EventData ed, void *ptr, int cbData) except -1:
+    cdef Py_ssize_t n = (cbData - <int>sizeof(ULONG64)) // <int>sizeof(ULONG)
+    cdef const ULONG *p = (<EVENT_EXTENDED_ITEM_STACK_TRACE32*>ptr).Address
+    cdef array.array r = array.clone(_STACK_TEMPLATE, max(n, 0), False)
+    cdef Py_ssize_t i
     for i in range(n):
-        r.append(p[i])
-    return r
+        r.data.as_ulonglongs[i] = p[i]
+    if ctxt.stacks is not None:
+        return ctxt.stacks.intern(ed, r.tobytes(), r)
+    ed.stack = r
+    return 0
+
+
+cdef int ReadStack64(ReadContext ctxt, EventData ed, void *ptr, int cbData) except -1:
+    cdef Py_ssize_t n = (cbData - <int>sizeof(ULONG64)) // <int>sizeof(ULONG64)
+    cdef const ULONG64 *p = (<EVENT_EXTENDED_ITEM_STACK_TRACE64*>ptr).Address
+    cdef array.array r
+    if n < 0:
+        n = 0
+    if ctxt.stacks is not None:
+        # Only allocate an array the first time we see this stack
+        return ctxt.stacks.intern(ed, (<char *>p)[:n * sizeof(ULONG64)], None)
+    r = array.clone(_STACK_TEMPLATE, n, False)
+    memcpy(r.data.as_voidptr, p, n * sizeof(ULONG64))
+    ed.stack = r
+    return 0
+
+
+cdef object ReadGuid(const void *ptr):
+    cdef const unsigned char *b = <const unsigned char *>ptr
+    cdef int i
+    for i in range(sizeof(GUID)):
+        if b[i]:
+            return uuid.UUID(bytes_le=b[:sizeof(GUID)])
+    return None
 
 
 cdef dict _formatters = {
@@ -439,6 +523,8 @@ cdef object ReadEventTraceInfo(ReadContext ctxt, TraceCallbackInfo *info):
     ed.keyword = evt.EventDescriptor.Keyword
     ed.process_id = record.EventHeader.ProcessId
     ed.thread_id = record.EventHeader.ThreadId
+    ed.timestamp = record.EventHeader.TimeStamp.QuadPart
+    ed.activity_id = ReadGuid(&record.EventHeader.ActivityId)
 
     ed.provider_name = ctxt.read_str(evt, evt_bytes, evt.ProviderNameOffset)
     ed.channel_name = ctxt.read_str(evt, evt_bytes, evt.ChannelNameOffset)
@@ -489,19 +575,27 @@ cdef object ReadEventTraceInfo(ReadContext ctxt, TraceCallbackInfo *info):
             ep.value = FormatPropertyValue(info, p, userdata, ptrsize)
 
     # Special-case for stack traces
+    cdef array.array stack
+    cdef Py_ssize_t j
     if ed.provider == SYSTRACE_GUID and not memcmp(<char *>STACKWALK_GUID, &evt.EventGuid, sizeof(GUID)):
-        ed.stack = []
-        for i in range(3, ed._property_count):
-            ed.stack.append(ed._properties[i].value)
+        stack = array.clone(_STACK_TEMPLATE, max(ed._property_count - 3, 0), False)
+        for j in range(3, ed._property_count):
+            stack.data.as_ulonglongs[j - 3] = ed._properties[j].value
+        if ctxt.stacks is not None:
+            ctxt.stacks.intern(ed, stack.tobytes(), stack)
+        else:
+            ed.stack = stack
 
         return ed
 
     for i in range(record.ExtendedDataCount):
         d = &record.ExtendedData[i]
         if d.ExtType == EVENT_HEADER_EXT_TYPE_STACK_TRACE32:
-            ed.stack = ReadStack32(<void *>d.DataPtr, d.DataSize)
+            ReadStack32(ctxt, ed, <void *>d.DataPtr, d.DataSize)
         elif d.ExtType == EVENT_HEADER_EXT_TYPE_STACK_TRACE64:
-            ed.stack = ReadStack64(<void *>d.DataPtr, d.DataSize)
+            ReadStack64(ctxt, ed, <void *>d.DataPtr, d.DataSize)
+        elif d.ExtType == EVENT_HEADER_EXT_TYPE_RELATED_ACTIVITYID and d.DataSize >= sizeof(GUID):
+            ed.related_activity_id = ReadGuid(<void *>d.DataPtr)
 
     return ed
 
@@ -522,6 +616,8 @@ cdef object ReadEventRecord(ReadContext ctxt, EVENT_RECORD *record):
     ed.keyword = evt.EventDescriptor.Keyword
     ed.thread_id = evt.ThreadId
     ed.process_id = evt.ProcessId
+    ed.timestamp = evt.TimeStamp.QuadPart
+    ed.activity_id = ReadGuid(&evt.ActivityId)
 
     ed.task = evt.EventProperty
 
@@ -533,9 +629,11 @@ cdef object ReadEventRecord(ReadContext ctxt, EVENT_RECORD *record):
     for i in range(record.ExtendedDataCount):
         d = &record.ExtendedData[i]
         if d.ExtType == EVENT_HEADER_EXT_TYPE_STACK_TRACE32:
-            ed.stack = ReadStack32(<void *>d.DataPtr, d.DataSize)
+            ReadStack32(ctxt, ed, <void *>d.DataPtr, d.DataSize)
         elif d.ExtType == EVENT_HEADER_EXT_TYPE_STACK_TRACE64:
-            ed.stack = ReadStack64(<void *>d.DataPtr, d.DataSize)
+            ReadStack64(ctxt, ed, <void *>d.DataPtr, d.DataSize)
+        elif d.ExtType == EVENT_HEADER_EXT_TYPE_RELATED_ACTIVITYID and d.DataSize >= sizeof(GUID):
+            ed.related_activity_id = ReadGuid(<void *>d.DataPtr)
 
     return ed
 
@@ -558,9 +656,25 @@ cdef int __stdcall _EtlReader_Event_nogil(void *context, TraceCallbackInfo *info
         return _EtlReader_Event(context, info)
 
 
+cdef object _FILETIME_EPOCH = None
+
+
+cdef LONGLONG _to_filetime(value) except? -1:
+    global _FILETIME_EPOCH
+    import datetime
+    if isinstance(value, datetime.datetime):
+        if _FILETIME_EPOCH is None:
+            _FILETIME_EPOCH = datetime.datetime(1601, 1, 1, tzinfo=datetime.timezone.utc)
+        if value.tzinfo is None:
+            value = value.astimezone()
+        return (value - _FILETIME_EPOCH) // datetime.timedelta(microseconds=1) * 10
+    return int(value)
+
+
 cdef class EtlReader:
     cdef TraceHandle *handle
     cdef dict _memo
+    cdef StackTable _stacks
 
     def __cinit__(self):
         self.handle = NULL
@@ -576,10 +690,15 @@ cdef class EtlReader:
         include_child_process_ids=True,
         keyword_mask_all=0,
         keyword_mask_any=0,
+        start_time=None,
+        end_time=None,
+        property_filters=None,
+        intern_stacks=False,
     ):
         path = os.fsdecode(path).encode('utf-16-le') + b'\0\0'
         cdef const wchar_t * path_ = <const wchar_t *><unsigned char*>path
         self._memo = {}
+        self._stacks = StackTable() if intern_stacks else None
         cdef int err
         with nogil:
             err = OpenEtlFile(path_, &self.handle)
@@ -640,6 +759,53 @@ cdef class EtlReader:
             if err:
                 raise winerror(err, NULL)
 
+        # Timestamps are FILETIME values (100ns units since 1601), as
+        # reported in EventData.timestamp. datetime objects are converted.
+        if start_time is not None or end_time is not None:
+            err = SetTraceTimeFilter(
+                self.handle,
+                _to_filetime(start_time) if start_time is not None else 0,
+                _to_filetime(end_time) if end_time is not None else 0,
+            )
+            if err:
+                raise winerror(err, NULL)
+
+        # Property filters map a property name to an int (equality),
+        # a range (inclusive of start, exclusive of stop) or any other
+        # iterable of ints (membership). Events without the property, or
+        # where it is not an integer, are excluded.
+        cdef const ULONGLONG *pointers_4
+        cdef int op
+        cdef ULONGLONG low, high
+        if property_filters:
+            for name, match in property_filters.items():
+                name_bytes = name.encode('utf-16-le') + b'\0\0'
+                values = b''
+                low = high = 0
+                if isinstance(match, range):
+                    if match.step != 1 or not match:
+                        raise ValueError(f"unsupported range for property filter {name!r}: {match}")
+                    op = TRACE_PROPERTY_FILTER_RANGE
+                    low = match.start & 0xFFFFFFFFFFFFFFFF
+                    high = (match.stop - 1) & 0xFFFFFFFFFFFFFFFF
+                else:
+                    op = TRACE_PROPERTY_FILTER_IN
+                    if isinstance(match, int):
+                        match = [match]
+                    values = b''.join((int(v) & 0xFFFFFFFFFFFFFFFF).to_bytes(sizeof(ULONGLONG), 'little') for v in match)
+                pointers_4 = <const ULONGLONG *><unsigned char*>values
+                err = AddTracePropertyFilter(
+                    self.handle,
+                    <const wchar_t *><unsigned char *>name_bytes,
+                    op,
+                    low,
+                    high,
+                    pointers_4,
+                    len(values) // sizeof(ULONGLONG),
+                )
+                if err:
+                    raise winerror(err, NULL)
+
     def __dealloc__(self):
         if self.handle:
             with nogil:
@@ -664,6 +830,13 @@ cdef class EtlReader:
                     q.append(v)
         return cb
 
+    @property
+    def stack_table(self):
+        """The shared StackTable when opened with intern_stacks=True.
+
+        Each event's stack_id is an index into this table."""
+        return self._stacks
+
     def close(self):
         cdef int err = 0
         cdef const char *err_source = NULL
@@ -689,7 +862,7 @@ cdef class EtlReader:
         if not self.handle:
             raise ValueError("no ETL trace open")
         cdef int err = 0
-        ctxt = ReadContext(n, self._memo)
+        ctxt = ReadContext(n, self._memo, self._stacks)
         with nogil:
             err = ReadTraceEvents(self.handle, &_EtlReader_Event_nogil, <PyObject*>ctxt)
         if err < 0:
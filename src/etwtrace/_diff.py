@@ -0,0 +1,199 @@
+"""Compares two traces of the same workload.
+
+Function IDs are assigned as functions are first called, so they differ
+between runs. Functions are instead matched by their source file, name and
+first line.
+
+Stack sampling traces are compared by the number of samples in which each
+function appears (inclusive) or is the innermost Python frame (exclusive).
+Instrumented traces are compared by inclusive or exclusive time. Values are
+divided by the duration of their trace, so captures of different lengths
+can be compared.
+
+The noise estimate treats sample counts as Poisson distributed, so the
+standard deviation of a count n is sqrt(n). For instrumented time, each
+call is assumed to vary by about its mean, giving sqrt(calls) times the
+mean. Differences smaller than twice the combined estimate are not
+considered significant.
+
+Each trace is read once, and memory use depends on the number of distinct
+functions and stacks rather than the size of the trace.
+"""
+
+import math
+
+from . import _symbolize
+from ._export import CollapsedExporter
+
+METRICS = ('inclusive', 'exclusive')
+
+
+class FunctionStats:
+    __slots__ = ('key', 'calls', 'inclusive', 'exclusive')
+
+    def __init__(self, key):
+        self.key = key
+        self.calls = 0
+        self.inclusive = 0
+        self.exclusive = 0
+
+
+class TraceProfile:
+    """Per-function totals and collapsed stacks for one trace.
+
+    Pass every event to add() in order, then call finish()."""
+
+    def __init__(self):
+        self._stacks = CollapsedExporter(None, processes=False)
+        self._pending_samples = set()
+        self.functions = {}
+        self.samples = 0
+        self.first = None
+        self.last = None
+        self.kind = None
+
+    @property
+    def duration(self):
+        """Duration of the trace in timestamp units (100ns)."""
+        if self.first is None:
+            return 0
+        return self.last - self.first
+
+    def _function(self, key):
+        f = self.functions.get(key)
+        if f is None:
+            f = self.functions[key] = FunctionStats(key)
+        return f
+
+    def add(self, event, frames=None):
+        if self.first is None:
+            self.first = event.timestamp
+        self.last = event.timestamp
+        self._stacks.add(event, frames)
+        if event.is_stack_sample:
+            self._pending_samples.add(event.thread_id)
+            return
+        if frames is None:
+            return
+        if event.event_name != 'PythonSample':
+            if event.opcode_name != 'Stack' or event.thread_id not in self._pending_samples:
+                return
+            self._pending_samples.discard(event.thread_id)
+        self.samples += 1
+        seen = set()
+        for f in frames:
+            if f.kind != 'python':
+                continue
+            key = f.file, f.name, f.line
+            stats = self._function(key)
+            if not seen:
+                stats.exclusive += 1
+            if key not in seen:
+                seen.add(key)
+                stats.inclusive += 1
+
+    def finish(self):
+        if self.samples:
+            self.kind = 'samples'
+            return
+        calls = self._stacks.calls
+        calls.finish()
+        for f in calls.functions.values():
+            if not f.calls:
+                continue
+            self.kind = 'calls'
+            # Combine the same function from each process
+            stats = self._function((f.source_file, f.name, f.line))
+            stats.calls += f.calls
+            stats.inclusive += f.inclusive
+            stats.exclusive += f.exclusive
+
+    def stacks(self):
+        """Returns collapsed stacks without process names."""
+        return self._stacks.stacks()
+
+
+def profile(events):
+    """Returns a finished TraceProfile from events."""
+    p = TraceProfile()
+    symbolizer = _symbolize.Symbolizer(native=False)
+    for event, frames in symbolizer.symbolize_events(events, all_events=True):
+        p.add(event, frames)
+    p.finish()
+    return p
+
+
+class FunctionDiff:
+    """The change in one function between two traces.
+
+    base and new are values per second of trace, change is the relative
+    difference (or infinity for new functions), and noise is the estimated
+    standard deviation of new - base."""
+    __slots__ = ('key', 'base', 'new', 'change', 'noise')
+
+    def __init__(self, key, base, new, noise):
+        self.key = key
+        self.base = base
+        self.new = new
+        self.noise = noise
+        if base:
+            self.change = (new - base) / base
+        else:
+            self.change = math.inf if new else 0.0
+
+    @property
+    def display_name(self):
+        file, name, line = self.key
+        return f"{name} ({file}:{line})" if file else name
+
+    @property
+    def significant(self):
+        return abs(self.new - self.base) > 2 * self.noise
+
+    def __repr__(self):
+        return f"<FunctionDiff({self.display_name!r}, change={self.change:+.1%})>"
+
+
+def _rate_and_noise(stats, metric, kind, seconds):
+    if stats is None:
+        return 0.0, 0.0
+    value = getattr(stats, metric)
+    if kind == 'samples':
+        sd = math.sqrt(value)
+    else:
+        # Time is in 100ns units
+        value /= 1e7
+        sd = value / math.sqrt(stats.calls) if stats.calls else 0.0
+    return value / seconds, sd / seconds
+
+
+def compare(base, new, metric='exclusive'):
+    """Returns a FunctionDiff for every function in either profile, largest
+    absolute difference first."""
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    if base.kind != new.kind:
+        raise ValueError(f"cannot compare {base.kind or 'empty'} trace with {new.kind or 'empty'} trace")
+    base_seconds = base.duration / 1e7 or 1.0
+    new_seconds = new.duration / 1e7 or 1.0
+    result = []
+    for key in base.functions.keys() | new.functions.keys():
+        b, b_sd = _rate_and_noise(base.functions.get(key), metric, base.kind, base_seconds)
+        n, n_sd = _rate_and_noise(new.functions.get(key), metric, new.kind, new_seconds)
+        result.append(FunctionDiff(key, b, n, math.hypot(b_sd, n_sd)))
+    result.sort(key=lambda d: -abs(d.new - d.base))
+    return result
+
+
+def write_diff_stacks(base, new, file):
+    """Writes collapsed stacks with base and new weights for a differential
+    flame graph, as produced by difffolded.pl and read by flamegraph.pl.
+
+    Base weights are scaled so both traces have the same total."""
+    base_stacks = base.stacks()
+    new_stacks = new.stacks()
+    base_total = sum(base_stacks.values())
+    new_total = sum(new_stacks.values())
+    scale = new_total / base_total if base_total else 1.0
+    for s in sorted(base_stacks.keys() | new_stacks.keys()):
+        print(s, round(base_stacks.get(s, 0) * scale), new_stacks.get(s, 0), file=file)
@@ -0,0 +1,224 @@
+"""Parallel decoding of ETL files.
+
+Splits a file into ranges of buffers and decodes each range in a worker
+process with the portable reader. Results are either merged back into a
+single timestamp-ordered stream, or reduced in the workers and returned
+unordered as each range completes.
+"""
+
+import collections
+import heapq
+import os
+import struct
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import _etlreader as R
+
+_PROCESS_GROUP = 0x03
+_THREAD_GROUP = 0x05
+
+
+class _Chunk:
+    __slots__ = ('start', 'stop', 'min_time')
+
+    def __init__(self, start, stop, min_time):
+        self.start = start
+        self.stop = stop
+        self.min_time = min_time
+
+
+def _scan_kernel_state(path, start, stop):
+    """Returns process and thread start/end records in a range of buffers.
+
+    Each record is (raw timestamp, group, opcode, pid, ppid or tid)."""
+    with R.EtlReader(path) as reader:
+        data = reader._data
+        result = []
+        ptrsize = reader.header.pointer_size
+        for raw, offset, header_type in R._iter_buffer_records(data, R._read_buffers(data, start, stop)):
+            if header_type not in (R.TRACE_HEADER_TYPE_SYSTEM32, R.TRACE_HEADER_TYPE_SYSTEM64):
+                continue
+            opcode = data[offset + 6]
+            group = data[offset + 7]
+            p = offset + R.SYSTEM_HEADER.size
+            if group == _PROCESS_GROUP and opcode in (1, 2, 3):
+                size = 8 if header_type == R.TRACE_HEADER_TYPE_SYSTEM64 else 4
+                pid, ppid = struct.unpack_from('<II', data, p + size)
+                result.append((raw, group, opcode, pid, ppid))
+            elif group == _THREAD_GROUP and opcode in (1, 3):
+                pid, tid = struct.unpack_from('<II', data, p)
+                result.append((raw, group, opcode, pid, tid))
+        return result
+
+
+def _open_chunk(path, filters, chunk, process_times, thread_times):
+    reader = R.EtlReader(path, **filters)
+    reader._restrict(chunk.start, chunk.stop, process_times, thread_times)
+    return reader
+
+
+def _decode_chunk(path, filters, chunk, process_times, thread_times):
+    with _open_chunk(path, filters, chunk, process_times, thread_times) as reader:
+        events = list(reader)
+        stacks = list(reader.stack_table) if reader.stack_table is not None else None
+    return events, stacks
+
+
+def _map_chunk(path, filters, chunk, process_times, thread_times, func):
+    with _open_chunk(path, filters, chunk, process_times, thread_times) as reader:
+        return func(reader)
+
+
+def _is_tracked(process_times, pid):
+    intervals = process_times.get(pid)
+    return bool(intervals) and intervals[-1][1] is None
+
+
+class ParallelEtlReader:
+    """Reads an ETL file using a pool of worker processes.
+
+    Iterating yields events in timestamp order, the same as EtlReader.
+    Use map() to run an aggregation in each worker instead, which avoids
+    sending every event back to this process.
+
+    Filters are the same as for EtlReader and are applied in the workers.
+    Child process tracking and the thread owners of sampled profile events
+    are resolved by a scan of the whole file before decoding starts, and
+    applied by each event's timestamp as IDs may be reused."""
+
+    def __init__(self, path, *, workers=None, chunk_buffers=None, **filters):
+        self._path = os.fspath(path)
+        self._workers = workers or os.cpu_count() or 1
+        self._chunk_buffers = chunk_buffers
+        self._filters = filters
+        self._stacks = R.StackTable() if filters.get('intern_stacks') else None
+        self._memo = {}
+        with R.EtlReader(self._path) as reader:
+            self.header = reader.header
+            self._chunks = self._split(reader._data)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    @property
+    def stack_table(self):
+        """The StackTable merged from all workers when intern_stacks=True."""
+        return self._stacks
+
+    def _split(self, data):
+        buffers = R._read_buffers(data)
+        # By default, aim for several ranges per worker so that uneven
+        # ranges do not leave workers idle
+        n = self._chunk_buffers or max(1, len(buffers) // (self._workers * 8))
+        chunks = []
+        for i in range(0, len(buffers), n):
+            group = buffers[i:i + n]
+            first = [next(R._iter_buffer_records(data, [b]), None) for b in group]
+            min_time = min((r[0] for r in first if r), default=None)
+            if min_time is None:
+                continue
+            chunks.append(_Chunk(group[0].offset, group[-1].offset + 1,
+                                 self.header.to_filetime(min_time)))
+        end_time = self._filters.get('end_time')
+        if end_time is not None:
+            end_time = R._to_filetime(end_time)
+            chunks = [c for c in chunks if c.min_time <= end_time]
+        return chunks
+
+    def _kernel_state(self, pool):
+        """Returns the included intervals of each process ID, or None to
+        include all processes, and the start times of each thread ID.
+
+        Records are replayed in time order the way EtlReader tracks them,
+        so reused IDs apply only from their own start."""
+        process_ids = self._filters.get('process_ids')
+        records = []
+        for f in [pool.submit(_scan_kernel_state, self._path, c.start, c.stop) for c in self._chunks]:
+            records.extend(f.result())
+        records.sort()
+        to_filetime = self.header.to_filetime
+        thread_times = {}
+        process_times = {pid: [[None, None]] for pid in process_ids} if process_ids else None
+        include_children = self._filters.get('include_child_process_ids', True)
+        for raw, group, opcode, pid, other in records:
+            if group == _THREAD_GROUP:
+                starts, pids = thread_times.setdefault(other, ([], []))
+                starts.append(to_filetime(raw))
+                pids.append(pid)
+            elif process_times is None or not include_children:
+                continue
+            elif opcode == 1 and _is_tracked(process_times, other) and not _is_tracked(process_times, pid):
+                process_times.setdefault(pid, []).append([to_filetime(raw), None])
+            elif opcode == 2 and _is_tracked(process_times, pid):
+                process_times[pid][-1][1] = to_filetime(raw)
+        return process_times, thread_times
+
+    def _intern(self, ed, stacks):
+        memo = self._memo
+        if ed.provider_name:
+            ed.provider_name = memo.setdefault(ed.provider_name, ed.provider_name)
+        if ed.event_name:
+            ed.event_name = memo.setdefault(ed.event_name, ed.event_name)
+        for i in range(len(ed)):
+            p = ed._properties[i]
+            if isinstance(p.value, str):
+                p.value = memo.setdefault(p.value, p.value)
+        if stacks is not None and ed.stack_id >= 0:
+            ed.stack_id = self._stacks.intern(stacks[ed.stack_id].tobytes())
+            ed.stack = self._stacks[ed.stack_id]
+
+    def __iter__(self):
+        chunks = self._chunks
+        # Events before the earliest start of any later chunk are final
+        safe = [None] * len(chunks)
+        low = None
+        for k in range(len(chunks) - 1, -1, -1):
+            safe[k] = low
+            low = chunks[k].min_time if low is None else min(low, chunks[k].min_time)
+
+        with ProcessPoolExecutor(self._workers) as pool:
+            process_times, thread_times = self._kernel_state(pool)
+            pending = collections.deque()
+            submitted = 0
+            heap = []
+            seq = 0
+            for k in range(len(chunks)):
+                while submitted < len(chunks) and len(pending) < 2 * self._workers:
+                    pending.append(pool.submit(
+                        _decode_chunk, self._path, self._filters, chunks[submitted],
+                        process_times, thread_times,
+                    ))
+                    submitted += 1
+                events, stacks = pending.popleft().result()
+                for ed in events:
+                    self._intern(ed, stacks)
+                    heapq.heappush(heap, (ed.timestamp, seq, ed))
+                    seq += 1
+                limit = safe[k]
+                while heap and (limit is None or heap[0][0] < limit):
+                    yield heapq.heappop(heap)[2]
+
+    def map(self, func):
+        """Calls func(reader) for each range of buffers in a worker process.
+
+        Results are yielded in the order they complete. func must be
+        picklable, and is passed an iterable of the events in its range."""
+        with ProcessPoolExecutor(self._workers) as pool:
+            process_times, thread_times = self._kernel_state(pool)
+            futures = [
+                pool.submit(_map_chunk, self._path, self._filters, c, process_times, thread_times, func)
+                for c in self._chunks
+            ]
+            for f in as_completed(futures):
+                yield f.result()
+
+
+def open(path, *, workers=None, **filters):
+    return ParallelEtlReader(path, workers=workers, **filters)
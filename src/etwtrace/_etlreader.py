@@ -0,0 +1,1027 @@
+"""Portable reader for ETL files.
+
+Decodes the ETL container directly rather than through the Windows TDH
+APIs, so captures can be analysed on any platform. TraceLogging events
+(which includes every event raised by etwtrace) and the kernel events used
+for analysis (process, thread, image load, sampled profile and stack walk)
+are fully decoded. Other events are returned with their header fields and
+no properties.
+
+The file is memory mapped and only the parts needed for each event are
+read. Events are returned in timestamp order, merged across processors,
+with timestamps converted to FILETIME (100ns units since 1601) to match
+the TDH-based decoder.
+"""
+
+import array
+import bisect
+import heapq
+import io
+import mmap
+import os
+import struct
+import uuid
+
+SYSTRACE_GUID = uuid.UUID('9e814aad-3204-11d2-9a82-006008a86939')
+EVENTTRACE_EVENT_ID = uuid.UUID('68fdd900-4a3e-11d1-84f4-0000f80464e3')
+PROCESS_EVENT_ID = uuid.UUID('3d6fa8d0-fe05-11d0-9dda-00c04fd7ba7c')
+THREAD_EVENT_ID = uuid.UUID('3d6fa8d1-fe05-11d0-9dda-00c04fd7ba7c')
+IMAGE_EVENT_ID = uuid.UUID('2cb15d1d-5fc1-11d2-abe1-00a0c911f518')
+PERFINFO_EVENT_ID = uuid.UUID('ce1dbfb4-137e-4da6-87b0-3f59aa102cbc')
+STACKWALK_EVENT_ID = uuid.UUID('def2fe46-7bd6-4b80-bd94-f57fe20d0ce3')
+
+EVENT_TRACE_TYPE_START = 1
+EVENT_TRACE_TYPE_END = 2
+
+BUFFER_HEADER = struct.Struct('<IIIiqqQBBHIIHH16x')
+SYSTEM_HEADER = struct.Struct('<HBBHBBIIqII')
+COMPACT_HEADER = struct.Struct('<HBBHBBIIq')
+PERFINFO_HEADER = struct.Struct('<HBBHBBq')
+EVENT_HEADER = struct.Struct('<HBBHHIIq16sHBBBBHQQ16s')
+CLASSIC_HEADER = struct.Struct('<HBBBBHIIq16sII')
+EXTENDED_ITEM = struct.Struct('<HHHH')
+
+TRACE_HEADER_TYPE_SYSTEM32 = 1
+TRACE_HEADER_TYPE_SYSTEM64 = 2
+TRACE_HEADER_TYPE_COMPACT32 = 3
+TRACE_HEADER_TYPE_COMPACT64 = 4
+TRACE_HEADER_TYPE_FULL_HEADER32 = 10
+TRACE_HEADER_TYPE_INSTANCE32 = 11
+TRACE_HEADER_TYPE_PERFINFO32 = 16
+TRACE_HEADER_TYPE_PERFINFO64 = 17
+TRACE_HEADER_TYPE_EVENT_HEADER32 = 18
+TRACE_HEADER_TYPE_EVENT_HEADER64 = 19
+TRACE_HEADER_TYPE_FULL_HEADER64 = 20
+TRACE_HEADER_TYPE_INSTANCE64 = 21
+
+# Kernel headers that carry a process and thread ID, as process and thread
+# events do
+_SYSTEM_HEADER_TYPES = (
+    TRACE_HEADER_TYPE_SYSTEM32, TRACE_HEADER_TYPE_SYSTEM64,
+    TRACE_HEADER_TYPE_COMPACT32, TRACE_HEADER_TYPE_COMPACT64,
+)
+
+EVENT_HEADER_FLAG_EXTENDED_INFO = 0x0001
+EVENT_HEADER_FLAG_STRING_ONLY = 0x0004
+EVENT_HEADER_FLAG_32_BIT_HEADER = 0x0020
+EVENT_HEADER_FLAG_64_BIT_HEADER = 0x0040
+
+EVENT_HEADER_EXT_TYPE_RELATED_ACTIVITYID = 1
+EVENT_HEADER_EXT_TYPE_STACK_TRACE32 = 5
+EVENT_HEADER_EXT_TYPE_STACK_TRACE64 = 6
+EVENT_HEADER_EXT_TYPE_EVENT_SCHEMA_TL = 11
+EVENT_HEADER_EXT_TYPE_PROV_TRAITS = 12
+
+# TraceLogging/TDH in-types (the TraceLogging values match TDH_INTYPE_*)
+INTYPE_NULL = 0
+INTYPE_UNICODESTRING = 1
+INTYPE_ANSISTRING = 2
+INTYPE_INT8 = 3
+INTYPE_UINT8 = 4
+INTYPE_INT16 = 5
+INTYPE_UINT16 = 6
+INTYPE_INT32 = 7
+INTYPE_UINT32 = 8
+INTYPE_INT64 = 9
+INTYPE_UINT64 = 10
+INTYPE_FLOAT = 11
+INTYPE_DOUBLE = 12
+INTYPE_BOOL32 = 13
+INTYPE_BINARY = 14
+INTYPE_GUID = 15
+INTYPE_POINTER = 16
+INTYPE_FILETIME = 17
+INTYPE_SYSTEMTIME = 18
+INTYPE_SID = 19
+INTYPE_HEXINT32 = 20
+INTYPE_HEXINT64 = 21
+INTYPE_COUNTEDSTRING = 22
+INTYPE_COUNTEDANSISTRING = 23
+INTYPE_STRUCT = 24
+INTYPE_COUNTEDBINARY = 25
+
+_TLG_IN_TYPE_MASK = 0x1F
+_TLG_IN_CCOUNT = 0x20
+_TLG_IN_VCOUNT = 0x40
+_TLG_IN_CUSTOM = 0x60
+_TLG_IN_CHAIN = 0x80
+_TLG_OUT_CHAIN = 0x80
+
+_FIXED_FORMATS = {
+    INTYPE_INT8: struct.Struct('<b'),
+    INTYPE_UINT8: struct.Struct('<B'),
+    INTYPE_INT16: struct.Struct('<h'),
+    INTYPE_UINT16: struct.Struct('<H'),
+    INTYPE_INT32: struct.Struct('<i'),
+    INTYPE_UINT32: struct.Struct('<I'),
+    INTYPE_INT64: struct.Struct('<q'),
+    INTYPE_UINT64: struct.Struct('<Q'),
+    INTYPE_FLOAT: struct.Struct('<f'),
+    INTYPE_DOUBLE: struct.Struct('<d'),
+    INTYPE_BOOL32: struct.Struct('<i'),
+    INTYPE_FILETIME: struct.Struct('<Q'),
+    INTYPE_HEXINT32: struct.Struct('<I'),
+    INTYPE_HEXINT64: struct.Struct('<Q'),
+}
+
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+
+_formatters = {
+    INTYPE_HEXINT32: lambda v: f'0x{v:08X}',
+    INTYPE_HEXINT64: lambda v: f'0x{v>>32:08X}_{v&0xFFFFFFFF:08X}',
+    INTYPE_GUID: lambda v: f'{v!s}',
+}
+
+
+class EtlFormatError(ValueError):
+    pass
+
+
+class EventData:
+    __slots__ = (
+        'provider', 'id', 'version', 'channel', 'level', 'opcode', 'task', 'keyword',
+        'thread_id', 'process_id', 'timestamp',
+        'provider_name', 'channel_name', 'level_name', 'opcode_name', 'task_name',
+        'keyword_names', 'event_name', 'event_uuid', 'event_message', 'provider_message',
+        'stack', 'stack_id', 'activity_id', 'related_activity_id', '_properties', '_property_count',
+    )
+
+    def __init__(self):
+        self.provider = None
+        self.id = self.version = self.channel = self.level = 0
+        self.opcode = self.task = self.keyword = 0
+        self.thread_id = self.process_id = -1
+        self.timestamp = 0
+        self.provider_name = None
+        self.channel_name = None
+        self.level_name = None
+        self.opcode_name = None
+        self.task_name = None
+        self.keyword_names = None
+        self.event_name = None
+        self.event_uuid = None
+        self.event_message = None
+        self.provider_message = None
+        self.activity_id = None
+        self.related_activity_id = None
+        self._properties = {}
+        self._property_count = 0
+        self.stack = None
+        self.stack_id = -1
+
+    def __repr__(self):
+        ev = self.event_name or self.opcode_name or self.task_name
+        msg = f", {self.event_message!r}" if self.event_message else ""
+        return f"<EventData({self.provider_name!r}, {self.id}, {ev!r}{msg})>"
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            if index < 0:
+                index += self._property_count
+            if index >= self._property_count:
+                raise IndexError()
+        return self._properties[index]
+
+    def __len__(self):
+        return self._property_count
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._properties[i].name
+
+    def items(self):
+        for i in range(len(self)):
+            p = self._properties[i]
+            yield p.name, p.value
+
+    def get(self, name, default=None):
+        """Returns the value of the named property, or default."""
+        p = self._properties.get(name)
+        return default if p is None else p.value
+
+    _STATE = __slots__[:-2]
+
+    def __getstate__(self):
+        # Compact state for sending events between processes. Only fields
+        # that differ from the defaults are included.
+        state = {}
+        for n, default in self._DEFAULTS:
+            v = getattr(self, n)
+            if v != default:
+                state[n] = v
+        props = [self._properties[i] for i in range(self._property_count)]
+        return state, [(p.name, p.value, p._in_type) for p in props]
+
+    def __setstate__(self, state):
+        EventData.__init__(self)
+        values, props = state
+        for n, v in values.items():
+            setattr(self, n, v)
+        for p in props:
+            self._add(*p)
+
+    def _add(self, name, value, in_type=None):
+        p = EventPropertyData(name, value, in_type)
+        self._properties[name] = self._properties[self._property_count] = p
+        self._property_count += 1
+
+    @property
+    def is_process_start(self):
+        return (self.provider == SYSTRACE_GUID
+            and self.event_uuid == PROCESS_EVENT_ID
+            and self.opcode == EVENT_TRACE_TYPE_START)
+
+    @property
+    def is_process_end(self):
+        return (self.provider == SYSTRACE_GUID
+            and self.event_uuid == PROCESS_EVENT_ID
+            and self.opcode == EVENT_TRACE_TYPE_END)
+
+    @property
+    def is_stack_sample(self):
+        return (self.provider == SYSTRACE_GUID
+            and self.event_uuid == PERFINFO_EVENT_ID
+            and self.opcode == 46)
+
+
+_default = EventData()
+EventData._DEFAULTS = tuple((n, getattr(_default, n)) for n in EventData._STATE)
+del _default
+
+
+class EventPropertyData:
+    __slots__ = ('name', 'flags', 'value', '_in_type')
+
+    def __init__(self, name, value, in_type=None):
+        self.name = name
+        self.flags = 0
+        self.value = value
+        self._in_type = in_type
+
+    @property
+    def formatted_value(self):
+        fmt = _formatters.get(self._in_type)
+        return fmt(self.value) if fmt else self.value
+
+    def __repr__(self):
+        return f"<EventPropertyData({self.name!r}, {self.formatted_value!r})>"
+
+    def __str__(self):
+        return f"{self.name}={self.formatted_value}"
+
+
+class StackTable:
+    """Shared storage for the distinct stacks read from a trace.
+
+    Stack IDs are indexes into the table, and each stack is an array('Q')
+    of addresses. Events with identical stacks share the same array."""
+    def __init__(self):
+        self._ids = {}
+        self._stacks = []
+
+    def __len__(self):
+        return len(self._stacks)
+
+    def __getitem__(self, stack_id):
+        return self._stacks[stack_id]
+
+    def __iter__(self):
+        return iter(self._stacks)
+
+    def intern(self, key):
+        stack_id = self._ids.get(key)
+        if stack_id is None:
+            stack = array.array('Q')
+            stack.frombytes(key)
+            stack_id = len(self._stacks)
+            self._stacks.append(stack)
+            self._ids[key] = stack_id
+        return stack_id
+
+
+def _read_wstr(data, offset, end):
+    i = offset
+    while i + 1 < end:
+        if data[i] == 0 and data[i + 1] == 0:
+            return bytes(data[offset:i]).decode('utf-16-le', 'replace').removeprefix('﻿'), i + 2
+        i += 2
+    return bytes(data[offset:end]).decode('utf-16-le', 'replace'), end
+
+
+def _read_str(data, offset, end):
+    i = offset
+    while i < end and data[i]:
+        i += 1
+    return bytes(data[offset:i]).decode('utf-8-sig', 'replace'), min(i + 1, end)
+
+
+def _read_sid(data, offset, end, ptrsize):
+    # A null SID is stored as a single zero ULONG. Otherwise it is a
+    # TOKEN_USER structure followed by the SID itself.
+    if offset + 4 > end:
+        raise EtlFormatError("truncated SID")
+    if not _U32.unpack_from(data, offset)[0]:
+        return None, offset + 4
+    sid_offset = offset + 2 * ptrsize
+    count = data[sid_offset + 1]
+    n = 8 + 4 * count
+    return bytes(data[sid_offset:sid_offset + n]), sid_offset + n
+
+
+# Kernel event layouts, keyed by (group, opcode). Codes are 'P' for
+# pointer-sized values, 'S'/'s' for wide/narrow strings, 'SID' for a
+# security identifier and otherwise struct format characters.
+_PROCESS = ('Process', PROCESS_EVENT_ID, [
+    ('UniqueProcessKey', 'P'), ('ProcessId', 'I'), ('ParentId', 'I'),
+    ('SessionId', 'I'), ('ExitStatus', 'i'), ('DirectoryTableBase', 'P'),
+    ('Flags', 'I'), ('UserSID', 'SID'), ('ImageFileName', 's'), ('CommandLine', 'S'),
+])
+_THREAD = ('Thread', THREAD_EVENT_ID, [
+    ('ProcessId', 'I'), ('TThreadId', 'I'), ('StackBase', 'P'), ('StackLimit', 'P'),
+    ('UserStackBase', 'P'), ('UserStackLimit', 'P'), ('Affinity', 'P'),
+    ('Win32StartAddr', 'P'), ('TebBase', 'P'), ('SubProcessTag', 'I'),
+])
+_IMAGE = ('Image', IMAGE_EVENT_ID, [
+    ('ImageBase', 'P'), ('ImageSize', 'P'), ('ProcessId', 'I'), ('ImageCheckSum', 'I'),
+    ('TimeDateStamp', 'I'), ('Reserved0', 'I'), ('DefaultBase', 'P'), ('Reserved1', 'I'),
+    ('Reserved2', 'I'), ('Reserved3', 'I'), ('Reserved4', 'I'), ('FileName', 'S'),
+])
+_SAMPLE = ('PerfInfo', PERFINFO_EVENT_ID, [
+    ('InstructionPointer', 'P'), ('ThreadId', 'I'), ('Count', 'H'), ('Reserved', 'H'),
+])
+_STACKWALK = ('StackWalk', STACKWALK_EVENT_ID, [
+    ('EventTimeStamp', 'Q'), ('StackProcess', 'I'), ('StackThread', 'I'),
+])
+_HEADER = ('EventTrace', EVENTTRACE_EVENT_ID, [])
+
+_KERNEL_EVENTS = {
+    (0x00, 0): (*_HEADER, 'Header'),
+    (0x03, 1): (*_PROCESS, 'Start'),
+    (0x03, 2): (*_PROCESS, 'End'),
+    (0x03, 3): (*_PROCESS, 'DCStart'),
+    (0x03, 4): (*_PROCESS, 'DCEnd'),
+    (0x05, 1): (*_THREAD, 'Start'),
+    (0x05, 2): (*_THREAD, 'End'),
+    (0x05, 3): (*_THREAD, 'DCStart'),
+    (0x05, 4): (*_THREAD, 'DCEnd'),
+    (0x0F, 46): (*_SAMPLE, 'SampleProf'),
+    (0x14, 2): (*_IMAGE, 'UnLoad'),
+    (0x14, 3): (*_IMAGE, 'DCStart'),
+    (0x14, 4): (*_IMAGE, 'DCEnd'),
+    (0x14, 10): (*_IMAGE, 'Load'),
+    (0x18, 32): (*_STACKWALK, 'Stack'),
+}
+
+_KERNEL_INTYPES = {'P': INTYPE_POINTER, 'I': INTYPE_UINT32, 'i': INTYPE_INT32,
+                   'H': INTYPE_UINT16, 'Q': INTYPE_UINT64}
+
+
+def _read_kernel_properties(ed, layout, data, offset, end, ptrsize, version):
+    ptr_fmt = _U64 if ptrsize == 8 else _U32
+    for name, code in layout:
+        if offset >= end:
+            break
+        if name == 'Flags' and version < 4:
+            continue
+        if code == 'P':
+            if offset + ptrsize > end:
+                break
+            value = ptr_fmt.unpack_from(data, offset)[0]
+            offset += ptrsize
+            ed._add(name, value, INTYPE_HEXINT64 if ptrsize == 8 else INTYPE_HEXINT32)
+        elif code == 'S':
+            value, offset = _read_wstr(data, offset, end)
+            ed._add(name, value)
+        elif code == 's':
+            value, offset = _read_str(data, offset, end)
+            ed._add(name, value)
+        elif code == 'SID':
+            value, offset = _read_sid(data, offset, end, ptrsize)
+            ed._add(name, value)
+        else:
+            fmt = struct.Struct('<' + code)
+            if offset + fmt.size > end:
+                break
+            ed._add(name, fmt.unpack_from(data, offset)[0], _KERNEL_INTYPES.get(code))
+            offset += fmt.size
+    return offset
+
+
+class _TlgField:
+    __slots__ = ('name', 'in_type', 'out_type', 'count', 'ccount', 'vcount', 'members')
+
+    def __init__(self, name, in_type, out_type, count, ccount, vcount):
+        self.name = name
+        self.in_type = in_type
+        self.out_type = out_type
+        self.count = count
+        self.ccount = ccount
+        self.vcount = vcount
+        self.members = None
+
+
+def _parse_tlg_schema(meta):
+    """Parses TraceLogging event metadata into (event_name, fields)."""
+    end = _U16.unpack_from(meta, 0)[0] if len(meta) >= 2 else 0
+    end = min(end or len(meta), len(meta))
+    i = 2
+    # Skip extension bytes (high bit means another follows)
+    while i < end and meta[i] & 0x80:
+        i += 1
+    i += 1
+    event_name, i = _read_str(meta, i, end)
+    fields = []
+    while i < end:
+        name, i = _read_str(meta, i, end)
+        if i >= end:
+            break
+        in_byte = meta[i]
+        i += 1
+        out_type = 0
+        if in_byte & _TLG_IN_CHAIN:
+            out_byte = meta[i]
+            i += 1
+            out_type = out_byte & 0x7F
+            if out_byte & _TLG_OUT_CHAIN:
+                while i < end and meta[i] & 0x80:
+                    i += 1
+                i += 1
+        flags = in_byte & _TLG_IN_CUSTOM
+        count = 1
+        if flags == _TLG_IN_CCOUNT:
+            count = _U16.unpack_from(meta, i)[0]
+            i += 2
+        elif flags == _TLG_IN_CUSTOM:
+            cb = _U16.unpack_from(meta, i)[0]
+            i += 2 + cb
+        fields.append(_TlgField(
+            name,
+            in_byte & _TLG_IN_TYPE_MASK,
+            out_type,
+            count,
+            flags == _TLG_IN_CCOUNT,
+            flags == _TLG_IN_VCOUNT,
+        ))
+    return event_name, _nest_tlg_fields(fields)
+
+
+def _nest_tlg_fields(fields):
+    result = []
+    it = iter(fields)
+    def take(n):
+        taken = []
+        for f in it:
+            if f.in_type == INTYPE_STRUCT:
+                f.members = take(f.out_type)
+            taken.append(f)
+            if len(taken) == n:
+                break
+        return taken
+    while True:
+        chunk = take(1)
+        if not chunk:
+            return result
+        result.extend(chunk)
+
+
+def _read_tlg_value(in_type, data, offset, end, ptrsize):
+    fmt = _FIXED_FORMATS.get(in_type)
+    if fmt:
+        if offset + fmt.size > end:
+            raise EtlFormatError("truncated value")
+        return fmt.unpack_from(data, offset)[0], offset + fmt.size
+    if in_type == INTYPE_UNICODESTRING:
+        return _read_wstr(data, offset, end)
+    if in_type == INTYPE_ANSISTRING:
+        return _read_str(data, offset, end)
+    if in_type == INTYPE_POINTER:
+        fmt = _U64 if ptrsize == 8 else _U32
+        return fmt.unpack_from(data, offset)[0], offset + ptrsize
+    if in_type == INTYPE_GUID:
+        return uuid.UUID(bytes_le=bytes(data[offset:offset + 16])), offset + 16
+    if in_type == INTYPE_SYSTEMTIME:
+        return struct.unpack_from('<8H', data, offset), offset + 16
+    if in_type in (INTYPE_BINARY, INTYPE_COUNTEDBINARY):
+        n = _U16.unpack_from(data, offset)[0]
+        return bytes(data[offset + 2:offset + 2 + n]), offset + 2 + n
+    if in_type == INTYPE_COUNTEDSTRING:
+        n = _U16.unpack_from(data, offset)[0]
+        return bytes(data[offset + 2:offset + 2 + n]).decode('utf-16-le', 'replace'), offset + 2 + n
+    if in_type == INTYPE_COUNTEDANSISTRING:
+        n = _U16.unpack_from(data, offset)[0]
+        return bytes(data[offset + 2:offset + 2 + n]).decode('utf-8', 'replace'), offset + 2 + n
+    if in_type == INTYPE_SID:
+        n = 8 + 4 * data[offset + 1]
+        return bytes(data[offset:offset + n]), offset + n
+    if in_type == INTYPE_NULL:
+        return None, offset
+    raise EtlFormatError(f"Could not decode {in_type}")
+
+
+def _read_tlg_field(field, data, offset, end, ptrsize):
+    count = field.count
+    if field.vcount:
+        count = _U16.unpack_from(data, offset)[0]
+        offset += 2
+    values = []
+    for _ in range(count):
+        if field.in_type == INTYPE_STRUCT:
+            v = {}
+            for m in field.members:
+                v[m.name], offset = _read_tlg_field(m, data, offset, end, ptrsize)
+        else:
+            v, offset = _read_tlg_value(field.in_type, data, offset, end, ptrsize)
+        values.append(v)
+    if field.vcount or field.ccount:
+        return values, offset
+    return values[0], offset
+
+
+class _LogfileHeader:
+    def __init__(self):
+        self.pointer_size = 8
+        self.perf_freq = 0
+        self.start_time = 0
+        self.start_raw = 0
+        self.clock_type = 0
+        self.cpu_speed = 0
+        self.number_of_processors = 0
+        self.events_lost = 0
+        self.buffers_lost = 0
+
+    def to_filetime(self, raw):
+        if self.clock_type == 2 or not self.start_time:
+            # System time, or we never saw a header to convert with
+            return raw
+        freq = self.perf_freq if self.clock_type != 3 else self.cpu_speed * 1000000
+        if not freq:
+            return raw
+        return self.start_time + (raw - self.start_raw) * 10000000 // freq
+
+
+class _Buffer:
+    __slots__ = ('offset', 'end', 'cpu', 'timestamp')
+
+    def __init__(self, offset, end, cpu, timestamp):
+        self.offset = offset
+        self.end = end
+        self.cpu = cpu
+        self.timestamp = timestamp
+
+
+def _read_buffers(data, start=0, stop=None):
+    """Returns the valid buffers in data that begin between start and stop."""
+    offset = start
+    stop = len(data) if stop is None else min(stop, len(data))
+    buffers = []
+    while offset < stop and offset + BUFFER_HEADER.size <= len(data):
+        (size, saved_offset, current_offset, _, timestamp, _, _,
+         cpu, _, _, _, filled, _, _) = BUFFER_HEADER.unpack_from(data, offset)
+        if size < BUFFER_HEADER.size or offset + size > len(data):
+            break
+        used = filled if BUFFER_HEADER.size < filled <= size else saved_offset
+        if not BUFFER_HEADER.size < used <= size:
+            used = current_offset if BUFFER_HEADER.size < current_offset <= size else size
+        buffers.append(_Buffer(offset, offset + used, cpu, timestamp))
+        offset += size
+    return buffers
+
+
+def _iter_buffer_records(data, buffers):
+    """Yields (raw timestamp, offset, header type) for each record."""
+    for b in buffers:
+        offset = b.offset + BUFFER_HEADER.size
+        end = b.end
+        while offset + 16 <= end:
+            header_type = data[offset + 2]
+            if header_type in (TRACE_HEADER_TYPE_EVENT_HEADER32, TRACE_HEADER_TYPE_EVENT_HEADER64):
+                size = _U16.unpack_from(data, offset)[0]
+                timestamp = struct.unpack_from('<q', data, offset + 16)[0]
+            elif header_type in (TRACE_HEADER_TYPE_SYSTEM32, TRACE_HEADER_TYPE_SYSTEM64,
+                                 TRACE_HEADER_TYPE_COMPACT32, TRACE_HEADER_TYPE_COMPACT64):
+                size = _U16.unpack_from(data, offset + 4)[0]
+                timestamp = struct.unpack_from('<q', data, offset + 16)[0]
+            elif header_type in (TRACE_HEADER_TYPE_PERFINFO32, TRACE_HEADER_TYPE_PERFINFO64):
+                size = _U16.unpack_from(data, offset + 4)[0]
+                timestamp = struct.unpack_from('<q', data, offset + 8)[0]
+            elif header_type in (TRACE_HEADER_TYPE_FULL_HEADER32, TRACE_HEADER_TYPE_FULL_HEADER64,
+                                 TRACE_HEADER_TYPE_INSTANCE32, TRACE_HEADER_TYPE_INSTANCE64):
+                size = _U16.unpack_from(data, offset)[0]
+                timestamp = struct.unpack_from('<q', data, offset + 16)[0]
+            else:
+                # Unknown record or padding - nothing more in this buffer
+                break
+            if size < 16 or offset + size > end:
+                break
+            yield timestamp, offset, header_type
+            offset += (size + 7) & ~7
+
+
+class EtlReader:
+    def __init__(
+        self,
+        path,
+        *,
+        providers=[],
+        provider_names=[],
+        event_names=[],
+        process_ids=[],
+        include_child_process_ids=True,
+        keyword_mask_all=0,
+        keyword_mask_any=0,
+        start_time=None,
+        end_time=None,
+        property_filters=None,
+        intern_stacks=False,
+    ):
+        self._file = io.open(os.fspath(path), 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self._data = b''
+        self._providers = frozenset(providers) if providers else None
+        self._provider_names = frozenset(n.lower() for n in provider_names) if provider_names else None
+        self._event_names = frozenset(n.lower() for n in event_names) if event_names else None
+        self._process_ids = set(process_ids) if process_ids else None
+        self._include_children = include_child_process_ids
+        self._keyword_all = int(keyword_mask_all)
+        self._keyword_any = int(keyword_mask_any)
+        self._start_time = _to_filetime(start_time) if start_time is not None else None
+        self._end_time = _to_filetime(end_time) if end_time is not None else None
+        self._property_filters = _compile_property_filters(property_filters)
+        self._stacks = StackTable() if intern_stacks else None
+        self._memo = {}
+        self._schemas = {}
+        self._thread_pids = {}
+        self._process_times = None
+        self._thread_times = None
+        self._buffer_range = (0, None)
+        self._buffer_offsets = None
+        self.header = _LogfileHeader()
+        self._read_logfile_header()
+
+    @property
+    def stack_table(self):
+        """The shared StackTable when opened with intern_stacks=True.
+
+        Each event's stack_id is an index into this table."""
+        return self._stacks
+
+    def close(self):
+        if self._data:
+            self._data.close()
+            self._data = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def include_process_id(self, pid):
+        if self._process_ids is None:
+            self._process_ids = set()
+        self._process_ids.add(pid)
+
+    def _restrict(self, start, stop, process_times=None, thread_times=None):
+        """Limits reading to the buffers beginning between start and stop.
+
+        Kernel state collected from the rest of the file may be provided,
+        as the process and thread events may be in other buffers. IDs may
+        be reused, so process_times maps each included process ID to its
+        [start, end] intervals, and thread_times maps each thread ID to
+        its (start times, process IDs) in time order."""
+        self._buffer_range = (start, stop)
+        if process_times is not None:
+            self._process_ids = set(process_times)
+            self._process_times = process_times
+            self._include_children = False
+        if thread_times:
+            self._thread_times = thread_times
+
+    def _select_buffers(self, offsets, thread_pids=None):
+        """Limits reading to the buffers at the specified offsets.
+
+        Used with an index, which provides the thread owners from buffers
+        that are not read."""
+        self._buffer_offsets = frozenset(offsets)
+        if thread_pids:
+            self._thread_pids.update(thread_pids)
+
+    def _read_logfile_header(self):
+        data = self._data
+        buffers = _read_buffers(data, 0, BUFFER_HEADER.size + 1)
+        if not buffers:
+            if data:
+                raise EtlFormatError("not an ETL file")
+            return
+        for _, offset, header_type in _iter_buffer_records(data, buffers[:1]):
+            if header_type not in (TRACE_HEADER_TYPE_SYSTEM32, TRACE_HEADER_TYPE_SYSTEM64):
+                continue
+            (_, _, _, size, opcode, group, _, _, raw, _, _) = SYSTEM_HEADER.unpack_from(data, offset)
+            if group or opcode:
+                continue
+            p = offset + SYSTEM_HEADER.size
+            h = self.header
+            (_, _, _, h.number_of_processors, _, _, _, _, _,
+             _, h.pointer_size, h.events_lost, h.cpu_speed) = struct.unpack_from('<IIIIqIIIIIIII', data, p)
+            ptrsize = h.pointer_size if h.pointer_size in (4, 8) else 8
+            # Two string pointers, then TIME_ZONE_INFORMATION, then
+            # 8-byte aligned BootTime, PerfFreq, StartTime.
+            p2 = p + 56 + 2 * ptrsize + 172
+            p2 = (p2 - p + 7) // 8 * 8 + p
+            (_, h.perf_freq, h.start_time, h.clock_type,
+             h.buffers_lost) = struct.unpack_from('<qqqII', data, p2)
+            h.start_raw = raw
+            return
+
+    def _records(self):
+        by_cpu = {}
+        for b in _read_buffers(self._data, *self._buffer_range):
+            if self._buffer_offsets is None or b.offset in self._buffer_offsets:
+                by_cpu.setdefault(b.cpu, []).append(b)
+        streams = [_iter_buffer_records(self._data, bs) for bs in by_cpu.values()]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, key=lambda r: r[0])
+
+    def __iter__(self):
+        if self._data is None:
+            raise ValueError("no ETL trace open")
+        to_filetime = self.header.to_filetime
+        start_time = self._start_time
+        end_time = self._end_time
+        data = self._data
+        for raw, offset, header_type in self._records():
+            timestamp = to_filetime(raw)
+            if end_time is not None and timestamp > end_time:
+                break
+            if start_time is not None and timestamp < start_time:
+                # Process and thread events before the window still decide
+                # which children are included and which process each thread
+                # belongs to, but are not returned
+                if header_type in _SYSTEM_HEADER_TYPES and data[offset + 7] in (0x03, 0x05):
+                    self._read_kernel(offset, header_type, timestamp)
+                continue
+            ed = self._read_record(offset, header_type, timestamp)
+            if ed is not None:
+                yield ed
+
+    def _read_record(self, offset, header_type, timestamp):
+        if header_type in (TRACE_HEADER_TYPE_EVENT_HEADER32, TRACE_HEADER_TYPE_EVENT_HEADER64):
+            return self._read_event_header(offset, header_type, timestamp)
+        if header_type in (TRACE_HEADER_TYPE_SYSTEM32, TRACE_HEADER_TYPE_SYSTEM64,
+                           TRACE_HEADER_TYPE_COMPACT32, TRACE_HEADER_TYPE_COMPACT64,
+                           TRACE_HEADER_TYPE_PERFINFO32, TRACE_HEADER_TYPE_PERFINFO64):
+            return self._read_kernel(offset, header_type, timestamp)
+        return self._read_classic(offset, header_type, timestamp)
+
+    def _str(self, s):
+        return self._memo.setdefault(s, s)
+
+    def _thread_pid(self, tid, timestamp):
+        times = self._thread_times.get(tid) if self._thread_times else None
+        if times is None:
+            return self._thread_pids.get(tid, -1)
+        starts, pids = times
+        i = bisect.bisect_right(starts, timestamp)
+        return pids[i - 1] if i else -1
+
+    def _filter_header(self, ed):
+        if self._providers is not None and ed.provider not in self._providers:
+            return False
+        if self._process_ids is not None and ed.process_id not in self._process_ids:
+            return False
+        if self._process_times is not None:
+            t = ed.timestamp
+            if not any((s is None or s <= t) and (e is None or t <= e)
+                       for s, e in self._process_times[ed.process_id]):
+                return False
+        kw = ed.keyword
+        if self._keyword_all and (kw & self._keyword_all) != self._keyword_all:
+            return False
+        if self._keyword_any and not (kw & self._keyword_any):
+            return False
+        return True
+
+    def _filter_names(self, ed):
+        if self._provider_names is not None:
+            if not ed.provider_name or ed.provider_name.lower() not in self._provider_names:
+                return False
+        if self._event_names is not None:
+            if not ed.event_name or ed.event_name.lower() not in self._event_names:
+                return False
+        if self._property_filters:
+            for name, match in self._property_filters:
+                p = ed._properties.get(name)
+                if p is None or not isinstance(p.value, int) or not match(p.value):
+                    return False
+        return True
+
+    def _set_stack(self, ed, key):
+        if self._stacks is not None:
+            ed.stack_id = self._stacks.intern(key)
+            ed.stack = self._stacks[ed.stack_id]
+        else:
+            ed.stack = array.array('Q')
+            ed.stack.frombytes(key)
+
+    def _read_event_header(self, offset, header_type, timestamp):
+        data = self._data
+        (size, _, _, flags, event_property, tid, pid, _, provider, event_id, version,
+         channel, level, opcode, task, keyword, _, activity_id) = EVENT_HEADER.unpack_from(data, offset)
+        ed = EventData()
+        ed.provider = self._provider_uuid(provider)
+        ed.id = event_id
+        ed.version = version
+        ed.channel = channel
+        ed.level = level
+        ed.opcode = opcode
+        ed.task = task
+        ed.keyword = keyword
+        ed.thread_id = tid
+        ed.process_id = pid
+        ed.timestamp = timestamp
+        if any(activity_id):
+            ed.activity_id = uuid.UUID(bytes_le=activity_id)
+        if not self._filter_header(ed):
+            return None
+
+        ptrsize = 8
+        if flags & EVENT_HEADER_FLAG_32_BIT_HEADER:
+            ptrsize = 4
+        elif flags & EVENT_HEADER_FLAG_64_BIT_HEADER:
+            ptrsize = 8
+
+        end = offset + size
+        p = offset + EVENT_HEADER.size
+        schema = traits = stack = None
+        if flags & EVENT_HEADER_FLAG_EXTENDED_INFO:
+            while p + EXTENDED_ITEM.size <= end:
+                _, ext_type, linkage, data_size = EXTENDED_ITEM.unpack_from(data, p)
+                item = p + EXTENDED_ITEM.size
+                if ext_type == EVENT_HEADER_EXT_TYPE_EVENT_SCHEMA_TL:
+                    schema = bytes(data[item:item + data_size])
+                elif ext_type == EVENT_HEADER_EXT_TYPE_PROV_TRAITS:
+                    traits = bytes(data[item:item + data_size])
+                elif ext_type == EVENT_HEADER_EXT_TYPE_STACK_TRACE64:
+                    stack = bytes(data[item + 8:item + data_size])
+                elif ext_type == EVENT_HEADER_EXT_TYPE_STACK_TRACE32:
+                    stack = array.array('Q', array.array('I', bytes(data[item + 8:item + data_size]))).tobytes()
+                elif ext_type == EVENT_HEADER_EXT_TYPE_RELATED_ACTIVITYID and data_size >= 16:
+                    ed.related_activity_id = uuid.UUID(bytes_le=bytes(data[item:item + 16]))
+                p = (item + data_size + 7) & ~7
+                if not linkage & 1:
+                    break
+
+        if traits:
+            ed.provider_name = self._str(_read_str(traits, 2, len(traits))[0])
+        if flags & EVENT_HEADER_FLAG_STRING_ONLY:
+            ed.event_message = _read_wstr(data, p, end)[0]
+        elif schema:
+            parsed = self._schemas.get(schema)
+            if parsed is None:
+                parsed = self._schemas[schema] = _parse_tlg_schema(schema)
+            event_name, fields = parsed
+            ed.event_name = self._str(event_name)
+            for f in fields:
+                try:
+                    value, p = _read_tlg_field(f, data, p, end, ptrsize)
+                except (EtlFormatError, struct.error, IndexError):
+                    break
+                if isinstance(value, str):
+                    value = self._str(value)
+                ed._add(f.name, value, f.in_type)
+
+        if not self._filter_names(ed):
+            return None
+        if stack is not None:
+            self._set_stack(ed, stack)
+        return ed
+
+    def _read_kernel(self, offset, header_type, timestamp):
+        data = self._data
+        if header_type in (TRACE_HEADER_TYPE_PERFINFO32, TRACE_HEADER_TYPE_PERFINFO64):
+            version, _, _, size, opcode, group, _ = PERFINFO_HEADER.unpack_from(data, offset)
+            tid = pid = -1
+            p = offset + PERFINFO_HEADER.size
+            ptrsize = 8 if header_type == TRACE_HEADER_TYPE_PERFINFO64 else 4
+        elif header_type in (TRACE_HEADER_TYPE_COMPACT32, TRACE_HEADER_TYPE_COMPACT64):
+            version, _, _, size, opcode, group, tid, pid, _ = COMPACT_HEADER.unpack_from(data, offset)
+            p = offset + COMPACT_HEADER.size
+            ptrsize = 8 if header_type == TRACE_HEADER_TYPE_COMPACT64 else 4
+        else:
+            version, _, _, size, opcode, group, tid, pid, _, _, _ = SYSTEM_HEADER.unpack_from(data, offset)
+            p = offset + SYSTEM_HEADER.size
+            ptrsize = 8 if header_type == TRACE_HEADER_TYPE_SYSTEM64 else 4
+        end = offset + size
+
+        ed = EventData()
+        ed.provider = SYSTRACE_GUID
+        ed.opcode = opcode
+        ed.version = version & 0xFF
+        ed.timestamp = timestamp
+        ed.thread_id = tid
+        ed.process_id = pid
+        ed.provider_name = "MSNT_SystemTrace"
+
+        known = _KERNEL_EVENTS.get((group, opcode))
+        if known:
+            task_name, ed.event_uuid, layout, ed.opcode_name = known
+            ed.task_name = task_name
+            p = _read_kernel_properties(ed, layout, data, p, end, ptrsize, ed.version)
+            if group == 0x05 and opcode in (1, 3):
+                self._thread_pids[ed.get('TThreadId')] = ed.get('ProcessId')
+        else:
+            ed.event_uuid = None
+
+        if (group, opcode) == (0x18, 32):
+            ed.process_id = ed.get('StackProcess', -1)
+            ed.thread_id = ed.get('StackThread', -1)
+            n = (end - p) // ptrsize
+            if ptrsize == 8:
+                key = bytes(data[p:p + n * 8])
+            else:
+                key = array.array('Q', array.array('I', bytes(data[p:p + n * 4]))).tobytes()
+            for i, ip in enumerate(array.array('Q', key), 1):
+                ed._add(f'Stack{i}', ip, INTYPE_HEXINT64)
+            if not self._filter_header(ed) or not self._filter_names(ed):
+                return None
+            self._set_stack(ed, key)
+            return ed
+        if (group, opcode) == (0x0F, 46):
+            ed.thread_id = ed.get('ThreadId', -1)
+            ed.process_id = self._thread_pid(ed.thread_id, timestamp)
+
+        if not self._filter_header(ed):
+            return None
+        if group == 0x03 and self._process_ids is not None and self._include_children:
+            # Track children of included processes until they end. Only
+            # events that passed the filter are considered, as TDH does.
+            pid = ed.get('ProcessId')
+            if opcode == EVENT_TRACE_TYPE_START:
+                if ed.get('ParentId') in self._process_ids:
+                    self._process_ids.add(pid)
+            elif opcode == EVENT_TRACE_TYPE_END:
+                self._process_ids.discard(pid)
+        if not self._filter_names(ed):
+            return None
+        return ed
+
+    def _read_classic(self, offset, header_type, timestamp):
+        data = self._data
+        (size, _, _, opcode, level, version, tid, pid, _, guid, _, _) = CLASSIC_HEADER.unpack_from(data, offset)
+        ed = EventData()
+        ed.provider = self._provider_uuid(guid)
+        ed.event_uuid = ed.provider
+        ed.opcode = opcode
+        ed.level = level
+        ed.version = version
+        ed.thread_id = tid
+        ed.process_id = pid
+        ed.timestamp = timestamp
+        if not self._filter_header(ed) or not self._filter_names(ed):
+            return None
+        return ed
+
+    def _provider_uuid(self, raw):
+        u = self._memo.get(raw)
+        if u is None:
+            u = self._memo[raw] = uuid.UUID(bytes_le=raw)
+        return u
+
+
+def _to_filetime(value):
+    import datetime
+    if isinstance(value, datetime.datetime):
+        epoch = datetime.datetime(1601, 1, 1, tzinfo=datetime.timezone.utc)
+        if value.tzinfo is None:
+            value = value.astimezone()
+        return (value - epoch) // datetime.timedelta(microseconds=1) * 10
+    return int(value)
+
+
+def _compile_property_filters(property_filters):
+    if not property_filters:
+        return None
+    compiled = []
+    for name, match in property_filters.items():
+        if isinstance(match, range):
+            if match.step != 1 or not match:
+                raise ValueError(f"unsupported range for property filter {name!r}: {match}")
+            compiled.append((name, match.__contains__))
+        elif isinstance(match, int):
+            compiled.append((name, match.__eq__))
+        else:
+            compiled.append((name, frozenset(match).__contains__))
+    return compiled
+
+
+def open(path, **filters):
+    return EtlReader(path, **filters)
@@ -1,7 +1,22 @@
-#include <Windows.h>
+#include "_platform.h"
 #include "_etwcommon.h"
 #include "_trace.h"
 
+#include <math.h>
+#include <stdint.h>
+#include <stdlib.h>
+#ifdef _WIN32
+#include <evntprov.h>
+#else
+#include <time.h>
+#endif
+
+
+#ifdef WITH_TRACELOGGING
+const struct TRACE_SINK *CurrentSink = &DEFAULT_SINK;
+
+static void forget_allocation_state(struct ETWCOMMON_STATE *state);
+#endif
 
 static FUNC_ID should_ignore(struct ETWCOMMON_STATE *state, PyObject *code, PyObject *filename, int is_filename)
 {
@@ -258,6 +273,75 @@ FUNC_ID ETWCOMMON_find_or_register_callable(struct ETWCOMMON_STATE *state, PyObj
 }
 
 
+// Fills frames with the function IDs of a thread's Python stack, innermost
+// first, and returns the number of frames. Frames that cannot be resolved,
+// and those in ignored files, are left out.
+int ETWCOMMON_get_stack(struct ETWCOMMON_STATE *state, PyThreadState *tstate, FUNC_ID *frames)
+{
+    PyFrameObject *frame = PyThreadState_GetFrame(tstate);
+    int count = 0;
+    while (frame && count < ETWCOMMON_MAX_DEPTH) {
+        PyObject *code = (PyObject *)PyFrame_GetCode(frame);
+        FUNC_ID func_id = ETWCOMMON_find_or_register_code_object(state, code);
+        Py_DECREF(code);
+        if (FUNC_ID_IS_VALID(func_id)) {
+            frames[count++] = func_id;
+        } else if (func_id == FUNC_ID_ERROR) {
+            PyErr_Clear();
+        }
+        PyFrameObject *back = PyFrame_GetBack(frame);
+        Py_DECREF(frame);
+        frame = back;
+    }
+    Py_XDECREF(frame);
+    return count;
+}
+
+
+// The metric writer and the listener that delivers events to subscribers
+// run on Python threads that are not part of the traced program, and mark
+// themselves here while they run. Only threads holding the GIL read or
+// change the list.
+int ETWCOMMON_is_internal_thread(struct ETWCOMMON_STATE *state, PyThreadState *tstate)
+{
+    for (int i = 0; i < state->internal_thread_count; ++i) {
+        if (state->internal_threads[i] == tstate) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+PyObject *ETWCOMMON_set_internal_thread(PyObject *module, PyObject *args)
+{
+    int internal;
+    if (!PyArg_ParseTuple(args, "p", &internal)) {
+        return NULL;
+    }
+    struct ETWCOMMON_STATE *state = (struct ETWCOMMON_STATE *)PyModule_GetState(module);
+    PyThreadState *tstate = PyThreadState_Get();
+    int count = state->internal_thread_count;
+    for (int i = 0; i < count; ++i) {
+        if (state->internal_threads[i] == tstate) {
+            if (!internal) {
+                state->internal_threads[i] = state->internal_threads[count - 1];
+                state->internal_thread_count = count - 1;
+            }
+            Py_RETURN_NONE;
+        }
+    }
+    if (internal) {
+        if (count == ETWCOMMON_MAX_INTERNAL_THREADS) {
+            PyErr_SetString(PyExc_RuntimeError, "too many internal threads");
+            return NULL;
+        }
+        state->internal_threads[count] = tstate;
+        state->internal_thread_count = count + 1;
+    }
+    Py_RETURN_NONE;
+}
+
+
 static FUNC_ID default_new_func_id(
     struct ETWCOMMON_STATE *state,
     PyObject *key,
@@ -314,6 +398,25 @@ int ETWCOMMON_Init(struct ETWCOMMON_STATE *state, void *owner)
             return 0;
         }
     }
+    if (!state->stacks) {
+        state->stacks = PyDict_New();
+        if (!state->stacks) {
+            return 0;
+        }
+    }
+    if (!state->exception_types) {
+        state->exception_types = PyDict_New();
+        if (!state->exception_types) {
+            return 0;
+        }
+    }
+    // Stack and exception type IDs are not reused within a process
+    if (!state->next_stack_id) {
+        state->next_stack_id = 1;
+    }
+    if (!state->next_exception_type_id) {
+        state->next_exception_type_id = 1;
+    }
     state->next_func_id = FUNC_ID_FIRST;
     state->co_extra_index = PyUnstable_Eval_RequestCodeExtraIndex(NULL);
     return 1;
@@ -331,6 +434,15 @@ int ETWCOMMON_Clear(struct ETWCOMMON_STATE *state)
     if (state && state->ignored_files) {
         Py_CLEAR(state->ignored_files);
     }
+    if (state && state->stacks) {
+        Py_CLEAR(state->stacks);
+    }
+    if (state && state->exception_types) {
+        Py_CLEAR(state->exception_types);
+    }
+#ifdef WITH_TRACELOGGING
+    forget_allocation_state(state);
+#endif
     state->next_func_id = FUNC_ID_FIRST;
     state->co_extra_index = -1;
     return 1;
@@ -341,6 +453,8 @@ int ETWCOMMON_Visit(struct ETWCOMMON_STATE *state, visitproc visit, void *arg)
     Py_VISIT(state->ignored_files);
     Py_VISIT(state->include_prefix);
     Py_VISIT(state->func_table);
+    Py_VISIT(state->stacks);
+    Py_VISIT(state->exception_types);
     return 0;
 }
 
@@ -383,9 +497,1029 @@ PyObject *ETWCOMMON_write_mark(PyObject *module, PyObject *args)
         return NULL;
     }
 
-    event_name[cb_event_name / sizeof(wchar_t)] = L'\0';
+    // The name is UTF-16 even where wchar_t is wider
+    ((USHORT *)event_name)[cb_event_name / 2] = 0;
     WriteCustomEvent(event_name, opcode);
 
     Py_RETURN_NONE;
 }
+
+// Returns the ID for a stack, writing it if it has not been seen before, or
+// 0 if it could not be recorded.
+int ETWCOMMON_intern_stack(struct ETWCOMMON_STATE *state, const FUNC_ID *frames, int count)
+{
+    PyObject *key = PyBytes_FromStringAndSize((const char *)frames, count * sizeof(FUNC_ID));
+    if (!key) {
+        PyErr_Clear();
+        return 0;
+    }
+    int stack_id = 0;
+    PyObject *o_id = PyDict_GetItemWithError(state->stacks, key);
+    if (o_id) {
+        stack_id = (int)PyLong_AsLong(o_id);
+    } else if (!PyErr_Occurred()) {
+        stack_id = state->next_stack_id;
+        o_id = PyLong_FromLong(stack_id);
+        if (o_id && PyDict_SetItem(state->stacks, key, o_id) == 0) {
+            state->next_stack_id += 1;
+            WriteStack(stack_id, frames, count);
+        } else {
+            stack_id = 0;
+        }
+        Py_XDECREF(o_id);
+    }
+    Py_DECREF(key);
+    PyErr_Clear();
+    return stack_id;
+}
+
+// Copies str into a buffer of UTF-16 (even where wchar_t is wider), which
+// is truncated to fit. Most names are Latin-1 or UCS-2, and these are copied
+// directly rather than encoded.
+static int to_utf16(PyObject *str, USHORT *buffer, Py_ssize_t size)
+{
+    Py_ssize_t len = PyUnicode_GET_LENGTH(str);
+    int kind = PyUnicode_KIND(str);
+    if (kind == PyUnicode_1BYTE_KIND || kind == PyUnicode_2BYTE_KIND) {
+        if (len > size - 1) {
+            len = size - 1;
+        }
+        const void *data = PyUnicode_DATA(str);
+        for (Py_ssize_t i = 0; i < len; ++i) {
+            buffer[i] = (USHORT)PyUnicode_READ(kind, data, i);
+        }
+        buffer[len] = 0;
+        return 0;
+    }
+    PyObject *encoded = PyUnicode_AsEncodedString(str, "utf-16-le", "surrogatepass");
+    if (!encoded) {
+        return -1;
+    }
+    len = PyBytes_GET_SIZE(encoded) / 2;
+    if (len > size - 1) {
+        len = size - 1;
+        // Do not split a surrogate pair
+        if ((((USHORT *)PyBytes_AS_STRING(encoded))[len - 1] & 0xFC00) == 0xD800) {
+            --len;
+        }
+    }
+    memcpy(buffer, PyBytes_AS_STRING(encoded), len * 2);
+    buffer[len] = 0;
+    Py_DECREF(encoded);
+    return 0;
+}
+
+PyObject *ETWCOMMON_write_task_create(PyObject *module, PyObject *args)
+{
+    unsigned long long task_id, parent_id;
+    PyObject *name;
+    USHORT buffer[256];
+    if (!PyArg_ParseTuple(args, "KKU:write_task_create", &task_id, &parent_id, &name)) {
+        return NULL;
+    }
+    if (to_utf16(name, buffer, sizeof(buffer) / sizeof(buffer[0])) < 0) {
+        return NULL;
+    }
+
+    WriteTaskCreate(task_id, parent_id, (LPCWSTR)buffer);
+
+    Py_RETURN_NONE;
+}
+
+PyObject *ETWCOMMON_write_task_step(PyObject *module, PyObject *args)
+{
+    unsigned long long task_id, awaiting_id = 0;
+    int opcode, done = 0;
+    if (!PyArg_ParseTuple(args, "Ki|Kp:write_task_step", &task_id, &opcode, &awaiting_id, &done)) {
+        return NULL;
+    }
+
+    WriteTaskStep(task_id, opcode, awaiting_id, done);
+
+    Py_RETURN_NONE;
+}
+
+PyObject *ETWCOMMON_write_callback(PyObject *module, PyObject *args)
+{
+    PyObject *name;
+    int opcode;
+    USHORT buffer[256];
+    if (!PyArg_ParseTuple(args, "Ui:write_callback", &name, &opcode)) {
+        return NULL;
+    }
+    if (to_utf16(name, buffer, sizeof(buffer) / sizeof(buffer[0])) < 0) {
+        return NULL;
+    }
+
+    WriteCallback((LPCWSTR)buffer, opcode);
+
+    Py_RETURN_NONE;
+}
+
+PyObject *ETWCOMMON_write_import(PyObject *module, PyObject *args)
+{
+    PyObject *name, *detail;
+    int opcode;
+    USHORT name_buffer[256];
+    USHORT detail_buffer[256];
+    if (!PyArg_ParseTuple(args, "UiU:write_import", &name, &opcode, &detail)) {
+        return NULL;
+    }
+    if (to_utf16(name, name_buffer, sizeof(name_buffer) / sizeof(name_buffer[0])) < 0 ||
+        to_utf16(detail, detail_buffer, sizeof(detail_buffer) / sizeof(detail_buffer[0])) < 0) {
+        return NULL;
+    }
+
+    WriteImport(opcode, (LPCWSTR)name_buffer, (LPCWSTR)detail_buffer);
+
+    Py_RETURN_NONE;
+}
+
+// The activity that the current thread is working on, which is also set as
+// the thread's activity ID by the ETW sink.
+static THREAD_LOCAL GUID current_activity;
+static THREAD_LOCAL int has_current_activity;
+
+static void create_activity_id(GUID *id)
+{
+#ifdef _WIN32
+    EventActivityIdControl(EVENT_ACTIVITY_CTRL_CREATE_ID, id);
+#else
+    // Unique within the process, and unlikely to collide with other
+    // processes. Only called while holding the GIL.
+    static uint32_t seed;
+    static uint64_t counter;
+    if (!seed) {
+        seed = (uint32_t)time(NULL) ^ ((uint32_t)clock() << 16) ^ 1;
+    }
+    uint64_t n = ++counter;
+    id->Data1 = (uint32_t)GetCurrentProcessId();
+    id->Data2 = (uint16_t)(seed >> 16);
+    id->Data3 = (uint16_t)seed;
+    for (int i = 7; i >= 0; --i) {
+        id->Data4[i] = (uint8_t)n;
+        n >>= 8;
+    }
+#endif
+}
+
+static PyObject *current_activity_bytes(void)
+{
+    if (!has_current_activity) {
+        Py_RETURN_NONE;
+    }
+    return PyBytes_FromStringAndSize((const char *)&current_activity, sizeof(GUID));
+}
+
+static int parse_activity_id(const char *data, Py_ssize_t size, GUID *id)
+{
+    if (size != sizeof(GUID)) {
+        PyErr_SetString(PyExc_ValueError, "activity ID must be 16 bytes");
+        return -1;
+    }
+    memcpy(id, data, sizeof(GUID));
+    return 0;
+}
+
+PyObject *ETWCOMMON_start_activity(PyObject *module, PyObject *args)
+{
+    PyObject *name;
+    const char *related = NULL;
+    Py_ssize_t cb_related = 0;
+    GUID related_id;
+    USHORT buffer[256];
+    if (!PyArg_ParseTuple(args, "U|z#:start_activity", &name, &related, &cb_related)) {
+        return NULL;
+    }
+    if (related && parse_activity_id(related, cb_related, &related_id) < 0) {
+        return NULL;
+    }
+    if (to_utf16(name, buffer, sizeof(buffer) / sizeof(buffer[0])) < 0) {
+        return NULL;
+    }
+
+    GUID id;
+    create_activity_id(&id);
+    WriteActivity(1, &id, related ? &related_id : NULL, (LPCWSTR)buffer);
+    current_activity = id;
+    has_current_activity = 1;
+
+    return PyBytes_FromStringAndSize((const char *)&id, sizeof(GUID));
+}
+
+PyObject *ETWCOMMON_stop_activity(PyObject *module, PyObject *args)
+{
+    const char *activity, *restore = NULL;
+    Py_ssize_t cb_activity, cb_restore = 0;
+    GUID id, restore_id;
+    if (!PyArg_ParseTuple(args, "y#|z#:stop_activity", &activity, &cb_activity, &restore, &cb_restore)) {
+        return NULL;
+    }
+    if (parse_activity_id(activity, cb_activity, &id) < 0 ||
+        (restore && parse_activity_id(restore, cb_restore, &restore_id) < 0)) {
+        return NULL;
+    }
+
+    WriteActivity(2, &id, restore ? &restore_id : NULL, NULL);
+    if (restore) {
+        current_activity = restore_id;
+    }
+    has_current_activity = restore != NULL;
+
+    Py_RETURN_NONE;
+}
+
+PyObject *ETWCOMMON_switch_activity(PyObject *module, PyObject *args)
+{
+    const char *activity = NULL;
+    Py_ssize_t cb_activity = 0;
+    GUID id;
+    if (!PyArg_ParseTuple(args, "z#:switch_activity", &activity, &cb_activity)) {
+        return NULL;
+    }
+    if (activity && parse_activity_id(activity, cb_activity, &id) < 0) {
+        return NULL;
+    }
+
+    PyObject *previous = current_activity_bytes();
+    if (!previous) {
+        return NULL;
+    }
+    if (activity && has_current_activity && !memcmp(&id, &current_activity, sizeof(GUID))) {
+        return previous;
+    }
+    if (!activity && !has_current_activity) {
+        return previous;
+    }
+    if (has_current_activity) {
+        WriteActivity(8, &current_activity, NULL, NULL);
+    }
+    if (activity) {
+        WriteActivity(7, &id, NULL, NULL);
+        current_activity = id;
+    }
+    has_current_activity = activity != NULL;
+
+    return previous;
+}
+
+// In 100ns units, like the event timestamps
+static DWORD64 gc_clock(void)
+{
+#ifdef _WIN32
+    static LARGE_INTEGER frequency;
+    LARGE_INTEGER now;
+    if (!frequency.QuadPart) {
+        QueryPerformanceFrequency(&frequency);
+    }
+    QueryPerformanceCounter(&now);
+    return (DWORD64)(now.QuadPart / frequency.QuadPart * 10000000
+        + now.QuadPart % frequency.QuadPart * 10000000 / frequency.QuadPart);
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (DWORD64)ts.tv_sec * 10000000 + (DWORD64)ts.tv_nsec / 100;
+#endif
+}
+
+static THREAD_LOCAL DWORD64 gc_start;
+
+static Py_ssize_t get_gc_info(PyObject *info, const char *key)
+{
+    PyObject *value = PyDict_GetItemString(info, key);
+    if (!value) {
+        return 0;
+    }
+    Py_ssize_t n = PyLong_AsSsize_t(value);
+    if (n < 0) {
+        PyErr_Clear();
+        return 0;
+    }
+    return n;
+}
+
+PyObject *ETWCOMMON_gc_callback(PyObject *module, PyObject *args)
+{
+    PyObject *phase, *info;
+    if (!PyArg_ParseTuple(args, "UO!:gc_callback", &phase, &PyDict_Type, &info)) {
+        return NULL;
+    }
+
+    int generation = (int)get_gc_info(info, "generation");
+    if (PyUnicode_CompareWithASCIIString(phase, "start") == 0) {
+        gc_start = gc_clock();
+        WriteGC(1, generation, 0, 0, 0);
+    } else if (PyUnicode_CompareWithASCIIString(phase, "stop") == 0) {
+        // A collection that started before tracing has no duration
+        DWORD64 duration = gc_start ? gc_clock() - gc_start : 0;
+        gc_start = 0;
+        WriteGC(2, generation, get_gc_info(info, "collected"),
+                get_gc_info(info, "uncollectable"), duration);
+    }
+
+    Py_RETURN_NONE;
+}
+
+
+// Returns the ID for an exception type, writing its name if it has not been
+// seen before, or 0 if it could not be recorded. Types outside builtins are
+// named with their module.
+static int intern_exception_type(struct ETWCOMMON_STATE *state, PyObject *type)
+{
+    PyObject *o_id = PyDict_GetItemWithError(state->exception_types, type);
+    if (o_id) {
+        return (int)PyLong_AsLong(o_id);
+    }
+    if (PyErr_Occurred()) {
+        PyErr_Clear();
+        return 0;
+    }
+
+    int type_id = 0;
+    USHORT buffer[256];
+    PyObject *name = NULL;
+    PyObject *module = PyObject_GetAttrString(type, "__module__");
+    PyObject *qualname = PyObject_GetAttrString(type, "__qualname__");
+    if (module && qualname && PyUnicode_Check(qualname)) {
+        if (PyUnicode_Check(module) && PyUnicode_CompareWithASCIIString(module, "builtins") != 0) {
+            name = PyUnicode_FromFormat("%U.%U", module, qualname);
+        } else {
+            name = qualname;
+            Py_INCREF(name);
+        }
+    }
+    if (name && to_utf16(name, buffer, sizeof(buffer) / sizeof(buffer[0])) == 0) {
+        o_id = PyLong_FromLong(state->next_exception_type_id);
+        if (o_id && PyDict_SetItem(state->exception_types, type, o_id) == 0) {
+            type_id = state->next_exception_type_id++;
+            WriteExceptionType(type_id, (LPCWSTR)buffer);
+        }
+        Py_XDECREF(o_id);
+    }
+    Py_XDECREF(name);
+    Py_XDECREF(qualname);
+    Py_XDECREF(module);
+    PyErr_Clear();
+    return type_id;
+}
+
+// Writes an exception event for the function running code, which was at
+// line. Returns -1 with an exception set if the function could not be
+// registered. Nothing is written for functions in ignored files.
+int ETWCOMMON_write_exception_event(struct ETWCOMMON_STATE *state, int opcode, PyObject *code, int line, PyObject *type)
+{
+    if (!state->func_table || !state->exception_types) {
+        return 0;
+    }
+    if (ETWCOMMON_is_internal_thread(state, PyThreadState_Get())) {
+        return 0;
+    }
+    FUNC_ID func_id = ETWCOMMON_find_or_register_code_object(state, code);
+    if (func_id == FUNC_ID_ERROR) {
+        return -1;
+    }
+    if (FUNC_ID_IS_VALID(func_id)) {
+        WriteException(opcode, intern_exception_type(state, type), func_id, line);
+    }
+    return 0;
+}
+
+// Key in the thread state dict for the traceback of the last function to
+// unwind on the thread. An exception that propagates into the caller is
+// raised there with this traceback as its tb_next, and a new exception never
+// has one. Holding a reference means that an exception swallowed by C code
+// after unwinding (such as by getattr() with a default) can never be
+// mistaken for a later one that reuses its memory, and keeping it in the
+// thread state dict releases it with the thread.
+static PyObject *unwound_key;
+
+// Returns 1 if a raise event for exc is the propagation of an exception out
+// of a function that has just unwound, and records the traceback of exc if
+// opcode is an unwind. Returns -1 with an exception set on failure.
+static int check_unwound(int opcode, PyObject *exc)
+{
+    PyObject *dict = PyThreadState_GetDict();
+    if (!dict) {
+        return 0;
+    }
+    if (!unwound_key) {
+        unwound_key = PyUnicode_InternFromString("etwtrace.unwound");
+        if (!unwound_key) {
+            return -1;
+        }
+    }
+    PyObject *unwound = PyDict_GetItemWithError(dict, unwound_key);
+    if (!unwound && PyErr_Occurred()) {
+        return -1;
+    }
+    PyObject *tb = PyException_GetTraceback(exc);
+    int propagated = opcode == 1 && unwound && tb
+        && (PyObject *)((PyTracebackObject *)tb)->tb_next == unwound;
+    int r = 0;
+    if (opcode == 11 && tb) {
+        r = PyDict_SetItem(dict, unwound_key, tb);
+    } else if (unwound) {
+        r = PyDict_DelItem(dict, unwound_key);
+    }
+    Py_XDECREF(tb);
+    return r < 0 ? -1 : propagated;
+}
+
+// Called by sys.monitoring with (code, offset, exception) for every raise,
+// reraise, handled exception and unwound frame, with the opcode for the
+// event bound as the first argument by _exceptiontrace.py. An exception is
+// also "raised" again in each function that it propagates into, and these
+// are left out so that only the original raise is written.
+PyObject *ETWCOMMON_write_exception(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    if (nargs != 4) {
+        PyErr_SetString(PyExc_TypeError, "write_exception() takes exactly 4 arguments");
+        return NULL;
+    }
+    int opcode = (int)PyLong_AsLong(args[0]);
+    int offset = (int)PyLong_AsLong(args[2]);
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+    if (!PyCode_Check(args[1])) {
+        PyErr_SetString(PyExc_TypeError, "write_exception() requires a code object");
+        return NULL;
+    }
+    if (!PyExceptionInstance_Check(args[3])) {
+        PyErr_SetString(PyExc_TypeError, "write_exception() requires an exception");
+        return NULL;
+    }
+    int propagated = check_unwound(opcode, args[3]);
+    if (propagated < 0) {
+        return NULL;
+    } else if (propagated) {
+        Py_RETURN_NONE;
+    }
+
+    struct ETWCOMMON_STATE *state = (struct ETWCOMMON_STATE *)PyModule_GetState(module);
+    int line = PyCode_Addr2Line((PyCodeObject *)args[1], offset);
+    // Handlers start with an instruction that has no line, so the line of
+    // the except clause is taken from the (two byte) instructions after it
+    for (int i = 1; line < 0 && opcode == 2 && i <= 4; ++i) {
+        line = PyCode_Addr2Line((PyCodeObject *)args[1], offset + i * 2);
+    }
+    // Cleanup blocks generated by the compiler have no lines at all, and
+    // only reraise the exception that was already reported
+    if (line < 0 && (opcode == 2 || opcode == 10)) {
+        Py_RETURN_NONE;
+    }
+    if (ETWCOMMON_write_exception_event(state, opcode, args[1], line, (PyObject *)Py_TYPE(args[3])) < 0) {
+        return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+// Allocation sampling
+//
+// While enabled, the PyMem and PyObject allocators are wrapped to count the
+// bytes allocated by all threads. When the count passes a threshold drawn
+// from an exponential distribution, the allocation is sampled and a new
+// threshold is drawn, so every byte is equally likely to be sampled (a
+// Poisson process) whatever the sizes of the allocations. A sample is
+// written with its size, an estimate of the bytes it stands for and the ID
+// of the thread's Python stack, which is interned with the stacks written
+// by SamplingTracer. When frees are tracked, sampled blocks are kept in a
+// hash set and freeing one of them is written too.
+//
+// Both domains are only used with the GIL held, which protects the count
+// and the hash set, so there is no per-thread state to look up on each
+// allocation. Allocations made while recording a sample are not sampled, and
+// garbage collection is disabled while recording so that no Python code
+// runs inside the allocator.
+
+#define ALLOC_TOMBSTONE ((void *)1)
+
+static struct {
+    struct ETWCOMMON_STATE *state;
+    PyMemAllocatorEx mem;
+    PyMemAllocatorEx obj;
+    int installed;
+    int enabled;
+    int track_frees;
+    double interval;
+    // Bytes to allocate before the next sample
+    long long remaining;
+    uint64_t random;
+    int in_hook;
+    // Open addressing hash set of sampled blocks that have not been freed
+    void **live;
+    size_t live_size;
+    size_t live_count;
+    size_t live_used;
+} alloc_hooks;
+
+static long long next_sample_distance(void)
+{
+    uint64_t x = alloc_hooks.random;
+    if (!x) {
+        x = (gc_clock() * 0x9E3779B97F4A7C15ULL) | 1;
+    }
+    // xorshift64*
+    x ^= x >> 12;
+    x ^= x << 25;
+    x ^= x >> 27;
+    alloc_hooks.random = x;
+    // Uniform in (0, 1]
+    double u = (double)(((x * 0x2545F4914F6CDD1DULL) >> 11) + 1) / 9007199254740992.0;
+    return (long long)(-log(u) * alloc_hooks.interval) + 1;
+}
+
+static size_t live_slot(void *ptr, size_t size)
+{
+    return (size_t)((((uint64_t)(uintptr_t)ptr >> 4) * 0x9E3779B97F4A7C15ULL) >> 20) & (size - 1);
+}
+
+static void remember_block(void *ptr)
+{
+    if ((alloc_hooks.live_used + 1) * 2 > alloc_hooks.live_size) {
+        // Rebuild without tombstones, and no more than a quarter full
+        size_t size = alloc_hooks.live_size ? alloc_hooks.live_size : 1024;
+        while (alloc_hooks.live_count * 4 >= size) {
+            size *= 2;
+        }
+        void **live = (void **)calloc(size, sizeof(void *));
+        if (!live) {
+            return;
+        }
+        for (size_t i = 0; i < alloc_hooks.live_size; ++i) {
+            void *p = alloc_hooks.live[i];
+            if (p && p != ALLOC_TOMBSTONE) {
+                size_t j = live_slot(p, size);
+                while (live[j]) {
+                    j = (j + 1) & (size - 1);
+                }
+                live[j] = p;
+            }
+        }
+        free(alloc_hooks.live);
+        alloc_hooks.live = live;
+        alloc_hooks.live_size = size;
+        alloc_hooks.live_used = alloc_hooks.live_count;
+    }
+    size_t mask = alloc_hooks.live_size - 1;
+    size_t i = live_slot(ptr, alloc_hooks.live_size);
+    while (alloc_hooks.live[i] && alloc_hooks.live[i] != ALLOC_TOMBSTONE) {
+        i = (i + 1) & mask;
+    }
+    if (!alloc_hooks.live[i]) {
+        alloc_hooks.live_used += 1;
+    }
+    alloc_hooks.live[i] = ptr;
+    alloc_hooks.live_count += 1;
+}
+
+static void forget_block(void *ptr)
+{
+    size_t mask = alloc_hooks.live_size - 1;
+    for (size_t i = live_slot(ptr, alloc_hooks.live_size); alloc_hooks.live[i]; i = (i + 1) & mask) {
+        if (alloc_hooks.live[i] == ptr) {
+            alloc_hooks.live[i] = ALLOC_TOMBSTONE;
+            alloc_hooks.live_count -= 1;
+            WriteAllocation(2, ptr, 0, 0, 0);
+            return;
+        }
+    }
+}
+
+static void sample_allocation(void *ptr, size_t size)
+{
+    if (alloc_hooks.in_hook) {
+        return;
+    }
+    alloc_hooks.remaining -= (long long)size;
+    if (alloc_hooks.remaining > 0) {
+        return;
+    }
+    alloc_hooks.remaining = next_sample_distance();
+
+#if PY_VERSION_HEX >= 0x030D0000
+    PyThreadState *tstate = PyThreadState_GetUnchecked();
+#else
+    PyThreadState *tstate = _PyThreadState_UncheckedGet();
+#endif
+    struct ETWCOMMON_STATE *state = alloc_hooks.state;
+    // Discarding the samples taken on internal threads leaves an unbiased
+    // estimate of the traced program's allocations
+    if (!tstate || !state || ETWCOMMON_is_internal_thread(state, tstate)) {
+        return;
+    }
+
+    alloc_hooks.in_hook = 1;
+    // The allocation may be made while an exception is set
+#if PY_VERSION_HEX >= 0x030C0000
+    PyObject *exc = PyErr_GetRaisedException();
+#else
+    PyObject *exc_type, *exc_value, *exc_tb;
+    PyErr_Fetch(&exc_type, &exc_value, &exc_tb);
+#endif
+#if PY_VERSION_HEX >= 0x030A0000
+    int gc_enabled = PyGC_Disable();
+#endif
+
+    FUNC_ID frames[ETWCOMMON_MAX_DEPTH];
+    int stack_id = 0;
+    if (state->func_table && state->stacks) {
+        int count = ETWCOMMON_get_stack(state, tstate, frames);
+        if (count) {
+            stack_id = ETWCOMMON_intern_stack(state, frames, count);
+        }
+    }
+
+#if PY_VERSION_HEX >= 0x030A0000
+    if (gc_enabled) {
+        PyGC_Enable();
+    }
+#endif
+#if PY_VERSION_HEX >= 0x030C0000
+    PyErr_SetRaisedException(exc);
+#else
+    PyErr_Restore(exc_type, exc_value, exc_tb);
+#endif
+
+    // An allocation of this size is sampled with probability
+    // 1 - exp(-size / interval), so it stands for size divided by that
+    double weight = (double)size / -expm1(-(double)size / alloc_hooks.interval);
+    WriteAllocation(1, ptr, (DWORD64)size, (DWORD64)weight, stack_id);
+    if (alloc_hooks.track_frees) {
+        remember_block(ptr);
+    }
+    alloc_hooks.in_hook = 0;
+}
+
+static void *alloc_hook_malloc(void *ctx, size_t size)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *)ctx;
+    void *ptr = alloc->malloc(alloc->ctx, size);
+    if (ptr && alloc_hooks.enabled) {
+        sample_allocation(ptr, size);
+    }
+    return ptr;
+}
+
+static void *alloc_hook_calloc(void *ctx, size_t nelem, size_t elsize)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *)ctx;
+    void *ptr = alloc->calloc(alloc->ctx, nelem, elsize);
+    if (ptr && alloc_hooks.enabled) {
+        sample_allocation(ptr, nelem * elsize);
+    }
+    return ptr;
+}
+
+// Resizing is treated as freeing the old block and allocating the new one
+static void *alloc_hook_realloc(void *ctx, void *ptr, size_t new_size)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *)ctx;
+    void *new_ptr = alloc->realloc(alloc->ctx, ptr, new_size);
+    if (new_ptr && alloc_hooks.enabled) {
+        if (ptr && alloc_hooks.live_count) {
+            forget_block(ptr);
+        }
+        sample_allocation(new_ptr, new_size);
+    }
+    return new_ptr;
+}
+
+static void alloc_hook_free(void *ctx, void *ptr)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *)ctx;
+    if (ptr && alloc_hooks.live_count) {
+        forget_block(ptr);
+    }
+    alloc->free(alloc->ctx, ptr);
+}
+
+static void stop_allocations(void)
+{
+    alloc_hooks.enabled = 0;
+    alloc_hooks.state = NULL;
+    free(alloc_hooks.live);
+    alloc_hooks.live = NULL;
+    alloc_hooks.live_size = alloc_hooks.live_count = alloc_hooks.live_used = 0;
+    if (!alloc_hooks.installed) {
+        return;
+    }
+    // When another hook (such as tracemalloc) has been installed over ours,
+    // it still calls through our wrappers, so they are left in place
+    PyMemAllocatorEx mem, obj;
+    PyMem_GetAllocator(PYMEM_DOMAIN_MEM, &mem);
+    PyMem_GetAllocator(PYMEM_DOMAIN_OBJ, &obj);
+    if (mem.malloc == alloc_hook_malloc && mem.ctx == &alloc_hooks.mem
+        && obj.malloc == alloc_hook_malloc && obj.ctx == &alloc_hooks.obj) {
+        PyMem_SetAllocator(PYMEM_DOMAIN_MEM, &alloc_hooks.mem);
+        PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, &alloc_hooks.obj);
+        alloc_hooks.installed = 0;
+    }
+}
+
+static void forget_allocation_state(struct ETWCOMMON_STATE *state)
+{
+    if (alloc_hooks.state == state) {
+        stop_allocations();
+    }
+}
+
+PyObject *ETWCOMMON_enable_allocations(PyObject *module, PyObject *args)
+{
+    double interval = 512 * 1024;
+    int track_frees = 1;
+    if (!PyArg_ParseTuple(args, "|dp:enable_allocations", &interval, &track_frees)) {
+        return NULL;
+    }
+#ifdef Py_GIL_DISABLED
+    PyErr_SetString(PyExc_RuntimeError, "allocation sampling requires the GIL");
+    return NULL;
+#else
+    if (!(interval >= 1)) {
+        PyErr_SetString(PyExc_ValueError, "interval must be at least 1 byte");
+        return NULL;
+    }
+    if (alloc_hooks.enabled) {
+        PyErr_SetString(PyExc_RuntimeError, "allocation sampling is already enabled");
+        return NULL;
+    }
+    struct ETWCOMMON_STATE *state = (struct ETWCOMMON_STATE *)PyModule_GetState(module);
+    if (!state || !state->func_table || !state->stacks) {
+        PyErr_SetString(PyExc_RuntimeError, "tracing is not enabled");
+        return NULL;
+    }
+
+    alloc_hooks.state = state;
+    alloc_hooks.interval = interval;
+    alloc_hooks.track_frees = track_frees;
+    alloc_hooks.remaining = next_sample_distance();
+    if (!alloc_hooks.installed) {
+        PyMem_GetAllocator(PYMEM_DOMAIN_MEM, &alloc_hooks.mem);
+        PyMem_GetAllocator(PYMEM_DOMAIN_OBJ, &alloc_hooks.obj);
+        PyMemAllocatorEx hook = {
+            NULL, alloc_hook_malloc, alloc_hook_calloc, alloc_hook_realloc, alloc_hook_free
+        };
+        hook.ctx = &alloc_hooks.mem;
+        PyMem_SetAllocator(PYMEM_DOMAIN_MEM, &hook);
+        hook.ctx = &alloc_hooks.obj;
+        PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, &hook);
+        alloc_hooks.installed = 1;
+    }
+    alloc_hooks.enabled = 1;
+
+    Py_RETURN_NONE;
+#endif
+}
+
+PyObject *ETWCOMMON_disable_allocations(PyObject *module, PyObject *args)
+{
+    if (!alloc_hooks.enabled || alloc_hooks.state != PyModule_GetState(module)) {
+        PyErr_SetString(PyExc_RuntimeError, "allocation sampling was not enabled");
+        return NULL;
+    }
+    stop_allocations();
+    Py_RETURN_NONE;
+}
+
+// Metrics
+//
+// Counters, gauges and histograms are aggregated by metric objects that
+// _metrictrace.py creates for each metric while tracing is enabled. Their
+// methods are called directly, so an update costs little more than the
+// call, and nothing is written until ETWCOMMON_write_metrics writes a
+// summary of the updates to each metric since its previous summary. The GIL
+// protects the totals, and free-threaded builds lock the metric instead.
+
+enum { METRIC_COUNTER = 1, METRIC_GAUGE = 2, METRIC_HISTOGRAM = 3 };
+
+// Histograms are log-linear: each power of two from 2**-64 to 2**64 is
+// split into 16 equal buckets, so values are kept to within 1/16 of their
+// size in a fixed amount of memory. Zero and negative values are counted in
+// the first bucket and larger values in the last. _metrics.py uses the same
+// layout to read them.
+#define HISTOGRAM_SUB_BUCKETS 16
+#define HISTOGRAM_MIN_EXPONENT (-63)
+#define HISTOGRAM_BUCKETS (128 * HISTOGRAM_SUB_BUCKETS)
+
+struct METRIC {
+    PyObject_HEAD
+    int id;
+    int kind;
+    // Updates since the previous summary
+    DWORD count;
+    double sum;
+    double min;
+    double max;
+    // The current value of a gauge, which carries over between summaries
+    double value;
+    // Counts for each bucket of a histogram, or NULL for other kinds
+    DWORD *buckets;
+};
+
+static inline void metric_update(struct METRIC *m, double value)
+{
+    if (!m->count || value < m->min) {
+        m->min = value;
+    }
+    if (!m->count || value > m->max) {
+        m->max = value;
+    }
+    m->count += 1;
+    m->sum += value;
+}
+
+static int histogram_bucket(double value)
+{
+    if (!(value > 0)) {
+        return 0;
+    }
+    if (isinf(value)) {
+        return HISTOGRAM_BUCKETS - 1;
+    }
+    int exponent;
+    double mantissa = frexp(value, &exponent);
+    int bucket = (exponent - HISTOGRAM_MIN_EXPONENT) * HISTOGRAM_SUB_BUCKETS
+        + (int)((mantissa - 0.5) * (2 * HISTOGRAM_SUB_BUCKETS));
+    if (bucket < 0) {
+        return 0;
+    }
+    return bucket < HISTOGRAM_BUCKETS ? bucket : HISTOGRAM_BUCKETS - 1;
+}
+
+static int metric_value(PyObject *arg, double *value)
+{
+    // Exact ints and floats are converted without allocating
+    if (PyFloat_CheckExact(arg)) {
+        *value = PyFloat_AS_DOUBLE(arg);
+        return 0;
+    }
+    *value = PyLong_CheckExact(arg) ? PyLong_AsDouble(arg) : PyFloat_AsDouble(arg);
+    return (*value == -1.0 && PyErr_Occurred()) ? -1 : 0;
+}
+
+static PyObject *metric_add(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct METRIC *m = (struct METRIC *)self;
+    double value = 1.0;
+    if (nargs > 1) {
+        PyErr_SetString(PyExc_TypeError, "add() takes at most 1 argument");
+        return NULL;
+    }
+    if (nargs == 1 && metric_value(args[0], &value) < 0) {
+        return NULL;
+    }
+    Py_BEGIN_CRITICAL_SECTION(self);
+    if (m->kind == METRIC_GAUGE) {
+        m->value += value;
+        metric_update(m, m->value);
+    } else {
+        metric_update(m, value);
+    }
+    Py_END_CRITICAL_SECTION();
+    Py_RETURN_NONE;
+}
+
+static PyObject *metric_set(PyObject *self, PyObject *arg)
+{
+    struct METRIC *m = (struct METRIC *)self;
+    double value;
+    if (metric_value(arg, &value) < 0) {
+        return NULL;
+    }
+    Py_BEGIN_CRITICAL_SECTION(self);
+    m->value = value;
+    metric_update(m, value);
+    Py_END_CRITICAL_SECTION();
+    Py_RETURN_NONE;
+}
+
+static PyObject *metric_record(PyObject *self, PyObject *arg)
+{
+    struct METRIC *m = (struct METRIC *)self;
+    double value;
+    if (metric_value(arg, &value) < 0) {
+        return NULL;
+    }
+    Py_BEGIN_CRITICAL_SECTION(self);
+    metric_update(m, value);
+    if (m->buckets) {
+        m->buckets[histogram_bucket(value)] += 1;
+    }
+    Py_END_CRITICAL_SECTION();
+    Py_RETURN_NONE;
+}
+
+static void metric_dealloc(PyObject *self)
+{
+    PyMem_Free(((struct METRIC *)self)->buckets);
+    Py_TYPE(self)->tp_free(self);
+}
+
+static PyMethodDef metric_methods[] = {
+    { "add", (PyCFunction)metric_add, METH_FASTCALL,
+      "Adds value (default 1) to a counter, or to the value of a gauge." },
+    { "set", metric_set, METH_O,
+      "Sets the value of a gauge." },
+    { "record", metric_record, METH_O,
+      "Records a value in a histogram." },
+    { NULL, NULL, 0, NULL }
+};
+
+static PyTypeObject MetricType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "etwtrace.Metric",
+    .tp_basicsize = sizeof(struct METRIC),
+    .tp_dealloc = metric_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "Aggregates updates to a metric until they are written.",
+    .tp_methods = metric_methods,
+};
+
+PyObject *ETWCOMMON_create_metric(PyObject *module, PyObject *args)
+{
+    int metric_id, kind;
+    PyObject *name;
+    USHORT buffer[256];
+    if (!PyArg_ParseTuple(args, "iiU:create_metric", &metric_id, &kind, &name)) {
+        return NULL;
+    }
+    if (kind < METRIC_COUNTER || kind > METRIC_HISTOGRAM) {
+        PyErr_Format(PyExc_ValueError, "unknown metric kind %d", kind);
+        return NULL;
+    }
+    if (to_utf16(name, buffer, sizeof(buffer) / sizeof(buffer[0])) < 0) {
+        return NULL;
+    }
+    if (PyType_Ready(&MetricType) < 0) {
+        return NULL;
+    }
+    struct METRIC *m = PyObject_New(struct METRIC, &MetricType);
+    if (!m) {
+        return NULL;
+    }
+    m->id = metric_id;
+    m->kind = kind;
+    m->count = 0;
+    m->sum = m->min = m->max = m->value = 0.0;
+    m->buckets = NULL;
+    if (kind == METRIC_HISTOGRAM) {
+        m->buckets = (DWORD *)PyMem_Calloc(HISTOGRAM_BUCKETS, sizeof(DWORD));
+        if (!m->buckets) {
+            Py_DECREF(m);
+            return PyErr_NoMemory();
+        }
+    }
+
+    WriteMetricInfo(metric_id, kind, (LPCWSTR)buffer);
+    return (PyObject *)m;
+}
+
+PyObject *ETWCOMMON_write_metrics(PyObject *module, PyObject *metrics)
+{
+    PyObject *seq = PySequence_Fast(metrics, "write_metrics() requires a sequence of metrics");
+    if (!seq) {
+        return NULL;
+    }
+    // Pairs of bucket index and count, allocated for the first histogram
+    DWORD *pairs = NULL;
+    PyObject *result = Py_None;
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(seq); ++i) {
+        PyObject *o = PySequence_Fast_GET_ITEM(seq, i);
+        if (Py_TYPE(o) != &MetricType) {
+            PyErr_SetString(PyExc_TypeError, "write_metrics() requires a sequence of metrics");
+            result = NULL;
+            break;
+        }
+        struct METRIC *m = (struct METRIC *)o;
+        if (m->buckets && !pairs) {
+            pairs = (DWORD *)PyMem_Malloc(2 * HISTOGRAM_BUCKETS * sizeof(DWORD));
+            if (!pairs) {
+                PyErr_NoMemory();
+                result = NULL;
+                break;
+            }
+        }
+        Py_BEGIN_CRITICAL_SECTION(o);
+        if (m->count) {
+            int pair_count = 0;
+            for (int b = 0; m->buckets && b < HISTOGRAM_BUCKETS; ++b) {
+                if (m->buckets[b]) {
+                    pairs[2 * pair_count] = (DWORD)b;
+                    pairs[2 * pair_count + 1] = m->buckets[b];
+                    m->buckets[b] = 0;
+                    ++pair_count;
+                }
+            }
+            WriteMetric(m->id, m->count, m->sum, m->min, m->max, m->value, pairs, pair_count);
+            m->count = 0;
+            m->sum = m->min = m->max = 0.0;
+        }
+        Py_END_CRITICAL_SECTION();
+    }
+    PyMem_Free(pairs);
+    Py_DECREF(seq);
+    Py_XINCREF(result);
+    return result;
+}
 #endif
@@ -37,6 +37,15 @@ static inline PyObject *PyUnstable_InterpreterFrame_GetCode(FRAME_OBJECT *frame)
 #endif
 
 
+#ifndef Py_BEGIN_CRITICAL_SECTION
+
+// Only needed for free-threaded builds, which are 3.13 and later
+#define Py_BEGIN_CRITICAL_SECTION(op) {
+#define Py_END_CRITICAL_SECTION() }
+
+#endif
+
+
 #if PY_VERSION_HEX < 0x030C0000
 
 static inline Py_ssize_t PyUnstable_Eval_RequestCodeExtraIndex(freefunc f) {
@@ -56,6 +65,14 @@ static inline int PyUnstable_Code_SetExtra(PyObject *code, Py_ssize_t index, voi
 #endif
 
 
+// Deeper stacks keep their innermost frames
+#define ETWCOMMON_MAX_DEPTH 256
+
+// Threads that etwtrace starts for itself
+#define ETWCOMMON_MAX_INTERNAL_THREADS 8
+
+
+// Every tracer module's state starts with this struct
 struct ETWCOMMON_STATE {
     // Fields for the owner to set/use directly
     FUNC_ID (*get_new_func_id)(
@@ -75,6 +92,18 @@ struct ETWCOMMON_STATE {
     PyObject *ignored_files;
     FUNC_ID next_func_id;
     Py_ssize_t co_extra_index;
+    // Maps stacks of function IDs to the IDs they were written with, and is
+    // cleared along with func_table
+    PyObject *stacks;
+    int next_stack_id;
+    // Maps exception types to the IDs they were written with, and is
+    // cleared along with func_table
+    PyObject *exception_types;
+    int next_exception_type_id;
+    // Threads started by etwtrace, which are not sampled and whose
+    // allocations and exceptions are not written
+    PyThreadState *internal_threads[ETWCOMMON_MAX_INTERNAL_THREADS];
+    int internal_thread_count;
 };
 
 int ETWCOMMON_Init(struct ETWCOMMON_STATE *state, void *owner);
@@ -85,5 +114,29 @@ int ETWCOMMON_Visit(struct ETWCOMMON_STATE *state, visitproc visit, void *arg);
 FUNC_ID ETWCOMMON_ClaimFuncId(struct ETWCOMMON_STATE *state, PyObject *key, FUNC_ID func_id);
 FUNC_ID ETWCOMMON_find_or_register_code_object(struct ETWCOMMON_STATE *state, PyObject *code);
 FUNC_ID ETWCOMMON_find_or_register_callable(struct ETWCOMMON_STATE *state, PyObject *code);
+int ETWCOMMON_get_stack(struct ETWCOMMON_STATE *state, PyThreadState *tstate, FUNC_ID *frames);
+int ETWCOMMON_intern_stack(struct ETWCOMMON_STATE *state, const FUNC_ID *frames, int count);
+int ETWCOMMON_write_exception_event(struct ETWCOMMON_STATE *state, int opcode, PyObject *code, int line, PyObject *type);
+int ETWCOMMON_is_internal_thread(struct ETWCOMMON_STATE *state, PyThreadState *tstate);
 
 PyObject *ETWCOMMON_write_mark(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_write_task_create(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_write_task_step(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_write_callback(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_write_import(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_start_activity(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_stop_activity(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_switch_activity(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_gc_callback(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_enable_allocations(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_disable_allocations(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_write_exception(PyObject *module, PyObject *const *args, Py_ssize_t nargs);
+PyObject *ETWCOMMON_create_metric(PyObject *module, PyObject *args);
+PyObject *ETWCOMMON_write_metrics(PyObject *module, PyObject *metrics);
+PyObject *ETWCOMMON_set_internal_thread(PyObject *module, PyObject *args);
+
+// Implemented in _filesink.c
+PyObject *FILESINK_set_output(PyObject *module, PyObject *args);
+PyObject *FILESINK_start_listener(PyObject *module, PyObject *args);
+PyObject *FILESINK_read_listener(PyObject *module, PyObject *args);
+PyObject *FILESINK_stop_listener(PyObject *module, PyObject *args);
@@ -1,4 +1,4 @@
-#include <Windows.h>
+#include "_platform.h"
 #include <assert.h>
 
 #include "_etwcommon.h"
@@ -8,6 +8,7 @@ const SIZE_T CHUNK_LEN = 1020;
 
 struct ETWINSTRUMENT_STATE {
     struct ETWCOMMON_STATE common;
+    int trace_exceptions;
 };
 
 
@@ -35,6 +36,7 @@ static int tracefunc(PyObject *module, PyFrameObject *frame, int what, PyObject
             }
         } else {
             from_thunk = FUNC_ID_NOT_FOUND;
+            from_line = 0;
         }
         if (what == PyTrace_CALL) {
             code_obj = (PyObject *)PyFrame_GetCode(frame);
@@ -73,6 +75,81 @@ static int tracefunc(PyObject *module, PyFrameObject *frame, int what, PyObject
 }
 
 
+#if PY_VERSION_HEX < 0x030C0000
+
+// Without sys.monitoring, exceptions are only passed to trace functions, so
+// one is installed alongside the profile function while exception events are
+// enabled, and turns off line events for each frame. Each frame that an
+// exception reaches adds an entry to its traceback, so a traceback with more
+// than one entry means that the function it came from has unwound.
+// Reraising and handling an exception are not reported.
+static int exceptiontracefunc(PyObject *module, PyFrameObject *frame, int what, PyObject *arg)
+{
+    struct ETWINSTRUMENT_STATE *state = PyModule_GetState(module);
+    if (!state->trace_exceptions) {
+        // Disabled on another thread
+        PyEval_SetTrace(NULL, NULL);
+        return 0;
+    }
+    if (what == PyTrace_CALL || what == PyTrace_LINE) {
+        frame->f_trace_lines = 0;
+        return 0;
+    }
+    if (what != PyTrace_EXCEPTION || !PyTuple_Check(arg) || PyTuple_GET_SIZE(arg) != 3) {
+        return 0;
+    }
+
+    PyObject *tb = PyTuple_GET_ITEM(arg, 2);
+    PyTracebackObject *callee = PyTraceBack_Check(tb) ? ((PyTracebackObject *)tb)->tb_next : NULL;
+    if (callee) {
+        // Raising an exception that was caught earlier keeps its traceback
+        PyFrameObject *back = PyFrame_GetBack(callee->tb_frame);
+        if (back != frame) {
+            callee = NULL;
+        }
+        Py_XDECREF(back);
+    }
+    PyObject *code_obj;
+    int opcode, line;
+    if (callee) {
+        opcode = 11;
+        code_obj = (PyObject *)PyFrame_GetCode(callee->tb_frame);
+        line = callee->tb_lineno;
+        if (line < 0) {
+            // Calculated on first use since 3.11
+            line = PyCode_Addr2Line((PyCodeObject *)code_obj, callee->tb_lasti);
+        }
+    } else {
+        opcode = 1;
+        code_obj = (PyObject *)PyFrame_GetCode(frame);
+        line = PyFrame_GetLineNumber(frame);
+    }
+    int r = ETWCOMMON_write_exception_event(&state->common, opcode, code_obj, line, PyTuple_GET_ITEM(arg, 0));
+    Py_DECREF(code_obj);
+    return r;
+}
+
+
+static PyObject *etwinstrument_enable_exceptions(PyObject *module, PyObject *args)
+{
+    struct ETWINSTRUMENT_STATE *state = PyModule_GetState(module);
+    state->trace_exceptions = 1;
+    PyEval_SetTrace(exceptiontracefunc, module);
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *etwinstrument_disable_exceptions(PyObject *module, PyObject *args)
+{
+    struct ETWINSTRUMENT_STATE *state = PyModule_GetState(module);
+    state->trace_exceptions = 0;
+    PyEval_SetTrace(NULL, NULL);
+    Py_RETURN_NONE;
+}
+
+#endif
+
+
 static PyObject *etwinstrument_enable(PyObject *module, PyObject *args)
 {
     int and_threads = 1;
@@ -139,6 +216,12 @@ static PyObject *etwinstrument_enable_thread(PyObject *module, PyObject *args)
     Register();
     WriteBeginThread(GetCurrentThreadId());
     PyEval_SetProfile(tracefunc, module);
+#if PY_VERSION_HEX < 0x030C0000
+    struct ETWINSTRUMENT_STATE *state = PyModule_GetState(module);
+    if (state->trace_exceptions) {
+        PyEval_SetTrace(exceptiontracefunc, module);
+    }
+#endif
 
     Py_RETURN_NONE;
 }
@@ -248,6 +331,48 @@ static struct PyMethodDef etwinstrument_methods[] = {
       "Enables tracing, optionally for all created threads and interpreters." },
     { "write_mark", ETWCOMMON_write_mark, METH_VARARGS,
       "Write a custom mark into the trace." },
+    { "write_task_create", ETWCOMMON_write_task_create, METH_VARARGS,
+      "Write the creation of an asyncio task into the trace." },
+    { "write_task_step", ETWCOMMON_write_task_step, METH_VARARGS,
+      "Write the start or end of a step of an asyncio task into the trace." },
+    { "write_callback", ETWCOMMON_write_callback, METH_VARARGS,
+      "Write the start or end of an event loop callback into the trace." },
+    { "write_import", ETWCOMMON_write_import, METH_VARARGS,
+      "Write the start or end of a module import into the trace." },
+    { "start_activity", ETWCOMMON_start_activity, METH_VARARGS,
+      "Starts a new activity on this thread and returns its ID." },
+    { "stop_activity", ETWCOMMON_stop_activity, METH_VARARGS,
+      "Stops an activity and optionally returns this thread to another." },
+    { "switch_activity", ETWCOMMON_switch_activity, METH_VARARGS,
+      "Switches this thread to another activity (or none) and returns the previous one." },
+    { "gc_callback", ETWCOMMON_gc_callback, METH_VARARGS,
+      "Writes garbage collections into the trace when added to gc.callbacks." },
+    { "enable_allocations", ETWCOMMON_enable_allocations, METH_VARARGS,
+      "Starts sampling allocations about every interval bytes, optionally tracking frees." },
+    { "disable_allocations", ETWCOMMON_disable_allocations, METH_NOARGS,
+      "Stops sampling allocations." },
+    { "write_exception", (PyCFunction)ETWCOMMON_write_exception, METH_FASTCALL,
+      "Writes an exception event into the trace when called by sys.monitoring." },
+    { "create_metric", ETWCOMMON_create_metric, METH_VARARGS,
+      "Writes the metric's kind and name and returns an object that aggregates its updates." },
+    { "write_metrics", ETWCOMMON_write_metrics, METH_O,
+      "Writes a summary of each metric's updates since the previous summary." },
+    { "set_internal_thread", ETWCOMMON_set_internal_thread, METH_VARARGS,
+      "Leaves this thread out of samples, allocations and exceptions while set, for etwtrace's own threads." },
+#if PY_VERSION_HEX < 0x030C0000
+    { "enable_exceptions", etwinstrument_enable_exceptions, METH_NOARGS,
+      "Starts writing exception events on this thread and new threads." },
+    { "disable_exceptions", etwinstrument_disable_exceptions, METH_NOARGS,
+      "Stops writing exception events." },
+#endif
+    { "set_output", FILESINK_set_output, METH_VARARGS,
+      "Writes events to a file instead of ETW until called with None." },
+    { "start_listener", FILESINK_start_listener, METH_VARARGS,
+      "Queues up to the given number of bytes of events with the given keywords for subscribers." },
+    { "read_listener", FILESINK_read_listener, METH_VARARGS,
+      "Returns the events queued for subscribers and the number dropped, and changes the keywords queued." },
+    { "stop_listener", FILESINK_stop_listener, METH_NOARGS,
+      "Stops queueing events for subscribers and returns the last of them." },
     { "get_ignored_files", etwinstrument_get_ignored_files, METH_NOARGS,
       "Returns a reference to the set containing filenames to ignore" },
     { "get_include_prefixes", etwinstrument_get_include_prefix, METH_NOARGS,
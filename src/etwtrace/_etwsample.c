@@ -0,0 +1,397 @@
+// Samples Python stacks from a native thread, without ETW stack walks.
+//
+// A sampler thread wakes at a fixed interval, takes the GIL, and walks the
+// frames of every thread in the interpreter. Frames are resolved to function
+// IDs through the same co_extra cache as the other tracers, and each distinct
+// stack is written once with WriteStack. Each sample after that is only the
+// thread ID and the stack ID.
+//
+// The GIL is required to walk another thread's frames safely, so a thread
+// that holds it is sampled when it next releases it. The tracer lowers the
+// switch interval to match the sampling interval while enabled.
+
+#include "_platform.h"
+#ifndef _WIN32
+#include <errno.h>
+#include <time.h>
+#endif
+
+#include "_etwcommon.h"
+#include "_trace.h"
+
+
+struct ETWSAMPLE_STATE {
+    struct ETWCOMMON_STATE common;
+    long long interval_ns;
+    volatile int running;
+    Py_ssize_t samples;
+#ifdef _WIN32
+    HANDLE thread;
+#else
+    pthread_t thread;
+#endif
+    int has_thread;
+};
+
+
+static long long monotonic_ns(void)
+{
+#ifdef _WIN32
+    static LARGE_INTEGER freq;
+    LARGE_INTEGER now;
+    if (!freq.QuadPart) {
+        QueryPerformanceFrequency(&freq);
+    }
+    QueryPerformanceCounter(&now);
+    return (long long)((double)now.QuadPart * 1e9 / (double)freq.QuadPart);
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (long long)ts.tv_sec * 1000000000LL + ts.tv_nsec;
+#endif
+}
+
+
+#ifdef _WIN32
+#ifndef CREATE_WAITABLE_TIMER_HIGH_RESOLUTION
+#define CREATE_WAITABLE_TIMER_HIGH_RESOLUTION 0x00000002
+#endif
+
+static HANDLE create_timer(void)
+{
+    // High resolution timers need Windows 10 1803, and otherwise waits are
+    // rounded up to the system timer resolution
+    HANDLE timer = CreateWaitableTimerExW(NULL, NULL, CREATE_WAITABLE_TIMER_HIGH_RESOLUTION, TIMER_ALL_ACCESS);
+    if (!timer) {
+        timer = CreateWaitableTimerExW(NULL, NULL, 0, TIMER_ALL_ACCESS);
+    }
+    return timer;
+}
+#endif
+
+
+static int thread_id_of(PyThreadState *tstate)
+{
+#if PY_VERSION_HEX >= 0x030B0000
+    return (int)tstate->native_thread_id;
+#else
+    // Matches GetCurrentThreadId() on Windows only
+    return (int)tstate->thread_id;
+#endif
+}
+
+
+static void sample_threads(struct ETWSAMPLE_STATE *state, PyThreadState *self)
+{
+    FUNC_ID frames[ETWCOMMON_MAX_DEPTH];
+    PyInterpreterState *interp = PyThreadState_GetInterpreter(self);
+    for (PyThreadState *tstate = PyInterpreterState_ThreadHead(interp); tstate; tstate = PyThreadState_Next(tstate)) {
+        if (tstate == self || ETWCOMMON_is_internal_thread(&state->common, tstate)) {
+            continue;
+        }
+        int count = ETWCOMMON_get_stack(&state->common, tstate, frames);
+        if (count) {
+            int stack_id = ETWCOMMON_intern_stack(&state->common, frames, count);
+            if (stack_id) {
+                WriteSample(thread_id_of(tstate), stack_id);
+                state->samples += 1;
+            }
+        }
+    }
+}
+
+
+#ifdef _WIN32
+static DWORD WINAPI sampler_main(void *arg)
+#else
+static void *sampler_main(void *arg)
+#endif
+{
+    struct ETWSAMPLE_STATE *state = (struct ETWSAMPLE_STATE *)arg;
+#ifdef _WIN32
+    HANDLE timer = create_timer();
+#endif
+    PyGILState_STATE gil = PyGILState_Ensure();
+    PyThreadState *self = PyThreadState_Get();
+    long long next = monotonic_ns();
+
+    while (state->running) {
+        PyThreadState *saved = PyEval_SaveThread();
+        next += state->interval_ns;
+        long long now = monotonic_ns();
+        if (next < now) {
+            // Ticks missed while waiting for the GIL are skipped
+            next = now;
+        } else {
+#ifdef _WIN32
+            LARGE_INTEGER due;
+            due.QuadPart = -(next - now) / 100;
+            if (timer && SetWaitableTimer(timer, &due, 0, NULL, NULL, FALSE)) {
+                WaitForSingleObject(timer, INFINITE);
+            } else {
+                Sleep((DWORD)((next - now) / 1000000));
+            }
+#else
+            struct timespec until = { (time_t)(next / 1000000000LL), (long)(next % 1000000000LL) };
+            while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &until, NULL) == EINTR) {
+            }
+#endif
+        }
+        PyEval_RestoreThread(saved);
+        if (state->running) {
+            sample_threads(state, self);
+        }
+    }
+
+    PyGILState_Release(gil);
+#ifdef _WIN32
+    if (timer) {
+        CloseHandle(timer);
+    }
+#endif
+    return 0;
+}
+
+
+static int stop_sampler(struct ETWSAMPLE_STATE *state)
+{
+    if (!state->has_thread) {
+        return 0;
+    }
+    state->running = 0;
+    // The sampler needs the GIL to finish its current tick
+    Py_BEGIN_ALLOW_THREADS
+#ifdef _WIN32
+    WaitForSingleObject(state->thread, INFINITE);
+    CloseHandle(state->thread);
+#else
+    pthread_join(state->thread, NULL);
+#endif
+    Py_END_ALLOW_THREADS
+    state->has_thread = 0;
+    return 1;
+}
+
+
+static PyObject *etwsample_enable(PyObject *module, PyObject *args)
+{
+    double interval = 0.001;
+    if (!PyArg_ParseTuple(args, "|d:enable", &interval)) {
+        return NULL;
+    }
+    if (interval < 1e-5) {
+        PyErr_SetString(PyExc_ValueError, "interval must be at least 10 microseconds");
+        return NULL;
+    }
+
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(module);
+    if (state->has_thread) {
+        PyErr_SetString(PyExc_RuntimeError, "sampling is already enabled");
+        return NULL;
+    }
+    // Function IDs start again, so stacks must be written again
+    if (!ETWCOMMON_Init(&state->common, state)) {
+        return NULL;
+    }
+    state->interval_ns = (long long)(interval * 1e9);
+    state->samples = 0;
+
+    Register();
+    WriteBeginThread(GetCurrentThreadId());
+
+    state->running = 1;
+#ifdef _WIN32
+    state->thread = CreateThread(NULL, 0, sampler_main, state, 0, NULL);
+    if (!state->thread) {
+        state->running = 0;
+        Unregister();
+        PyErr_SetFromWindowsErr(0);
+        return NULL;
+    }
+#else
+    int err = pthread_create(&state->thread, NULL, sampler_main, state);
+    if (err) {
+        state->running = 0;
+        Unregister();
+        errno = err;
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+#endif
+    state->has_thread = 1;
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *etwsample_disable(PyObject *module, PyObject *args)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(module);
+    if (!stop_sampler(state)) {
+        PyErr_SetString(PyExc_RuntimeError, "sampling was not enabled");
+        return NULL;
+    }
+    // Ignored files and include prefixes are kept for the next session, but
+    // function IDs are reassigned, and stacks and exception types are
+    // written again to the next output
+    Py_CLEAR(state->common.func_table);
+    Py_CLEAR(state->common.stacks);
+    Py_CLEAR(state->common.exception_types);
+
+    WriteEndThread(GetCurrentThreadId());
+    Unregister();
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *etwsample_get_sample_count(PyObject *module, PyObject *args)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(module);
+    return PyLong_FromSsize_t(state->samples);
+}
+
+
+static PyObject *etwsample_get_ignored_files(PyObject *module, PyObject *args)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(module);
+    Py_INCREF(state->common.ignored_files);
+    return state->common.ignored_files;
+}
+
+
+static PyObject *etwsample_get_include_prefix(PyObject *module, PyObject *args)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(module);
+    Py_INCREF(state->common.include_prefix);
+    return state->common.include_prefix;
+}
+
+
+static PyObject *etwsample_get_info(PyObject *module, PyObject *args)
+{
+    // Schema history:
+    // __name__ 1 arch reserved
+    return Py_BuildValue("sisn",
+        "_etwsample",
+        1, // version number
+#if defined(_ARM64_) || defined(__aarch64__)
+        "ARM64",
+#else
+        "AMD64",
+#endif
+        (Py_ssize_t)0
+    );
+}
+
+
+static int etwsample_exec(PyObject *m)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(m);
+
+    if (!ETWCOMMON_Init(&state->common, state)) {
+        return -1;
+    }
+
+    return 0;
+}
+
+
+static int etwsample_traverse(PyObject *m, visitproc visit, void *arg)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(m);
+    ETWCOMMON_VISIT(&state->common);
+    return 0;
+}
+
+
+static int etwsample_clear(PyObject *m)
+{
+    struct ETWSAMPLE_STATE *state = PyModule_GetState(m);
+    ETWCOMMON_Clear(&state->common);
+    return 0;
+}
+
+
+static void etwsample_free(void *m)
+{
+}
+
+
+static struct PyMethodDef etwsample_methods[] = {
+    { "enable", etwsample_enable, METH_VARARGS,
+      "Starts sampling every thread at the specified interval in seconds." },
+    { "disable", etwsample_disable, METH_VARARGS,
+      "Stops sampling and waits for the sampler thread to exit." },
+    { "write_mark", ETWCOMMON_write_mark, METH_VARARGS,
+      "Write a custom mark into the trace." },
+    { "write_task_create", ETWCOMMON_write_task_create, METH_VARARGS,
+      "Write the creation of an asyncio task into the trace." },
+    { "write_task_step", ETWCOMMON_write_task_step, METH_VARARGS,
+      "Write the start or end of a step of an asyncio task into the trace." },
+    { "write_callback", ETWCOMMON_write_callback, METH_VARARGS,
+      "Write the start or end of an event loop callback into the trace." },
+    { "write_import", ETWCOMMON_write_import, METH_VARARGS,
+      "Write the start or end of a module import into the trace." },
+    { "start_activity", ETWCOMMON_start_activity, METH_VARARGS,
+      "Starts a new activity on this thread and returns its ID." },
+    { "stop_activity", ETWCOMMON_stop_activity, METH_VARARGS,
+      "Stops an activity and optionally returns this thread to another." },
+    { "switch_activity", ETWCOMMON_switch_activity, METH_VARARGS,
+      "Switches this thread to another activity (or none) and returns the previous one." },
+    { "gc_callback", ETWCOMMON_gc_callback, METH_VARARGS,
+      "Writes garbage collections into the trace when added to gc.callbacks." },
+    { "enable_allocations", ETWCOMMON_enable_allocations, METH_VARARGS,
+      "Starts sampling allocations about every interval bytes, optionally tracking frees." },
+    { "disable_allocations", ETWCOMMON_disable_allocations, METH_NOARGS,
+      "Stops sampling allocations." },
+    { "write_exception", (PyCFunction)ETWCOMMON_write_exception, METH_FASTCALL,
+      "Writes an exception event into the trace when called by sys.monitoring." },
+    { "create_metric", ETWCOMMON_create_metric, METH_VARARGS,
+      "Writes the metric's kind and name and returns an object that aggregates its updates." },
+    { "write_metrics", ETWCOMMON_write_metrics, METH_O,
+      "Writes a summary of each metric's updates since the previous summary." },
+    { "set_internal_thread", ETWCOMMON_set_internal_thread, METH_VARARGS,
+      "Leaves this thread out of samples, allocations and exceptions while set, for etwtrace's own threads." },
+    { "set_output", FILESINK_set_output, METH_VARARGS,
+      "Writes events to a file instead of ETW until called with None." },
+    { "start_listener", FILESINK_start_listener, METH_VARARGS,
+      "Queues up to the given number of bytes of events with the given keywords for subscribers." },
+    { "read_listener", FILESINK_read_listener, METH_VARARGS,
+      "Returns the events queued for subscribers and the number dropped, and changes the keywords queued." },
+    { "stop_listener", FILESINK_stop_listener, METH_NOARGS,
+      "Stops queueing events for subscribers and returns the last of them." },
+    { "get_sample_count", etwsample_get_sample_count, METH_NOARGS,
+      "Returns the number of samples written since sampling was enabled." },
+    { "get_ignored_files", etwsample_get_ignored_files, METH_NOARGS,
+      "Returns a reference to the set containing filenames to ignore" },
+    { "get_include_prefixes", etwsample_get_include_prefix, METH_NOARGS,
+      "Returns a reference to the list containing path prefixes to include" },
+    { "_get_technical_info", etwsample_get_info, METH_NOARGS,
+      "Returns technical information about the build" },
+    { NULL },
+};
+
+
+static struct PyModuleDef_Slot etwsample_slots[] = {
+    { Py_mod_exec, etwsample_exec },
+    { 0, NULL }
+};
+
+
+static struct PyModuleDef _etwsamplemodule = {
+    .m_base = PyModuleDef_HEAD_INIT,
+    .m_name = "_etwsample",
+    .m_doc = "Implementation for in-process stack sampling",
+    .m_size = sizeof(struct ETWSAMPLE_STATE),
+    .m_methods = etwsample_methods,
+    .m_slots = etwsample_slots,
+    .m_traverse = etwsample_traverse,
+    .m_clear = etwsample_clear,
+    .m_free = etwsample_free
+};
+
+PyMODINIT_FUNC PyInit__etwsample(void)
+{
+    return PyModuleDef_Init(&_etwsamplemodule);
+}
@@ -1,6 +1,13 @@
-#include <Windows.h>
+#include "_platform.h"
 #include <assert.h>
 
+#ifndef _WIN32
+#include <errno.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#endif
+
 #include "_etwcommon.h"
 #include "_trace.h"
 
@@ -10,6 +17,11 @@ const int THUNK_ALIGNMENT = 16;
 
 typedef PyObject *(*PThunk)(PyThreadState *tstate, FRAME_OBJECT *frame, int o, _PyFrameEvalFunction eval);
 
+#ifdef _WIN32
+
+#define NOINLINE __declspec(noinline)
+#define SetErrorFromLastError() PyErr_SetFromWindowsErr(0)
+
 #pragma optimize("", off)
 #pragma optimize("s", on)
 static PyObject *_thunk(PyThreadState *tstate, FRAME_OBJECT *frame, int o, _PyFrameEvalFunction eval)
@@ -18,6 +30,38 @@ static PyObject *_thunk(PyThreadState *tstate, FRAME_OBJECT *frame, int o, _PyFr
 }
 #pragma optimize("", on)
 
+#else
+
+#define NOINLINE __attribute__((noinline))
+#define SetErrorFromLastError() PyErr_SetFromErrno(PyExc_OSError)
+
+// Without function tables to describe a copy of a compiled function, the
+// thunk is written out directly. It keeps a frame pointer, so that perf can
+// unwind through it with --call-graph fp, and calls eval with the arguments
+// already in place.
+#if defined(__x86_64__)
+static const unsigned char THUNK_CODE[] = {
+    0xF3, 0x0F, 0x1E, 0xFA,     // endbr64
+    0x55,                       // push %rbp
+    0x48, 0x89, 0xE5,           // mov %rsp, %rbp
+    0xFF, 0xD1,                 // call *%rcx
+    0x5D,                       // pop %rbp
+    0xC3,                       // ret
+};
+#elif defined(__aarch64__)
+static const uint32_t THUNK_CODE[] = {
+    0xA9BF7BFD,                 // stp x29, x30, [sp, #-16]!
+    0x910003FD,                 // mov x29, sp
+    0xD63F0060,                 // blr x3
+    0xA8C17BFD,                 // ldp x29, x30, [sp], #16
+    0xD65F03C0,                 // ret
+};
+#else
+#error "Thunks are not implemented for this architecture"
+#endif
+
+#endif
+
 
 struct THUNK {
     PThunk thunk;
@@ -25,7 +69,7 @@ struct THUNK {
 };
 
 
-#ifdef _ARM64_
+#if defined(_WIN32) && defined(_ARM64_)
 struct UNWIND_INFO {
     unsigned char Version : 3;
     unsigned char Flags : 5;
@@ -36,7 +80,7 @@ struct UNWIND_INFO {
     // Just to make sure we copy enough
     unsigned short UnwindCode[8];
 };
-#else
+#elif defined(_WIN32)
 struct UNWIND_INFO {
     UCHAR Version : 3;
     UCHAR Flags : 5;
@@ -69,11 +113,16 @@ struct ETWTRACE_STATE {
     USHORT thunk_size;
     USHORT thunk_stride;
     DWORD unwind_offset;
+#ifdef _WIN32
     struct UNWIND_INFO unwind_info;
     RUNTIME_FUNCTION *functions;
+#endif
 };
 
 
+#ifdef _WIN32
+
+
 static struct THUNK_TABLE *AllocThunkTable(struct ETWTRACE_STATE *state)
 {
     int err = 0;
@@ -134,6 +183,61 @@ static void FreeThunkTable(struct THUNK_TABLE *table)
     }
 }
 
+#else
+
+static struct THUNK_TABLE *AllocThunkTable(struct ETWTRACE_STATE *state)
+{
+    int err = 0;
+    struct THUNK_TABLE *table = NULL;
+    void *new_table = MAP_FAILED;
+
+    table = (struct THUNK_TABLE*)calloc(1,
+        sizeof(struct THUNK_TABLE) + sizeof(struct THUNK) * (state->thunk_count - 1));
+    if (!table) {
+        errno = ENOMEM;
+        return NULL;
+    }
+
+    new_table = mmap(NULL, state->table_size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (new_table == MAP_FAILED) goto error;
+
+    table->base = (DWORD64)(uintptr_t)new_table;
+    table->size = state->table_size;
+
+    for (int i = 0; i < state->thunk_count; ++i) {
+        UINT8* p = (UINT8*)new_table + (i * state->thunk_stride);
+        memcpy(p, THUNK_CODE, state->thunk_size);
+        table->thunk[i].thunk = (PThunk)(void *)p;
+    }
+
+    if (mprotect(new_table, state->table_size, PROT_READ | PROT_EXEC)) goto error;
+    __builtin___clear_cache((char *)new_table, (char *)new_table + state->table_size);
+
+    return table;
+
+error:
+    err = errno;
+    if (new_table != MAP_FAILED)
+        munmap(new_table, state->table_size);
+    free(table);
+    errno = err;
+    return NULL;
+}
+
+
+static void FreeThunkTable(struct THUNK_TABLE *table)
+{
+    struct THUNK_TABLE *tt = table;
+    while (tt) {
+        struct THUNK_TABLE *next = tt->next;
+        munmap((void *)(uintptr_t)tt->base, tt->size);
+        free(tt);
+        tt = next;
+    }
+}
+
+#endif
+
 
 struct THUNK IGNORED_THUNK = { 0 };
 
@@ -191,7 +295,7 @@ static FUNC_ID alloc_new_thunk(
         if (!tt->next) {
             tt->next = AllocThunkTable(state);
             if (!tt->next) {
-                PyErr_SetFromWindowsErr(0);
+                SetErrorFromLastError();
                 return FUNC_ID_ERROR;
             }
         }
@@ -206,7 +310,7 @@ static FUNC_ID alloc_new_thunk(
 }
 
 
-static __declspec(noinline)
+static NOINLINE
 struct THUNK *GetThunkForPythonFrame(PyThreadState *tstate, FRAME_OBJECT *frame, int o, _PyFrameEvalFunction *default_eval)
 {
     PyInterpreterState *interp = PyThreadState_GetInterpreter(tstate);
@@ -240,8 +344,10 @@ struct THUNK *GetThunkForPythonFrame(PyThreadState *tstate, FRAME_OBJECT *frame,
 }
 
 
+#ifdef _WIN32
 #pragma optimize("", off)
 #pragma optimize("t", on)
+#endif
 static PyObject *PythonFrame(PyThreadState *tstate, FRAME_OBJECT *frame, int o)
 {
     _PyFrameEvalFunction default_eval;
@@ -257,7 +363,9 @@ static PyObject *PythonFrame(PyThreadState *tstate, FRAME_OBJECT *frame, int o)
     }
     return thunk->thunk(tstate, frame, o, default_eval);
 }
+#ifdef _WIN32
 #pragma optimize("", on)
+#endif
 
 
 static PyObject *etwtrace_enable(PyObject *module, PyObject *args)
@@ -287,7 +395,7 @@ static PyObject *etwtrace_enable(PyObject *module, PyObject *args)
     if (!state->table) {
         state->table = AllocThunkTable(state);
         if (!state->table) {
-            PyErr_SetFromWindowsErr(0);
+            SetErrorFromLastError();
             return NULL;
         }
     }
@@ -331,6 +439,8 @@ static PyObject *etwtrace_disable(PyObject *module, PyObject *args)
         FreeThunkTable(state->table);
         state->table = NULL;
     }
+    // Exception types are written again to the next output
+    Py_CLEAR(state->common.exception_types);
 
     Py_RETURN_NONE;
 }
@@ -360,7 +470,7 @@ static PyObject *etwtrace_get_info(PyObject *module, PyObject *args)
     return Py_BuildValue("sisnnnnn",
         "_etwtrace",
         1, // version number
-#ifdef _ARM64_
+#if defined(_ARM64_) || defined(__aarch64__)
         "ARM64",
 #else
         "AMD64",
@@ -378,6 +488,8 @@ static int etwtrace_exec(PyObject *m)
 {
     struct ETWTRACE_STATE *state = PyModule_GetState(m);
 
+    state->table_size = DEFAULT_TABLE_SIZE;
+#ifdef _WIN32
     DWORD64 imagebase;
     UNWIND_HISTORY_TABLE history;
     PRUNTIME_FUNCTION orig = RtlLookupFunctionEntry((DWORD64)(void *)_thunk, &imagebase, &history);
@@ -397,17 +509,20 @@ static int etwtrace_exec(PyObject *m)
         return -1;
     }
 
-    state->table_size = DEFAULT_TABLE_SIZE;
 #ifdef _ARM64_
     int cb = (int)(orig->FunctionLength) * 4;
 #else
     int cb = (int)(orig->EndAddress - orig->BeginAddress);
+#endif
+#else
+    int cb = (int)sizeof(THUNK_CODE);
 #endif
     state->thunk_size = cb;
     cb = (((cb - 1) / THUNK_ALIGNMENT) + 1) * THUNK_ALIGNMENT;
     state->thunk_stride = cb;
     assert(state->thunk_stride >= state->thunk_size);
     assert((state->thunk_stride % THUNK_ALIGNMENT) == 0);
+#ifdef _WIN32
     state->thunk_count = (int)((state->table_size - sizeof(struct UNWIND_INFO)) / state->thunk_stride);
     state->unwind_offset = state->thunk_stride * state->thunk_count;
     assert((state->unwind_offset % sizeof(void *)) == 0);
@@ -435,12 +550,19 @@ static int etwtrace_exec(PyObject *m)
 #endif
         state->functions[i].UnwindData = state->unwind_offset;
     }
+#else
+    // Thunks do not need unwind information, so the table is all thunks
+    state->thunk_count = (int)(state->table_size / state->thunk_stride);
+    state->unwind_offset = 0;
+#endif
 
     state->table = NULL;
 
     if (!ETWCOMMON_Init(&state->common, state)) {
+#ifdef _WIN32
         HeapFree(GetProcessHeap(), 0, state->functions);
         state->functions = NULL;
+#endif
         return -1;
     }
 
@@ -466,10 +588,12 @@ static int etwtrace_clear(PyObject *m)
 
 static void etwtrace_free(void *m)
 {
+#ifdef _WIN32
     struct ETWTRACE_STATE *state = PyModule_GetState((PyObject *)m);
 
     HeapFree(GetProcessHeap(), 0, state->functions);
     state->functions = NULL;
+#endif
 }
 
 
@@ -480,6 +604,42 @@ static struct PyMethodDef etwtrace_methods[] = {
       "Enables tracing, optionally for all created threads and interpreters." },
     { "write_mark", ETWCOMMON_write_mark, METH_VARARGS,
       "Write a custom mark into the trace." },
+    { "write_task_create", ETWCOMMON_write_task_create, METH_VARARGS,
+      "Write the creation of an asyncio task into the trace." },
+    { "write_task_step", ETWCOMMON_write_task_step, METH_VARARGS,
+      "Write the start or end of a step of an asyncio task into the trace." },
+    { "write_callback", ETWCOMMON_write_callback, METH_VARARGS,
+      "Write the start or end of an event loop callback into the trace." },
+    { "write_import", ETWCOMMON_write_import, METH_VARARGS,
+      "Write the start or end of a module import into the trace." },
+    { "start_activity", ETWCOMMON_start_activity, METH_VARARGS,
+      "Starts a new activity on this thread and returns its ID." },
+    { "stop_activity", ETWCOMMON_stop_activity, METH_VARARGS,
+      "Stops an activity and optionally returns this thread to another." },
+    { "switch_activity", ETWCOMMON_switch_activity, METH_VARARGS,
+      "Switches this thread to another activity (or none) and returns the previous one." },
+    { "gc_callback", ETWCOMMON_gc_callback, METH_VARARGS,
+      "Writes garbage collections into the trace when added to gc.callbacks." },
+    { "enable_allocations", ETWCOMMON_enable_allocations, METH_VARARGS,
+      "Starts sampling allocations about every interval bytes, optionally tracking frees." },
+    { "disable_allocations", ETWCOMMON_disable_allocations, METH_NOARGS,
+      "Stops sampling allocations." },
+    { "write_exception", (PyCFunction)ETWCOMMON_write_exception, METH_FASTCALL,
+      "Writes an exception event into the trace when called by sys.monitoring." },
+    { "create_metric", ETWCOMMON_create_metric, METH_VARARGS,
+      "Writes the metric's kind and name and returns an object that aggregates its updates." },
+    { "write_metrics", ETWCOMMON_write_metrics, METH_O,
+      "Writes a summary of each metric's updates since the previous summary." },
+    { "set_internal_thread", ETWCOMMON_set_internal_thread, METH_VARARGS,
+      "Leaves this thread out of samples, allocations and exceptions while set, for etwtrace's own threads." },
+    { "set_output", FILESINK_set_output, METH_VARARGS,
+      "Writes events to a file instead of ETW until called with None." },
+    { "start_listener", FILESINK_start_listener, METH_VARARGS,
+      "Queues up to the given number of bytes of events with the given keywords for subscribers." },
+    { "read_listener", FILESINK_read_listener, METH_VARARGS,
+      "Returns the events queued for subscribers and the number dropped, and changes the keywords queued." },
+    { "stop_listener", FILESINK_stop_listener, METH_NOARGS,
+      "Stops queueing events for subscribers and returns the last of them." },
     { "get_ignored_files", etwtrace_get_ignored_files, METH_NOARGS,
       "Returns a reference to the set containing filenames to ignore" },
     { "get_include_prefixes", etwtrace_get_include_prefix, METH_NOARGS,
@@ -0,0 +1,187 @@
+"""Reports where exceptions are raised and handled from exception events.
+
+Tracers enabled with exceptions=True raise a PythonException event when an
+exception is raised (opcode 1), handled (2), reraised (10) and for each
+function it unwinds out of (11), with the exception type and the function
+and line (see _exceptiontrace.py). Types and functions are written once
+with PythonExceptionType and PythonFunction events.
+
+ExceptionAnalyzer follows each exception on its thread from where it was
+raised, through every frame it unwinds, to the handler that caught it. Each
+site (type, function and line) counts the exceptions raised, reraised and
+handled there, and the sites where exceptions were raised also total the
+frames they unwound and the time spent propagating them. An exception
+reraised after being handled, such as by a finally block or a bare raise,
+continues to count against the site that first raised it.
+
+Before Python 3.12, handlers are not reported, so exceptions are followed
+until their last unwind or the next exception raised on the thread.
+"""
+
+RAISED = 1
+HANDLED = 2
+RERAISED = 10
+UNWOUND = 11
+
+
+class ExceptionSite:
+    """Counts for one exception type at one line of a function.
+
+    frames and time are the frames unwound and the time spent propagating
+    the exceptions raised here. line is -1 when the position in the
+    function is not known."""
+    __slots__ = ('process_id', 'type_id', 'function_id', 'line', 'type', 'function',
+                 'raised', 'reraised', 'handled', 'unwound', 'frames', 'time')
+
+    def __init__(self, process_id, type_id, function_id, line):
+        self.process_id = process_id
+        self.type_id = type_id
+        self.function_id = function_id
+        self.line = line
+        self.type = None
+        self.function = None
+        self.raised = 0
+        self.reraised = 0
+        self.handled = 0
+        self.unwound = 0
+        self.frames = 0
+        self.time = 0
+
+    @property
+    def location(self):
+        if self.line < 0:
+            return self.function
+        return f"{self.function} line {self.line}"
+
+    def __repr__(self):
+        return f"<ExceptionSite({self.type!r}, {self.location!r}, raised={self.raised})>"
+
+
+class _Propagation:
+    __slots__ = ('site', 'type_id', 'start', 'last')
+
+    def __init__(self, site, type_id, timestamp):
+        self.site = site
+        self.type_id = type_id
+        self.start = timestamp
+        self.last = timestamp
+
+    def close(self, timestamp):
+        self.site.time += timestamp - self.start
+
+
+class ExceptionAnalyzer:
+    """Accumulates exception sites from PythonException events.
+
+    sites is keyed by (process, type ID, function ID, line). The type and
+    function names of each site are filled in by finish().
+    """
+
+    def __init__(self):
+        self.sites = {}
+        self.raised = 0
+        self.handled = 0
+        self.unmatched_unwinds = 0
+        # Names by (process, ID)
+        self._types = {}
+        self._functions = {}
+        # The exception propagating on each thread, and the last one handled
+        self._propagating = {}
+        self._handled = {}
+        self._finished = False
+
+    def _site(self, event):
+        pid = event.process_id
+        key = (pid, event['TypeID'].value, event['FunctionID'].value, event['Line'].value)
+        site = self.sites.get(key)
+        if site is None:
+            site = self.sites[key] = ExceptionSite(*key)
+        return site
+
+    def add(self, event):
+        name = event.event_name
+        if name == 'PythonExceptionType':
+            self._types[event.process_id, event['TypeID'].value] = event['Name'].value
+            return
+        if name == 'PythonFunction':
+            source_file = event['SourceFile'].value
+            name = event['Name'].value
+            if source_file:
+                name = f"{name} ({source_file}:{event['LineNumber'].value})"
+            self._functions[event.process_id, event['FunctionID'].value] = name
+            return
+        if name != 'PythonException':
+            return
+
+        thread = event.process_id, event.thread_id
+        site = self._site(event)
+        current = self._propagating.get(thread)
+        opcode = event.opcode
+        if opcode == RAISED:
+            if current:
+                current.close(current.last)
+            site.raised += 1
+            self.raised += 1
+            self._propagating[thread] = _Propagation(site, site.type_id, event.timestamp)
+        elif opcode == RERAISED:
+            site.reraised += 1
+            if current:
+                current.last = event.timestamp
+                return
+            handled = self._handled.get(thread)
+            if handled and handled.type_id == site.type_id:
+                origin = handled.site
+            else:
+                origin = site
+            self._propagating[thread] = _Propagation(origin, site.type_id, event.timestamp)
+        elif opcode == UNWOUND:
+            site.unwound += 1
+            if not current:
+                self.unmatched_unwinds += 1
+                return
+            current.site.frames += 1
+            current.last = event.timestamp
+        elif opcode == HANDLED:
+            site.handled += 1
+            self.handled += 1
+            if current:
+                current.close(event.timestamp)
+                self._handled[thread] = current
+                del self._propagating[thread]
+
+    def finish(self):
+        """Ends exceptions still propagating and resolves names."""
+        if self._finished:
+            return
+        self._finished = True
+        for current in self._propagating.values():
+            current.close(current.last)
+        self._propagating.clear()
+        self._handled.clear()
+        for site in self.sites.values():
+            pid = site.process_id
+            site.type = self._types.get((pid, site.type_id), f"<type {site.type_id}>")
+            site.function = self._functions.get((pid, site.function_id),
+                                                f"<function 0x{site.function_id:X}>")
+
+    def top_sites(self, key='raised', count=None):
+        sites = [s for s in self.sites.values() if getattr(s, key)]
+        sites.sort(key=lambda s: getattr(s, key), reverse=True)
+        return sites[:count] if count else sites
+
+    def by_type(self):
+        """Returns a dict mapping each type name to (raised, handled, time)."""
+        types = {}
+        for s in self.sites.values():
+            raised, handled, time = types.get(s.type, (0, 0, 0))
+            types[s.type] = raised + s.raised, handled + s.handled, time + s.time
+        return types
+
+
+def analyze(events):
+    """Returns a finished ExceptionAnalyzer for events."""
+    a = ExceptionAnalyzer()
+    for e in events:
+        a.add(e)
+    a.finish()
+    return a
@@ -0,0 +1,90 @@
+"""Raises events for exceptions.
+
+On Python 3.12 and later, the tracer module's write_exception is registered
+with sys.monitoring for the RAISE, RERAISE, EXCEPTION_HANDLED and PY_UNWIND
+events, which are raised for every exception in Python code and do not
+interfere with sys.settrace() or sys.setprofile(). Each raises a
+PythonException event with the exception type and the function and line it
+happened at: raised (opcode 1) where the exception was raised, or where a
+call raised it, handled (2) where it is caught, reraised (10) and unwound
+(11) for each function that it propagates out of. Jumping to a finally
+block or leaving a with statement also counts as handling the exception,
+and these usually reraise it.
+
+Earlier versions only report exceptions to trace functions, so
+InstrumentedTracer installs one alongside its profile function (see
+_etwinstrument.c), and other tracers do not support exception events. This
+replaces any sys.settrace() function, such as a debugger or coverage, and
+only raises and unwinds are reported.
+"""
+
+import sys
+
+from functools import partial
+
+_monitoring = getattr(sys, "monitoring", None)
+
+# Opcodes of PythonException events
+RAISED = 1
+HANDLED = 2
+RERAISED = 10
+UNWOUND = 11
+
+
+def _events():
+    events = _monitoring.events
+    return [
+        (events.RAISE, RAISED),
+        (events.EXCEPTION_HANDLED, HANDLED),
+        (events.RERAISE, RERAISED),
+        (events.PY_UNWIND, UNWOUND),
+    ]
+
+
+def _use_tool_id():
+    # Prefer the profiler ID, but share nicely with other profilers
+    for tool_id in (_monitoring.PROFILER_ID, 3, 4):
+        try:
+            _monitoring.use_tool_id(tool_id, "etwtrace")
+        except ValueError:
+            continue
+        return tool_id
+    raise RuntimeError("no sys.monitoring tool ID is available for exception events")
+
+
+class ExceptionHooks:
+    """Registers sys.monitoring callbacks for exception events, or asks the
+    tracer module to report them itself before 3.12."""
+
+    def __init__(self, module):
+        self._module = module
+        self._tool_id = None
+        self._tracing = False
+
+    def install(self):
+        if _monitoring is None:
+            enable = getattr(self._module, "enable_exceptions", None)
+            if enable is None:
+                raise RuntimeError("exception events require Python 3.12 or later, or InstrumentedTracer")
+            enable()
+            self._tracing = True
+            return
+
+        tool_id = self._tool_id = _use_tool_id()
+        write_exception = self._module.write_exception
+        mask = 0
+        for event, opcode in _events():
+            _monitoring.register_callback(tool_id, event, partial(write_exception, opcode))
+            mask |= event
+        _monitoring.set_events(tool_id, mask)
+
+    def uninstall(self):
+        if self._tracing:
+            self._tracing = False
+            self._module.disable_exceptions()
+        if self._tool_id is not None:
+            tool_id, self._tool_id = self._tool_id, None
+            _monitoring.set_events(tool_id, 0)
+            for event, _ in _events():
+                _monitoring.register_callback(tool_id, event, None)
+            _monitoring.free_tool_id(tool_id)
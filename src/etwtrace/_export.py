@@ -0,0 +1,307 @@
+"""Exports decoded traces to formats used by other tools.
+
+collapsed
+    One line per distinct stack, root first and separated by semicolons,
+    followed by its weight. Accepted by flamegraph.pl, speedscope and most
+    flame graph viewers. Stack samples are weighted by count, and
+    instrumented calls by exclusive time in microseconds.
+
+chrome (or perfetto)
+    Chrome Trace Event JSON, which can be opened in chrome://tracing,
+    Perfetto and speedscope. Function calls become nested slices, mark
+    ranges become async spans, and stack samples refer to an ID table of
+    stack frames that is written at the end of the file.
+
+pprof
+    A gzipped pprof profile, written when the trace has been read. See
+    _pprof for details.
+
+sqlite
+    A SQLite database of normalized tables for ad-hoc queries. See _sqlite
+    for details.
+
+Exporters are fed events one at a time and write as they go, so memory use
+depends on the number of distinct stacks and functions rather than the
+size of the trace.
+"""
+
+import json
+
+from . import _symbolize
+from ._pprof import PprofExporter
+from ._sqlite import SqliteExporter
+
+STACK_OPCODE_NAME = 'Stack'
+
+
+def _safe(name):
+    return name.replace(';', ',').replace('\n', ' ')
+
+
+class _Exporter:
+    # Override to receive symbolized frames for events with stacks
+    needs_frames = False
+
+    def __init__(self, file, *, native=False):
+        self.file = file
+        self.native = native
+        self.process_names = {}
+
+    def add(self, event, frames=None):
+        if event.task_name == 'Process' and event.opcode_name in ('Start', 'DCStart'):
+            try:
+                self.process_names[event['ProcessId'].value] = event['ImageFileName'].value
+            except LookupError:
+                pass
+
+    def process_name(self, pid):
+        name = self.process_names.get(pid)
+        return f"{name} ({pid})" if name else f"Process {pid}"
+
+    def close(self):
+        pass
+
+
+class CollapsedExporter(_Exporter):
+    """Writes collapsed stacks for flame graphs.
+
+    Stacks are taken from the kernel stack walks that follow sampled profile
+    events, or from SamplingTracer's samples. If the trace has neither,
+    instrumented calls are used instead.
+    Each stack starts with its process unless processes=False. The
+    CallTreeAnalyzer used for instrumented calls is available as calls."""
+    needs_frames = True
+
+    def __init__(self, file, *, native=False, processes=True):
+        super().__init__(file, native=native)
+        self.processes = processes
+        from ._calltree import CallTreeAnalyzer
+        self.calls = CallTreeAnalyzer()
+        self._pending_samples = set()
+        # Frames are converted to strings once per distinct stack
+        self._stack_ids = {}
+        self._stacks = []
+        self._counts = []
+
+    def _frame_names(self, frames):
+        names = []
+        for f in reversed(frames):
+            if f.kind == 'python':
+                name = f"{f.name} ({f.file}:{f.line})"
+            elif self.native and f.kind == 'native':
+                name = f.module
+            elif self.native:
+                name = '[unknown]'
+            else:
+                continue
+            if not names or names[-1] != name:
+                names.append(_safe(name))
+        return names or ['[native code]']
+
+    def _prefix(self, pid):
+        return [_safe(self.process_name(pid))] if self.processes else []
+
+    def add(self, event, frames=None):
+        super().add(event, frames)
+        if event.is_stack_sample:
+            self._pending_samples.add(event.thread_id)
+            return
+        if frames is not None and event.opcode_name == STACK_OPCODE_NAME:
+            if event.thread_id not in self._pending_samples:
+                return
+            self._pending_samples.discard(event.thread_id)
+            self._add_sample(event.process_id, frames)
+            return
+        if frames is not None and event.event_name == 'PythonSample':
+            self._add_sample(event.process_id, frames)
+            return
+        self.calls.add(event)
+
+    def _add_sample(self, pid, frames):
+        key = pid, tuple(frames)
+        i = self._stack_ids.get(key)
+        if i is None:
+            i = self._stack_ids[key] = len(self._stacks)
+            self._stacks.append(';'.join([*self._prefix(pid), *self._frame_names(frames)]))
+            self._counts.append(0)
+        self._counts[i] += 1
+
+    def stacks(self):
+        """Returns a dict mapping each collapsed stack to its weight."""
+        totals = {}
+        if self._stacks:
+            # Stacks that only differ in omitted frames have the same string
+            for s, n in zip(self._stacks, self._counts):
+                totals[s] = totals.get(s, 0) + n
+            return totals
+        self.calls.finish()
+        for (pid, tid), t in self.calls.threads.items():
+            prefix = self._prefix(pid)
+            path = []
+            for depth, node in t.root.walk():
+                if not node.function:
+                    continue
+                del path[depth - 1:]
+                path.append(_safe(node.function.display_name))
+                # Weights are integers, so use microseconds
+                weight = node.exclusive // 10
+                if weight > 0:
+                    s = ';'.join(prefix + path)
+                    totals[s] = totals.get(s, 0) + weight
+        return totals
+
+    def close(self):
+        for s, n in self.stacks().items():
+            print(s, n, file=self.file)
+
+
+class ChromeTraceExporter(_Exporter):
+    """Writes Chrome Trace Event JSON."""
+    needs_frames = True
+
+    def __init__(self, file, *, native=False):
+        super().__init__(file, native=native)
+        self._base = None
+        self._first = True
+        self._functions = {}
+        self._metrics = {}
+        self._named_processes = set()
+        self._named_threads = set()
+        self._pending_samples = set()
+        self._frame_ids = {}
+        self.file.write('{"traceEvents":[\n')
+
+    def _write(self, obj):
+        if not self._first:
+            self.file.write(',\n')
+        self._first = False
+        self.file.write(json.dumps(obj, separators=(',', ':')))
+
+    def _ts(self, event):
+        if self._base is None:
+            self._base = event.timestamp
+        return (event.timestamp - self._base) / 10
+
+    def _name_process(self, pid):
+        if pid not in self._named_processes and pid in self.process_names:
+            self._named_processes.add(pid)
+            self._write({"ph": "M", "name": "process_name", "pid": pid,
+                         "args": {"name": self.process_names[pid]}})
+
+    def _frame_id(self, frames):
+        # Each distinct (parent, frame) pair gets one entry in stackFrames
+        parent = None
+        for f in reversed(frames):
+            if f.kind != 'python' and not self.native:
+                continue
+            key = parent, str(f) if f.kind == 'python' else (f.module or '[unknown]')
+            i = self._frame_ids.get(key)
+            if i is None:
+                i = self._frame_ids[key] = len(self._frame_ids) + 1
+            parent = i
+        return parent
+
+    def add(self, event, frames=None):
+        super().add(event, frames)
+        name = event.event_name
+        pid, tid = event.process_id, event.thread_id
+        if name == 'PythonFunction':
+            self._functions[pid, event['FunctionID'].value] = (
+                f"{event['Name'].value} ({event['SourceFile'].value}:{event['LineNumber'].value})"
+            )
+        elif name == 'PythonFunctionPush':
+            func_id = event['FunctionID'].value
+            self._name_process(pid)
+            self._write({"ph": "B", "cat": "function", "pid": pid, "tid": tid, "ts": self._ts(event),
+                         "name": self._functions.get((pid, func_id), f"0x{func_id:X}")})
+        elif name == 'PythonFunctionPop':
+            self._write({"ph": "E", "cat": "function", "pid": pid, "tid": tid, "ts": self._ts(event)})
+        elif name == 'PythonMark':
+            mark = event['Mark'].value
+            self._name_process(pid)
+            if event.opcode in (1, 2):
+                self._write({"ph": "b" if event.opcode == 1 else "e", "cat": "mark", "id": mark,
+                             "name": mark, "pid": pid, "tid": tid, "ts": self._ts(event)})
+            else:
+                self._write({"ph": "i", "s": "t", "cat": "mark", "name": mark,
+                             "pid": pid, "tid": tid, "ts": self._ts(event)})
+        elif name == 'PythonMetricInfo':
+            self._metrics[pid, event['MetricID'].value] = event['Name'].value, event['Kind'].value
+        elif name == 'PythonMetric':
+            metric_id = event['MetricID'].value
+            metric, kind = self._metrics.get((pid, metric_id), (f"metric {metric_id}", 0))
+            if kind == 2:
+                args = {"value": event['Value'].value}
+            elif kind == 3:
+                args = {"mean": event['Sum'].value / event['Count'].value, "max": event['Max'].value}
+            else:
+                args = {"added": event['Sum'].value}
+            self._name_process(pid)
+            self._write({"ph": "C", "cat": "metric", "name": metric, "pid": pid, "ts": self._ts(event),
+                         "args": args})
+        elif name == 'PythonThread':
+            self._name_process(pid)
+            if event.opcode == 1 and tid not in self._named_threads:
+                self._named_threads.add(tid)
+                self._write({"ph": "M", "name": "thread_name", "pid": pid, "tid": tid,
+                             "args": {"name": f"Python thread {tid}"}})
+            self._write({"ph": "i", "s": "t", "cat": "thread", "pid": pid, "tid": tid,
+                         "ts": self._ts(event), "name": "Thread start" if event.opcode == 1 else "Thread end"})
+        elif event.is_stack_sample:
+            self._pending_samples.add(tid)
+        elif frames is not None and event.opcode_name == STACK_OPCODE_NAME:
+            if tid in self._pending_samples:
+                self._pending_samples.discard(tid)
+                self._sample(event, pid, tid, frames)
+        elif frames is not None and name == 'PythonSample':
+            # Written by the sampler thread on behalf of the sampled thread
+            self._sample(event, pid, event['ThreadID'].value, frames)
+
+    def _sample(self, event, pid, tid, frames):
+        sf = self._frame_id(frames)
+        if sf is not None:
+            self._name_process(pid)
+            self._write({"ph": "P", "cat": "sample", "name": "sample", "pid": pid, "tid": tid,
+                         "ts": self._ts(event), "sf": sf})
+
+    def close(self):
+        self.file.write('\n],\n"displayTimeUnit":"ms",\n"stackFrames":{')
+        first = True
+        for (parent, name), i in self._frame_ids.items():
+            frame = {"name": name, "category": "python"}
+            if parent is not None:
+                frame["parent"] = parent
+            self.file.write(('' if first else ',') + f'\n"{i}":' + json.dumps(frame, separators=(',', ':')))
+            first = False
+        self.file.write('\n}}\n')
+
+
+EXPORTERS = {
+    'collapsed': (CollapsedExporter, '.folded', 'w'),
+    'chrome': (ChromeTraceExporter, '.json', 'w'),
+    'perfetto': (ChromeTraceExporter, '.json', 'w'),
+    'pprof': (PprofExporter, '.pb.gz', 'wb'),
+    # Opens the database itself, so is passed a path or a connection
+    'sqlite': (SqliteExporter, '.db', None),
+}
+
+
+def export(events, file, format, **options):
+    """Writes events to file in the specified format and returns the exporter.
+
+    file must be opened in the mode listed in EXPORTERS for the format, or
+    be a path when the mode is None."""
+    try:
+        cls = EXPORTERS[format][0]
+    except KeyError:
+        raise ValueError(f"unsupported format {format!r}") from None
+    exporter = cls(file, **options)
+    if exporter.needs_frames:
+        symbolizer = _symbolize.Symbolizer(native=options.get('native', False))
+        stream = symbolizer.symbolize_events(events, all_events=True)
+    else:
+        stream = ((e, None) for e in events)
+    for event, frames in stream:
+        exporter.add(event, frames)
+    exporter.close()
+    return exporter
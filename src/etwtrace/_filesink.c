@@ -0,0 +1,1254 @@
+// Implements a sink that writes events to a compact file instead of ETW.
+//
+// This needs no ETW session, elevation or wpr.exe, and works on any
+// platform. Files are read by _tracefile.py, which returns the same events
+// as the ETL reader.
+//
+// Layout (all integers little endian):
+//
+//   header  "PYTRACE\0", u32 version, u32 process ID, u64 start time
+//   chunk   u8 kind, 3 bytes padding, u32 size, u64 thread ID,
+//           u64 base timestamp, then size bytes of records
+//
+// Each thread collects its events in its own buffer, which is written as a
+// single THREAD chunk when it fills up, so the file is written in large
+// sequential blocks. Records are a type byte, the time since the previous
+// record in the chunk (or the chunk's base timestamp) and the fields for
+// the type. Integers are LEB128 varints, signed values are zigzag encoded,
+// and function IDs (and task IDs) are stored as the difference from the
+// previous function ID (or task ID) in the chunk. Strings are only written
+// once, in STRINGS chunks as (ID, length, UTF-8), and records refer to them
+// by ID. Timestamps are FILETIME units (100ns since 1601) to match ETL files.
+//
+// The same chunks may also be queued in memory for subscribers in this
+// process (see _listener.py), with or without a file. A file replaces the
+// module's default sink, but subscribers alone are added to it, so ETW still
+// receives every event while they listen. The queue is bounded, and once it
+// is full, thread chunks are dropped and their records counted until the
+// queue is read. Strings are never dropped. Without a file, only records with
+// the keywords that subscribers asked for are queued. Queued chunks are
+// copied into native memory, as chunks may be flushed from inside the
+// allocation hooks where Python objects cannot be created.
+//
+// Python only calls into the sink while holding the GIL, which protects the
+// buffers, the string table and the file.
+
+#include "_platform.h"
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#ifndef _WIN32
+#include <time.h>
+#endif
+
+#include "_etwcommon.h"
+#include "_trace.h"
+
+#define FILESINK_VERSION 1
+#define BUFFER_SIZE (64 * 1024)
+// Larger than the largest record, so a record always fits after a flush
+#define MAX_RECORD 64
+#define FILE_BUFFER_SIZE (1024 * 1024)
+
+enum CHUNK_KIND {
+    CHUNK_STRINGS = 1,
+    CHUNK_THREAD = 2,
+};
+
+enum RECORD_TYPE {
+    RECORD_FUNCTION = 1,
+    RECORD_PUSH = 2,
+    RECORD_POP = 3,
+    RECORD_MARK = 4,
+    RECORD_BEGIN_THREAD = 5,
+    RECORD_END_THREAD = 6,
+    RECORD_STACK = 7,
+    RECORD_SAMPLE = 8,
+    RECORD_TASK_CREATE = 9,
+    RECORD_TASK_STEP = 10,
+    RECORD_CALLBACK = 11,
+    RECORD_ACTIVITY = 12,
+    RECORD_GC = 13,
+    RECORD_IMPORT = 14,
+    RECORD_ALLOCATION = 15,
+    RECORD_EXCEPTION_TYPE = 16,
+    RECORD_EXCEPTION = 17,
+    RECORD_METRIC_INFO = 18,
+    RECORD_METRIC = 19,
+};
+
+// The keywords of the events each record type is read as (see _trace.cpp).
+// Activities are always recorded, as they set the activity of later events.
+static const uint64_t RECORD_KEYWORDS[] = {
+    [RECORD_FUNCTION] = 0x400,
+    [RECORD_PUSH] = 0x1000,
+    [RECORD_POP] = 0x2000,
+    [RECORD_MARK] = 0x800 | 0x200,
+    [RECORD_BEGIN_THREAD] = 0x100,
+    [RECORD_END_THREAD] = 0x100,
+    [RECORD_STACK] = 0x4000,
+    [RECORD_SAMPLE] = 0x4000,
+    [RECORD_TASK_CREATE] = 0x8000,
+    [RECORD_TASK_STEP] = 0x8000,
+    [RECORD_CALLBACK] = 0x8000,
+    [RECORD_ACTIVITY] = ~(uint64_t)0,
+    [RECORD_GC] = 0x20000,
+    [RECORD_IMPORT] = 0x40000,
+    [RECORD_ALLOCATION] = 0x80000,
+    [RECORD_EXCEPTION_TYPE] = 0x100000,
+    [RECORD_EXCEPTION] = 0x100000,
+    [RECORD_METRIC_INFO] = 0x200000,
+    [RECORD_METRIC] = 0x200000,
+};
+
+
+#define STRING_CACHE_SIZE 256
+#define STRING_CACHE_CHARS 64
+
+struct STRING_CACHE_ENTRY {
+    uint64_t id;
+    Py_ssize_t len;
+    uint16_t chars[STRING_CACHE_CHARS];
+};
+
+
+struct BUFFER {
+    struct BUFFER *next;
+    uint64_t thread_id;
+    uint64_t base;
+    uint64_t last;
+    FUNC_ID last_func_id;
+    DWORD64 last_task_id;
+    DWORD records;
+    size_t used;
+    unsigned char data[BUFFER_SIZE];
+};
+
+
+struct QUEUED_CHUNK {
+    struct QUEUED_CHUNK *next;
+    size_t size;
+    // Followed by size bytes of chunk header and records
+};
+
+
+static FILE *file = NULL;
+static int write_error = 0;
+static unsigned int session = 0;
+static struct BUFFER *buffers = NULL;
+static PyObject *strings = NULL;
+static struct STRING_CACHE_ENTRY string_cache[STRING_CACHE_SIZE];
+static unsigned char *pending_strings = NULL;
+static size_t pending_used = 0;
+static size_t pending_size = 0;
+static int listening = 0;
+static size_t queue_limit = 0;
+static uint64_t queue_keywords = 0;
+static size_t queue_size = 0;
+static uint64_t queue_dropped = 0;
+static struct QUEUED_CHUNK *queue_head = NULL;
+static struct QUEUED_CHUNK *queue_tail = NULL;
+
+// The buffer for the current thread is only valid in the session that it
+// was allocated in
+static THREAD_LOCAL struct BUFFER *thread_buffer = NULL;
+static THREAD_LOCAL unsigned int thread_session = 0;
+
+
+// Events are recorded while there is a file or subscribers to receive them
+static inline int is_open(void)
+{
+    return file || listening;
+}
+
+
+static uint64_t get_timestamp(void)
+{
+#ifdef _WIN32
+    FILETIME ft;
+    GetSystemTimePreciseAsFileTime(&ft);
+    return ((uint64_t)ft.dwHighDateTime << 32) | ft.dwLowDateTime;
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    return ((uint64_t)ts.tv_sec + 11644473600ULL) * 10000000ULL + (uint64_t)ts.tv_nsec / 100;
+#endif
+}
+
+
+static inline unsigned char *put_varint(unsigned char *p, uint64_t v)
+{
+    while (v >= 0x80) {
+        *p++ = (unsigned char)(v | 0x80);
+        v >>= 7;
+    }
+    *p++ = (unsigned char)v;
+    return p;
+}
+
+
+static inline uint64_t zigzag(int64_t v)
+{
+    return ((uint64_t)v << 1) ^ (uint64_t)(v >> 63);
+}
+
+
+static void put_le(unsigned char *p, uint64_t v, int size)
+{
+    for (int i = 0; i < size; ++i) {
+        p[i] = (unsigned char)(v >> (8 * i));
+    }
+}
+
+
+static unsigned char *put_double(unsigned char *p, double value)
+{
+    uint64_t bits;
+    memcpy(&bits, &value, sizeof(bits));
+    put_le(p, bits, 8);
+    return p + 8;
+}
+
+
+static void write_bytes(const void *data, size_t size)
+{
+    if (file && !write_error && fwrite(data, 1, size, file) != size) {
+        write_error = errno ? errno : EIO;
+    }
+}
+
+
+static void queue_chunk(const unsigned char *header, size_t header_size, const void *data,
+                        size_t size, DWORD records)
+{
+    struct QUEUED_CHUNK *chunk = NULL;
+    if (!records || queue_size + size <= queue_limit) {
+        chunk = (struct QUEUED_CHUNK *)malloc(sizeof(struct QUEUED_CHUNK) + header_size + size);
+    }
+    if (!chunk) {
+        queue_dropped += records;
+        return;
+    }
+    chunk->next = NULL;
+    chunk->size = header_size + size;
+    unsigned char *p = (unsigned char *)(chunk + 1);
+    memcpy(p, header, header_size);
+    memcpy(p + header_size, data, size);
+    if (queue_tail) {
+        queue_tail->next = chunk;
+    } else {
+        queue_head = chunk;
+    }
+    queue_tail = chunk;
+    queue_size += chunk->size;
+}
+
+
+static void write_chunk(int kind, uint64_t thread_id, uint64_t base, const void *data, size_t size,
+                        DWORD records)
+{
+    unsigned char header[24] = { (unsigned char)kind };
+    put_le(&header[4], size, 4);
+    put_le(&header[8], thread_id, 8);
+    put_le(&header[16], base, 8);
+    write_bytes(header, sizeof(header));
+    write_bytes(data, size);
+    if (listening) {
+        queue_chunk(header, sizeof(header), data, size, records);
+    }
+}
+
+
+static void flush_strings(void)
+{
+    if (pending_used) {
+        write_chunk(CHUNK_STRINGS, 0, 0, pending_strings, pending_used, 0);
+        pending_used = 0;
+    }
+}
+
+
+static void flush_buffer(struct BUFFER *b)
+{
+    if (b->used) {
+        // Strings are written before the records that refer to them
+        flush_strings();
+        write_chunk(CHUNK_THREAD, b->thread_id, b->base, b->data, b->used, b->records);
+        b->used = 0;
+    }
+}
+
+
+static void flush_all_buffers(void)
+{
+    for (struct BUFFER *b = buffers; b; b = b->next) {
+        flush_buffer(b);
+    }
+    flush_strings();
+}
+
+
+static struct BUFFER *get_buffer(void)
+{
+    struct BUFFER *b = thread_buffer;
+    if (b && thread_session == session) {
+        return b;
+    }
+    b = (struct BUFFER *)malloc(sizeof(struct BUFFER));
+    if (!b) {
+        return NULL;
+    }
+    b->thread_id = GetCurrentThreadId();
+    b->used = 0;
+    b->next = buffers;
+    buffers = b;
+    thread_buffer = b;
+    thread_session = session;
+    return b;
+}
+
+
+// Returns a pointer to write up to size bytes of the record's fields to, or
+// NULL if the event cannot be recorded. The record is completed by end_record.
+static unsigned char *begin_sized_record(enum RECORD_TYPE type, size_t size, struct BUFFER **buffer)
+{
+    if (!(file || listening) || size > BUFFER_SIZE) {
+        return NULL;
+    }
+    if (!file && queue_keywords && !(RECORD_KEYWORDS[type] & queue_keywords)) {
+        return NULL;
+    }
+    struct BUFFER *b = get_buffer();
+    if (!b) {
+        return NULL;
+    }
+    uint64_t ts = get_timestamp();
+    if (BUFFER_SIZE - b->used < size) {
+        flush_buffer(b);
+    }
+    if (!b->used) {
+        b->base = b->last = ts;
+        b->last_func_id = 0;
+        b->last_task_id = 0;
+        b->records = 0;
+    }
+    unsigned char *p = &b->data[b->used];
+    *p++ = (unsigned char)type;
+    // The clock may go backwards, but records in a chunk may not
+    if (ts > b->last) {
+        p = put_varint(p, ts - b->last);
+        b->last = ts;
+    } else {
+        *p++ = 0;
+    }
+    *buffer = b;
+    return p;
+}
+
+
+static inline unsigned char *begin_record(enum RECORD_TYPE type, struct BUFFER **buffer)
+{
+    return begin_sized_record(type, MAX_RECORD, buffer);
+}
+
+
+static inline void end_record(struct BUFFER *b, unsigned char *p)
+{
+    b->used = p - b->data;
+    ++b->records;
+}
+
+
+static inline unsigned char *put_func_id(struct BUFFER *b, unsigned char *p, FUNC_ID func_id)
+{
+    p = put_varint(p, zigzag((int64_t)func_id - b->last_func_id));
+    b->last_func_id = func_id;
+    return p;
+}
+
+
+static inline unsigned char *put_task_id(struct BUFFER *b, unsigned char *p, DWORD64 task_id)
+{
+    p = put_varint(p, zigzag((int64_t)(task_id - b->last_task_id)));
+    b->last_task_id = task_id;
+    return p;
+}
+
+
+static void cache_string(struct STRING_CACHE_ENTRY *entry, const uint16_t *u16, Py_ssize_t len,
+                         uint64_t id)
+{
+    if (len <= STRING_CACHE_CHARS) {
+        memcpy(entry->chars, u16, len * 2);
+        entry->len = len;
+        entry->id = id;
+    }
+}
+
+
+// Returns the ID of a string, adding it to the string table if necessary,
+// or 0 if it cannot be added.
+static uint64_t get_string_id(LPCWSTR s)
+{
+    if (!s) {
+        return 0;
+    }
+    // _etwcommon.c passes UTF-16, even where wchar_t is not 16 bits
+    const uint16_t *u16 = (const uint16_t *)s;
+    Py_ssize_t len = 0;
+    uint32_t hash = 2166136261u;
+    while (u16[len]) {
+        hash = (hash ^ u16[len]) * 16777619u;
+        ++len;
+    }
+    // Callback and mark names are repeated often, so recent strings are
+    // found without decoding them
+    struct STRING_CACHE_ENTRY *cached = &string_cache[hash % STRING_CACHE_SIZE];
+    if (cached->id && cached->len == len && !memcmp(cached->chars, u16, len * 2)) {
+        return cached->id;
+    }
+    int byteorder = 0;
+    PyObject *str = PyUnicode_DecodeUTF16((const char *)u16, len * 2, "surrogatepass", &byteorder);
+    if (!str) {
+        PyErr_Clear();
+        return 0;
+    }
+    uint64_t id = 0;
+    PyObject *o_id = PyDict_GetItemWithError(strings, str);
+    if (o_id) {
+        id = PyLong_AsUnsignedLongLong(o_id);
+        Py_DECREF(str);
+        cache_string(cached, u16, len, id);
+        return id;
+    } else if (PyErr_Occurred()) {
+        goto error;
+    }
+
+    Py_ssize_t cb;
+    const char *utf8 = PyUnicode_AsUTF8AndSize(str, &cb);
+    if (!utf8) goto error;
+    if (pending_size - pending_used < (size_t)cb + 20) {
+        size_t new_size = pending_size * 2 + (size_t)cb + 20;
+        unsigned char *p = (unsigned char *)realloc(pending_strings, new_size);
+        if (!p) goto error;
+        pending_strings = p;
+        pending_size = new_size;
+    }
+    id = (uint64_t)PyDict_GET_SIZE(strings) + 1;
+    o_id = PyLong_FromUnsignedLongLong(id);
+    if (!o_id || PyDict_SetItem(strings, str, o_id) < 0) {
+        Py_XDECREF(o_id);
+        id = 0;
+        goto error;
+    }
+    Py_DECREF(o_id);
+    unsigned char *p = &pending_strings[pending_used];
+    p = put_varint(p, id);
+    p = put_varint(p, (uint64_t)cb);
+    memcpy(p, utf8, cb);
+    pending_used = (p + cb) - pending_strings;
+    if (pending_used >= BUFFER_SIZE) {
+        flush_strings();
+    }
+    Py_DECREF(str);
+    cache_string(cached, u16, len, id);
+    return id;
+
+error:
+    PyErr_Clear();
+    Py_DECREF(str);
+    return id;
+}
+
+
+static int FileRegister(void)
+{
+    return 1;
+}
+
+static int FileUnregister(void)
+{
+    return 0;
+}
+
+static void write_thread_record(enum RECORD_TYPE type, int thread_id)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(type, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)(DWORD)thread_id);
+        end_record(b, p);
+    }
+}
+
+static void FileWriteBeginThread(int thread_id)
+{
+    write_thread_record(RECORD_BEGIN_THREAD, thread_id);
+}
+
+static void FileWriteEndThread(int thread_id)
+{
+    write_thread_record(RECORD_END_THREAD, thread_id);
+    if (thread_buffer && thread_session == session) {
+        flush_buffer(thread_buffer);
+    }
+}
+
+static void FileWriteEvalFunctionEvent(void *dll_handle)
+{
+}
+
+static void FileWriteFunctionEvent(
+    FUNC_ID func_id,
+    void *begin_addr,
+    void *end_addr,
+    LPCWSTR source_file,
+    LPCWSTR name,
+    int line_no,
+    int is_python_code
+)
+{
+    if (!is_open()) {
+        return;
+    }
+    // Strings are added first, as they may run Python code
+    uint64_t source_id = get_string_id(source_file);
+    uint64_t name_id = get_string_id(name);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_FUNCTION, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)func_id);
+        p = put_varint(p, (uint64_t)(uintptr_t)begin_addr);
+        p = put_varint(p, (uint64_t)((uintptr_t)end_addr - (uintptr_t)begin_addr));
+        p = put_varint(p, zigzag(line_no));
+        p = put_varint(p, source_id);
+        p = put_varint(p, name_id);
+        *p++ = is_python_code ? 1 : 0;
+        end_record(b, p);
+    }
+}
+
+static void FileWriteFunctionPush(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_PUSH, &b);
+    if (p) {
+        p = put_func_id(b, p, to_func_id);
+        p = put_varint(p, (uint64_t)from_func_id);
+        p = put_varint(p, (uint64_t)from_line);
+        end_record(b, p);
+    }
+}
+
+static void FileWriteFunctionPop(FUNC_ID func_id)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_POP, &b);
+    if (p) {
+        p = put_func_id(b, p, func_id);
+        end_record(b, p);
+    }
+}
+
+static void FileWriteCustomEvent(LPCWSTR name, int opcode)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = get_string_id(name);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_MARK, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        p = put_varint(p, name_id);
+        end_record(b, p);
+    }
+}
+
+// Stacks are written as (stack ID, number of frames, frames), with each
+// frame's function ID stored as the difference from the previous one.
+static void FileWriteStack(int stack_id, const FUNC_ID *frames, int count)
+{
+    struct BUFFER *b;
+    // Each frame takes at most 5 bytes, as FUNC_ID is 32 bits
+    unsigned char *p = begin_sized_record(RECORD_STACK, MAX_RECORD + 5 * (size_t)count, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)stack_id);
+        p = put_varint(p, (uint64_t)count);
+        FUNC_ID last = 0;
+        for (int i = 0; i < count; ++i) {
+            p = put_varint(p, zigzag((int64_t)frames[i] - last));
+            last = frames[i];
+        }
+        end_record(b, p);
+    }
+}
+
+static void FileWriteSample(int thread_id, int stack_id)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_SAMPLE, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)(DWORD)thread_id);
+        p = put_varint(p, (uint64_t)stack_id);
+        end_record(b, p);
+    }
+}
+
+static void FileWriteTaskCreate(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = get_string_id(name);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_TASK_CREATE, &b);
+    if (p) {
+        p = put_task_id(b, p, task_id);
+        p = put_varint(p, parent_id);
+        p = put_varint(p, name_id);
+        end_record(b, p);
+    }
+}
+
+// Steps are (opcode, task ID), and stops add the awaited ID and done flag.
+// A step usually starts and stops in the same chunk, so the stop's task ID
+// takes a single byte.
+static void FileWriteTaskStep(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_TASK_STEP, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        p = put_task_id(b, p, task_id);
+        if (opcode != 1) {
+            p = put_varint(p, awaiting_id);
+            *p++ = done ? 1 : 0;
+        }
+        end_record(b, p);
+    }
+}
+
+static void FileWriteCallback(LPCWSTR name, int opcode)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = get_string_id(name);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_CALLBACK, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        p = put_varint(p, name_id);
+        end_record(b, p);
+    }
+}
+
+// Activities are (opcode, activity ID), with the related ID after start and
+// stop (16 zero bytes for none) and the name after start.
+static void FileWriteActivity(int opcode, const GUID *activity_id, const GUID *related_id,
+                              LPCWSTR name)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = opcode == 1 ? get_string_id(name) : 0;
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_ACTIVITY, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        memcpy(p, activity_id, sizeof(GUID));
+        p += sizeof(GUID);
+        if (opcode == 1 || opcode == 2) {
+            if (related_id) {
+                memcpy(p, related_id, sizeof(GUID));
+            } else {
+                memset(p, 0, sizeof(GUID));
+            }
+            p += sizeof(GUID);
+        }
+        if (opcode == 1) {
+            p = put_varint(p, name_id);
+        }
+        end_record(b, p);
+    }
+}
+
+// Collections are (opcode, generation), with the counts and duration after
+// stop.
+static void FileWriteGC(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable,
+                        DWORD64 duration)
+{
+    if (!is_open()) {
+        return;
+    }
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_GC, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        *p++ = (unsigned char)generation;
+        if (opcode == 2) {
+            p = put_varint(p, collected);
+            p = put_varint(p, uncollectable);
+            p = put_varint(p, duration);
+        }
+        end_record(b, p);
+    }
+}
+
+// Imports are (opcode, name, detail), with the importing module as the
+// detail for start and how it was loaded for stop.
+static void FileWriteImport(int opcode, LPCWSTR name, LPCWSTR detail)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = get_string_id(name);
+    uint64_t detail_id = get_string_id(detail);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_IMPORT, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        p = put_varint(p, name_id);
+        p = put_varint(p, detail_id);
+        end_record(b, p);
+    }
+}
+
+// Allocations are (opcode, address), with the size, weight and stack ID
+// after an allocation.
+static void FileWriteAllocation(int opcode, void *address, DWORD64 size, DWORD64 weight,
+                                int stack_id)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_ALLOCATION, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        p = put_varint(p, (uint64_t)(uintptr_t)address);
+        if (opcode == 1) {
+            p = put_varint(p, size);
+            p = put_varint(p, weight);
+            p = put_varint(p, (uint64_t)stack_id);
+        }
+        end_record(b, p);
+    }
+}
+
+static void FileWriteExceptionType(int type_id, LPCWSTR name)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = get_string_id(name);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_EXCEPTION_TYPE, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)type_id);
+        p = put_varint(p, name_id);
+        end_record(b, p);
+    }
+}
+
+// Exceptions are (opcode, type ID, function ID, line).
+static void FileWriteException(int opcode, int type_id, FUNC_ID func_id, int line)
+{
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_EXCEPTION, &b);
+    if (p) {
+        *p++ = (unsigned char)opcode;
+        p = put_varint(p, (uint64_t)type_id);
+        p = put_func_id(b, p, func_id);
+        p = put_varint(p, zigzag(line));
+        end_record(b, p);
+    }
+}
+
+static void FileWriteMetricInfo(int metric_id, int kind, LPCWSTR name)
+{
+    if (!is_open()) {
+        return;
+    }
+    uint64_t name_id = get_string_id(name);
+    struct BUFFER *b;
+    unsigned char *p = begin_record(RECORD_METRIC_INFO, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)metric_id);
+        *p++ = (unsigned char)kind;
+        p = put_varint(p, name_id);
+        end_record(b, p);
+    }
+}
+
+// Metrics are (ID, count, sum, min, max, value, bucket count), with the
+// doubles stored as 8 bytes, followed by bucket count pairs of the bucket
+// index (as the difference from the previous index) and count.
+static void FileWriteMetric(int metric_id, DWORD count, double sum, double min, double max,
+                            double value, const DWORD *buckets, int bucket_count)
+{
+    struct BUFFER *b;
+    // Each pair takes at most 10 bytes
+    size_t size = MAX_RECORD + 10 * (size_t)bucket_count;
+    unsigned char *p = begin_sized_record(RECORD_METRIC, size, &b);
+    if (p) {
+        p = put_varint(p, (uint64_t)metric_id);
+        p = put_varint(p, count);
+        p = put_double(p, sum);
+        p = put_double(p, min);
+        p = put_double(p, max);
+        p = put_double(p, value);
+        p = put_varint(p, (uint64_t)bucket_count);
+        DWORD last = 0;
+        for (int i = 0; i < bucket_count; ++i) {
+            p = put_varint(p, buckets[2 * i] - last);
+            p = put_varint(p, buckets[2 * i + 1]);
+            last = buckets[2 * i];
+        }
+        end_record(b, p);
+    }
+}
+
+
+static const struct TRACE_SINK FILE_SINK = {
+    FileRegister,
+    FileUnregister,
+    FileWriteBeginThread,
+    FileWriteEndThread,
+    FileWriteEvalFunctionEvent,
+    FileWriteFunctionEvent,
+    FileWriteFunctionPush,
+    FileWriteFunctionPop,
+    FileWriteCustomEvent,
+    FileWriteStack,
+    FileWriteSample,
+    FileWriteTaskCreate,
+    FileWriteTaskStep,
+    FileWriteCallback,
+    FileWriteActivity,
+    FileWriteGC,
+    FileWriteImport,
+    FileWriteAllocation,
+    FileWriteExceptionType,
+    FileWriteException,
+    FileWriteMetricInfo,
+    FileWriteMetric,
+};
+
+
+// Without a file, events for subscribers are also written to the default
+// sink, so that ETW (or perf map) output continues while listening.
+static int TeeRegister(void)
+{
+    return DEFAULT_SINK.Register();
+}
+
+static int TeeUnregister(void)
+{
+    return DEFAULT_SINK.Unregister();
+}
+
+static void TeeWriteBeginThread(int thread_id)
+{
+    DEFAULT_SINK.WriteBeginThread(thread_id);
+    FileWriteBeginThread(thread_id);
+}
+
+static void TeeWriteEndThread(int thread_id)
+{
+    DEFAULT_SINK.WriteEndThread(thread_id);
+    FileWriteEndThread(thread_id);
+}
+
+static void TeeWriteEvalFunctionEvent(void *dll_handle)
+{
+    DEFAULT_SINK.WriteEvalFunctionEvent(dll_handle);
+}
+
+static void TeeWriteFunctionEvent(
+    FUNC_ID func_id,
+    void *begin_addr,
+    void *end_addr,
+    LPCWSTR source_file,
+    LPCWSTR name,
+    int line_no,
+    int is_python_code
+)
+{
+    DEFAULT_SINK.WriteFunctionEvent(func_id, begin_addr, end_addr, source_file, name, line_no,
+                                    is_python_code);
+    FileWriteFunctionEvent(func_id, begin_addr, end_addr, source_file, name, line_no,
+                           is_python_code);
+}
+
+static void TeeWriteFunctionPush(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id)
+{
+    DEFAULT_SINK.WriteFunctionPush(from_func_id, from_line, to_func_id);
+    FileWriteFunctionPush(from_func_id, from_line, to_func_id);
+}
+
+static void TeeWriteFunctionPop(FUNC_ID func_id)
+{
+    DEFAULT_SINK.WriteFunctionPop(func_id);
+    FileWriteFunctionPop(func_id);
+}
+
+static void TeeWriteCustomEvent(LPCWSTR name, int opcode)
+{
+    DEFAULT_SINK.WriteCustomEvent(name, opcode);
+    FileWriteCustomEvent(name, opcode);
+}
+
+static void TeeWriteStack(int stack_id, const FUNC_ID *frames, int count)
+{
+    DEFAULT_SINK.WriteStack(stack_id, frames, count);
+    FileWriteStack(stack_id, frames, count);
+}
+
+static void TeeWriteSample(int thread_id, int stack_id)
+{
+    DEFAULT_SINK.WriteSample(thread_id, stack_id);
+    FileWriteSample(thread_id, stack_id);
+}
+
+static void TeeWriteTaskCreate(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name)
+{
+    DEFAULT_SINK.WriteTaskCreate(task_id, parent_id, name);
+    FileWriteTaskCreate(task_id, parent_id, name);
+}
+
+static void TeeWriteTaskStep(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done)
+{
+    DEFAULT_SINK.WriteTaskStep(task_id, opcode, awaiting_id, done);
+    FileWriteTaskStep(task_id, opcode, awaiting_id, done);
+}
+
+static void TeeWriteCallback(LPCWSTR name, int opcode)
+{
+    DEFAULT_SINK.WriteCallback(name, opcode);
+    FileWriteCallback(name, opcode);
+}
+
+static void TeeWriteActivity(int opcode, const GUID *activity_id, const GUID *related_id,
+                             LPCWSTR name)
+{
+    DEFAULT_SINK.WriteActivity(opcode, activity_id, related_id, name);
+    FileWriteActivity(opcode, activity_id, related_id, name);
+}
+
+static void TeeWriteGC(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable,
+                       DWORD64 duration)
+{
+    DEFAULT_SINK.WriteGC(opcode, generation, collected, uncollectable, duration);
+    FileWriteGC(opcode, generation, collected, uncollectable, duration);
+}
+
+static void TeeWriteImport(int opcode, LPCWSTR name, LPCWSTR detail)
+{
+    DEFAULT_SINK.WriteImport(opcode, name, detail);
+    FileWriteImport(opcode, name, detail);
+}
+
+static void TeeWriteAllocation(int opcode, void *address, DWORD64 size, DWORD64 weight,
+                               int stack_id)
+{
+    DEFAULT_SINK.WriteAllocation(opcode, address, size, weight, stack_id);
+    FileWriteAllocation(opcode, address, size, weight, stack_id);
+}
+
+static void TeeWriteExceptionType(int type_id, LPCWSTR name)
+{
+    DEFAULT_SINK.WriteExceptionType(type_id, name);
+    FileWriteExceptionType(type_id, name);
+}
+
+static void TeeWriteException(int opcode, int type_id, FUNC_ID func_id, int line)
+{
+    DEFAULT_SINK.WriteException(opcode, type_id, func_id, line);
+    FileWriteException(opcode, type_id, func_id, line);
+}
+
+static void TeeWriteMetricInfo(int metric_id, int kind, LPCWSTR name)
+{
+    DEFAULT_SINK.WriteMetricInfo(metric_id, kind, name);
+    FileWriteMetricInfo(metric_id, kind, name);
+}
+
+static void TeeWriteMetric(int metric_id, DWORD count, double sum, double min, double max,
+                           double value, const DWORD *buckets, int bucket_count)
+{
+    DEFAULT_SINK.WriteMetric(metric_id, count, sum, min, max, value, buckets, bucket_count);
+    FileWriteMetric(metric_id, count, sum, min, max, value, buckets, bucket_count);
+}
+
+
+static const struct TRACE_SINK TEE_SINK = {
+    TeeRegister,
+    TeeUnregister,
+    TeeWriteBeginThread,
+    TeeWriteEndThread,
+    TeeWriteEvalFunctionEvent,
+    TeeWriteFunctionEvent,
+    TeeWriteFunctionPush,
+    TeeWriteFunctionPop,
+    TeeWriteCustomEvent,
+    TeeWriteStack,
+    TeeWriteSample,
+    TeeWriteTaskCreate,
+    TeeWriteTaskStep,
+    TeeWriteCallback,
+    TeeWriteActivity,
+    TeeWriteGC,
+    TeeWriteImport,
+    TeeWriteAllocation,
+    TeeWriteExceptionType,
+    TeeWriteException,
+    TeeWriteMetricInfo,
+    TeeWriteMetric,
+};
+
+
+// A file replaces the default sink, while subscribers alone are added to it.
+// Called whenever the file or listener changes, which happens outside of
+// enable and disable so that Register and Unregister go to the same sink.
+static void select_sink(void)
+{
+    if (file) {
+        CurrentSink = &FILE_SINK;
+    } else if (listening) {
+        CurrentSink = &TEE_SINK;
+    } else {
+        CurrentSink = &DEFAULT_SINK;
+    }
+}
+
+
+// Starts recording events with new buffers and strings, unless they are
+// already being recorded for a file or subscribers.
+static int open_buffers(void)
+{
+    if (is_open()) {
+        return 0;
+    }
+    strings = PyDict_New();
+    if (!strings) {
+        return -1;
+    }
+    // Invalidates every thread's previous buffer
+    ++session;
+    return 0;
+}
+
+
+// Stops recording events. Buffers must already be flushed.
+static void close_buffers(void)
+{
+    struct BUFFER *b = buffers;
+    while (b) {
+        struct BUFFER *next = b->next;
+        free(b);
+        b = next;
+    }
+    buffers = NULL;
+    free(pending_strings);
+    pending_strings = NULL;
+    pending_used = pending_size = 0;
+    Py_CLEAR(strings);
+    memset(string_cache, 0, sizeof(string_cache));
+    // Invalidates every thread's buffer
+    ++session;
+}
+
+
+static void discard_queue(void)
+{
+    struct QUEUED_CHUNK *chunk = queue_head;
+    while (chunk) {
+        struct QUEUED_CHUNK *next = chunk->next;
+        free(chunk);
+        chunk = next;
+    }
+    queue_head = queue_tail = NULL;
+    queue_size = 0;
+    queue_dropped = 0;
+}
+
+
+static int close_output(void)
+{
+    if (!file) {
+        return 0;
+    }
+    flush_all_buffers();
+    if (!listening) {
+        close_buffers();
+    }
+    if (fclose(file) && !write_error) {
+        write_error = errno ? errno : EIO;
+    }
+    file = NULL;
+    select_sink();
+
+    if (write_error) {
+        errno = write_error;
+        write_error = 0;
+        PyErr_SetFromErrno(PyExc_OSError);
+        return -1;
+    }
+    return 0;
+}
+
+
+static int open_output(PyObject *path)
+{
+    FILE *f = NULL;
+#ifdef _WIN32
+    PyObject *decoded = NULL;
+    if (!PyUnicode_FSDecoder(path, &decoded)) {
+        return -1;
+    }
+    wchar_t *wpath = PyUnicode_AsWideCharString(decoded, NULL);
+    if (wpath) {
+        f = _wfopen(wpath, L"wb");
+        if (!f) {
+            PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, decoded);
+        }
+        PyMem_Free(wpath);
+    }
+    Py_DECREF(decoded);
+#else
+    PyObject *encoded = NULL;
+    if (!PyUnicode_FSConverter(path, &encoded)) {
+        return -1;
+    }
+    f = fopen(PyBytes_AS_STRING(encoded), "wb");
+    if (!f) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+    }
+    Py_DECREF(encoded);
+#endif
+    if (!f) {
+        return -1;
+    }
+
+    if (open_buffers() < 0) {
+        fclose(f);
+        return -1;
+    }
+    setvbuf(f, NULL, _IOFBF, FILE_BUFFER_SIZE);
+    file = f;
+    select_sink();
+    write_error = 0;
+
+    unsigned char header[24] = "PYTRACE";
+    put_le(&header[8], FILESINK_VERSION, 4);
+    put_le(&header[12], GetCurrentProcessId(), 4);
+    put_le(&header[16], get_timestamp(), 8);
+    write_bytes(header, sizeof(header));
+    return 0;
+}
+
+
+PyObject *FILESINK_set_output(PyObject *module, PyObject *args)
+{
+    PyObject *path;
+    if (!PyArg_ParseTuple(args, "O:set_output", &path)) {
+        return NULL;
+    }
+    if (close_output() < 0) {
+        return NULL;
+    }
+    if (path != Py_None && open_output(path) < 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+PyObject *FILESINK_start_listener(PyObject *module, PyObject *args)
+{
+    Py_ssize_t limit;
+    unsigned long long keywords = 0;
+    if (!PyArg_ParseTuple(args, "n|K:start_listener", &limit, &keywords)) {
+        return NULL;
+    }
+    if (listening) {
+        PyErr_SetString(PyExc_RuntimeError, "events are already queued for subscribers");
+        return NULL;
+    }
+    if (open_buffers() < 0) {
+        return NULL;
+    }
+    queue_limit = limit > 0 ? (size_t)limit : 0;
+    queue_keywords = keywords;
+    listening = 1;
+    select_sink();
+    Py_RETURN_NONE;
+}
+
+
+// Returns every chunk queued since the last call, including those still in
+// each thread's buffer, as one bytes object, with the number of records
+// dropped since the last call.
+static PyObject *take_queue(void)
+{
+    flush_all_buffers();
+    // Allocating the result may flush more chunks, which are left for the
+    // next call
+    struct QUEUED_CHUNK *chunk = queue_head;
+    size_t size = queue_size;
+    uint64_t dropped = queue_dropped;
+    queue_head = queue_tail = NULL;
+    queue_size = 0;
+    queue_dropped = 0;
+
+    PyObject *data = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)size);
+    unsigned char *p = data ? (unsigned char *)PyBytes_AS_STRING(data) : NULL;
+    while (chunk) {
+        struct QUEUED_CHUNK *next = chunk->next;
+        if (p) {
+            memcpy(p, chunk + 1, chunk->size);
+            p += chunk->size;
+        }
+        free(chunk);
+        chunk = next;
+    }
+    if (!data) {
+        return NULL;
+    }
+    return Py_BuildValue("NK", data, (unsigned long long)dropped);
+}
+
+
+PyObject *FILESINK_read_listener(PyObject *module, PyObject *args)
+{
+    unsigned long long keywords = 0;
+    if (!PyArg_ParseTuple(args, "|K:read_listener", &keywords)) {
+        return NULL;
+    }
+    if (!listening) {
+        PyErr_SetString(PyExc_RuntimeError, "events are not queued for subscribers");
+        return NULL;
+    }
+    PyObject *result = take_queue();
+    queue_keywords = keywords;
+    return result;
+}
+
+
+PyObject *FILESINK_stop_listener(PyObject *module, PyObject *args)
+{
+    if (!listening) {
+        PyErr_SetString(PyExc_RuntimeError, "events are not queued for subscribers");
+        return NULL;
+    }
+    PyObject *result = take_queue();
+    listening = 0;
+    select_sink();
+    queue_limit = 0;
+    queue_keywords = 0;
+    discard_queue();
+    if (!file) {
+        close_buffers();
+    }
+    return result;
+}
@@ -1,5 +1,7 @@
 #pragma once
 
+#include <stdint.h>
+
 // Must be no larger than sizeof(void *), as it is reported as pointer sized
 // in ETW events.
 typedef int FUNC_ID;
@@ -10,17 +12,11 @@ typedef int FUNC_ID;
 #define FUNC_ID_IS_VALID(f) ((f) > 0)
 
 static inline FUNC_ID Void_AsFUNC_ID(void *v) {
-#pragma warning(push)
-#pragma warning(disable: 4302 4311)
-    return (FUNC_ID)v;
-#pragma warning(pop)
+    return (FUNC_ID)(intptr_t)v;
 }
 
 static inline void *Void_FromFUNC_ID(FUNC_ID v) {
-#pragma warning(push)
-#pragma warning(disable: 4312)
-    return (void *)v;
-#pragma warning(pop)
+    return (void *)(intptr_t)v;
 }
 
 #define FUNC_ID_FIRST (FUNC_ID)1
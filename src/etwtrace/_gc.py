@@ -0,0 +1,240 @@
+"""Reports garbage collection pauses from GC events.
+
+Tracers enabled with gc=True add a native callback to gc.callbacks that
+raises a PythonGC start event when a collection begins and a stop event with
+the number of objects collected and found uncollectable, and the duration of
+the collection, when it ends. GCAnalyzer pairs these events up and totals
+the pause time for each generation.
+
+Stack samples taken on the collecting thread during a pause are counted
+against the pause, and when events are symbolized, the innermost Python
+frame of each is recorded, which is typically the allocation that started
+the collection. SamplingTracer needs the GIL to take a sample, so only ETW
+stack samples can fall inside a pause. mark_range() spans that were open
+on any thread of the process when a pause ended are listed with the pause,
+and each span name is totalled with the pause time it contained.
+"""
+
+from . import _symbolize
+
+
+class GCPause:
+    """One collection.
+
+    functions maps the innermost Python frame of each sample in the pause
+    to the number of samples, and marks lists the names of the mark_range
+    spans that were open."""
+    __slots__ = ('process_id', 'thread_id', 'generation', 'start', 'end', 'collected',
+                 'uncollectable', '_duration', 'samples', 'functions', 'marks')
+
+    def __init__(self, process_id, thread_id, generation, timestamp):
+        self.process_id = process_id
+        self.thread_id = thread_id
+        self.generation = generation
+        self.start = timestamp
+        self.end = None
+        self.collected = 0
+        self.uncollectable = 0
+        self._duration = 0
+        self.samples = 0
+        self.functions = {}
+        self.marks = []
+
+    @property
+    def duration(self):
+        """The duration measured by the tracer, or the time between the
+        events if it was not recorded."""
+        if self._duration:
+            return self._duration
+        return (self.end - self.start) if self.end is not None else 0
+
+    def __repr__(self):
+        return f"<GCPause(generation={self.generation}, duration={self.duration})>"
+
+
+class GenerationInfo:
+    """Totals for collections of one generation."""
+    __slots__ = ('generation', 'count', 'total', 'longest', 'collected', 'uncollectable')
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.count = 0
+        self.total = 0
+        self.longest = 0
+        self.collected = 0
+        self.uncollectable = 0
+
+    def __repr__(self):
+        return f"<GenerationInfo({self.generation}, count={self.count}, total={self.total})>"
+
+
+class MarkInfo:
+    """Totals for mark_range() spans with the same name.
+
+    affected is the number of spans that contained at least one pause."""
+    __slots__ = ('name', 'count', 'affected', 'pauses', 'pause_time')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.affected = 0
+        self.pauses = 0
+        self.pause_time = 0
+
+    def __repr__(self):
+        return f"<MarkInfo({self.name!r}, pauses={self.pauses})>"
+
+
+class GCAnalyzer:
+    """Accumulates collections from PythonGC events.
+
+    pauses lists every completed collection, and generations and marks
+    total them by generation and by the mark_range() spans they fell in.
+    Samples only name the frame that triggered a pause when add() is
+    passed their frames.
+    """
+
+    def __init__(self):
+        self.pauses = []
+        self.generations = {}
+        self.marks = {}
+        self.unmatched_stops = 0
+        # The pause in progress on each thread
+        self._collecting = {}
+        # Stack samples on a collecting thread that are waiting for their
+        # stack event
+        self._pending_samples = {}
+        # [pause count, pause time] for each open span, by process and then
+        # by (thread, name)
+        self._open_marks = {}
+
+    def _mark(self, name):
+        m = self.marks.get(name)
+        if m is None:
+            m = self.marks[name] = MarkInfo(name)
+        return m
+
+    def add(self, event, frames=None):
+        name = event.event_name
+        if name == 'PythonGC':
+            if event.opcode == 1:
+                self._collecting[event.thread_id] = GCPause(
+                    event.process_id, event.thread_id, event['Generation'].value, event.timestamp)
+            elif event.opcode == 2:
+                pause = self._collecting.pop(event.thread_id, None)
+                if pause is None:
+                    self.unmatched_stops += 1
+                    return
+                self._stop(pause, event)
+            return
+
+        if name == 'PythonMark':
+            if event.opcode not in (1, 2):
+                return
+            key = event.thread_id, event['Mark'].value
+            spans = self._open_marks.setdefault(event.process_id, {})
+            if event.opcode == 1:
+                spans.setdefault(key, []).append([0, 0])
+                return
+            stack = spans.get(key)
+            if not stack:
+                return
+            pauses, pause_time = stack.pop()
+            if not stack:
+                del spans[key]
+            m = self._mark(key[1])
+            m.count += 1
+            if pauses:
+                m.affected += 1
+                m.pauses += pauses
+                m.pause_time += pause_time
+            return
+
+        if event.is_stack_sample:
+            pause = self._collecting.get(event.thread_id)
+            if pause is not None:
+                pause.samples += 1
+                self._pending_samples[event.thread_id] = pause
+            return
+        if name == 'PythonSample':
+            pause = self._collecting.get(event['ThreadID'].value)
+            if pause is not None:
+                pause.samples += 1
+                self._add_frames(pause, frames)
+            return
+        if frames is not None and event.opcode_name == 'Stack':
+            pause = self._pending_samples.pop(event.thread_id, None)
+            if pause is not None:
+                self._add_frames(pause, frames)
+
+    def _add_frames(self, pause, frames):
+        if not frames:
+            return
+        for f in frames:
+            if f.kind == 'python':
+                key = str(f)
+                pause.functions[key] = pause.functions.get(key, 0) + 1
+                return
+
+    def _stop(self, pause, event):
+        pause.end = event.timestamp
+        pause.collected = event['Collected'].value
+        pause.uncollectable = event['Uncollectable'].value
+        pause._duration = event['Duration'].value
+        self.pauses.append(pause)
+
+        g = self.generations.get(pause.generation)
+        if g is None:
+            g = self.generations[pause.generation] = GenerationInfo(pause.generation)
+        duration = pause.duration
+        g.count += 1
+        g.total += duration
+        if duration > g.longest:
+            g.longest = duration
+        g.collected += pause.collected
+        g.uncollectable += pause.uncollectable
+
+        for (_, name), stack in self._open_marks.get(pause.process_id, {}).items():
+            for span in stack:
+                span[0] += 1
+                span[1] += duration
+            if name not in pause.marks:
+                pause.marks.append(name)
+
+    def finish(self):
+        """Discards collections still in progress at the end of the trace."""
+        self._collecting.clear()
+        self._pending_samples.clear()
+
+    @property
+    def total(self):
+        return sum(g.total for g in self.generations.values())
+
+    def longest_pauses(self, count=None):
+        pauses = sorted(self.pauses, key=lambda p: p.duration, reverse=True)
+        return pauses[:count] if count else pauses
+
+    def functions(self):
+        """Returns the number of samples in pauses for each innermost Python
+        frame, most first."""
+        totals = {}
+        for p in self.pauses:
+            for key, n in p.functions.items():
+                totals[key] = totals.get(key, 0) + n
+        return sorted(totals.items(), key=lambda i: i[1], reverse=True)
+
+
+def analyze(events, *, symbolize=True):
+    """Returns a finished GCAnalyzer for events.
+
+    Python frames are resolved for samples unless symbolize is False."""
+    a = GCAnalyzer()
+    if symbolize:
+        symbolizer = _symbolize.Symbolizer(native=False)
+        for event, frames in symbolizer.symbolize_events(events, all_events=True):
+            a.add(event, frames)
+    else:
+        for event in events:
+            a.add(event)
+    a.finish()
+    return a
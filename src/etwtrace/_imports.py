@@ -0,0 +1,139 @@
+"""Reconstructs import trees from import events.
+
+Tracers enabled with imports=True raise a PythonImport start event with the
+module name and the module that imported it, and a stop event with how the
+module was loaded, around every import (see _importtrace.py). Imports made
+while another is in progress on the same thread are nested within it. From
+these, ImportAnalyzer builds the tree of imports with the cumulative and
+self time of each, as reported by -X importtime.
+
+Stack samples (from ETW or SamplingTracer) taken on a thread while it is
+importing are counted against the innermost import in progress, so that
+time spent executing a module can be told apart from waiting for the GIL or
+for I/O. Imports still in progress at the end of the trace end with the
+last event.
+"""
+
+
+class ImportInfo:
+    """One import of a module.
+
+    importer is the name of the module whose code performed the import, and
+    parent is the import that was in progress when it started, if any."""
+    __slots__ = ('process_id', 'thread_id', 'name', 'importer', 'parent', 'children',
+                 'start', 'end', 'origin', 'samples')
+
+    def __init__(self, process_id, thread_id, name, importer, parent, timestamp):
+        self.process_id = process_id
+        self.thread_id = thread_id
+        self.name = name
+        self.importer = importer
+        self.parent = parent
+        self.children = []
+        self.start = timestamp
+        self.end = None
+        self.origin = None
+        self.samples = 0
+        if parent:
+            parent.children.append(self)
+
+    @property
+    def cumulative(self):
+        return (self.end if self.end is not None else self.start) - self.start
+
+    @property
+    def self_time(self):
+        return self.cumulative - sum(c.cumulative for c in self.children)
+
+    @property
+    def inclusive_samples(self):
+        return self.samples + sum(c.inclusive_samples for c in self.children)
+
+    def __repr__(self):
+        return f"<ImportInfo({self.name!r}, cumulative={self.cumulative})>"
+
+
+class ImportAnalyzer:
+    """Accumulates import trees from PythonImport events.
+
+    imports lists every import in the order it started, nested ones
+    included. Follow parent and children for the tree.
+    """
+
+    def __init__(self):
+        self.imports = []
+        self.unmatched_stops = 0
+        # The imports in progress on each thread, innermost last
+        self._stacks = {}
+        self._finished = False
+
+    def add(self, event):
+        name = event.event_name
+        if name == 'PythonImport':
+            stack = self._stacks.setdefault(event.thread_id, [])
+            module = event['Name'].value
+            if event.opcode == 1:
+                i = ImportInfo(event.process_id, event.thread_id, module,
+                               event['Parent'].value, stack[-1] if stack else None, event.timestamp)
+                self.imports.append(i)
+                stack.append(i)
+                return
+            for depth in range(len(stack) - 1, -1, -1):
+                if stack[depth].name == module:
+                    break
+            else:
+                self.unmatched_stops += 1
+                return
+            # Imports inside this one that did not stop end with it
+            for i in stack[depth:]:
+                i.end = event.timestamp
+            stack[depth].origin = event['Origin'].value
+            del stack[depth:]
+            return
+
+        if event.is_stack_sample:
+            thread_id = event.thread_id
+        elif name == 'PythonSample':
+            thread_id = event['ThreadID'].value
+        else:
+            return
+        stack = self._stacks.get(thread_id)
+        if stack:
+            stack[-1].samples += 1
+
+    def finish(self, timestamp=None):
+        """Ends imports that are still in progress at the end of the trace."""
+        if self._finished:
+            return
+        self._finished = True
+        for stack in self._stacks.values():
+            for i in stack:
+                i.end = timestamp if timestamp is not None else i.start
+        self._stacks.clear()
+
+    def roots(self):
+        """Returns imports that were not nested in another, in order."""
+        return [i for i in self.imports if i.parent is None]
+
+    def top_imports(self, key='self_time', count=None):
+        imports = sorted(self.imports, key=lambda i: getattr(i, key), reverse=True)
+        return imports[:count] if count else imports
+
+    def by_origin(self):
+        """Returns a dict mapping each origin to (imports, total self time)."""
+        origins = {}
+        for i in self.imports:
+            count, total = origins.get(i.origin, (0, 0))
+            origins[i.origin] = count + 1, total + i.self_time
+        return origins
+
+
+def analyze(events):
+    """Returns a finished ImportAnalyzer for events."""
+    a = ImportAnalyzer()
+    last = None
+    for e in events:
+        a.add(e)
+        last = e.timestamp
+    a.finish(last)
+    return a
@@ -0,0 +1,111 @@
+"""Raises events for module imports.
+
+Every import of a module that is not already in sys.modules is performed by
+importlib._bootstrap._find_and_load, which the interpreter looks up on the
+frozen importlib module each time. This is replaced while tracing to raise
+a PythonImport start/stop pair around each import, so nested imports are
+nested pairs on the same thread, as with -X importtime.
+
+The start event has the name of the module whose code performed the import
+(skipping importlib's own frames), which is the parent import for nested
+imports and otherwise the module that imported at runtime. The stop event
+has how the module was loaded: source, bytecode (from a cached .pyc),
+extension, builtin, frozen, namespace, or error if the import failed. The
+loader's type name is used for other loaders. Source imports are detected
+by replacing SourceLoader.source_to_code, which is only called when there
+is no usable cached bytecode.
+
+Imports made before tracing is enabled are not seen. When tracing starts
+from the .pth file written by "python -m etwtrace --enable", this is
+everything imported before site processes .pth files.
+"""
+
+import sys
+
+from importlib import _bootstrap, _bootstrap_external
+
+# Frames to skip when looking for the importer, including our own hook,
+# which is on the stack when importing a submodule imports its package
+_IMPORTLIB_MODULES = frozenset({
+    "importlib", "importlib._bootstrap", "importlib._bootstrap_external",
+    "_frozen_importlib", "_frozen_importlib_external", __name__,
+})
+
+_LOADER_ORIGINS = {
+    _bootstrap.BuiltinImporter: "builtin",
+    _bootstrap.FrozenImporter: "frozen",
+    _bootstrap_external.ExtensionFileLoader: "extension",
+    _bootstrap_external.SourcelessFileLoader: "bytecode",
+    _bootstrap_external.SourceFileLoader: "bytecode",
+}
+
+
+def _importer():
+    frame = sys._getframe(2)
+    while frame:
+        name = frame.f_globals.get("__name__")
+        if name not in _IMPORTLIB_MODULES:
+            return name or ""
+        frame = frame.f_back
+    return ""
+
+
+def _origin(name, compiled):
+    module = sys.modules.get(name)
+    spec = getattr(module, "__spec__", None)
+    if spec is None:
+        return "builtin" if name in sys.builtin_module_names else ""
+    loader = spec.loader
+    if loader is None or spec.origin is None and spec.submodule_search_locations is not None:
+        return "namespace"
+    loader_type = loader if isinstance(loader, type) else type(loader)
+    for t in loader_type.__mro__:
+        origin = _LOADER_ORIGINS.get(t)
+        if origin:
+            if origin == "bytecode" and name in compiled:
+                return "source"
+            return origin
+    return loader_type.__name__
+
+
+class ImportHooks:
+    """Replaces importlib's _find_and_load to write an import event around
+    each import, until uninstalled."""
+
+    def __init__(self, module):
+        self._module = module
+        self._find_and_load = None
+        self._source_to_code = None
+
+    def install(self):
+        write_import = self._module.write_import
+        find_and_load = self._find_and_load = _bootstrap._find_and_load
+        source_to_code = self._source_to_code = _bootstrap_external.SourceLoader.source_to_code
+        # Names of modules compiled from source during their import
+        compiled = set()
+
+        def traced_find_and_load(name, import_):
+            write_import(name, 1, _importer())
+            origin = "error"
+            try:
+                module = find_and_load(name, import_)
+                origin = _origin(name, compiled)
+                return module
+            finally:
+                compiled.discard(name)
+                write_import(name, 2, origin)
+
+        def traced_source_to_code(self, *args, **kwargs):
+            name = getattr(self, "name", None)
+            if name:
+                compiled.add(name)
+            return source_to_code(self, *args, **kwargs)
+
+        _bootstrap._find_and_load = traced_find_and_load
+        _bootstrap_external.SourceLoader.source_to_code = traced_source_to_code
+
+    def uninstall(self):
+        if self._find_and_load is not None:
+            _bootstrap._find_and_load = self._find_and_load
+            _bootstrap_external.SourceLoader.source_to_code = self._source_to_code
+            self._find_and_load = self._source_to_code = None
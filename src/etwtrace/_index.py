@@ -0,0 +1,390 @@
+"""Sidecar index files for ETL traces.
+
+Decoding a large ETL file is slow, and analysis often runs several queries
+against the same capture. build() decodes a trace once and writes a sidecar
+file next to it (trace.etl.etwidx) containing:
+
+* event counts and time ranges for each process, provider and event name
+* process and thread start records
+* the function table from PythonFunction events
+* for each buffer, its offset, time range, processes and event names
+* optionally, the decoded timestamp, process, thread, event name and record
+  offset of every event as fixed-width columns
+
+open() uses a valid sidecar to read only the buffers that may contain
+matching events, and load() provides the summary and columns without
+reading the trace at all.
+
+The file starts with a magic number and the length of a JSON header, which
+is followed by the columns. Each column is 8-byte aligned so it can be used
+directly from a memory map. A sidecar is only used if the size, modification
+time and a hash of the start and end of the trace match those recorded when
+it was built.
+"""
+
+import array
+import bisect
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+
+from . import _etlreader as R
+
+SUFFIX = '.etwidx'
+MAGIC = b'ETWIDX\x00\x01'
+_PREFIX = struct.Struct('<8sQ')
+
+# Amount of data at each end of the trace that is hashed
+_HASH_BLOCK = 1024 * 1024
+
+COLUMNS = {
+    'timestamp': 'q',
+    'process_id': 'i',
+    'thread_id': 'i',
+    'event': 'I',
+    'offset': 'Q',
+}
+
+
+class IndexFormatError(ValueError):
+    pass
+
+
+def index_path(path):
+    return os.fspath(path) + SUFFIX
+
+
+def _fingerprint(path):
+    st = os.stat(path)
+    h = hashlib.blake2b(digest_size=16)
+    with io.open(path, 'rb') as f:
+        h.update(f.read(_HASH_BLOCK))
+        if st.st_size > _HASH_BLOCK:
+            f.seek(max(_HASH_BLOCK, st.st_size - _HASH_BLOCK))
+            h.update(f.read())
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': h.hexdigest()}
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class _Builder:
+    def __init__(self, columns):
+        self.names = {}
+        self.counts = {}
+        self.processes = []
+        self.threads = {}
+        self.functions = {}
+        self.buffer_pids = []
+        self.buffer_events = []
+        self.buffer_first = array.array('q')
+        self.buffer_last = array.array('q')
+        self.columns = {k: array.array(t) for k, t in COLUMNS.items()} if columns else None
+
+    def name_id(self, ed):
+        key = ed.provider_name or str(ed.provider), ed.event_name or ed.task_name or '', ed.opcode_name or ''
+        i = self.names.get(key)
+        if i is None:
+            i = self.names[key] = len(self.names)
+        return i
+
+    def add(self, b, ed, offset):
+        ts = ed.timestamp
+        pid = ed.process_id
+        name = self.name_id(ed)
+        if ts < self.buffer_first[b]:
+            self.buffer_first[b] = ts
+        if ts > self.buffer_last[b]:
+            self.buffer_last[b] = ts
+        self.buffer_pids[b].add(pid)
+        self.buffer_events[b].add(name)
+
+        key = pid, name
+        c = self.counts.get(key)
+        if c is None:
+            self.counts[key] = [1, ts, ts]
+        else:
+            c[0] += 1
+            c[2] = ts
+
+        if self.columns:
+            cols = self.columns
+            cols['timestamp'].append(ts)
+            cols['process_id'].append(pid)
+            cols['thread_id'].append(ed.thread_id)
+            cols['event'].append(name)
+            cols['offset'].append(offset)
+
+        if ed.task_name == 'Process' and ed.opcode_name in ('Start', 'DCStart', 'End', 'DCEnd'):
+            self.processes.append({
+                'opcode': ed.opcode_name,
+                'timestamp': ts,
+                'process_id': ed.get('ProcessId'),
+                'parent_id': ed.get('ParentId'),
+                'image': ed.get('ImageFileName'),
+            })
+        elif ed.task_name == 'Thread' and ed.opcode_name in ('Start', 'DCStart'):
+            self.threads[ed.get('TThreadId')] = ed.get('ProcessId')
+        elif ed.event_name == 'PythonFunction':
+            self.functions[pid, ed.get('FunctionID')] = [
+                pid,
+                ed.get('FunctionID'),
+                ed.get('Name'),
+                ed.get('SourceFile'),
+                ed.get('LineNumber'),
+                ed.get('BeginAddress'),
+                ed.get('EndAddress'),
+            ]
+
+
+def build(path, *, columns=False):
+    """Decodes the trace at path and writes its sidecar index.
+
+    Returns the loaded TraceIndex."""
+    path = os.fspath(path)
+    source = _fingerprint(path)
+    b = _Builder(columns)
+    with R.EtlReader(path) as reader:
+        data = reader._data
+        buffers = R._read_buffers(data) if data else []
+        starts = [buf.offset for buf in buffers]
+        for _ in buffers:
+            b.buffer_pids.append(set())
+            b.buffer_events.append(set())
+            b.buffer_first.append(2 ** 63 - 1)
+            b.buffer_last.append(-1)
+        to_filetime = reader.header.to_filetime
+        for raw, offset, header_type in reader._records():
+            ed = reader._read_record(offset, header_type, to_filetime(raw))
+            if ed is not None:
+                b.add(bisect.bisect_right(starts, offset) - 1, ed, offset)
+
+    arrays = {
+        'buffer_offset': array.array('Q', starts),
+        'buffer_first': b.buffer_first,
+        'buffer_last': b.buffer_last,
+    }
+    if b.columns:
+        arrays.update(b.columns)
+    layout = {}
+    pos = 0
+    for k, a in arrays.items():
+        layout[k] = [a.typecode, pos, len(a)]
+        pos = _align(pos + len(a) * a.itemsize)
+
+    names = list(b.names)
+    header = {
+        'source': source,
+        'byteorder': sys.byteorder,
+        'names': names,
+        'counts': [[pid, name, *c] for (pid, name), c in b.counts.items()],
+        'processes': b.processes,
+        'threads': [[tid, pid] for tid, pid in b.threads.items()],
+        'functions': list(b.functions.values()),
+        'buffer_process_ids': [sorted(s) for s in b.buffer_pids],
+        'buffer_events': [sorted(s) for s in b.buffer_events],
+        'columns': bool(b.columns),
+        'arrays': layout,
+    }
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    out = index_path(path)
+    tmp = out + '.tmp'
+    with io.open(tmp, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        for k, a in arrays.items():
+            f.write(a.tobytes())
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+    os.replace(tmp, out)
+    return TraceIndex(out)
+
+
+def load(path):
+    """Returns the TraceIndex for the trace at path, or None if there is no
+    sidecar or the trace has changed since it was built."""
+    path = os.fspath(path)
+    try:
+        index = TraceIndex(index_path(path))
+    except (OSError, IndexFormatError):
+        return None
+    try:
+        if index.source != _fingerprint(path):
+            index.close()
+            return None
+    except OSError:
+        index.close()
+        return None
+    return index
+
+
+class TraceIndex:
+    """A loaded sidecar index.
+
+    Summary attributes are plain lists and dicts from the JSON header, and
+    columns are memoryviews over the memory mapped file. Release any
+    columns before calling close() (or leaving the with block)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._file = io.open(path, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = _PREFIX.unpack_from(self._data, 0)
+            if magic != MAGIC:
+                raise IndexFormatError(f"{path} is not an index file")
+            h = json.loads(bytes(self._data[_PREFIX.size:_PREFIX.size + length]))
+            if h['byteorder'] != sys.byteorder:
+                raise IndexFormatError(f"{path} was created on an incompatible platform")
+        except (ValueError, struct.error, KeyError) as ex:
+            self.close()
+            if isinstance(ex, IndexFormatError):
+                raise
+            raise IndexFormatError(f"{path} is not a valid index file") from None
+        except Exception:
+            self.close()
+            raise
+        self._base = _align(_PREFIX.size + length)
+        self._arrays = h['arrays']
+        self.source = h['source']
+        self.names = [tuple(n) for n in h['names']]
+        self.processes = h['processes']
+        self.thread_pids = {tid: pid for tid, pid in h['threads']}
+        self.functions = h['functions']
+        self.has_columns = h['columns']
+        self._counts = h['counts']
+        self._buffer_pids = h['buffer_process_ids']
+        self._buffer_events = h['buffer_events']
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _array(self, name):
+        typecode, offset, count = self._arrays[name]
+        start = self._base + offset
+        size = array.array(typecode).itemsize
+        return memoryview(self._data)[start:start + count * size].cast(typecode)
+
+    def column(self, name):
+        """Returns a memoryview of a decoded column.
+
+        Columns are timestamp, process_id, thread_id, event (an index into
+        names) and offset (of the record in the trace). Only available if
+        the index was built with columns=True."""
+        if not self.has_columns or name not in COLUMNS:
+            raise KeyError(name)
+        return self._array(name)
+
+    def counts(self):
+        """Yields (process_id, (provider, event, opcode), count, first, last)
+        for each combination of process and event in the trace."""
+        for pid, name, count, first, last in self._counts:
+            yield pid, self.names[name], count, first, last
+
+    def time_range(self):
+        first = [c[3] for c in self._counts]
+        last = [c[4] for c in self._counts]
+        if not first:
+            return None, None
+        return min(first), max(last)
+
+    def _descendants(self, process_ids):
+        tracked = set(process_ids)
+        for p in self.processes:
+            if p['opcode'] in ('Start', 'DCStart') and p['parent_id'] in tracked:
+                tracked.add(p['process_id'])
+        return tracked
+
+    def select_buffers(self, *, process_ids=None, include_child_process_ids=True,
+                       provider_names=None, event_names=None, start_time=None, end_time=None):
+        """Returns the offsets of buffers that may contain matching events,
+        or None if every buffer is needed."""
+        keep_kernel = False
+        pids = None
+        if process_ids:
+            pids = set(process_ids)
+            if include_child_process_ids:
+                pids = self._descendants(pids)
+                # Process events update which processes are tracked
+                keep_kernel = True
+        names = None
+        if provider_names or event_names:
+            providers = {n.lower() for n in provider_names} if provider_names else None
+            events = {n.lower() for n in event_names} if event_names else None
+            names = {
+                i for i, (provider, event, _) in enumerate(self.names)
+                if (providers is None or provider.lower() in providers)
+                and (events is None or event.lower() in events)
+            }
+        if pids is None and names is None and start_time is None and end_time is None:
+            return None
+        kernel = {
+            i for i, (provider, event, _) in enumerate(self.names)
+            if provider == 'MSNT_SystemTrace' and event == 'Process'
+        }
+        if start_time is not None:
+            start_time = R._to_filetime(start_time)
+        if end_time is not None:
+            end_time = R._to_filetime(end_time)
+
+        offsets = self._array('buffer_offset')
+        first = self._array('buffer_first')
+        last = self._array('buffer_last')
+        result = []
+        for i in range(len(offsets)):
+            if last[i] < 0:
+                continue
+            if end_time is not None and first[i] > end_time:
+                continue
+            events = self._buffer_events[i]
+            # Process events before the window still update which processes
+            # are tracked
+            if keep_kernel and not kernel.isdisjoint(events):
+                result.append(offsets[i])
+                continue
+            if start_time is not None and last[i] < start_time:
+                continue
+            if pids is not None and pids.isdisjoint(self._buffer_pids[i]):
+                continue
+            if names is not None and names.isdisjoint(events):
+                continue
+            result.append(offsets[i])
+        return result
+
+
+def open(path, **filters):
+    """Opens an EtlReader, reading only the buffers that may contain
+    matching events if a valid index is available."""
+    reader = R.EtlReader(path, **filters)
+    index = load(path)
+    if index is None:
+        return reader
+    with index:
+        offsets = index.select_buffers(
+            process_ids=filters.get('process_ids'),
+            include_child_process_ids=filters.get('include_child_process_ids', True),
+            provider_names=filters.get('provider_names'),
+            event_names=filters.get('event_names'),
+            start_time=filters.get('start_time'),
+            end_time=filters.get('end_time'),
+        )
+        if offsets is not None:
+            reader._select_buffers(offsets, index.thread_pids)
+    return reader
@@ -0,0 +1,159 @@
+"""Delivers events to callbacks in the traced process.
+
+Subscriptions from subscribe() are kept for the life of the process, and
+may be made before any tracer is enabled. When a tracer is enabled while
+there are subscriptions (later subscriptions wait for the next tracer), the
+file sink (see _filesink.c) queues the chunks of events it records in
+memory. Events still go to any output file, or to ETW when there is no
+file. Each thread collects its queued events in its own buffer, so queuing
+an event costs the same as writing it to a file. Without a file, only events
+with the keywords that subscribers asked for are queued.
+
+A background thread takes the queued chunks every interval seconds,
+decodes them into EventData objects with TraceChunkDecoder, and passes them
+to each subscription's callback in lists of at most batch_size events. The
+last events are delivered on the thread that disables the tracer. When the
+callbacks fall behind and the queue reaches its limit, further chunks are
+dropped and their events are counted in each subscription's dropped
+attribute, so memory use stays bounded.
+"""
+
+import os
+import sys
+import threading
+
+from ._tracefile import TraceChunkDecoder
+
+_lock = threading.Lock()
+_subscriptions = []
+
+
+class Subscription:
+    """A callback that receives lists of events while tracing.
+
+    delivered is the number of events passed to the callback, and dropped
+    is the number of events of any kind that were not recorded because the
+    subscribers fell behind. Call close() to stop receiving events. If the
+    callback raises, the exception is reported with sys.excepthook and the
+    subscription is closed."""
+
+    def __init__(self, callback, keywords, batch_size):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.callback = callback
+        self.keywords = keywords
+        self.batch_size = batch_size
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+
+    def close(self):
+        with _lock:
+            self.closed = True
+            try:
+                _subscriptions.remove(self)
+            except ValueError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _deliver(self, events):
+        keywords = self.keywords
+        if keywords:
+            events = [e for e in events if e.keyword & keywords]
+        batch_size = self.batch_size
+        for i in range(0, len(events), batch_size):
+            if self.closed:
+                return
+            batch = events[i:i + batch_size]
+            try:
+                self.callback(batch)
+            except Exception:
+                self.close()
+                sys.excepthook(*sys.exc_info())
+                return
+            self.delivered += len(batch)
+
+    def __repr__(self):
+        return (f"<Subscription({self.callback!r}, delivered={self.delivered}, "
+                f"dropped={self.dropped})>")
+
+
+def subscribe(callback, keywords, batch_size):
+    subscription = Subscription(callback, keywords, batch_size)
+    with _lock:
+        _subscriptions.append(subscription)
+    return subscription
+
+
+def has_subscriptions():
+    return bool(_subscriptions)
+
+
+def _keywords(subscriptions):
+    # Zero means every keyword
+    keywords = 0
+    for s in subscriptions:
+        if not s.keywords:
+            return 0
+        keywords |= s.keywords
+    return keywords
+
+
+class Listener:
+    """Queues events from a tracer module for subscribers and delivers them
+    until stopped."""
+
+    def __init__(self, module, interval, buffer_size):
+        self._module = module
+        self._interval = interval
+        self._buffer_size = buffer_size
+        self._decoder = TraceChunkDecoder(os.getpid())
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        with _lock:
+            keywords = _keywords(_subscriptions)
+        self._module.start_listener(self._buffer_size, keywords)
+        self._thread = threading.Thread(target=self._run, name="etwtrace listener", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # Calls made while delivering are not worth instrumenting, and
+        # decoding is not part of the traced program
+        sys.setprofile(None)
+        self._module.set_internal_thread(True)
+        try:
+            while not self._stopping.wait(self._interval):
+                with _lock:
+                    keywords = _keywords(_subscriptions)
+                self._deliver(*self._module.read_listener(keywords))
+        finally:
+            self._module.set_internal_thread(False)
+
+    def _deliver(self, data, dropped):
+        with _lock:
+            subscriptions = list(_subscriptions)
+        if not subscriptions:
+            # Later events may still refer to these strings
+            self._decoder.skip(data)
+            return
+        for s in subscriptions:
+            s.dropped += dropped
+        self._decoder.select(keyword_mask_any=_keywords(subscriptions))
+        events = self._decoder.decode(data)
+        if events:
+            for s in subscriptions:
+                s._deliver(events)
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._deliver(*self._module.stop_listener())
@@ -0,0 +1,209 @@
+"""Turns metric summaries into time series.
+
+Counters, gauges and histograms from etwtrace.counter(), gauge() and
+histogram() are described once by a PythonMetricInfo event with their kind
+and name, and while tracing a PythonMetric event summarizes the updates to
+each one since its previous summary (see _metrictrace.py). Summaries are
+only written for metrics that were updated. Each has the number of
+updates, the sum, minimum and maximum of the values, the current value of
+a gauge, and for histograms, pairs of bucket index and count.
+
+MetricAnalyzer keeps the summaries of each metric in order as its time
+series, along with totals for the whole trace. Histogram buckets are
+log-linear: each power of two is split into 16 buckets, and percentiles are
+estimated from the middle of the bucket they fall in.
+"""
+
+import math
+
+COUNTER = 1
+GAUGE = 2
+HISTOGRAM = 3
+
+KIND_NAMES = {COUNTER: 'counter', GAUGE: 'gauge', HISTOGRAM: 'histogram'}
+
+# Must match _etwcommon.c
+SUB_BUCKETS = 16
+MIN_EXPONENT = -63
+
+
+def bucket_range(index):
+    """Returns the lowest and highest values counted in a histogram bucket.
+
+    The first bucket also counts zero and negative values, and the last
+    bucket counts every larger value."""
+    exponent, sub = divmod(index, SUB_BUCKETS)
+    exponent += MIN_EXPONENT
+    return (math.ldexp(0.5 + sub / (2 * SUB_BUCKETS), exponent),
+            math.ldexp(0.5 + (sub + 1) / (2 * SUB_BUCKETS), exponent))
+
+
+def _percentile(buckets, low, high, q):
+    count = sum(buckets.values())
+    if not count:
+        return None
+    rank = count * q / 100
+    seen = 0
+    for index in sorted(buckets):
+        seen += buckets[index]
+        if seen >= rank:
+            break
+    value = sum(bucket_range(index)) / 2
+    # The exact range of the values is known
+    return min(max(value, low), high)
+
+
+class MetricPoint:
+    """A summary of the updates to a metric since its previous summary.
+
+    value is the value of a gauge when the summary was written, and buckets
+    maps histogram bucket indexes to counts."""
+    __slots__ = ('timestamp', 'count', 'sum', 'min', 'max', 'value', 'buckets')
+
+    def __init__(self, timestamp, count, total, low, high, value, buckets):
+        self.timestamp = timestamp
+        self.count = count
+        self.sum = total
+        self.min = low
+        self.max = high
+        self.value = value
+        self.buckets = buckets
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, q):
+        """Estimates the q-th percentile of the values in a histogram."""
+        return _percentile(self.buckets, self.min, self.max, q)
+
+    def __repr__(self):
+        return f"<MetricPoint({self.timestamp}, count={self.count}, sum={self.sum})>"
+
+
+class MetricInfo:
+    """One metric and its summaries, in order.
+
+    count and sum are totals for the whole trace, min and max are the range
+    of every value, value is the last value of a gauge, and buckets are the
+    counts for every histogram bucket."""
+    __slots__ = ('process_id', 'metric_id', 'name', 'kind', 'points',
+                 'count', 'sum', 'min', 'max', 'value', 'buckets')
+
+    def __init__(self, process_id, metric_id):
+        self.process_id = process_id
+        self.metric_id = metric_id
+        self.name = None
+        self.kind = None
+        self.points = []
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.value = None
+        self.buckets = {}
+
+    @property
+    def kind_name(self):
+        return KIND_NAMES.get(self.kind, 'unknown')
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, q):
+        """Estimates the q-th percentile of every value in a histogram."""
+        return _percentile(self.buckets, self.min, self.max, q)
+
+    def series(self):
+        """Returns (timestamp, value) for each summary.
+
+        The value is the running total for a counter, the current value for
+        a gauge, and the median of the values since the previous summary
+        for a histogram."""
+        if self.kind == COUNTER:
+            total = 0
+            result = []
+            for p in self.points:
+                total += p.sum
+                result.append((p.timestamp, total))
+            return result
+        if self.kind == HISTOGRAM:
+            return [(p.timestamp, p.percentile(50)) for p in self.points]
+        return [(p.timestamp, p.value) for p in self.points]
+
+    def _add(self, point):
+        self.points.append(point)
+        self.count += point.count
+        self.sum += point.sum
+        if self.min is None or point.min < self.min:
+            self.min = point.min
+        if self.max is None or point.max > self.max:
+            self.max = point.max
+        self.value = point.value
+        for index, count in point.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def __repr__(self):
+        return f"<MetricInfo({self.name!r}, {self.kind_name}, count={self.count})>"
+
+
+class MetricAnalyzer:
+    """Accumulates time series from PythonMetric events.
+
+    metrics lists every metric in order of first appearance, with its
+    summaries as points.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._by_id = {}
+
+    def _metric(self, event):
+        key = event.process_id, event['MetricID'].value
+        m = self._by_id.get(key)
+        if m is None:
+            m = self._by_id[key] = MetricInfo(*key)
+            self.metrics.append(m)
+        return m
+
+    def add(self, event):
+        name = event.event_name
+        if name == 'PythonMetricInfo':
+            # Written again each time tracing is enabled
+            m = self._metric(event)
+            m.name = event['Name'].value
+            m.kind = event['Kind'].value
+        elif name == 'PythonMetric':
+            pairs = event['Buckets'].value or ()
+            self._metric(event)._add(MetricPoint(
+                event.timestamp,
+                event['Count'].value,
+                event['Sum'].value,
+                event['Min'].value,
+                event['Max'].value,
+                event['Value'].value,
+                dict(zip(pairs[::2], pairs[1::2])),
+            ))
+
+    def finish(self):
+        """Names metrics whose PythonMetricInfo event was not seen."""
+        for m in self.metrics:
+            if m.name is None:
+                m.name = f"<metric {m.metric_id}>"
+
+    def find(self, name, process_id=None):
+        """Returns the first metric with name, or None."""
+        for m in self.metrics:
+            if m.name == name and (process_id is None or m.process_id == process_id):
+                return m
+        return None
+
+
+def analyze(events):
+    """Returns a finished MetricAnalyzer for events."""
+    a = MetricAnalyzer()
+    for e in events:
+        a.add(e)
+    a.finish()
+    return a
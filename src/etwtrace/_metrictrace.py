@@ -0,0 +1,143 @@
+"""Counters, gauges and histograms that are summarized in the trace.
+
+Metrics returned by counter(), gauge() and histogram() are kept by name
+for the life of the process, and may be created before any tracer is
+enabled. While a tracer is enabled, each one has a native metric object
+from the tracer module (see _etwcommon.c) that aggregates its updates, and
+its update methods are those of the native object, so an update is a single
+call into C. A PythonMetric event with a summary of the updates is written
+for each metric every interval seconds by a background thread, and when the
+tracer is disabled. While no tracer is enabled, updates do nothing.
+"""
+
+import threading
+
+# Kinds of PythonMetricInfo events
+COUNTER = 1
+GAUGE = 2
+HISTOGRAM = 3
+
+_lock = threading.Lock()
+_metrics = {}
+_writer = None
+
+
+def _ignore(value=1):
+    pass
+
+
+class _Metric:
+    __slots__ = ('name', 'id')
+    _methods = ()
+
+    def __init__(self, name, metric_id):
+        self.name = name
+        self.id = metric_id
+        self._bind(None)
+
+    def _bind(self, native):
+        for name in self._methods:
+            setattr(self, name, getattr(native, name) if native else _ignore)
+
+    def __repr__(self):
+        return f"<{type(self).__name__}({self.name!r})>"
+
+
+class Counter(_Metric):
+    """Counts events or totals amounts, such as requests or bytes sent.
+
+    add(value=1) adds to the total, which is summarized as the number and
+    sum of the values added."""
+    __slots__ = ('add',)
+    _methods = __slots__
+    kind = COUNTER
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, such as the length of a queue.
+
+    set(value) replaces the value and add(value=1) adds to it. Summaries
+    have the value at the time and its range since the previous summary."""
+    __slots__ = ('set', 'add')
+    _methods = __slots__
+    kind = GAUGE
+
+
+class Histogram(_Metric):
+    """The distribution of values, such as latencies.
+
+    record(value) counts the value in one of a fixed set of buckets, each
+    within 1/16 of the values it holds, so that percentiles can be estimated
+    from the trace. Values should not be negative."""
+    __slots__ = ('record',)
+    _methods = __slots__
+    kind = HISTOGRAM
+
+
+def get_metric(cls, name):
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, len(_metrics) + 1)
+            if _writer:
+                _writer.attach(metric)
+    if type(metric) is not cls:
+        raise ValueError(f"metric {name!r} is already a {type(metric).__name__.lower()}")
+    return metric
+
+
+class MetricWriter:
+    """Attaches every metric to a tracer module and writes their summaries
+    until stopped.
+
+    The thread that writes summaries every interval seconds is only started
+    once there are metrics. With no interval, summaries are only written
+    when stopped."""
+
+    def __init__(self, module, interval):
+        self._module = module
+        self._interval = interval
+        self._natives = []
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        global _writer
+        with _lock:
+            _writer = self
+            for metric in _metrics.values():
+                self.attach(metric)
+
+    def attach(self, metric):
+        # Called with _lock held
+        native = self._module.create_metric(metric.id, metric.kind, metric.name)
+        self._natives.append(native)
+        metric._bind(native)
+        if self._interval and not self._thread:
+            self._thread = threading.Thread(target=self._run, name="etwtrace metrics", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        self._module.set_internal_thread(True)
+        try:
+            while not self._stopping.wait(self._interval):
+                self.write()
+        finally:
+            self._module.set_internal_thread(False)
+
+    def write(self):
+        self._module.write_metrics(tuple(self._natives))
+
+    def stop(self):
+        global _writer
+        with _lock:
+            if _writer is self:
+                _writer = None
+            for metric in _metrics.values():
+                metric._bind(None)
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.write()
+        self._natives.clear()
@@ -0,0 +1,142 @@
+// Implements _trace.h without emitting any events.
+//
+// Linking a tracer module with this file instead of _trace.cpp measures the
+// cost of hooking Python and looking up function IDs, separately from the
+// cost of writing events. It also builds on platforms without ETW.
+
+#include <string.h>
+
+#include "_platform.h"
+#include "_func_id.h"
+#include "_trace.h"
+
+
+void GetProviderGuid(GUID *provider)
+{
+    memset(provider, 0, sizeof(GUID));
+}
+
+static int NullRegister(void)
+{
+    return 0;
+}
+
+static int NullUnregister(void)
+{
+    return 0;
+}
+
+static void NullWriteBeginThread(int thread_id)
+{
+}
+
+static void NullWriteEndThread(int thread_id)
+{
+}
+
+static void NullWriteEvalFunctionEvent(void *dll_handle)
+{
+}
+
+static void NullWriteFunctionEvent(
+    FUNC_ID func_id,
+    void *begin_addr,
+    void *end_addr,
+    LPCWSTR source_file,
+    LPCWSTR name,
+    int line_no,
+    int is_python_code
+)
+{
+}
+
+static void NullWriteFunctionPush(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id)
+{
+}
+
+static void NullWriteFunctionPop(FUNC_ID func_id)
+{
+}
+
+static void NullWriteCustomEvent(LPCWSTR name, int opcode)
+{
+}
+
+static void NullWriteStack(int stack_id, const FUNC_ID *frames, int count)
+{
+}
+
+static void NullWriteSample(int thread_id, int stack_id)
+{
+}
+
+static void NullWriteTaskCreate(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name)
+{
+}
+
+static void NullWriteTaskStep(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done)
+{
+}
+
+static void NullWriteCallback(LPCWSTR name, int opcode)
+{
+}
+
+static void NullWriteActivity(int opcode, const GUID *activity_id, const GUID *related_id, LPCWSTR name)
+{
+}
+
+static void NullWriteGC(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable, DWORD64 duration)
+{
+}
+
+static void NullWriteImport(int opcode, LPCWSTR name, LPCWSTR detail)
+{
+}
+
+static void NullWriteAllocation(int opcode, void *address, DWORD64 size, DWORD64 weight, int stack_id)
+{
+}
+
+static void NullWriteExceptionType(int type_id, LPCWSTR name)
+{
+}
+
+static void NullWriteException(int opcode, int type_id, FUNC_ID func_id, int line)
+{
+}
+
+static void NullWriteMetricInfo(int metric_id, int kind, LPCWSTR name)
+{
+}
+
+static void NullWriteMetric(int metric_id, DWORD count, double sum, double min, double max, double value,
+                            const DWORD *buckets, int bucket_count)
+{
+}
+
+
+const struct TRACE_SINK DEFAULT_SINK = {
+    NullRegister,
+    NullUnregister,
+    NullWriteBeginThread,
+    NullWriteEndThread,
+    NullWriteEvalFunctionEvent,
+    NullWriteFunctionEvent,
+    NullWriteFunctionPush,
+    NullWriteFunctionPop,
+    NullWriteCustomEvent,
+    NullWriteStack,
+    NullWriteSample,
+    NullWriteTaskCreate,
+    NullWriteTaskStep,
+    NullWriteCallback,
+    NullWriteActivity,
+    NullWriteGC,
+    NullWriteImport,
+    NullWriteAllocation,
+    NullWriteExceptionType,
+    NullWriteException,
+    NullWriteMetricInfo,
+    NullWriteMetric,
+};
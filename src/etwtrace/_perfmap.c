@@ -0,0 +1,210 @@
+// Implements _trace.h for platforms without ETW by writing a perf map.
+//
+// The Linux perf tool symbolizes addresses in anonymous executable memory
+// using /tmp/perf-<pid>.map, which has one "START SIZE name" line per
+// symbol. Each thunk allocated by _etwtrace.c is written to the map as it is
+// allocated, so samples that pass through a thunk show the Python function
+// it was allocated for. Other events have nowhere to go and are dropped.
+
+#include <inttypes.h>
+#include <stdio.h>
+#include <string.h>
+#include <unistd.h>
+
+#include "_platform.h"
+#include "_func_id.h"
+#include "_trace.h"
+
+
+static FILE *perf_map = NULL;
+static int register_count = 0;
+
+
+void GetProviderGuid(GUID *provider)
+{
+    memset(provider, 0, sizeof(GUID));
+}
+
+static int PerfMapRegister(void)
+{
+    if (register_count == 0) {
+        char path[64];
+        snprintf(path, sizeof(path), "/tmp/perf-%d.map", (int)getpid());
+        // Thunks from earlier tracing sessions are still listed, but their
+        // addresses may be reused, so entries are only ever appended
+        perf_map = fopen(path, "a");
+    }
+    return ++register_count;
+}
+
+static int PerfMapUnregister(void)
+{
+    if (register_count == 1 && perf_map) {
+        fclose(perf_map);
+        perf_map = NULL;
+    }
+    return --register_count;
+}
+
+static void PerfMapWriteBeginThread(int thread_id)
+{
+}
+
+static void PerfMapWriteEndThread(int thread_id)
+{
+}
+
+static void PerfMapWriteEvalFunctionEvent(void *dll_handle)
+{
+}
+
+
+// _etwcommon.c passes UTF-16 strings (with a byte order mark, because wchar_t
+// is not 16 bits here), which are written to the map as UTF-8.
+static void write_utf16(FILE *f, const uint16_t *s)
+{
+    if (!s) {
+        return;
+    }
+    if (*s == 0xFEFF) {
+        ++s;
+    }
+    for (; *s; ++s) {
+        uint32_t c = *s;
+        if (c >= 0xD800 && c < 0xDC00 && s[1] >= 0xDC00 && s[1] < 0xE000) {
+            c = 0x10000 + ((c - 0xD800) << 10) + (*++s - 0xDC00);
+        }
+        if (c == '\n' || c == '\r') {
+            fputc(' ', f);
+        } else if (c < 0x80) {
+            fputc((int)c, f);
+        } else if (c < 0x800) {
+            fputc(0xC0 | (c >> 6), f);
+            fputc(0x80 | (c & 0x3F), f);
+        } else if (c < 0x10000) {
+            fputc(0xE0 | (c >> 12), f);
+            fputc(0x80 | ((c >> 6) & 0x3F), f);
+            fputc(0x80 | (c & 0x3F), f);
+        } else {
+            fputc(0xF0 | (c >> 18), f);
+            fputc(0x80 | ((c >> 12) & 0x3F), f);
+            fputc(0x80 | ((c >> 6) & 0x3F), f);
+            fputc(0x80 | (c & 0x3F), f);
+        }
+    }
+}
+
+static void PerfMapWriteFunctionEvent(
+    FUNC_ID func_id,
+    void *begin_addr,
+    void *end_addr,
+    LPCWSTR source_file,
+    LPCWSTR name,
+    int line_no,
+    int is_python_code
+)
+{
+    if (!perf_map || !begin_addr) {
+        return;
+    }
+    // Matches the names used by CPython's own perf trampolines
+    fprintf(perf_map, "%" PRIxPTR " %" PRIxPTR " py::",
+        (uintptr_t)begin_addr, (uintptr_t)end_addr - (uintptr_t)begin_addr);
+    write_utf16(perf_map, (const uint16_t *)name);
+    fputc(':', perf_map);
+    write_utf16(perf_map, (const uint16_t *)source_file);
+    fputc('\n', perf_map);
+    // perf may read the map while the process is still running
+    fflush(perf_map);
+}
+
+static void PerfMapWriteFunctionPush(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id)
+{
+}
+
+static void PerfMapWriteFunctionPop(FUNC_ID func_id)
+{
+}
+
+static void PerfMapWriteCustomEvent(LPCWSTR name, int opcode)
+{
+}
+
+static void PerfMapWriteStack(int stack_id, const FUNC_ID *frames, int count)
+{
+}
+
+static void PerfMapWriteSample(int thread_id, int stack_id)
+{
+}
+
+static void PerfMapWriteTaskCreate(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name)
+{
+}
+
+static void PerfMapWriteTaskStep(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done)
+{
+}
+
+static void PerfMapWriteCallback(LPCWSTR name, int opcode)
+{
+}
+
+static void PerfMapWriteActivity(int opcode, const GUID *activity_id, const GUID *related_id, LPCWSTR name)
+{
+}
+
+static void PerfMapWriteGC(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable, DWORD64 duration)
+{
+}
+
+static void PerfMapWriteImport(int opcode, LPCWSTR name, LPCWSTR detail)
+{
+}
+
+static void PerfMapWriteAllocation(int opcode, void *address, DWORD64 size, DWORD64 weight, int stack_id)
+{
+}
+
+static void PerfMapWriteExceptionType(int type_id, LPCWSTR name)
+{
+}
+
+static void PerfMapWriteException(int opcode, int type_id, FUNC_ID func_id, int line)
+{
+}
+
+static void PerfMapWriteMetricInfo(int metric_id, int kind, LPCWSTR name)
+{
+}
+
+static void PerfMapWriteMetric(int metric_id, DWORD count, double sum, double min, double max, double value,
+                               const DWORD *buckets, int bucket_count)
+{
+}
+
+
+const struct TRACE_SINK DEFAULT_SINK = {
+    PerfMapRegister,
+    PerfMapUnregister,
+    PerfMapWriteBeginThread,
+    PerfMapWriteEndThread,
+    PerfMapWriteEvalFunctionEvent,
+    PerfMapWriteFunctionEvent,
+    PerfMapWriteFunctionPush,
+    PerfMapWriteFunctionPop,
+    PerfMapWriteCustomEvent,
+    PerfMapWriteStack,
+    PerfMapWriteSample,
+    PerfMapWriteTaskCreate,
+    PerfMapWriteTaskStep,
+    PerfMapWriteCallback,
+    PerfMapWriteActivity,
+    PerfMapWriteGC,
+    PerfMapWriteImport,
+    PerfMapWriteAllocation,
+    PerfMapWriteExceptionType,
+    PerfMapWriteException,
+    PerfMapWriteMetricInfo,
+    PerfMapWriteMetric,
+};
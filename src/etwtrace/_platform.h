@@ -0,0 +1,55 @@
+#pragma once
+
+#ifdef _WIN32
+
+#include <Windows.h>
+
+#else
+
+// Enough of the Windows API for the null sink build, which exercises the
+// shared tracing code on other platforms without emitting any events, and
+// for the perf map build of _etwtrace.
+
+#include <pthread.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <unistd.h>
+#include <wchar.h>
+#ifdef __linux__
+#include <sys/syscall.h>
+#endif
+
+typedef struct {
+    uint32_t Data1;
+    uint16_t Data2;
+    uint16_t Data3;
+    uint8_t Data4[8];
+} GUID;
+
+typedef size_t SIZE_T;
+typedef const wchar_t *LPCWSTR;
+typedef uint8_t UINT8;
+typedef unsigned short USHORT;
+typedef uint32_t DWORD;
+typedef uint64_t DWORD64;
+
+static inline DWORD GetCurrentThreadId(void) {
+#ifdef __linux__
+    return (DWORD)syscall(SYS_gettid);
+#else
+    return (DWORD)(uintptr_t)pthread_self();
+#endif
+}
+
+static inline DWORD GetCurrentProcessId(void) {
+    return (DWORD)getpid();
+}
+
+#endif
+
+
+#ifdef _MSC_VER
+#define THREAD_LOCAL __declspec(thread)
+#else
+#define THREAD_LOCAL _Thread_local
+#endif
@@ -0,0 +1,308 @@
+"""Writes traces as pprof profiles.
+
+The output is a gzipped Profile message as defined by
+https://github.com/google/pprof/blob/main/proto/profile.proto, encoded
+directly so that no protobuf package is required.
+
+Stack sampling traces produce one sample per distinct stack with the
+number of samples and the estimated CPU time (the sample count multiplied
+by the sampling interval). Python frames are identified from their thunks,
+so their locations refer to the line where the function is defined.
+
+Instrumented traces produce one sample per distinct call stack with the
+number of calls and the wall time spent in that stack, excluding its
+callees. pprof's "flat" values are then the exclusive time of each function
+and "cum" values are inclusive time. Callers are attributed to the line
+that made the call (from the CallerLine field) so the profile can be
+viewed per line as well as per function.
+
+Every sample is labelled with its pid and tid, and with the innermost
+mark_range that was open on its thread, if any.
+"""
+
+import gzip
+
+# Offset from the FILETIME epoch (1601) to the Unix epoch, in 100ns units
+FILETIME_UNIX_EPOCH = 116444736000000000
+
+# The default sampling interval on Windows
+DEFAULT_SAMPLE_INTERVAL_NS = 1_000_000
+
+
+def _varint(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+class _Message:
+    """Accumulates encoded protobuf fields."""
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def int(self, field, value):
+        if value:
+            self.data += _varint(field << 3)
+            self.data += _varint(value)
+        return self
+
+    def bytes(self, field, value):
+        self.data += _varint(field << 3 | 2)
+        self.data += _varint(len(value))
+        self.data += value
+        return self
+
+    def message(self, field, message):
+        return self.bytes(field, message.data)
+
+    def packed(self, field, values):
+        if values:
+            data = bytearray()
+            for v in values:
+                data += _varint(v)
+            self.bytes(field, data)
+        return self
+
+
+class ProfileBuilder:
+    """Builds a pprof Profile, deduplicating strings, functions, locations
+    and mappings, and merging samples with identical stacks and labels.
+
+    sample_types is a sequence of (type, unit) pairs, and every sample must
+    provide one value for each."""
+
+    def __init__(self, sample_types, *, period_type=None, period=0):
+        self.sample_types = list(sample_types)
+        self.period_type = period_type
+        self.period = period
+        self.time_nanos = 0
+        self.duration_nanos = 0
+        self._strings = {'': 0}
+        self._functions = {}
+        self._locations = {}
+        self._mappings = {}
+        self._samples = {}
+
+    def string(self, s):
+        i = self._strings.get(s)
+        if i is None:
+            i = self._strings[s] = len(self._strings)
+        return i
+
+    def mapping(self, filename, start=0, limit=0):
+        key = filename, start, limit
+        i = self._mappings.get(key)
+        if i is None:
+            i = self._mappings[key] = len(self._mappings) + 1
+        return i
+
+    def function(self, name, filename='', start_line=0):
+        key = name, filename, start_line
+        i = self._functions.get(key)
+        if i is None:
+            i = self._functions[key] = len(self._functions) + 1
+        return i
+
+    def location(self, function_id=0, line=0, mapping_id=0, address=0):
+        key = function_id, line, mapping_id, address
+        i = self._locations.get(key)
+        if i is None:
+            i = self._locations[key] = len(self._locations) + 1
+        return i
+
+    def add_sample(self, location_ids, values, labels=()):
+        """Adds values to the sample for location_ids (leaf first).
+
+        labels is a sequence of (key, value) pairs, where values may be
+        strings or integers."""
+        key = tuple(location_ids), tuple(labels)
+        total = self._samples.get(key)
+        if total is None:
+            self._samples[key] = list(values)
+        else:
+            for i, v in enumerate(values):
+                total[i] += v
+
+    def _value_type(self, type_unit):
+        return _Message().int(1, self.string(type_unit[0])).int(2, self.string(type_unit[1]))
+
+    def encode(self):
+        """Returns the uncompressed Profile message."""
+        m = _Message()
+        for vt in self.sample_types:
+            m.message(1, self._value_type(vt))
+        for (location_ids, labels), values in self._samples.items():
+            s = _Message().packed(1, location_ids).packed(2, values)
+            for k, v in labels:
+                label = _Message().int(1, self.string(k))
+                if isinstance(v, str):
+                    label.int(2, self.string(v))
+                else:
+                    label.int(3, v)
+                s.message(3, label)
+            m.message(2, s)
+        for (filename, start, limit), i in self._mappings.items():
+            m.message(3, _Message().int(1, i).int(2, start).int(3, limit).int(5, self.string(filename)))
+        for (function_id, line, mapping_id, address), i in self._locations.items():
+            loc = _Message().int(1, i).int(2, mapping_id).int(3, address)
+            if function_id:
+                loc.message(4, _Message().int(1, function_id).int(2, line))
+            m.message(4, loc)
+        for (name, filename, start_line), i in self._functions.items():
+            name = self.string(name)
+            m.message(5, _Message().int(1, i).int(2, name).int(3, name)
+                      .int(4, self.string(filename)).int(5, start_line))
+        # Everything else has been interned by now
+        for s in self._strings:
+            m.bytes(6, s.encode('utf-8'))
+        m.int(9, self.time_nanos)
+        m.int(10, self.duration_nanos)
+        if self.period_type:
+            m.message(11, self._value_type(self.period_type))
+        m.int(12, self.period)
+        return bytes(m.data)
+
+    def write(self, file):
+        """Writes the gzipped Profile to a binary file."""
+        file.write(gzip.compress(self.encode()))
+
+
+class _CallFrame:
+    __slots__ = ('function_id', 'function', 'start_line', 'start', 'child_time', 'line')
+
+    def __init__(self, function_id, function, line, start):
+        self.function_id = function_id
+        self.function = function
+        self.start_line = line
+        self.start = start
+        self.child_time = 0
+        # Updated to the caller's line by each call this frame makes
+        self.line = line
+
+
+class PprofExporter:
+    """Writes a gzipped pprof profile from stack samples or instrumented
+    calls. Use with etwtrace.export(..., format='pprof')."""
+    needs_frames = True
+
+    def __init__(self, file, *, native=False, sample_interval_ns=DEFAULT_SAMPLE_INTERVAL_NS):
+        self.file = file
+        self.native = native
+        self.sample_interval_ns = sample_interval_ns
+        self._samples = ProfileBuilder(
+            [('samples', 'count'), ('cpu', 'nanoseconds')],
+            period_type=('cpu', 'nanoseconds'),
+            period=sample_interval_ns,
+        )
+        self._calls = ProfileBuilder([('calls', 'count'), ('wall', 'nanoseconds')])
+        self._definitions = {}
+        self._pending_samples = set()
+        self._stacks = {}
+        self._last_seen = {}
+        self._marks = {}
+        self._first = None
+        self._last = None
+
+    def _labels(self, pid, tid):
+        labels = [('pid', pid), ('tid', tid)]
+        marks = self._marks.get((pid, tid))
+        if marks:
+            labels.append(('mark', marks[-1]))
+        return labels
+
+    def _frame_location(self, frame):
+        b = self._samples
+        if frame.kind == 'python':
+            return b.location(b.function(frame.name, frame.file, frame.line), frame.line)
+        if not self.native:
+            return None
+        if frame.kind == 'native':
+            return b.location(mapping_id=b.mapping(frame.module), address=frame.address)
+        return b.location(address=frame.address)
+
+    def add(self, event, frames=None):
+        ts = event.timestamp
+        if self._first is None:
+            self._first = ts
+        self._last = ts
+        name = event.event_name
+        pid, tid = event.process_id, event.thread_id
+        if name == 'PythonFunction':
+            self._definitions[pid, event['FunctionID'].value] = (
+                event['Name'].value, event['SourceFile'].value, event['LineNumber'].value,
+            )
+        elif name == 'PythonFunctionPush':
+            self._push(pid, tid, event)
+        elif name == 'PythonFunctionPop':
+            self._pop(pid, tid, event['FunctionID'].value, ts)
+        elif name == 'PythonMark':
+            if event.opcode == 1:
+                self._marks.setdefault((pid, tid), []).append(event['Mark'].value)
+            elif event.opcode == 2:
+                marks = self._marks.get((pid, tid), ())
+                for i in range(len(marks) - 1, -1, -1):
+                    if marks[i] == event['Mark'].value:
+                        del marks[i]
+                        break
+        elif event.is_stack_sample:
+            self._pending_samples.add(tid)
+        elif frames is not None and event.opcode_name == 'Stack' and tid in self._pending_samples:
+            self._pending_samples.discard(tid)
+            self._add_sample(pid, tid, frames)
+        elif frames is not None and name == 'PythonSample':
+            self._add_sample(pid, event['ThreadID'].value, frames)
+
+    def _add_sample(self, pid, tid, frames):
+        locations = [i for i in map(self._frame_location, frames) if i]
+        if locations:
+            self._samples.add_sample(locations, [1, self.sample_interval_ns], self._labels(pid, tid))
+
+    def _push(self, pid, tid, event):
+        stack = self._stacks.setdefault((pid, tid), [])
+        self._last_seen[pid, tid] = event.timestamp
+        func_id = event['FunctionID'].value
+        name, file, line = self._definitions.get((pid, func_id), (f"<function 0x{func_id:X}>", '', 0))
+        if stack:
+            stack[-1].line = event['CallerLine'].value
+        stack.append(_CallFrame(func_id, self._calls.function(name, file, line), line, event.timestamp))
+
+    def _pop(self, pid, tid, func_id, ts):
+        self._last_seen[pid, tid] = ts
+        stack = self._stacks.get((pid, tid))
+        if not stack:
+            # Calls that started before the trace have no known stack
+            return
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].function_id == func_id:
+                while len(stack) > i:
+                    self._close(pid, tid, stack, ts)
+                return
+
+    def _close(self, pid, tid, stack, ts):
+        b = self._calls
+        frame = stack[-1]
+        elapsed = ts - frame.start
+        # The leaf is located at its definition, and callers at their call
+        locations = [b.location(frame.function, frame.start_line)]
+        locations.extend(b.location(f.function, f.line) for f in reversed(stack[:-1]))
+        stack.pop()
+        if stack:
+            stack[-1].child_time += elapsed
+        b.add_sample(locations, [1, (elapsed - frame.child_time) * 100], self._labels(pid, tid))
+
+    def close(self):
+        for (pid, tid), stack in self._stacks.items():
+            while stack:
+                self._close(pid, tid, stack, self._last_seen[pid, tid])
+        # Prefer stack samples when the trace has both
+        b = self._samples if self._samples._samples else self._calls
+        if self._first is not None:
+            b.time_nanos = (self._first - FILETIME_UNIX_EPOCH) * 100
+            b.duration_nanos = (self._last - self._first) * 100
+        b.write(self.file)
@@ -0,0 +1,338 @@
+"""Exports decoded traces to SQLite databases.
+
+Tables (every row has the trace_id of the capture it came from):
+
+traces
+    One row per export, with the source path, event count and time range.
+strings
+    Dictionary of provider, event, function, file and module names, which
+    other tables refer to by id.
+events
+    Every event with its timestamp, process, thread, provider, name and
+    opcode. PythonFunctionPush/Pop events use the function_id, caller_id and
+    caller_line columns. Other events keep their properties as JSON, which
+    can be queried with json_extract(). Events with a stack refer to stacks.
+functions
+    PythonFunction definitions by process and function ID.
+stacks, stack_frames
+    Each distinct stack once, with its frames in order from the innermost
+    (position 0), including native frames and the modules they are in.
+marks
+    Mark ranges with their start and end times, and instant marks.
+threads, processes
+    Start and end times from the Python and kernel events.
+
+Rows are inserted with executemany() in batches, and committed in large
+transactions. Indexes are created once loading is complete. Memory use
+depends on the number of distinct strings and stacks rather than the size
+of the trace.
+
+With append=True, existing tables are kept and the capture is added with
+a new trace_id, so many captures can be loaded into the same database.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traces (
+    trace_id INTEGER PRIMARY KEY,
+    source TEXT,
+    loaded_at REAL,
+    events INTEGER,
+    first_timestamp INTEGER,
+    last_timestamp INTEGER
+);
+CREATE TABLE IF NOT EXISTS strings (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS events (
+    trace_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    process_id INTEGER,
+    thread_id INTEGER,
+    provider_id INTEGER,
+    name_id INTEGER,
+    opcode INTEGER,
+    opcode_name_id INTEGER,
+    function_id INTEGER,
+    caller_id INTEGER,
+    caller_line INTEGER,
+    stack_id INTEGER,
+    properties TEXT
+);
+CREATE TABLE IF NOT EXISTS functions (
+    trace_id INTEGER NOT NULL,
+    process_id INTEGER NOT NULL,
+    function_id INTEGER NOT NULL,
+    name_id INTEGER,
+    file_id INTEGER,
+    line INTEGER,
+    begin_address INTEGER,
+    end_address INTEGER,
+    timestamp INTEGER
+);
+CREATE TABLE IF NOT EXISTS stacks (
+    trace_id INTEGER NOT NULL,
+    stack_id INTEGER NOT NULL,
+    process_id INTEGER,
+    depth INTEGER
+);
+CREATE TABLE IF NOT EXISTS stack_frames (
+    trace_id INTEGER NOT NULL,
+    stack_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    kind TEXT,
+    name_id INTEGER,
+    file_id INTEGER,
+    line INTEGER,
+    module_id INTEGER,
+    address INTEGER
+);
+CREATE TABLE IF NOT EXISTS marks (
+    trace_id INTEGER NOT NULL,
+    process_id INTEGER,
+    thread_id INTEGER,
+    name_id INTEGER,
+    start INTEGER,
+    end INTEGER,
+    instant INTEGER
+);
+CREATE TABLE IF NOT EXISTS threads (
+    trace_id INTEGER NOT NULL,
+    process_id INTEGER,
+    thread_id INTEGER,
+    start INTEGER,
+    end INTEGER
+);
+CREATE TABLE IF NOT EXISTS processes (
+    trace_id INTEGER NOT NULL,
+    process_id INTEGER,
+    parent_id INTEGER,
+    image_id INTEGER,
+    command_line TEXT,
+    start INTEGER,
+    end INTEGER
+);
+"""
+
+INDEXES = {
+    "events_time": "events (trace_id, timestamp)",
+    "events_name": "events (trace_id, name_id)",
+    "events_thread": "events (trace_id, process_id, thread_id)",
+    "events_function": "events (trace_id, function_id)",
+    "functions_id": "functions (trace_id, process_id, function_id)",
+    "stacks_id": "stacks (trace_id, stack_id)",
+    "stack_frames_id": "stack_frames (trace_id, stack_id, position)",
+    "marks_name": "marks (trace_id, name_id)",
+    "threads_id": "threads (trace_id, process_id, thread_id)",
+    "processes_id": "processes (trace_id, process_id)",
+}
+
+TABLES = ("traces", "strings", "events", "functions", "stacks", "stack_frames",
+          "marks", "threads", "processes")
+
+# Properties of StackWalk events that are stored in stack_frames instead
+_STACK_PROPERTY = re.compile(r"Stack\d+$")
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+
+class SqliteExporter:
+    """Loads events into a SQLite database.
+
+    database is a path or an open sqlite3.Connection. The trace_id used for
+    the capture is available as trace_id, and events and elapsed give the
+    number of events loaded and the time taken once closed."""
+    needs_frames = True
+
+    def __init__(self, database, *, native=False, append=False, trace_id=None,
+                 source=None, batch_size=10_000, commit_every=500_000):
+        self.native = native
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        if isinstance(database, sqlite3.Connection):
+            self._con = database
+            self._owned = False
+        else:
+            database = os.fspath(database)
+            if not append and os.path.exists(database):
+                os.unlink(database)
+            self._con = sqlite3.connect(database)
+            self._owned = True
+        con = self._con
+        # The database is only being loaded, so favour speed over durability
+        con.execute("PRAGMA synchronous = OFF")
+        if not append:
+            for t in TABLES:
+                con.execute(f"DROP TABLE IF EXISTS {t}")
+        # Indexes are recreated after loading
+        for name in INDEXES:
+            con.execute(f"DROP INDEX IF EXISTS {name}")
+        con.executescript(SCHEMA)
+        if trace_id is None:
+            trace_id = con.execute("SELECT COALESCE(MAX(trace_id), 0) + 1 FROM traces").fetchone()[0]
+        elif con.execute("SELECT 1 FROM traces WHERE trace_id = ?", (trace_id,)).fetchone():
+            raise ValueError(f"trace {trace_id} is already in the database")
+        self.trace_id = trace_id
+        con.execute("INSERT INTO traces (trace_id, source, loaded_at) VALUES (?, ?, ?)",
+                    (trace_id, source and os.fspath(source), time.time()))
+        self._strings = dict(con.execute("SELECT value, id FROM strings"))
+        self._new_strings = []
+        self._stack_ids = {}
+        self._rows = {t: [] for t in ("events", "functions", "stacks", "stack_frames",
+                                      "marks", "threads", "processes")}
+        self._open_marks = {}
+        self._open_threads = {}
+        self._open_processes = {}
+        self._pending = 0
+        self._uncommitted = 0
+        self.events = 0
+        self.first = None
+        self.last = None
+        self.elapsed = 0.0
+        self._start = time.perf_counter()
+
+    def _string(self, value):
+        if value is None:
+            return None
+        i = self._strings.get(value)
+        if i is None:
+            i = self._strings[value] = len(self._strings) + 1
+            self._new_strings.append((i, value))
+        return i
+
+    def _stack(self, pid, frames):
+        key = pid, tuple(frames)
+        i = self._stack_ids.get(key)
+        if i is None:
+            i = self._stack_ids[key] = len(self._stack_ids) + 1
+            self._rows["stacks"].append((self.trace_id, i, pid, len(frames)))
+            s = self._string
+            self._rows["stack_frames"].extend(
+                (self.trace_id, i, pos, f.kind, s(f.name), s(f.file), f.line, s(f.module), f.address)
+                for pos, f in enumerate(frames)
+            )
+        return i
+
+    def add(self, event, frames=None):
+        ts = event.timestamp
+        if self.first is None:
+            self.first = ts
+        self.last = ts
+        self.events += 1
+        pid, tid = event.process_id, event.thread_id
+        name = event.event_name or event.task_name
+        function_id = caller_id = caller_line = properties = None
+        if name == 'PythonFunctionPush':
+            function_id = event['FunctionID'].value
+            caller_id = event['Caller'].value
+            caller_line = event['CallerLine'].value
+        elif name == 'PythonFunctionPop':
+            function_id = event['FunctionID'].value
+        else:
+            props = {k: v for k, v in event.items() if frames is None or not _STACK_PROPERTY.match(k)}
+            if props:
+                properties = json.dumps(props, default=_json_default, separators=(',', ':'))
+            self._record(event, name, pid, tid, ts)
+        stack_id = self._stack(pid, frames) if frames is not None else None
+        s = self._string
+        self._rows["events"].append((
+            self.trace_id, self.events, ts, pid, tid, s(event.provider_name), s(name),
+            event.opcode, s(event.opcode_name), function_id, caller_id, caller_line, stack_id, properties,
+        ))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._flush()
+
+    def _record(self, event, name, pid, tid, ts):
+        if name == 'PythonFunction':
+            self._rows["functions"].append((
+                self.trace_id, pid, event['FunctionID'].value, self._string(event['Name'].value),
+                self._string(event['SourceFile'].value), event['LineNumber'].value,
+                event.get('BeginAddress'), event.get('EndAddress'), ts,
+            ))
+        elif name == 'PythonMark':
+            mark = event['Mark'].value
+            if event.opcode == 1:
+                self._open_marks.setdefault((pid, tid, mark), []).append(ts)
+            elif event.opcode == 2:
+                starts = self._open_marks.get((pid, tid, mark))
+                start = starts.pop() if starts else None
+                self._rows["marks"].append((self.trace_id, pid, tid, self._string(mark), start, ts, 0))
+            elif event.opcode == 0:
+                self._rows["marks"].append((self.trace_id, pid, tid, self._string(mark), ts, ts, 1))
+        elif name == 'PythonThread':
+            if event.opcode == 1:
+                self._open_threads[pid, tid] = ts
+            elif event.opcode == 2:
+                self._rows["threads"].append((self.trace_id, pid, tid, self._open_threads.pop((pid, tid), None), ts))
+        elif name == 'Process' and event.opcode_name in ('Start', 'DCStart', 'End', 'DCEnd'):
+            process_id = event.get('ProcessId')
+            if event.opcode_name in ('Start', 'DCStart'):
+                # The start time of processes running when the trace began is unknown
+                start = ts if event.opcode_name == 'Start' else None
+                self._open_processes[process_id] = (
+                    event.get('ParentId'), self._string(event.get('ImageFileName')),
+                    event.get('CommandLine'), start,
+                )
+            else:
+                parent, image, command_line, start = self._open_processes.pop(process_id, (
+                    event.get('ParentId'), self._string(event.get('ImageFileName')),
+                    event.get('CommandLine'), None,
+                ))
+                end = ts if event.opcode_name == 'End' else None
+                self._rows["processes"].append(
+                    (self.trace_id, process_id, parent, image, command_line, start, end)
+                )
+
+    def _flush(self):
+        con = self._con
+        if self._new_strings:
+            con.executemany("INSERT INTO strings (id, value) VALUES (?, ?)", self._new_strings)
+            self._uncommitted += len(self._new_strings)
+            self._new_strings = []
+        for table, rows in self._rows.items():
+            if rows:
+                placeholders = ", ".join("?" * len(rows[0]))
+                con.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+                self._uncommitted += len(rows)
+                rows.clear()
+        self._pending = 0
+        if self._uncommitted >= self.commit_every:
+            con.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        # Ranges and threads still open at the end of the trace
+        for (pid, tid, mark), starts in self._open_marks.items():
+            for start in starts:
+                self._rows["marks"].append((self.trace_id, pid, tid, self._string(mark), start, None, 0))
+        for (pid, tid), start in self._open_threads.items():
+            self._rows["threads"].append((self.trace_id, pid, tid, start, None))
+        for process_id, (parent, image, command_line, start) in self._open_processes.items():
+            self._rows["processes"].append((self.trace_id, process_id, parent, image, command_line, start, None))
+        self._open_marks.clear()
+        self._open_threads.clear()
+        self._open_processes.clear()
+        self._flush()
+        con = self._con
+        con.execute(
+            "UPDATE traces SET events = ?, first_timestamp = ?, last_timestamp = ? WHERE trace_id = ?",
+            (self.events, self.first, self.last, self.trace_id),
+        )
+        for name, target in INDEXES.items():
+            con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        con.commit()
+        if self._owned:
+            con.close()
+        self.elapsed = time.perf_counter() - self._start
@@ -0,0 +1,358 @@
+"""Resolves sampled stack addresses into Python and native frames.
+
+With stack sampling enabled, every Python function gets a thunk in
+memory owned by _etwtrace, and the PythonFunction event records the thunk's
+BeginAddress and EndAddress. Any stack sample that passes through that
+range was executing that function. Image load events provide the ranges
+for native modules.
+
+When tracing is disabled and re-enabled the thunk tables are released and
+reallocated, so the same addresses may later refer to different functions.
+IntervalIndex keeps each set of non-overlapping ranges as a generation, and
+addresses are resolved against the generation in effect at the time of
+the sample. Re-registering every function after tracing is re-enabled
+starts a single generation, rather than one for each function.
+
+SamplingTracer records stacks of function IDs instead of addresses. Each
+PythonSampledStack event is resolved to frames when it is read, using the
+PythonFunction events before it, and PythonSample events (and sampled
+PythonAllocation events) refer to it by ID.
+"""
+
+import array
+import bisect
+
+from collections import namedtuple
+
+
+class Frame(namedtuple('Frame', 'kind name file line module address')):
+    """A symbolized stack frame.
+
+    kind is 'python' for functions identified by their thunk, 'native' for
+    addresses within a loaded image (name is None, module is the image),
+    and 'unknown' otherwise."""
+    __slots__ = ()
+
+    def __str__(self):
+        if self.kind == 'python':
+            return f"{self.name} ({self.file}:{self.line})"
+        if self.kind == 'native':
+            return f"{self.module}!0x{self.address:X}"
+        return f"0x{self.address:X}"
+
+
+def _basename(path):
+    return path.rpartition('\\')[2].rpartition('/')[2]
+
+
+class _Generation:
+    __slots__ = ('start', 'begins', 'ends', 'values')
+
+    def __init__(self, start, begins, ends, values):
+        self.start = start
+        self.begins = begins
+        self.ends = ends
+        self.values = values
+
+
+def _lookup(begins, ends, values, address):
+    i = bisect.bisect_right(begins, address) - 1
+    if i >= 0 and address < ends[i]:
+        return values[i]
+    return None
+
+
+class IntervalIndex:
+    """Maps address ranges to values, allowing ranges to be reused over time.
+
+    Ranges must be added in timestamp order. Adding a range that overlaps
+    one added in the current generation, or removing a range, starts a new
+    generation, and lookups with a timestamp use the generation that was in
+    effect at that time. Ranges from earlier generations are replaced
+    without starting another, so that replacing every range costs one copy
+    of the table rather than one for each range."""
+
+    def __init__(self):
+        self._begins = []
+        self._ends = []
+        self._values = []
+        # The generation that each current range was added in
+        self._added = []
+        self._start = None
+        self._sealed = []
+        self._sealed_starts = []
+
+    def __len__(self):
+        return len(self._begins)
+
+    @property
+    def generations(self):
+        return len(self._sealed) + 1
+
+    def _seal(self, timestamp):
+        self._sealed.append(_Generation(
+            self._start,
+            array.array('Q', self._begins),
+            array.array('Q', self._ends),
+            list(self._values),
+        ))
+        self._sealed_starts.append(self._start if self._start is not None else -1)
+        self._start = timestamp
+
+    def _overlapping(self, begin, end):
+        i = bisect.bisect_right(self._begins, begin) - 1
+        if i < 0 or self._ends[i] <= begin:
+            i += 1
+        j = i
+        while j < len(self._begins) and self._begins[j] < end:
+            j += 1
+        return i, j
+
+    def add(self, begin, end, value, timestamp=None):
+        if end <= begin:
+            return
+        i, j = self._overlapping(begin, end)
+        if i < j:
+            if j == i + 1 and (self._begins[i], self._ends[i], self._values[i]) == (begin, end, value):
+                return
+            if len(self._sealed) in self._added[i:j]:
+                self._seal(timestamp)
+            del self._begins[i:j]
+            del self._ends[i:j]
+            del self._values[i:j]
+            del self._added[i:j]
+        elif self._start is None:
+            self._start = timestamp
+        self._begins.insert(i, begin)
+        self._ends.insert(i, end)
+        self._values.insert(i, value)
+        self._added.insert(i, len(self._sealed))
+
+    def remove(self, begin, timestamp=None):
+        i = bisect.bisect_left(self._begins, begin)
+        if i < len(self._begins) and self._begins[i] == begin:
+            self._seal(timestamp)
+            del self._begins[i]
+            del self._ends[i]
+            del self._values[i]
+            del self._added[i]
+
+    def generation_id(self, timestamp=None):
+        """Returns a number identifying the generation used at timestamp."""
+        if timestamp is None or not self._sealed:
+            return len(self._sealed)
+        if self._start is not None and timestamp >= self._start:
+            return len(self._sealed)
+        return max(bisect.bisect_right(self._sealed_starts, timestamp) - 1, 0)
+
+    def _generation(self, timestamp):
+        i = self.generation_id(timestamp)
+        if i == len(self._sealed):
+            return self._begins, self._ends, self._values
+        g = self._sealed[i]
+        return g.begins, g.ends, g.values
+
+    def lookup(self, address, timestamp=None):
+        """Returns the value for address at timestamp, or None."""
+        return _lookup(*self._generation(timestamp), address)
+
+    def lookup_many(self, addresses, timestamp=None):
+        """Returns a dict mapping each address to its value, or None.
+
+        Addresses are sorted and resolved in a single pass over the ranges,
+        which is faster than individual lookups for large batches."""
+        begins, ends, values = self._generation(timestamp)
+        result = {}
+        n = len(begins)
+        i = 0
+        for address in sorted(set(addresses)):
+            while i + 1 < n and begins[i + 1] <= address:
+                i += 1
+            if n and begins[i] <= address < ends[i]:
+                result[address] = values[i]
+            else:
+                result[address] = None
+        return result
+
+
+class _ProcessSymbols:
+    __slots__ = ('python', 'native', 'functions', 'sampled')
+
+    def __init__(self):
+        self.python = IntervalIndex()
+        self.native = IntervalIndex()
+        self.functions = {}
+        self.sampled = {}
+
+
+class Symbolizer:
+    """Builds per-process address indexes from trace events.
+
+    Pass every event from the trace to add(), in order. PythonFunction and
+    image load/unload events update the indexes and other events are
+    ignored. Stacks can then be resolved with symbolize(), or during a
+    single pass with symbolize_events().
+    """
+
+    def __init__(self, *, native=True):
+        self.native = native
+        self._processes = {}
+        self._frames = {}
+
+    def _process(self, pid):
+        p = self._processes.get(pid)
+        if p is None:
+            p = self._processes[pid] = _ProcessSymbols()
+        return p
+
+    def _frame(self, *args):
+        # Share identical frames between processes and generations
+        f = Frame(*args)
+        return self._frames.setdefault(f, f)
+
+    def add(self, event):
+        """Updates the indexes from event, and returns True if it was used."""
+        name = event.event_name
+        if name == 'PythonFunction':
+            begin = event['BeginAddress'].value
+            end = event['EndAddress'].value
+            frame = self._frame(
+                'python',
+                event['Name'].value,
+                event['SourceFile'].value,
+                event['LineNumber'].value,
+                None,
+                begin or None,
+            )
+            p = self._process(event.process_id)
+            p.functions[event['FunctionID'].value] = frame
+            if begin and end:
+                p.python.add(begin, end, frame, event.timestamp)
+            return True
+        if name == 'PythonSampledStack':
+            p = self._process(event.process_id)
+            p.sampled[event['StackID'].value] = [
+                p.functions.get(f) or self._frame('unknown', None, None, None, None, f)
+                for f in event['FunctionIDs'].value
+            ]
+            return True
+        if not self.native or event.task_name != 'Image':
+            return False
+        try:
+            pid = event['ProcessId'].value
+            base = event['ImageBase'].value
+        except LookupError:
+            return False
+        if event.opcode_name in ('Load', 'DCStart'):
+            module = _basename(event['FileName'].value)
+            size = event['ImageSize'].value
+            self._process(pid).native.add(base, base + size, (module, base), event.timestamp)
+            return True
+        if event.opcode_name == 'UnLoad':
+            self._process(pid).native.remove(base, event.timestamp)
+            return True
+        return False
+
+    def _resolve(self, address, python, native):
+        frame = python.get(address)
+        if frame is not None:
+            return frame
+        image = native.get(address) if native else None
+        if image is not None:
+            module, base = image
+            return self._frame('native', None, None, None, module, address - base)
+        return self._frame('unknown', None, None, None, None, address)
+
+    def sampled_frames(self, event):
+        """Returns the frames for a PythonSample or PythonAllocation event,
+        or None."""
+        p = self._processes.get(event.process_id)
+        if p is None:
+            return None
+        return p.sampled.get(event['StackID'].value)
+
+    def symbolize(self, process_id, stack, timestamp=None):
+        """Returns the list of frames for the addresses in stack."""
+        return self.symbolize_many([(process_id, timestamp, stack)])[0]
+
+    def symbolize_many(self, samples):
+        """Resolves a batch of (process_id, timestamp, stack) samples.
+
+        Returns a list of frame lists in the same order. Samples are grouped
+        by process and generation, so that each distinct address is only
+        looked up once per batch, and identical stacks share a frame list.
+        """
+        samples = list(samples)
+        groups = {}
+        for i, (pid, ts, stack) in enumerate(samples):
+            p = self._processes.get(pid)
+            if p is None:
+                key = (pid, None, None)
+            else:
+                key = (pid, p.python.generation_id(ts), p.native.generation_id(ts) if self.native else None)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (ts, [])
+            group[1].append(i)
+
+        result = [None] * len(samples)
+        for (pid, _, _), (ts, indexes) in groups.items():
+            p = self._processes.get(pid) or _ProcessSymbols()
+            addresses = set()
+            for i in indexes:
+                addresses.update(samples[i][2])
+            python = p.python.lookup_many(addresses, ts)
+            native = p.native.lookup_many(addresses, ts) if self.native else None
+            memo = {}
+            for i in indexes:
+                stack = samples[i][2]
+                key = bytes(stack) if isinstance(stack, array.array) else tuple(stack)
+                frames = memo.get(key)
+                if frames is None:
+                    frames = memo[key] = [self._resolve(a, python, native) for a in stack]
+                result[i] = frames
+        return result
+
+    def symbolize_events(self, events, *, batch_size=4096, all_events=False):
+        """Yields (event, frames) for each event in events that has a stack.
+
+        Definitions are taken from the same events as they are read, so
+        only one pass over the trace is required. With all_events=True,
+        every event is yielded in its original order, and frames is None
+        for those without a stack."""
+        batch = []
+        # Sampled stacks are resolved as they are read, as their IDs are
+        # defined by earlier events rather than by time
+        sampled = {}
+        stacks = 0
+        for e in events:
+            used = self.add(e)
+            if not used and e.stack is not None:
+                stacks += 1
+            elif not used and (e.event_name == 'PythonSample' or
+                               e.event_name == 'PythonAllocation' and e.opcode == 1):
+                frames = self.sampled_frames(e)
+                if frames is not None:
+                    sampled[id(e)] = frames
+                elif not all_events:
+                    continue
+            elif not all_events:
+                continue
+            batch.append(e)
+            if stacks >= batch_size or len(batch) >= batch_size * 4:
+                yield from self._flush(batch, sampled)
+                batch = []
+                sampled = {}
+                stacks = 0
+        if batch:
+            yield from self._flush(batch, sampled)
+
+    def _flush(self, batch, sampled=None):
+        with_stacks = [e for e in batch if e.stack is not None]
+        frames = self.symbolize_many((e.process_id, e.timestamp, e.stack) for e in with_stacks)
+        if not sampled and len(with_stacks) == len(batch):
+            return zip(batch, frames)
+        lookup = {id(e): f for e, f in zip(with_stacks, frames)}
+        if sampled:
+            lookup.update(sampled)
+        return ((e, lookup.get(id(e))) for e in batch)
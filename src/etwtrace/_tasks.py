@@ -0,0 +1,243 @@
+"""Reconstructs asyncio task timelines from task events.
+
+Tracers enabled with tasks=True raise PythonTaskCreate when a task is
+created, with the task that created it, a PythonTaskStep start/stop pair
+around each step of a task, and a PythonCallback start/stop pair around
+other event loop callbacks (see _asynctrace.py). From these, TaskAnalyzer
+builds a timeline for each task: when it was running (and on which thread),
+waiting on another task or future, or ready to run.
+
+Each task's CPU time is the time spent in its steps, and its wall time is
+from its creation to the end of its last step. Tasks are linked to the
+task that created them, so the root of each tree of tasks is typically the
+request or connection handler that the work was done for. Tasks that were
+already running when the trace started are created at their first step,
+with no parent. A second PythonTaskCreate for a task that has not run yet
+only changes its name.
+"""
+
+RUNNING = 'running'
+WAITING = 'waiting'
+READY = 'ready'
+
+
+class TaskInfo:
+    """The timeline and totals for one task.
+
+    segments is a list of (start, end, state, detail) in time order. detail
+    is the thread ID while running, and the awaited TaskInfo (or None for
+    other futures) while waiting."""
+    __slots__ = ('process_id', 'task_id', 'name', 'parent', 'children', 'created',
+                 'finished', 'last_seen', 'steps', 'cpu', 'segments', 'awaiters',
+                 '_step_start', '_suspended', '_awaiting')
+
+    def __init__(self, process_id, task_id, name, parent, timestamp):
+        self.process_id = process_id
+        self.task_id = task_id
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.created = timestamp
+        self.finished = None
+        self.last_seen = timestamp
+        self.steps = 0
+        self.cpu = 0
+        self.segments = []
+        # Tasks that have awaited this one directly
+        self.awaiters = []
+        self._step_start = None
+        self._suspended = timestamp
+        self._awaiting = None
+        if parent:
+            parent.children.append(self)
+
+    @property
+    def display_name(self):
+        return self.name or f"<task 0x{self.task_id:X}>"
+
+    @property
+    def wall(self):
+        return (self.finished if self.finished is not None else self.last_seen) - self.created
+
+    @property
+    def inclusive_cpu(self):
+        """CPU time of this task and every task it created."""
+        return self.cpu + sum(c.inclusive_cpu for c in self.children)
+
+    @property
+    def root(self):
+        t = self
+        while t.parent:
+            t = t.parent
+        return t
+
+    def logical_stack(self):
+        """Returns the chain of tasks from the root to this task."""
+        stack = []
+        t = self
+        while t:
+            stack.append(t)
+            t = t.parent
+        stack.reverse()
+        return stack
+
+    def __repr__(self):
+        return f"<TaskInfo({self.display_name!r}, steps={self.steps}, cpu={self.cpu})>"
+
+
+class CallbackInfo:
+    """Totals for event loop callbacks with the same name."""
+    __slots__ = ('process_id', 'name', 'calls', 'total', 'longest')
+
+    def __init__(self, process_id, name):
+        self.process_id = process_id
+        self.name = name
+        self.calls = 0
+        self.total = 0
+        self.longest = 0
+
+    def __repr__(self):
+        return f"<CallbackInfo({self.name!r}, calls={self.calls})>"
+
+
+class TaskAnalyzer:
+    """Accumulates task timelines from PythonTaskCreate/Step and
+    PythonCallback events.
+
+    tasks lists every task seen, in order of creation, and callbacks totals
+    the other event loop callbacks by name.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.callbacks = {}
+        self.unmatched_stops = 0
+        # Task IDs are reused after a task is done, so only the latest
+        # task with each ID is found here
+        self._live = {}
+        self._callback_starts = {}
+        self._finished = False
+
+    def _create(self, pid, task_id, name, parent_id, timestamp):
+        parent = self._live.get((pid, parent_id)) if parent_id else None
+        t = TaskInfo(pid, task_id, name, parent, timestamp)
+        self.tasks.append(t)
+        self._live[pid, task_id] = t
+        return t
+
+    def add(self, event):
+        name = event.event_name
+        if name == 'PythonTaskStep':
+            pid = event.process_id
+            task_id = event['TaskID'].value
+            ts = event.timestamp
+            t = self._live.get((pid, task_id))
+            if event.opcode == 1:
+                if t is None:
+                    t = self._create(pid, task_id, None, 0, ts)
+                self._start(t, event.thread_id, ts)
+            elif t is None or t._step_start is None:
+                self.unmatched_stops += 1
+            else:
+                self._stop(t, event, ts)
+        elif name == 'PythonTaskCreate':
+            pid = event.process_id
+            task_id = event['TaskID'].value
+            t = self._live.get((pid, task_id))
+            if t is not None and not t.steps and t._step_start is None:
+                # Renamed before its first step
+                t.name = event['Name'].value
+            else:
+                self._create(pid, task_id, event['Name'].value,
+                             event['ParentTaskID'].value, event.timestamp)
+        elif name == 'PythonCallback':
+            key = event.process_id, event.thread_id
+            if event.opcode == 1:
+                self._callback_starts[key] = event.timestamp
+            else:
+                start = self._callback_starts.pop(key, None)
+                if start is None:
+                    self.unmatched_stops += 1
+                    return
+                ckey = event.process_id, event['Name'].value
+                c = self.callbacks.get(ckey)
+                if c is None:
+                    c = self.callbacks[ckey] = CallbackInfo(*ckey)
+                elapsed = event.timestamp - start
+                c.calls += 1
+                c.total += elapsed
+                if elapsed > c.longest:
+                    c.longest = elapsed
+
+    def _start(self, t, thread_id, timestamp):
+        if t._suspended < timestamp:
+            state = WAITING if t._awaiting is not None else READY
+            awaited = t._awaiting if isinstance(t._awaiting, TaskInfo) else None
+            t.segments.append((t._suspended, timestamp, state, awaited))
+        t._step_start = timestamp, thread_id
+        t.last_seen = timestamp
+
+    def _stop(self, t, event, timestamp):
+        start, thread_id = t._step_start
+        t._step_start = None
+        t.steps += 1
+        t.cpu += timestamp - start
+        t.segments.append((start, timestamp, RUNNING, thread_id))
+        t.last_seen = t._suspended = timestamp
+        if event['Done'].value:
+            t.finished = timestamp
+            t._awaiting = None
+            del self._live[t.process_id, t.task_id]
+            return
+        awaiting_id = event['AwaitingID'].value
+        if not awaiting_id:
+            t._awaiting = None
+            return
+        awaited = self._live.get((t.process_id, awaiting_id))
+        if awaited is not None and awaited is not t:
+            if t not in awaited.awaiters:
+                awaited.awaiters.append(t)
+            t._awaiting = awaited
+        else:
+            # A future other than a task
+            t._awaiting = awaiting_id
+
+    def finish(self, timestamp=None):
+        """Closes steps that are still running at the end of the trace."""
+        if self._finished:
+            return
+        self._finished = True
+        for t in self._live.values():
+            if t._step_start is not None:
+                start, thread_id = t._step_start
+                end = timestamp if timestamp is not None else start
+                t.steps += 1
+                t.cpu += end - start
+                t.segments.append((start, end, RUNNING, thread_id))
+                t.last_seen = end
+                t._step_start = None
+
+    def roots(self):
+        """Returns tasks without a parent, by the CPU time of their trees."""
+        roots = [t for t in self.tasks if t.parent is None]
+        roots.sort(key=lambda t: t.inclusive_cpu, reverse=True)
+        return roots
+
+    def top_tasks(self, key='cpu', count=None):
+        tasks = sorted(self.tasks, key=lambda t: getattr(t, key), reverse=True)
+        return tasks[:count] if count else tasks
+
+    def top_callbacks(self, count=None):
+        callbacks = sorted(self.callbacks.values(), key=lambda c: c.total, reverse=True)
+        return callbacks[:count] if count else callbacks
+
+
+def analyze(events):
+    """Returns a finished TaskAnalyzer for events."""
+    a = TaskAnalyzer()
+    last = None
+    for e in events:
+        a.add(e)
+        last = e.timestamp
+    a.finish(last)
+    return a
@@ -8,8 +8,24 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
+#include <cwctype>
+#include <new>
+#include <string>
+#include <unordered_set>
+#include <vector>
+
 #include "_tdhreader.h"
 
+typedef std::unordered_set<std::wstring> NameSet;
+
+struct PropertyFilter {
+    std::wstring name;
+    int op;
+    ULONGLONG low;
+    ULONGLONG high;
+    std::unordered_set<ULONGLONG> values;
+};
+
 struct TraceHandle {
     EVENT_TRACE_LOGFILEW logfile;
     TRACEHANDLE handle;
@@ -28,16 +44,18 @@ struct TraceHandle {
     TRACE_EVENT_INFO *info;
 
     const GUID *include_provider;
-    const wchar_t * const *include_provider_name;
-    const wchar_t * const *include_event_name;
-    const ULONG *include_process_id;
+    NameSet *include_provider_name;
+    NameSet *include_event_name;
+    std::unordered_set<ULONG> *include_process_id;
+    std::vector<PropertyFilter> *include_property;
+    std::wstring *name_buffer;
     ULONGLONG include_all_keyword_mask;
     ULONGLONG include_any_keyword_mask;
+    LONGLONG start_time;
+    LONGLONG end_time;
     int include_provider_count;
-    int include_provider_name_count;
-    int include_event_name_count;
-    int include_process_id_count;
     bool include_child_processes;
+    volatile bool past_end_time;
 };
 
 
@@ -49,15 +67,152 @@ DEFINE_GUID( /* 3d6fa8d0-fe05-11d0-9dda-00c04fd7ba7c */
 int AddTraceProcessIdFilter(TraceHandle *handle, ULONG process_id);
 
 
+static bool MatchName(TraceHandle *t, const NameSet *names, ULONG offset)
+{
+    if (!t->info || !offset) {
+        return false;
+    }
+    const wchar_t *name = (const wchar_t *)((const char *)t->info + offset);
+    std::wstring &key = *t->name_buffer;
+    key.assign(name);
+    for (auto &c : key) {
+        c = towlower(c);
+    }
+    return names->find(key) != names->end();
+}
+
+
+static bool ReadIntegerProperty(TraceHandle *t, EVENT_RECORD *evt, const std::wstring &name, ULONGLONG *value, bool *is_signed)
+{
+    USHORT in_type = 0;
+    const wchar_t *schema_name = NULL;
+    for (ULONG i = 0; i < t->info->TopLevelPropertyCount; ++i) {
+        const EVENT_PROPERTY_INFO *p = &t->info->EventPropertyInfoArray[i];
+        if ((p->Flags & PropertyStruct) || !p->NameOffset) {
+            continue;
+        }
+        const wchar_t *n = (const wchar_t *)((const char *)t->info + p->NameOffset);
+        if (!_wcsicmp(n, name.c_str())) {
+            in_type = p->nonStructType.InType;
+            schema_name = n;
+            break;
+        }
+    }
+    if (!schema_name) {
+        return false;
+    }
+
+    ULONG size;
+    *is_signed = false;
+    switch (in_type) {
+    case TDH_INTYPE_INT8: *is_signed = true; // fall through
+    case TDH_INTYPE_UINT8: size = 1; break;
+    case TDH_INTYPE_INT16: *is_signed = true; // fall through
+    case TDH_INTYPE_UINT16: size = 2; break;
+    case TDH_INTYPE_INT32: *is_signed = true; // fall through
+    case TDH_INTYPE_UINT32:
+    case TDH_INTYPE_HEXINT32:
+    case TDH_INTYPE_BOOLEAN: size = 4; break;
+    case TDH_INTYPE_INT64: *is_signed = true; // fall through
+    case TDH_INTYPE_UINT64:
+    case TDH_INTYPE_HEXINT64: size = 8; break;
+    case TDH_INTYPE_POINTER:
+    case TDH_INTYPE_SIZET:
+        if (evt->EventHeader.Flags & EVENT_HEADER_FLAG_32_BIT_HEADER) {
+            size = 4;
+        } else if (evt->EventHeader.Flags & EVENT_HEADER_FLAG_64_BIT_HEADER) {
+            size = 8;
+        } else {
+            size = sizeof(void *);
+        }
+        break;
+    default:
+        return false;
+    }
+
+    PROPERTY_DATA_DESCRIPTOR desc = { 0 };
+    desc.PropertyName = (ULONGLONG)schema_name;
+    desc.ArrayIndex = ULONG_MAX;
+    BYTE buffer[8] = { 0 };
+    if (TdhGetProperty(evt, 0, NULL, 1, &desc, size, buffer)) {
+        return false;
+    }
+    LONGLONG v = 0;
+    switch (size) {
+    case 1: v = *is_signed ? (LONGLONG)*(INT8 *)buffer : (LONGLONG)*(UINT8 *)buffer; break;
+    case 2: v = *is_signed ? (LONGLONG)*(INT16 *)buffer : (LONGLONG)*(UINT16 *)buffer; break;
+    case 4: v = *is_signed ? (LONGLONG)*(INT32 *)buffer : (LONGLONG)*(UINT32 *)buffer; break;
+    case 8: memcpy(&v, buffer, sizeof(v)); break;
+    }
+    *value = (ULONGLONG)v;
+    return true;
+}
+
+
+static bool MatchProperties(TraceHandle *t, EVENT_RECORD *evt)
+{
+    if (!t->info) {
+        return false;
+    }
+    for (const auto &f : *t->include_property) {
+        ULONGLONG v;
+        bool is_signed;
+        if (!ReadIntegerProperty(t, evt, f.name, &v, &is_signed)) {
+            return false;
+        }
+        switch (f.op) {
+        case TRACE_PROPERTY_FILTER_IN:
+            if (f.values.find(v) == f.values.end()) {
+                return false;
+            }
+            break;
+        case TRACE_PROPERTY_FILTER_RANGE:
+            if (is_signed) {
+                if ((LONGLONG)v < (LONGLONG)f.low || (LONGLONG)v > (LONGLONG)f.high) {
+                    return false;
+                }
+            } else if (v < f.low || v > f.high) {
+                return false;
+            }
+            break;
+        default:
+            return false;
+        }
+    }
+    return true;
+}
+
+
 static void RecordCallback(PEVENT_RECORD evt)
 {
     auto ph = GetProcessHeap();
     auto t = (TraceHandle *)evt->UserContext;
-    if (t->cancelled)
+    if (t->cancelled || t->past_end_time)
         return;
 
     int err;
 
+    LONGLONG timestamp = evt->EventHeader.TimeStamp.QuadPart;
+    if (t->end_time && timestamp > t->end_time) {
+        // ProcessTrace merges the buffers of a single file into one stream in
+        // time order, so nothing later can match. This would not hold for
+        // several files or a real-time session, which are not opened here.
+        t->past_end_time = true;
+        return;
+    }
+    // Events before the window are not delivered, but process starts and ends
+    // are still decoded to track the children of included processes
+    bool before_start = t->start_time && timestamp < t->start_time;
+    if (before_start && !(
+        t->include_process_id &&
+        t->include_child_processes &&
+        (evt->EventHeader.Flags & EVENT_HEADER_FLAG_CLASSIC_HEADER) &&
+        (evt->EventHeader.EventDescriptor.Opcode == EVENT_TRACE_TYPE_START ||
+         evt->EventHeader.EventDescriptor.Opcode == EVENT_TRACE_TYPE_END)
+    )) {
+        return;
+    }
+
     if (t->include_provider && t->include_provider_count > 0) {
         err = ERROR_NOT_FOUND;
         for (int i = 0; i < t->include_provider_count; ++i) {
@@ -70,15 +225,8 @@ static void RecordCallback(PEVENT_RECORD evt)
             return;
         }
     }
-    if (t->include_process_id && t->include_process_id_count > 0) {
-        err = ERROR_NOT_FOUND;
-        for (int i = 0; i < t->include_process_id_count; ++i) {
-            if (evt->EventHeader.ProcessId == t->include_process_id[i]) {
-                err = 0;
-                break;
-            }
-        }
-        if (err) {
+    if (t->include_process_id) {
+        if (t->include_process_id->find(evt->EventHeader.ProcessId) == t->include_process_id->end()) {
             return;
         }
     }
@@ -147,11 +295,8 @@ static void RecordCallback(PEVENT_RECORD evt)
             memcpy(&ppid, &ud[1], sizeof(ULONG));
             if (t->info->EventDescriptor.Opcode == EVENT_TRACE_TYPE_START) {
                 /* Start - we want events from children started by tracked processes */
-                for (int i = 0; i < t->include_process_id_count; ++i) {
-                    if (t->include_process_id[i] == ppid) {
-                        add_pid = pid;
-                        break;
-                    }
+                if (t->include_process_id->find(ppid) != t->include_process_id->end()) {
+                    add_pid = pid;
                 }
                 if (add_pid) {
                     err = AddTraceProcessIdFilter(t, add_pid);
@@ -164,44 +309,30 @@ static void RecordCallback(PEVENT_RECORD evt)
                 }
             } else  if (t->info->EventDescriptor.Opcode == EVENT_TRACE_TYPE_END) {
                 /* End - stop getting events from a tracked process when it ends */
-                for (int i = 0; i < t->include_process_id_count; ++i) {
-                    if (t->include_process_id[i] == pid) {
-                        ((ULONG *)t->include_process_id)[i] = 0;
-                        break;
-                    }
-                }
+                t->include_process_id->erase(pid);
             }
         }
     }
 
-    if (t->include_provider_name && t->include_provider_name_count > 0) {
-        err = ERROR_NOT_FOUND;
-        if (t->info) {
-            for (int i = 0; i < t->include_provider_name_count; ++i) {
-                const wchar_t *name = (const wchar_t *)((const char *)t->info + t->info->ProviderNameOffset);
-                if (t->info->ProviderNameOffset && !_wcsicmp(name, t->include_provider_name[i])) {
-                    err = 0;
-                    break;
-                }
-            }
-        }
-        if (err) {
+    if (before_start) {
+        err = 0;
+        goto error;
+    }
+
+    if (t->include_provider_name) {
+        if (!MatchName(t, t->include_provider_name, t->info ? t->info->ProviderNameOffset : 0)) {
             err = 0;
             goto error;
         }
     }
-    if (t->include_event_name && t->include_event_name_count > 0) {
-        err = ERROR_NOT_FOUND;
-        if (t->info) {
-            for (int i = 0; i < t->include_event_name_count; ++i) {
-                const wchar_t *name = (const wchar_t *)((const char *)t->info + t->info->EventNameOffset);
-                if (t->info->EventNameOffset && !_wcsicmp(name, t->include_event_name[i])) {
-                    err = 0;
-                    break;
-                }
-            }
+    if (t->include_event_name) {
+        if (!MatchName(t, t->include_event_name, t->info ? t->info->EventNameOffset : 0)) {
+            err = 0;
+            goto error;
         }
-        if (err) {
+    }
+    if (t->include_property) {
+        if (!MatchProperties(t, evt)) {
             err = 0;
             goto error;
         }
@@ -257,7 +388,7 @@ int ReadTraceEvents(TraceHandle *handle, TraceCallback callback, void *context)
 static ULONG BufferCallback(EVENT_TRACE_LOGFILEW *logfile)
 {
     auto t = (TraceHandle *)logfile->Context;
-    return !t->cancelled;
+    return !t->cancelled && !t->past_end_time;
 }
 
 
@@ -268,6 +399,10 @@ DWORD WINAPI EtlProcessor(LPVOID lpParam)
     handle->error = 0;
     handle->error_source = NULL;
     int err = ProcessTrace(&handle->handle, 1, NULL, NULL);
+    if (err == ERROR_CANCELLED && handle->past_end_time) {
+        // We stopped early because we passed the end of the time filter
+        err = 0;
+    }
     if (!err) {
         SetEvent(handle->ready_event);
     }
@@ -300,6 +435,11 @@ int OpenEtlFile(const wchar_t *path, TraceHandle **handle)
     t->logfile.EventRecordCallback = RecordCallback;
     t->logfile.BufferCallback = BufferCallback;
     t->logfile.Context = t;
+    t->name_buffer = new (std::nothrow) std::wstring();
+    if (!t->name_buffer) {
+        SetLastError(ERROR_OUTOFMEMORY);
+        goto error;
+    }
     t->handle = OpenTraceW(&t->logfile);
     if (t->handle == INVALID_PROCESSTRACE_HANDLE)
         goto error;
@@ -339,6 +479,7 @@ error:
         HeapFree(ph, 0, t->path);
         t->path = NULL;
     }
+    delete t->name_buffer;
     HeapFree(ph, 0, t);
     return err;
 }
@@ -376,41 +517,33 @@ int SetTraceProviderFilter(TraceHandle *handle, const GUID *providers, int count
 
 int SetTraceProcessIdFilter(TraceHandle *handle, const ULONG *process_ids, int count)
 {
-    return CopyValueArray(
-        (const void**)&handle->include_process_id,
-        &handle->include_process_id_count,
-        process_ids,
-        count,
-        sizeof(GUID)
-    );
+    delete handle->include_process_id;
+    handle->include_process_id = NULL;
+    if (process_ids && count > 0) {
+        handle->include_process_id = new (std::nothrow) std::unordered_set<ULONG>(
+            process_ids, process_ids + count
+        );
+        if (!handle->include_process_id) {
+            return ERROR_OUTOFMEMORY;
+        }
+    }
+    return 0;
 }
 
 
 int AddTraceProcessIdFilter(TraceHandle *handle, ULONG process_id)
 {
-    int free = -1;
-    for (int i = 0; i < handle->include_process_id_count; ++i) {
-        if (handle->include_process_id[i] == process_id) {
-            return 0;
-        }
-        if (!handle->include_process_id[i] && free < 0) {
-            free = i;
-        }
-    }
-    if (free < 0) {
-        auto ph = GetProcessHeap();
-        free = handle->include_process_id_count;
-        handle->include_process_id_count = free + 1;
-        handle->include_process_id = (const ULONG *)HeapReAlloc(ph, 0,
-            (LPVOID)handle->include_process_id,
-            sizeof(ULONG) * handle->include_process_id_count
-        );
+    if (!handle->include_process_id) {
+        handle->include_process_id = new (std::nothrow) std::unordered_set<ULONG>();
         if (!handle->include_process_id) {
-            handle->include_process_id_count = 0;
-            return GetLastError();
+            return ERROR_OUTOFMEMORY;
         }
     }
-    ((ULONG *)handle->include_process_id)[free] = process_id;
+    try {
+        handle->include_process_id->insert(process_id);
+    } catch (const std::bad_alloc &) {
+        return ERROR_OUTOFMEMORY;
+    }
     return 0;
 }
 
@@ -422,37 +555,24 @@ int SetTraceProcessIdChildrenFilter(TraceHandle *handle, int trace_children)
 }
 
 
-static int CopyWcharArray(const wchar_t * const **dest, int *destCount, const wchar_t * const *src, int count)
+static int CopyNameSet(NameSet **dest, const wchar_t * const *src, int count)
 {
-    auto ph = GetProcessHeap();
-    if (*dest) {
-        for (int i = 0; i < *destCount; ++i) {
-            HeapFree(ph, 0, (LPVOID)(*dest[i]));
-        }
-        HeapFree(ph, 0, (LPVOID)*dest);
-        *dest = NULL;
-        *destCount = 0;
-    }
+    delete *dest;
+    *dest = NULL;
     if (src && count > 0) {
-        const wchar_t **p_array = (const wchar_t **)HeapAlloc(ph, 0, sizeof(const wchar_t *) * count);
-        if (!p_array)
-            return GetLastError();
-        for (int i = 0; i < count; ++i) {
-            size_t len = wcslen(src[i]) + 1;
-            wchar_t *p = (wchar_t *)HeapAlloc(ph, 0, sizeof(wchar_t) * len);
-            if (!p) {
-                int err = GetLastError();
-                while (--i >= 0) {
-                    HeapFree(ph, 0, (LPVOID)p_array[i]);
+        try {
+            auto names = new NameSet();
+            for (int i = 0; i < count; ++i) {
+                std::wstring name(src[i]);
+                for (auto &c : name) {
+                    c = towlower(c);
                 }
-                HeapFree(ph, 0, (LPVOID)p_array);
-                return err;
+                names->insert(std::move(name));
             }
-            wcscpy_s(p, len, src[i]);
-            p_array[i] = p;
+            *dest = names;
+        } catch (const std::bad_alloc &) {
+            return ERROR_OUTOFMEMORY;
         }
-        *dest = p_array;
-        *destCount = count;
     }
     return 0;
 }
@@ -460,23 +580,13 @@ static int CopyWcharArray(const wchar_t * const **dest, int *destCount, const wc
 
 int SetTraceProviderNameFilter(TraceHandle *handle, const wchar_t * const *providers, int count)
 {
-    return CopyWcharArray(
-        &handle->include_provider_name,
-        &handle->include_provider_name_count,
-        providers,
-        count
-    );
+    return CopyNameSet(&handle->include_provider_name, providers, count);
 }
 
 
 int SetTraceEventNameFilter(TraceHandle *handle, const wchar_t * const *events, int count)
 {
-    return CopyWcharArray(
-        &handle->include_event_name,
-        &handle->include_event_name_count,
-        events,
-        count
-    );
+    return CopyNameSet(&handle->include_event_name, events, count);
 }
 
 
@@ -488,6 +598,54 @@ int SetTraceKeywordFilter(TraceHandle *handle, ULONGLONG allMask, ULONGLONG anyM
 }
 
 
+int SetTraceTimeFilter(TraceHandle *handle, LONGLONG start_time, LONGLONG end_time)
+{
+    handle->start_time = start_time;
+    handle->end_time = end_time;
+    return 0;
+}
+
+
+int AddTracePropertyFilter(
+    TraceHandle *handle,
+    const wchar_t *name,
+    int op,
+    ULONGLONG low,
+    ULONGLONG high,
+    const ULONGLONG *values,
+    int count
+) {
+    if (op != TRACE_PROPERTY_FILTER_IN && op != TRACE_PROPERTY_FILTER_RANGE) {
+        return ERROR_INVALID_PARAMETER;
+    }
+    try {
+        if (!handle->include_property) {
+            handle->include_property = new std::vector<PropertyFilter>();
+        }
+        PropertyFilter f;
+        f.name = name;
+        f.op = op;
+        f.low = low;
+        f.high = high;
+        if (values && count > 0) {
+            f.values.insert(values, values + count);
+        }
+        handle->include_property->push_back(std::move(f));
+    } catch (const std::bad_alloc &) {
+        return ERROR_OUTOFMEMORY;
+    }
+    return 0;
+}
+
+
+int ClearTracePropertyFilter(TraceHandle *handle)
+{
+    delete handle->include_property;
+    handle->include_property = NULL;
+    return 0;
+}
+
+
 int CancelReadTrace(TraceHandle *handle)
 {
     handle->cancelled = true;
@@ -532,6 +690,9 @@ int CloseTraceHandle(TraceHandle *handle, int *error, const char **error_source)
     SetTraceProviderNameFilter(handle, NULL, 0);
     SetTraceEventNameFilter(handle, NULL, 0);
     SetTraceProcessIdFilter(handle, NULL, 0);
+    ClearTracePropertyFilter(handle);
+    delete handle->name_buffer;
+    handle->name_buffer = NULL;
 
     if (error) {
         *error = handle->error;
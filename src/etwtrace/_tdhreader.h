@@ -17,6 +17,10 @@ typedef struct TraceCallbackInfo TraceCallbackInfo;
 #endif
 
 
+#define TRACE_PROPERTY_FILTER_IN 1
+#define TRACE_PROPERTY_FILTER_RANGE 2
+
+
 typedef int (__stdcall *TraceCallback)(void *context, TraceCallbackInfo *info);
 
 int OpenEtlFile(const wchar_t *path, TraceHandle **handle);
@@ -30,6 +34,9 @@ int SetTraceProcessIdFilter(TraceHandle *handle, const ULONG *process_ids, int c
 int AddTraceProcessIdFilter(TraceHandle *handle, ULONG process_id);
 int SetTraceProcessIdChildrenFilter(TraceHandle *handle, int trace_children);
 int SetTraceKeywordFilter(TraceHandle *handle, ULONGLONG allMask, ULONGLONG anyMask);
+int SetTraceTimeFilter(TraceHandle *handle, LONGLONG start_time, LONGLONG end_time);
+int AddTracePropertyFilter(TraceHandle *handle, const wchar_t *name, int op, ULONGLONG low, ULONGLONG high, const ULONGLONG *values, int count);
+int ClearTracePropertyFilter(TraceHandle *handle);
 
 #ifdef __cplusplus
 }
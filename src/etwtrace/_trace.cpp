@@ -16,7 +16,21 @@ enum PythonETWKeywords {
     PYTHON_KEYWORD_FUNCTION = 0x400,
     PYTHON_KEYWORD_MARK = 0x800,
     PYTHON_KEYWORD_FUNCTION_PUSH = 0x1000,
-    PYTHON_KEYWORD_FUNCTION_POP = 0x2000
+    PYTHON_KEYWORD_FUNCTION_POP = 0x2000,
+    PYTHON_KEYWORD_SAMPLE = 0x4000,
+    PYTHON_KEYWORD_TASK = 0x8000,
+    PYTHON_KEYWORD_ACTIVITY = 0x10000,
+    PYTHON_KEYWORD_GC = 0x20000,
+    PYTHON_KEYWORD_IMPORT = 0x40000,
+    PYTHON_KEYWORD_ALLOCATION = 0x80000,
+    PYTHON_KEYWORD_EXCEPTION = 0x100000,
+    PYTHON_KEYWORD_METRIC = 0x200000
+};
+
+// Opcodes 10 and above are not defined by Windows
+enum {
+    PYTHON_OPCODE_RERAISE = 10,
+    PYTHON_OPCODE_UNWIND = 11
 };
 
 
@@ -28,14 +42,14 @@ void GetProviderGuid(GUID *provider) {
 
 static int register_count = 0;
 
-int Register() {
+static int EtwRegister(void) {
     if (register_count == 0) {
         TraceLoggingRegister(PythonProvider);
     }
     return ++register_count;
 }
 
-int Unregister() {
+static int EtwUnregister(void) {
     if (register_count == 1) {
         TraceLoggingUnregister(PythonProvider);
     }
@@ -43,7 +57,7 @@ int Unregister() {
 }
 
 
-void WriteEvalFunctionEvent(void *dll_handle) {
+static void EtwWriteEvalFunctionEvent(void *dll_handle) {
     typedef void* (*PPyInterpreterState_Get)(void);
     typedef void* (*P_PyInterpreterState_GetEvalFrameFunc)(void *interp);
     auto dll = (HMODULE)dll_handle;
@@ -70,7 +84,7 @@ void WriteEvalFunctionEvent(void *dll_handle) {
 }
 
 
-void WriteBeginThread(int thread_id) {
+static void EtwWriteBeginThread(int thread_id) {
     TraceLoggingWrite(
         PythonProvider,
         "PythonThread",
@@ -81,7 +95,7 @@ void WriteBeginThread(int thread_id) {
     );
 }
 
-void WriteEndThread(int thread_id) {
+static void EtwWriteEndThread(int thread_id) {
     TraceLoggingWrite(
         PythonProvider,
         "PythonThread",
@@ -92,7 +106,7 @@ void WriteEndThread(int thread_id) {
     );
 }
 
-void WriteFunctionEvent(
+static void EtwWriteFunctionEvent(
     FUNC_ID func_id,
     void *begin_addr,
     void *end_addr,
@@ -117,7 +131,7 @@ void WriteFunctionEvent(
 }
 
 
-void WriteCustomEvent(const wchar_t *name, int opcode) {
+static void EtwWriteCustomEvent(const wchar_t *name, int opcode) {
     switch (opcode) {
     case 0:
         TraceLoggingWrite(
@@ -161,7 +175,7 @@ void WriteCustomEvent(const wchar_t *name, int opcode) {
 }
 
 
-void WriteFunctionPush(FUNC_ID from_func_id, size_t from_func_line, FUNC_ID func_id) {
+static void EtwWriteFunctionPush(FUNC_ID from_func_id, size_t from_func_line, FUNC_ID func_id) {
     TraceLoggingWrite(
         PythonProvider,
         "PythonFunctionPush",
@@ -173,7 +187,7 @@ void WriteFunctionPush(FUNC_ID from_func_id, size_t from_func_line, FUNC_ID func
     );
 }
 
-void WriteFunctionPop(FUNC_ID func_id) {
+static void EtwWriteFunctionPop(FUNC_ID func_id) {
     TraceLoggingWrite(
         PythonProvider,
         "PythonFunctionPop",
@@ -182,3 +196,337 @@ void WriteFunctionPop(FUNC_ID func_id) {
         TraceLoggingValue(Void_FromFUNC_ID(func_id), "FunctionID")
     );
 }
+
+
+static void EtwWriteStack(int stack_id, const FUNC_ID *frames, int count) {
+    TraceLoggingWrite(
+        PythonProvider,
+        "PythonSampledStack",
+        TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+        TraceLoggingKeyword(PYTHON_KEYWORD_SAMPLE),
+        TraceLoggingValue(stack_id, "StackID"),
+        TraceLoggingInt32Array(frames, (UINT16)count, "FunctionIDs")
+    );
+}
+
+static void EtwWriteSample(int thread_id, int stack_id) {
+    TraceLoggingWrite(
+        PythonProvider,
+        "PythonSample",
+        TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+        TraceLoggingKeyword(PYTHON_KEYWORD_SAMPLE),
+        TraceLoggingValue(thread_id, "ThreadID"),
+        TraceLoggingValue(stack_id, "StackID")
+    );
+}
+
+static void EtwWriteTaskCreate(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name) {
+    TraceLoggingWrite(
+        PythonProvider,
+        "PythonTaskCreate",
+        TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+        TraceLoggingKeyword(PYTHON_KEYWORD_TASK),
+        TraceLoggingValue(task_id, "TaskID"),
+        TraceLoggingValue(parent_id, "ParentTaskID"),
+        TraceLoggingValue(name, "Name")
+    );
+}
+
+static void EtwWriteTaskStep(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done) {
+    if (opcode == 1) {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonTaskStep",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_TASK),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(task_id, "TaskID")
+        );
+    } else {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonTaskStep",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_TASK),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP),
+            TraceLoggingValue(task_id, "TaskID"),
+            TraceLoggingValue(awaiting_id, "AwaitingID"),
+            TraceLoggingValue(done, "Done")
+        );
+    }
+}
+
+static void EtwWriteCallback(LPCWSTR name, int opcode) {
+    if (opcode == 1) {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonCallback",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_TASK),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(name, "Name")
+        );
+    } else {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonCallback",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_TASK),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP),
+            TraceLoggingValue(name, "Name")
+        );
+    }
+}
+
+// Also sets the thread's activity ID, so that every event written by this
+// thread (by any provider) is tagged with the activity it is working on.
+static void EtwWriteActivity(int opcode, const GUID *activity_id, const GUID *related_id, LPCWSTR name) {
+    GUID current = {0};
+    switch (opcode) {
+    case 1:
+        TraceLoggingWriteActivity(
+            PythonProvider,
+            "PythonActivity",
+            activity_id,
+            related_id,
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_ACTIVITY),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(name, "Name")
+        );
+        current = *activity_id;
+        break;
+    case 2:
+        TraceLoggingWriteActivity(
+            PythonProvider,
+            "PythonActivity",
+            activity_id,
+            related_id,
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_ACTIVITY),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP)
+        );
+        if (related_id) {
+            current = *related_id;
+        }
+        break;
+    case 7:
+        TraceLoggingWriteActivity(
+            PythonProvider,
+            "PythonActivity",
+            activity_id,
+            NULL,
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_ACTIVITY),
+            TraceLoggingOpcode(WINEVENT_OPCODE_RESUME)
+        );
+        current = *activity_id;
+        break;
+    case 8:
+        TraceLoggingWriteActivity(
+            PythonProvider,
+            "PythonActivity",
+            activity_id,
+            NULL,
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_ACTIVITY),
+            TraceLoggingOpcode(WINEVENT_OPCODE_SUSPEND)
+        );
+        break;
+    }
+    EventActivityIdControl(EVENT_ACTIVITY_CTRL_SET_ID, &current);
+}
+
+static void EtwWriteGC(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable, DWORD64 duration) {
+    if (opcode == 1) {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonGC",
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_GC),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(generation, "Generation")
+        );
+    } else {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonGC",
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_GC),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP),
+            TraceLoggingValue(generation, "Generation"),
+            TraceLoggingValue(collected, "Collected"),
+            TraceLoggingValue(uncollectable, "Uncollectable"),
+            TraceLoggingValue(duration, "Duration")
+        );
+    }
+}
+
+static void EtwWriteImport(int opcode, LPCWSTR name, LPCWSTR detail) {
+    if (opcode == 1) {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonImport",
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_IMPORT),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(name, "Name"),
+            TraceLoggingValue(detail, "Parent")
+        );
+    } else {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonImport",
+            TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+            TraceLoggingKeyword(PYTHON_KEYWORD_IMPORT),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP),
+            TraceLoggingValue(name, "Name"),
+            TraceLoggingValue(detail, "Origin")
+        );
+    }
+}
+
+static void EtwWriteAllocation(int opcode, void *address, DWORD64 size, DWORD64 weight, int stack_id) {
+    if (opcode == 1) {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonAllocation",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_ALLOCATION),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(address, "Address"),
+            TraceLoggingValue(size, "Size"),
+            TraceLoggingValue(weight, "Weight"),
+            TraceLoggingValue(stack_id, "StackID")
+        );
+    } else {
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonAllocation",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_ALLOCATION),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP),
+            TraceLoggingValue(address, "Address")
+        );
+    }
+}
+
+static void EtwWriteExceptionType(int type_id, LPCWSTR name) {
+    TraceLoggingWrite(
+        PythonProvider,
+        "PythonExceptionType",
+        TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+        TraceLoggingKeyword(PYTHON_KEYWORD_EXCEPTION),
+        TraceLoggingValue(type_id, "TypeID"),
+        TraceLoggingValue(name, "Name")
+    );
+}
+
+static void EtwWriteException(int opcode, int type_id, FUNC_ID func_id, int line) {
+    switch (opcode) {
+    case 1:
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonException",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_EXCEPTION),
+            TraceLoggingOpcode(WINEVENT_OPCODE_START),
+            TraceLoggingValue(type_id, "TypeID"),
+            TraceLoggingValue(Void_FromFUNC_ID(func_id), "FunctionID"),
+            TraceLoggingValue(line, "Line")
+        );
+        break;
+    case 2:
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonException",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_EXCEPTION),
+            TraceLoggingOpcode(WINEVENT_OPCODE_STOP),
+            TraceLoggingValue(type_id, "TypeID"),
+            TraceLoggingValue(Void_FromFUNC_ID(func_id), "FunctionID"),
+            TraceLoggingValue(line, "Line")
+        );
+        break;
+    case 10:
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonException",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_EXCEPTION),
+            TraceLoggingOpcode(PYTHON_OPCODE_RERAISE),
+            TraceLoggingValue(type_id, "TypeID"),
+            TraceLoggingValue(Void_FromFUNC_ID(func_id), "FunctionID"),
+            TraceLoggingValue(line, "Line")
+        );
+        break;
+    case 11:
+        TraceLoggingWrite(
+            PythonProvider,
+            "PythonException",
+            TraceLoggingLevel(WINEVENT_LEVEL_VERBOSE),
+            TraceLoggingKeyword(PYTHON_KEYWORD_EXCEPTION),
+            TraceLoggingOpcode(PYTHON_OPCODE_UNWIND),
+            TraceLoggingValue(type_id, "TypeID"),
+            TraceLoggingValue(Void_FromFUNC_ID(func_id), "FunctionID"),
+            TraceLoggingValue(line, "Line")
+        );
+        break;
+    }
+}
+
+static void EtwWriteMetricInfo(int metric_id, int kind, LPCWSTR name) {
+    TraceLoggingWrite(
+        PythonProvider,
+        "PythonMetricInfo",
+        TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+        TraceLoggingKeyword(PYTHON_KEYWORD_METRIC),
+        TraceLoggingValue(metric_id, "MetricID"),
+        TraceLoggingValue(kind, "Kind"),
+        TraceLoggingValue(name, "Name")
+    );
+}
+
+static void EtwWriteMetric(int metric_id, DWORD count, double sum, double min, double max, double value,
+                           const DWORD *buckets, int bucket_count) {
+    TraceLoggingWrite(
+        PythonProvider,
+        "PythonMetric",
+        TraceLoggingLevel(WINEVENT_LEVEL_INFO),
+        TraceLoggingKeyword(PYTHON_KEYWORD_METRIC),
+        TraceLoggingValue(metric_id, "MetricID"),
+        TraceLoggingValue((UINT32)count, "Count"),
+        TraceLoggingValue(sum, "Sum"),
+        TraceLoggingValue(min, "Min"),
+        TraceLoggingValue(max, "Max"),
+        TraceLoggingValue(value, "Value"),
+        TraceLoggingUInt32Array((const UINT32 *)buckets, (UINT16)(2 * bucket_count), "Buckets")
+    );
+}
+
+
+
+extern "C" const struct TRACE_SINK DEFAULT_SINK = {
+    EtwRegister,
+    EtwUnregister,
+    EtwWriteBeginThread,
+    EtwWriteEndThread,
+    EtwWriteEvalFunctionEvent,
+    EtwWriteFunctionEvent,
+    EtwWriteFunctionPush,
+    EtwWriteFunctionPop,
+    EtwWriteCustomEvent,
+    EtwWriteStack,
+    EtwWriteSample,
+    EtwWriteTaskCreate,
+    EtwWriteTaskStep,
+    EtwWriteCallback,
+    EtwWriteActivity,
+    EtwWriteGC,
+    EtwWriteImport,
+    EtwWriteAllocation,
+    EtwWriteExceptionType,
+    EtwWriteException,
+    EtwWriteMetricInfo,
+    EtwWriteMetric,
+};
@@ -5,15 +5,96 @@ extern "C" {
 #endif
 
 void GetProviderGuid(GUID *provider);
-int Register();
-int Unregister();
 
-void WriteBeginThread(int thread_id);
-void WriteEndThread(int thread_id);
+// Events are written to the current sink. Each module is linked with a
+// default sink (_trace.cpp for ETW, or _perfmap.c or _nullsink.c elsewhere),
+// which may be replaced at runtime with the file sink in _filesink.c, or
+// combined with it while events are queued for subscribers.
+struct TRACE_SINK {
+    int (*Register)(void);
+    int (*Unregister)(void);
 
-void WriteEvalFunctionEvent(void *dll_handle);
+    void (*WriteBeginThread)(int thread_id);
+    void (*WriteEndThread)(int thread_id);
 
-void WriteFunctionEvent(
+    void (*WriteEvalFunctionEvent)(void *dll_handle);
+
+    void (*WriteFunctionEvent)(
+        FUNC_ID func_id,
+        void *begin_addr,
+        void *end_addr,
+        LPCWSTR source_file,
+        LPCWSTR name,
+        int line_no,
+        int is_python_code
+    );
+
+    void (*WriteFunctionPush)(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id);
+    void (*WriteFunctionPop)(FUNC_ID func_id);
+    void (*WriteCustomEvent)(LPCWSTR name, int opcode);
+
+    // Written by _etwsample.c. Each stack is written once, innermost frame
+    // first, before the first sample that refers to it.
+    void (*WriteStack)(int stack_id, const FUNC_ID *frames, int count);
+    void (*WriteSample)(int thread_id, int stack_id);
+
+    // Written by _asynctrace.py through ETWCOMMON_write_task_*. Task IDs are
+    // the id() of the task, and awaiting_id is the id() of the future (or
+    // task) that a suspended task is waiting on, or zero.
+    void (*WriteTaskCreate)(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name);
+    void (*WriteTaskStep)(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done);
+    void (*WriteCallback)(LPCWSTR name, int opcode);
+
+    // Written by ETWCOMMON_*_activity. Opcodes are 1 (start), 2 (stop),
+    // 7 (resume) and 8 (suspend), and afterwards the thread is working on
+    // activity_id after start and resume, related_id (which may be NULL)
+    // after stop, and nothing after suspend. name is only passed to start.
+    void (*WriteActivity)(int opcode, const GUID *activity_id, const GUID *related_id, LPCWSTR name);
+
+    // Written by ETWCOMMON_gc_callback. Opcodes are 1 (start) and 2 (stop),
+    // and the counts and duration (in 100ns units) are only used for stop.
+    void (*WriteGC)(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable, DWORD64 duration);
+
+    // Written by _importtrace.py through ETWCOMMON_write_import. detail is
+    // the importing module for start (opcode 1) and how the module was
+    // loaded for stop (opcode 2).
+    void (*WriteImport)(int opcode, LPCWSTR name, LPCWSTR detail);
+
+    // Written by the allocation hooks in _etwcommon.c. Opcode 1 is a sampled
+    // allocation, with its size, the bytes it represents and the ID of a
+    // stack from WriteStack (or zero), and opcode 2 is the sampled block at
+    // address being freed.
+    void (*WriteAllocation)(int opcode, void *address, DWORD64 size, DWORD64 weight, int stack_id);
+
+    // Written by ETWCOMMON_write_exception_event. Each exception type is
+    // written once before the first event that refers to it. Opcodes are 1
+    // (raised), 2 (handled), 10 (reraised) and 11 (unwound out of func_id),
+    // and line is where it happened in func_id.
+    void (*WriteExceptionType)(int type_id, LPCWSTR name);
+    void (*WriteException)(int opcode, int type_id, FUNC_ID func_id, int line);
+
+    // Written by the metric objects in _etwcommon.c. Each metric is written
+    // with its kind (1 counter, 2 gauge, 3 histogram) and name before its
+    // first summary. Summaries cover the updates since the previous one,
+    // with the current value of a gauge, and bucket_count pairs of bucket
+    // index and count for the histogram buckets that were used.
+    void (*WriteMetricInfo)(int metric_id, int kind, LPCWSTR name);
+    void (*WriteMetric)(int metric_id, DWORD count, double sum, double min, double max, double value,
+                        const DWORD *buckets, int bucket_count);
+};
+
+extern const struct TRACE_SINK DEFAULT_SINK;
+extern const struct TRACE_SINK *CurrentSink;
+
+static inline int Register(void) { return CurrentSink->Register(); }
+static inline int Unregister(void) { return CurrentSink->Unregister(); }
+
+static inline void WriteBeginThread(int thread_id) { CurrentSink->WriteBeginThread(thread_id); }
+static inline void WriteEndThread(int thread_id) { CurrentSink->WriteEndThread(thread_id); }
+
+static inline void WriteEvalFunctionEvent(void *dll_handle) { CurrentSink->WriteEvalFunctionEvent(dll_handle); }
+
+static inline void WriteFunctionEvent(
     FUNC_ID func_id,
     void *begin_addr,
     void *end_addr,
@@ -21,11 +102,57 @@ void WriteFunctionEvent(
     LPCWSTR name,
     int line_no,
     int is_python_code
-);
+) {
+    CurrentSink->WriteFunctionEvent(func_id, begin_addr, end_addr, source_file, name, line_no, is_python_code);
+}
+
+static inline void WriteFunctionPush(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id) {
+    CurrentSink->WriteFunctionPush(from_func_id, from_line, to_func_id);
+}
+static inline void WriteFunctionPop(FUNC_ID func_id) { CurrentSink->WriteFunctionPop(func_id); }
+static inline void WriteCustomEvent(LPCWSTR name, int opcode) { CurrentSink->WriteCustomEvent(name, opcode); }
 
-void WriteFunctionPush(FUNC_ID from_func_id, size_t from_line, FUNC_ID to_func_id);
-void WriteFunctionPop(FUNC_ID func_id);
-void WriteCustomEvent(LPCWSTR name, int opcode);
+static inline void WriteStack(int stack_id, const FUNC_ID *frames, int count) {
+    CurrentSink->WriteStack(stack_id, frames, count);
+}
+static inline void WriteSample(int thread_id, int stack_id) { CurrentSink->WriteSample(thread_id, stack_id); }
+
+static inline void WriteTaskCreate(DWORD64 task_id, DWORD64 parent_id, LPCWSTR name) {
+    CurrentSink->WriteTaskCreate(task_id, parent_id, name);
+}
+static inline void WriteTaskStep(DWORD64 task_id, int opcode, DWORD64 awaiting_id, int done) {
+    CurrentSink->WriteTaskStep(task_id, opcode, awaiting_id, done);
+}
+static inline void WriteCallback(LPCWSTR name, int opcode) { CurrentSink->WriteCallback(name, opcode); }
+
+static inline void WriteActivity(int opcode, const GUID *activity_id, const GUID *related_id, LPCWSTR name) {
+    CurrentSink->WriteActivity(opcode, activity_id, related_id, name);
+}
+
+static inline void WriteGC(int opcode, int generation, DWORD64 collected, DWORD64 uncollectable, DWORD64 duration) {
+    CurrentSink->WriteGC(opcode, generation, collected, uncollectable, duration);
+}
+
+static inline void WriteImport(int opcode, LPCWSTR name, LPCWSTR detail) {
+    CurrentSink->WriteImport(opcode, name, detail);
+}
+
+static inline void WriteAllocation(int opcode, void *address, DWORD64 size, DWORD64 weight, int stack_id) {
+    CurrentSink->WriteAllocation(opcode, address, size, weight, stack_id);
+}
+
+static inline void WriteExceptionType(int type_id, LPCWSTR name) { CurrentSink->WriteExceptionType(type_id, name); }
+static inline void WriteException(int opcode, int type_id, FUNC_ID func_id, int line) {
+    CurrentSink->WriteException(opcode, type_id, func_id, line);
+}
+
+static inline void WriteMetricInfo(int metric_id, int kind, LPCWSTR name) {
+    CurrentSink->WriteMetricInfo(metric_id, kind, name);
+}
+static inline void WriteMetric(int metric_id, DWORD count, double sum, double min, double max, double value,
+                               const DWORD *buckets, int bucket_count) {
+    CurrentSink->WriteMetric(metric_id, count, sum, min, max, value, buckets, bucket_count);
+}
 
 #ifdef __cplusplus
 }
@@ -0,0 +1,557 @@
+"""Reader for files written by the file sink.
+
+Tracers write to these files instead of ETW when given an output path (see
+_filesink.c for the layout). The reader returns the same EventData objects
+as the ETL reader, with the Python provider's event names, keywords and
+property names, so the analysis and export functions work unchanged.
+
+Each thread's events are stored in order in its own chunks, so events are
+merged across threads by timestamp as they are read. Strings are loaded
+before any events are returned.
+
+TraceChunkDecoder reads the same chunks as they are queued for subscribers
+in the traced process (see _listener.py), one batch at a time.
+"""
+
+import heapq
+import io
+import mmap
+import os
+import struct
+import uuid
+
+from ._etlreader import EventData, INTYPE_DOUBLE, INTYPE_INT32, INTYPE_POINTER, INTYPE_UINT32
+from ._etlreader import INTYPE_UINT64, INTYPE_UNICODESTRING
+from ._etlreader import _compile_property_filters, _to_filetime
+
+MAGIC = b"PYTRACE\0"
+VERSION = 1
+
+PYTHON_GUID = uuid.UUID('99a10640-320d-4b37-9e26-c311d86da7ab')
+
+FILE_HEADER = struct.Struct('<8sIIQ')
+CHUNK_HEADER = struct.Struct('<B3xIQQ')
+METRIC_VALUES = struct.Struct('<4d')
+
+CHUNK_STRINGS = 1
+CHUNK_THREAD = 2
+
+RECORD_FUNCTION = 1
+RECORD_PUSH = 2
+RECORD_POP = 3
+RECORD_MARK = 4
+RECORD_BEGIN_THREAD = 5
+RECORD_END_THREAD = 6
+RECORD_STACK = 7
+RECORD_SAMPLE = 8
+RECORD_TASK_CREATE = 9
+RECORD_TASK_STEP = 10
+RECORD_CALLBACK = 11
+RECORD_ACTIVITY = 12
+RECORD_GC = 13
+RECORD_IMPORT = 14
+RECORD_ALLOCATION = 15
+RECORD_EXCEPTION_TYPE = 16
+RECORD_EXCEPTION = 17
+RECORD_METRIC_INFO = 18
+RECORD_METRIC = 19
+
+# Event name, level and keyword of each record type, as raised by _trace.cpp
+_EVENTS = {
+    RECORD_FUNCTION: ('PythonFunction', 5, 0x400),
+    RECORD_PUSH: ('PythonFunctionPush', 5, 0x1000),
+    RECORD_POP: ('PythonFunctionPop', 5, 0x2000),
+    RECORD_MARK: ('PythonMark', 5, 0x800),
+    RECORD_BEGIN_THREAD: ('PythonThread', 4, 0x100),
+    RECORD_END_THREAD: ('PythonThread', 4, 0x100),
+    RECORD_STACK: ('PythonSampledStack', 5, 0x4000),
+    RECORD_SAMPLE: ('PythonSample', 5, 0x4000),
+    RECORD_TASK_CREATE: ('PythonTaskCreate', 5, 0x8000),
+    RECORD_TASK_STEP: ('PythonTaskStep', 5, 0x8000),
+    RECORD_CALLBACK: ('PythonCallback', 5, 0x8000),
+    RECORD_ACTIVITY: ('PythonActivity', 4, 0x10000),
+    RECORD_GC: ('PythonGC', 4, 0x20000),
+    RECORD_IMPORT: ('PythonImport', 4, 0x40000),
+    RECORD_ALLOCATION: ('PythonAllocation', 5, 0x80000),
+    RECORD_EXCEPTION_TYPE: ('PythonExceptionType', 5, 0x100000),
+    RECORD_EXCEPTION: ('PythonException', 5, 0x100000),
+    RECORD_METRIC_INFO: ('PythonMetricInfo', 4, 0x200000),
+    RECORD_METRIC: ('PythonMetric', 4, 0x200000),
+}
+
+# Written by WriteCustomEvent with opcode 3
+_STACK_SAMPLE = ('PythonStackSample', 5, 0x200)
+
+
+class TraceFileFormatError(ValueError):
+    pass
+
+
+def is_trace_file(path):
+    """Returns True if path is a file written by the file sink."""
+    try:
+        with io.open(os.fspath(path), 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class _Header:
+    def __init__(self, version, process_id, start_time):
+        self.version = version
+        self.process_id = process_id
+        self.start_time = start_time
+        self.pointer_size = 8
+
+    def to_filetime(self, raw):
+        return raw
+
+
+def _read_varint(data, p):
+    b = data[p]
+    if b < 0x80:
+        return b, p + 1
+    value = b & 0x7F
+    shift = 7
+    while True:
+        p += 1
+        b = data[p]
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, p + 1
+        shift += 7
+
+
+def _unzigzag(v):
+    return (v >> 1) ^ -(v & 1)
+
+
+def _read_guid(data, p):
+    raw = data[p:p + 16]
+    return (uuid.UUID(bytes_le=bytes(raw)) if any(raw) else None), p + 16
+
+
+class TraceFileReader:
+    def __init__(
+        self,
+        path,
+        *,
+        providers=[],
+        provider_names=[],
+        event_names=[],
+        process_ids=[],
+        include_child_process_ids=True,
+        keyword_mask_all=0,
+        keyword_mask_any=0,
+        start_time=None,
+        end_time=None,
+        property_filters=None,
+        intern_stacks=False,
+    ):
+        self._file = io.open(os.fspath(path), 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._data = b''
+        data = self._data
+        if len(data) < FILE_HEADER.size:
+            self.close()
+            raise TraceFileFormatError("file is too short")
+        magic, version, pid, start = FILE_HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            self.close()
+            raise TraceFileFormatError("not a trace file")
+        if version != VERSION:
+            self.close()
+            raise TraceFileFormatError(f"unsupported trace file version {version}")
+        self.header = _Header(version, pid, start)
+        self._select_events(
+            providers=providers,
+            provider_names=provider_names,
+            event_names=event_names,
+            process_ids=process_ids,
+            keyword_mask_all=keyword_mask_all,
+            keyword_mask_any=keyword_mask_any,
+        )
+        self._start_time = _to_filetime(start_time) if start_time is not None else None
+        self._end_time = _to_filetime(end_time) if end_time is not None else None
+        self._property_filters = _compile_property_filters(property_filters)
+
+        self.strings = {0: None}
+        self._threads = {}
+        self._activities = {}
+        self._scan(FILE_HEADER.size)
+
+    def _select_events(self, providers=(), provider_names=(), event_names=(), process_ids=(),
+                       keyword_mask_all=0, keyword_mask_any=0):
+        selected = True
+        if providers and PYTHON_GUID not in providers:
+            selected = False
+        if provider_names and 'python' not in (n.lower() for n in provider_names):
+            selected = False
+        if process_ids and self.header.process_id not in process_ids:
+            selected = False
+        names = frozenset(n.lower() for n in event_names) if event_names else None
+        self._events = {}
+        for record, event in [*_EVENTS.items(), ('stack', _STACK_SAMPLE)]:
+            name, _, keyword = event
+            if not selected:
+                continue
+            if names is not None and name.lower() not in names:
+                continue
+            if keyword_mask_all and (keyword & keyword_mask_all) != keyword_mask_all:
+                continue
+            if keyword_mask_any and not (keyword & keyword_mask_any):
+                continue
+            self._events[record] = event
+
+    @property
+    def stack_table(self):
+        # Events in these files never have stacks
+        return None
+
+    def close(self):
+        if self._data:
+            self._data.close()
+        self._data = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def _scan(self, p):
+        data = self._data
+        end = len(data)
+        while p + CHUNK_HEADER.size <= end:
+            kind, size, tid, base = CHUNK_HEADER.unpack_from(data, p)
+            p += CHUNK_HEADER.size
+            if p + size > end:
+                # The process exited before the file was closed
+                break
+            if kind == CHUNK_STRINGS:
+                self._read_strings(p, p + size)
+            elif kind == CHUNK_THREAD:
+                self._threads.setdefault(tid, []).append((base, p, p + size))
+            p += size
+
+    def _read_strings(self, p, end):
+        data = self._data
+        strings = self.strings
+        while p < end:
+            sid, p = _read_varint(data, p)
+            n, p = _read_varint(data, p)
+            strings[sid] = str(data[p:p + n], 'utf-8', 'surrogatepass')
+            p += n
+
+    def _thread_events(self, tid, chunks):
+        data = self._data
+        events = self._events
+        strings = self.strings
+        pid = self.header.process_id
+        # The thread's activity continues across chunks, and is set on every
+        # event as ETW does with the thread's activity ID
+        activity = self._activities.get(tid)
+        for base, p, end in chunks:
+            ts = base
+            last_func_id = 0
+            last_task_id = 0
+            while p < end:
+                record = data[p]
+                delta, p = _read_varint(data, p + 1)
+                ts += delta
+                event_activity = activity
+                related = None
+                if record == RECORD_PUSH:
+                    d, p = _read_varint(data, p)
+                    last_func_id += _unzigzag(d)
+                    caller, p = _read_varint(data, p)
+                    caller_line, p = _read_varint(data, p)
+                    props = (
+                        ('FunctionID', last_func_id, INTYPE_POINTER),
+                        ('Caller', caller, INTYPE_POINTER),
+                        ('CallerLine', caller_line, INTYPE_UINT64),
+                    )
+                    opcode = 0
+                elif record == RECORD_POP:
+                    d, p = _read_varint(data, p)
+                    last_func_id += _unzigzag(d)
+                    props = (('FunctionID', last_func_id, INTYPE_POINTER),)
+                    opcode = 0
+                elif record == RECORD_FUNCTION:
+                    func_id, p = _read_varint(data, p)
+                    begin, p = _read_varint(data, p)
+                    size, p = _read_varint(data, p)
+                    line, p = _read_varint(data, p)
+                    source, p = _read_varint(data, p)
+                    name, p = _read_varint(data, p)
+                    is_python_code = data[p]
+                    p += 1
+                    props = (
+                        ('FunctionID', func_id, INTYPE_POINTER),
+                        ('BeginAddress', begin, INTYPE_POINTER),
+                        ('EndAddress', begin + size, INTYPE_POINTER),
+                        ('LineNumber', _unzigzag(line), INTYPE_INT32),
+                        ('SourceFile', strings.get(source), INTYPE_UNICODESTRING),
+                        ('Name', strings.get(name), INTYPE_UNICODESTRING),
+                        ('IsPythonCode', is_python_code, INTYPE_INT32),
+                    )
+                    opcode = 0
+                elif record == RECORD_MARK:
+                    opcode = data[p]
+                    mark, p = _read_varint(data, p + 1)
+                    props = (('Mark', strings.get(mark), INTYPE_UNICODESTRING),)
+                    if opcode == 3:
+                        record = 'stack'
+                        opcode = 0
+                elif record == RECORD_SAMPLE:
+                    thread_id, p = _read_varint(data, p)
+                    stack_id, p = _read_varint(data, p)
+                    props = (('ThreadID', thread_id, INTYPE_INT32), ('StackID', stack_id, INTYPE_INT32))
+                    opcode = 0
+                elif record == RECORD_STACK:
+                    stack_id, p = _read_varint(data, p)
+                    count, p = _read_varint(data, p)
+                    frames = []
+                    func_id = 0
+                    for _ in range(count):
+                        d, p = _read_varint(data, p)
+                        func_id += _unzigzag(d)
+                        frames.append(func_id)
+                    props = (('StackID', stack_id, INTYPE_INT32), ('FunctionIDs', frames, INTYPE_INT32))
+                    opcode = 0
+                elif record == RECORD_TASK_STEP:
+                    opcode = data[p]
+                    d, p = _read_varint(data, p + 1)
+                    last_task_id += _unzigzag(d)
+                    if opcode == 1:
+                        props = (('TaskID', last_task_id, INTYPE_UINT64),)
+                    else:
+                        awaiting, p = _read_varint(data, p)
+                        done = data[p]
+                        p += 1
+                        props = (
+                            ('TaskID', last_task_id, INTYPE_UINT64),
+                            ('AwaitingID', awaiting, INTYPE_UINT64),
+                            ('Done', done, INTYPE_INT32),
+                        )
+                elif record == RECORD_CALLBACK:
+                    opcode = data[p]
+                    name, p = _read_varint(data, p + 1)
+                    props = (('Name', strings.get(name), INTYPE_UNICODESTRING),)
+                elif record == RECORD_TASK_CREATE:
+                    d, p = _read_varint(data, p)
+                    last_task_id += _unzigzag(d)
+                    parent, p = _read_varint(data, p)
+                    name, p = _read_varint(data, p)
+                    props = (
+                        ('TaskID', last_task_id, INTYPE_UINT64),
+                        ('ParentTaskID', parent, INTYPE_UINT64),
+                        ('Name', strings.get(name), INTYPE_UNICODESTRING),
+                    )
+                    opcode = 0
+                elif record == RECORD_ACTIVITY:
+                    opcode = data[p]
+                    event_activity, p = _read_guid(data, p + 1)
+                    if opcode == 1 or opcode == 2:
+                        related, p = _read_guid(data, p)
+                    if opcode == 1:
+                        name, p = _read_varint(data, p)
+                        props = (('Name', strings.get(name), INTYPE_UNICODESTRING),)
+                    else:
+                        props = ()
+                    if opcode == 1 or opcode == 7:
+                        activity = event_activity
+                    elif opcode == 2:
+                        activity = related
+                    else:
+                        activity = None
+                elif record == RECORD_GC:
+                    opcode = data[p]
+                    generation = data[p + 1]
+                    p += 2
+                    if opcode == 1:
+                        props = (('Generation', generation, INTYPE_INT32),)
+                    else:
+                        collected, p = _read_varint(data, p)
+                        uncollectable, p = _read_varint(data, p)
+                        duration, p = _read_varint(data, p)
+                        props = (
+                            ('Generation', generation, INTYPE_INT32),
+                            ('Collected', collected, INTYPE_UINT64),
+                            ('Uncollectable', uncollectable, INTYPE_UINT64),
+                            ('Duration', duration, INTYPE_UINT64),
+                        )
+                elif record == RECORD_IMPORT:
+                    opcode = data[p]
+                    name, p = _read_varint(data, p + 1)
+                    detail, p = _read_varint(data, p)
+                    props = (
+                        ('Name', strings.get(name), INTYPE_UNICODESTRING),
+                        ('Parent' if opcode == 1 else 'Origin', strings.get(detail), INTYPE_UNICODESTRING),
+                    )
+                elif record == RECORD_ALLOCATION:
+                    opcode = data[p]
+                    address, p = _read_varint(data, p + 1)
+                    if opcode == 1:
+                        size, p = _read_varint(data, p)
+                        weight, p = _read_varint(data, p)
+                        stack_id, p = _read_varint(data, p)
+                        props = (
+                            ('Address', address, INTYPE_POINTER),
+                            ('Size', size, INTYPE_UINT64),
+                            ('Weight', weight, INTYPE_UINT64),
+                            ('StackID', stack_id, INTYPE_INT32),
+                        )
+                    else:
+                        props = (('Address', address, INTYPE_POINTER),)
+                elif record == RECORD_EXCEPTION:
+                    opcode = data[p]
+                    type_id, p = _read_varint(data, p + 1)
+                    d, p = _read_varint(data, p)
+                    last_func_id += _unzigzag(d)
+                    line, p = _read_varint(data, p)
+                    props = (
+                        ('TypeID', type_id, INTYPE_INT32),
+                        ('FunctionID', last_func_id, INTYPE_POINTER),
+                        ('Line', _unzigzag(line), INTYPE_INT32),
+                    )
+                elif record == RECORD_EXCEPTION_TYPE:
+                    type_id, p = _read_varint(data, p)
+                    name, p = _read_varint(data, p)
+                    props = (('TypeID', type_id, INTYPE_INT32), ('Name', strings.get(name), INTYPE_UNICODESTRING))
+                    opcode = 0
+                elif record == RECORD_METRIC:
+                    metric_id, p = _read_varint(data, p)
+                    count, p = _read_varint(data, p)
+                    total, low, high, value = METRIC_VALUES.unpack_from(data, p)
+                    pair_count, p = _read_varint(data, p + METRIC_VALUES.size)
+                    buckets = []
+                    bucket = 0
+                    for _ in range(pair_count):
+                        d, p = _read_varint(data, p)
+                        bucket += d
+                        n, p = _read_varint(data, p)
+                        buckets.extend((bucket, n))
+                    props = (
+                        ('MetricID', metric_id, INTYPE_INT32),
+                        ('Count', count, INTYPE_UINT32),
+                        ('Sum', total, INTYPE_DOUBLE),
+                        ('Min', low, INTYPE_DOUBLE),
+                        ('Max', high, INTYPE_DOUBLE),
+                        ('Value', value, INTYPE_DOUBLE),
+                        ('Buckets', buckets, INTYPE_UINT32),
+                    )
+                    opcode = 0
+                elif record == RECORD_METRIC_INFO:
+                    metric_id, p = _read_varint(data, p)
+                    kind = data[p]
+                    name, p = _read_varint(data, p + 1)
+                    props = (
+                        ('MetricID', metric_id, INTYPE_INT32),
+                        ('Kind', kind, INTYPE_INT32),
+                        ('Name', strings.get(name), INTYPE_UNICODESTRING),
+                    )
+                    opcode = 0
+                elif record in (RECORD_BEGIN_THREAD, RECORD_END_THREAD):
+                    thread_id, p = _read_varint(data, p)
+                    props = (('ThreadID', thread_id, INTYPE_INT32),)
+                    opcode = 1 if record == RECORD_BEGIN_THREAD else 2
+                else:
+                    raise TraceFileFormatError(f"unknown record type {record} at offset {p}")
+
+                event = events.get(record)
+                if event is None:
+                    continue
+                ed = EventData()
+                ed.provider = PYTHON_GUID
+                ed.provider_name = 'Python'
+                ed.event_name, ed.level, ed.keyword = event
+                ed.opcode = opcode
+                ed.process_id = pid
+                ed.thread_id = tid
+                ed.timestamp = ts
+                ed.activity_id = event_activity
+                ed.related_activity_id = related
+                for prop in props:
+                    ed._add(*prop)
+                yield ts, ed
+            self._activities[tid] = activity
+
+    def _filter(self, ed):
+        for name, match in self._property_filters:
+            p = ed._properties.get(name)
+            if p is None or not isinstance(p.value, int) or not match(p.value):
+                return False
+        return True
+
+    def __iter__(self):
+        if self._data is None:
+            raise ValueError("no trace file open")
+        if not self._events:
+            return
+        streams = [self._thread_events(tid, chunks) for tid, chunks in self._threads.items()]
+        if len(streams) == 1:
+            merged = streams[0]
+        else:
+            merged = heapq.merge(*streams, key=lambda e: e[0])
+        start_time = self._start_time
+        end_time = self._end_time
+        for ts, ed in merged:
+            if end_time is not None and ts > end_time:
+                break
+            if start_time is not None and ts < start_time:
+                continue
+            if self._property_filters and not self._filter(ed):
+                continue
+            yield ed
+
+
+class TraceChunkDecoder(TraceFileReader):
+    """Decodes batches of chunks queued by the file sink for subscribers.
+
+    Strings and each thread's activity are kept from one batch to the next,
+    and events are selected with the same filters as open()."""
+
+    def __init__(self, process_id, **filters):
+        self._file = None
+        self._data = None
+        self.header = _Header(VERSION, process_id, 0)
+        self._start_time = self._end_time = None
+        self._property_filters = None
+        self.select(**filters)
+        self.strings = {0: None}
+        self._threads = {}
+        self._activities = {}
+
+    def select(self, **filters):
+        """Changes the events that are returned from later batches."""
+        self._select_events(**filters)
+
+    def skip(self, data):
+        """Reads only the strings in data."""
+        self._data = data
+        self._threads = {}
+        try:
+            self._scan(0)
+        finally:
+            self._data = None
+            self._threads = {}
+
+    def decode(self, data):
+        """Returns the events in data, merged across threads by timestamp."""
+        self._data = data
+        self._threads = {}
+        try:
+            self._scan(0)
+            return list(self)
+        finally:
+            self._data = None
+
+
+def open(path, **filters):
+    return TraceFileReader(path, **filters)
@@ -2,7 +2,7 @@
 
 from libc.stddef cimport wchar_t
 from libc.string cimport memcpy
-from libc.stdint cimport uint64_t, uint32_t, uint16_t, uint8_t
+from libc.stdint cimport int64_t, uint64_t, uint32_t, uint16_t, uint8_t
 from cpython.ref cimport PyObject
 
 
@@ -17,12 +17,13 @@ cdef extern from "windows.h" nogil:
     ctypedef uint64_t ULONG64
     ctypedef uint64_t UINT64
     ctypedef uint64_t ULONGLONG
+    ctypedef int64_t LONGLONG
     ctypedef wchar_t WCHAR
     ctypedef WCHAR *PWSTR
     ctypedef struct GUID:
         pass
     ctypedef struct LARGE_INTEGER:
-        uint64_t QuadPart
+        int64_t QuadPart
 
     cdef DWORD GetLastError()
 
@@ -71,6 +72,7 @@ cdef extern from "evntprov.h" nogil:
 
     USHORT EVENT_HEADER_EXT_TYPE_STACK_TRACE32
     USHORT EVENT_HEADER_EXT_TYPE_STACK_TRACE64
+    USHORT EVENT_HEADER_EXT_TYPE_RELATED_ACTIVITYID
 
     UCHAR EVENT_TRACE_TYPE_START
     UCHAR EVENT_TRACE_TYPE_END
@@ -0,0 +1,348 @@
+"""Writes small synthetic ETL files for tests.
+
+The files use the same on-disk layout as the ETW logger: fixed size
+buffers with a WMI_BUFFER_HEADER, a logfile header event in the first
+buffer, TraceLogging events carrying their schema as extended data, and
+kernel events with system or perfinfo headers. Timestamps are QPC ticks
+at 10MHz, so one tick is one FILETIME unit.
+
+Run this file to regenerate the sample traces in tests/traces.
+"""
+
+import struct
+
+from pathlib import Path
+from uuid import UUID
+
+PYTHON_PROVIDER = UUID('99a10640-320d-4b37-9e26-c311d86da7ab')
+
+START_TIME = 133_000_000_000_000_000
+
+UNICODESTRING = 1
+INT32 = 7
+UINT32 = 8
+UINT64 = 10
+HEXINT32 = 20
+HEXINT64 = 21
+POINTER = object()
+
+# Schemas of the events raised by _trace.cpp: (level, keyword, fields)
+PYTHON_EVENTS = {
+    'PythonEvalFunction': (5, 0, [('BeginAddress', POINTER)]),
+    'PythonThread': (4, 0x100, [('ThreadID', INT32)]),
+    'PythonFunction': (5, 0x400, [
+        ('FunctionID', POINTER),
+        ('BeginAddress', POINTER),
+        ('EndAddress', POINTER),
+        ('LineNumber', INT32),
+        ('SourceFile', UNICODESTRING),
+        ('Name', UNICODESTRING),
+        ('IsPythonCode', INT32),
+    ]),
+    'PythonMark': (5, 0x800, [('Mark', UNICODESTRING)]),
+    'PythonStackSample': (5, 0x200, [('Mark', UNICODESTRING)]),
+    'PythonFunctionPush': (5, 0x1000, [
+        ('FunctionID', POINTER),
+        ('Caller', POINTER),
+        ('CallerLine', UINT64),
+    ]),
+    'PythonFunctionPop': (5, 0x2000, [('FunctionID', POINTER)]),
+}
+
+_BUFFER_HEADER = struct.Struct('<IIIiqqQBBHIIHH16x')
+_SYSTEM_HEADER = struct.Struct('<HBBHBBIIqII')
+_PERFINFO_HEADER = struct.Struct('<HBBHBBq')
+_EVENT_HEADER = struct.Struct('<HBBHHIIq16sHBBBBHQQ16s')
+
+
+def _align8(b):
+    return b + b'\0' * (-len(b) % 8)
+
+
+def _wstr(s):
+    return s.encode('utf-16-le') + b'\0\0'
+
+
+def _str(s):
+    return s.encode('utf-8') + b'\0'
+
+
+class EtlWriter:
+    def __init__(self, path, *, pointer_size=8, cpus=1, buffer_size=0x1000):
+        self.path = Path(path)
+        self.pointer_size = pointer_size
+        self.cpus = cpus
+        self.buffer_size = buffer_size
+        self._ptr = '<Q' if pointer_size == 8 else '<I'
+        # Buffers are written as they fill, so large traces are not held in memory
+        self._file = open(self.path, 'wb')
+        self._buffer_count = 0
+        self._current = {}
+        self._last_ts = {}
+        self._schemas = {}
+        self._write_logfile_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _pack_ptr(self, value):
+        return struct.pack(self._ptr, value)
+
+    def _append(self, cpu, record, ts):
+        record = _align8(record)
+        capacity = self.buffer_size - _BUFFER_HEADER.size
+        if len(record) > capacity:
+            raise ValueError("event is larger than a buffer")
+        buf = self._current.setdefault(cpu, bytearray())
+        if len(buf) + len(record) > capacity:
+            self._flush(cpu)
+            buf = self._current.setdefault(cpu, bytearray())
+        buf += record
+        self._last_ts[cpu] = ts
+
+    def _flush(self, cpu):
+        events = self._current.pop(cpu, None)
+        if not events:
+            return
+        used = _BUFFER_HEADER.size + len(events)
+        header = _BUFFER_HEADER.pack(
+            self.buffer_size, used, used, 0, self._last_ts.get(cpu, 0), self._buffer_count,
+            0, cpu, 0, 1, 0, used, 1, 0,
+        )
+        self._file.write(header + bytes(events) + b'\0' * (self.buffer_size - used))
+        self._buffer_count += 1
+
+    def _write_logfile_header(self):
+        ptr = self.pointer_size
+        payload = struct.pack(
+            '<IIIIqIIIIIIII',
+            self.buffer_size, 0x0A000005, 26100, self.cpus, 0, 156250, 0, 1, 0,
+            0, ptr, 0, 3000,
+        )
+        payload += b'\0' * (2 * ptr) + b'\0' * 172
+        payload = _align8(payload)
+        payload += struct.pack('<qqqII', START_TIME - 1_000_000_000, 10_000_000, START_TIME, 1, 0)
+        payload += _wstr("Synthetic") + _wstr(self.path.name)
+        self._system_event(0, 0x00, 0, 0, 0, payload, version=2)
+        self._flush(0)
+
+    def _system_event(self, cpu, group, opcode, pid, tid, payload, *, ts=0, version=4):
+        htype = 2 if self.pointer_size == 8 else 1
+        size = _SYSTEM_HEADER.size + len(payload)
+        header = _SYSTEM_HEADER.pack(version, htype, 0xC0, size, opcode, group, tid, pid, ts, 0, 0)
+        self._append(cpu, header + payload, ts)
+
+    def _perfinfo_event(self, cpu, group, opcode, payload, *, ts=0, version=2):
+        htype = 0x11 if self.pointer_size == 8 else 0x10
+        size = _PERFINFO_HEADER.size + len(payload)
+        header = _PERFINFO_HEADER.pack(version, htype, 0xC0, size, opcode, group, ts)
+        self._append(cpu, header + payload, ts)
+
+    def _field_metadata(self, name, in_type):
+        if in_type is POINTER:
+            in_type = HEXINT64 if self.pointer_size == 8 else HEXINT32
+        return _str(name) + bytes([in_type])
+
+    def _field_value(self, in_type, value):
+        if in_type is POINTER:
+            return self._pack_ptr(value)
+        if in_type == UNICODESTRING:
+            return _wstr(value)
+        if in_type == INT32:
+            return struct.pack('<i', value)
+        if in_type in (UINT32, HEXINT32):
+            return struct.pack('<I', value)
+        if in_type in (UINT64, HEXINT64):
+            return struct.pack('<Q', value)
+        raise ValueError(f"unsupported type {in_type}")
+
+    def tracelogging_event(
+        self,
+        provider,
+        provider_name,
+        event_name,
+        fields,
+        values,
+        *,
+        ts,
+        pid,
+        tid,
+        cpu=0,
+        level=5,
+        keyword=0,
+        opcode=0,
+        stack=None,
+        activity_id=None,
+    ):
+        schema = self._schemas.get((provider_name, event_name))
+        if schema is None:
+            meta = b'\0' + _str(event_name) + b''.join(self._field_metadata(n, t) for n, t in fields)
+            meta = struct.pack('<H', len(meta) + 2) + meta
+            traits = _str(provider_name)
+            traits = struct.pack('<H', len(traits) + 2) + traits
+            schema = self._schemas[provider_name, event_name] = meta, traits
+        meta, traits = schema
+        items = [(11, meta), (12, traits)]
+        if stack is not None:
+            if self.pointer_size == 8:
+                items.append((6, struct.pack(f'<Q{len(stack)}Q', 0, *stack)))
+            else:
+                items.append((5, struct.pack(f'<Q{len(stack)}I', 0, *stack)))
+        ext = b''
+        for i, (ext_type, data) in enumerate(items):
+            linkage = 1 if i + 1 < len(items) else 0
+            ext += _align8(struct.pack('<HHHH', 0, ext_type, linkage, len(data)) + data)
+        user_data = b''.join(self._field_value(t, v) for (_, t), v in zip(fields, values))
+        size = _EVENT_HEADER.size + len(ext) + len(user_data)
+        flags = 0x01 | (0x40 if self.pointer_size == 8 else 0x20)
+        htype = 0x13 if self.pointer_size == 8 else 0x12
+        header = _EVENT_HEADER.pack(
+            size, htype, 0xC0, flags, 0, tid, pid, ts, provider.bytes_le,
+            0, 0, 11, level, opcode, 0, keyword, 0,
+            activity_id.bytes_le if activity_id else b'\0' * 16,
+        )
+        self._append(cpu, header + ext + user_data, ts)
+
+    def python_event(self, event_name, *values, opcode=0, **kwargs):
+        level, keyword, fields = PYTHON_EVENTS[event_name]
+        self.tracelogging_event(
+            PYTHON_PROVIDER, "Python", event_name, fields, values,
+            level=level, keyword=keyword, opcode=opcode, **kwargs,
+        )
+
+    def process(self, opcode, pid, ppid, image, command_line, *, ts, cpu=0):
+        ptr = self._pack_ptr
+        payload = (ptr(0xFFFF800000000000 + pid if self.pointer_size == 8 else 0x80000000 + pid)
+            + struct.pack('<IIIi', pid, ppid, 1, 0) + ptr(0) + struct.pack('<I', 0)
+            + struct.pack('<I', 0) + _str(image) + _wstr(command_line) + _wstr('') + _wstr(''))
+        self._system_event(cpu, 0x03, opcode, ppid if opcode == 1 else pid, 0, payload, ts=ts)
+
+    def thread(self, opcode, pid, tid, *, ts, cpu=0):
+        ptr = self._pack_ptr
+        payload = struct.pack('<II', pid, tid) + b''.join(ptr(0) for _ in range(7)) + struct.pack('<IBBBB', 0, 8, 5, 2, 0)
+        self._system_event(cpu, 0x05, opcode, pid, tid, payload, ts=ts, version=3)
+
+    def image(self, opcode, pid, base, size, filename, *, ts, cpu=0):
+        ptr = self._pack_ptr
+        payload = (ptr(base) + ptr(size) + struct.pack('<IIII', pid, 0, 0, 0) + ptr(base)
+            + struct.pack('<IIII', 0, 0, 0, 0) + _wstr(filename))
+        self._system_event(cpu, 0x14, opcode, pid, 0, payload, ts=ts, version=3)
+
+    def sample(self, tid, ip, *, ts, cpu=0):
+        payload = self._pack_ptr(ip) + struct.pack('<IHH', tid, 1, 0)
+        self._perfinfo_event(cpu, 0x0F, 46, payload, ts=ts)
+
+    def stackwalk(self, pid, tid, stack, *, event_ts, ts, cpu=0):
+        payload = struct.pack('<QII', event_ts, pid, tid) + b''.join(self._pack_ptr(ip) for ip in stack)
+        self._perfinfo_event(cpu, 0x18, 32, payload, ts=ts)
+
+    def close(self):
+        for cpu in sorted(self._current):
+            self._flush(cpu)
+        self._file.close()
+
+
+# Addresses used by the sample traces
+PYTHON_DLL = 0x7FFA_1000_0000
+ETWTRACE_PYD = 0x7FFA_2000_0000
+EVAL_FRAME = PYTHON_DLL + 0x1_2340
+THUNK_SIZE = 0x40
+THUNKS = [ETWTRACE_PYD + 0x1000 + i * THUNK_SIZE for i in range(3)]
+FUNCTIONS = [
+    # (function ID, thunk address, line, source file, name)
+    (0x100, THUNKS[0], 1, r'C:\scripts\basic.py', '<module>'),
+    (0x101, THUNKS[1], 4, r'C:\scripts\basic.py', 'outer'),
+    (0x102, THUNKS[2], 8, r'C:\scripts\basic.py', 'inner'),
+]
+
+
+def write_stack_trace(path, *, cpus=2):
+    """Writes a trace similar to running basic.py with --stack.
+
+    Process 1000 is traced and starts child process 1001. Samples on thread
+    1100 are spread over the CPUs and walk through the function thunks."""
+    with EtlWriter(path, cpus=cpus) as w:
+        ts = 1000
+        w.process(3, 4, 0, 'System', '', ts=ts)
+        w.process(1, 1000, 900, 'python.exe', 'python.exe basic.py', ts=ts + 10)
+        w.thread(1, 1000, 1100, ts=ts + 20)
+        w.image(10, 1000, PYTHON_DLL, 0x60_0000, r'C:\Python\python313.dll', ts=ts + 30)
+        w.image(10, 1000, ETWTRACE_PYD, 0x10_0000, r'C:\Python\Lib\etwtrace\_etwtrace.pyd', ts=ts + 40)
+        w.python_event('PythonEvalFunction', EVAL_FRAME, ts=ts + 50, pid=1000, tid=1100)
+        w.python_event('PythonThread', 1100, opcode=1, ts=ts + 60, pid=1000, tid=1100)
+        for i, (func_id, thunk, line, source, name) in enumerate(FUNCTIONS):
+            w.python_event(
+                'PythonFunction', func_id, thunk, thunk + THUNK_SIZE, line, source, name, 1,
+                ts=ts + 70 + i, pid=1000, tid=1100,
+            )
+        w.python_event('PythonMark', 'phase', opcode=1, ts=ts + 100, pid=1000, tid=1100)
+        for i in range(10):
+            t = ts + 200 + i * 100
+            cpu = i % cpus
+            depth = 1 + i % 3
+            stack = [EVAL_FRAME + 0x10]
+            for thunk in THUNKS[:depth]:
+                stack[:0] = [thunk + 0x8, EVAL_FRAME + 0x20]
+            w.sample(1100, stack[0], ts=t, cpu=cpu)
+            w.stackwalk(1000, 1100, stack, event_ts=t, ts=t + 1, cpu=cpu)
+        w.process(1, 1001, 1000, 'cmd.exe', 'cmd /c exit', ts=ts + 1250)
+        w.thread(1, 1001, 1200, ts=ts + 1260)
+        w.sample(1200, 0x7FF6_0000_1000, ts=ts + 1270)
+        w.stackwalk(1001, 1200, [0x7FF6_0000_1000], event_ts=ts + 1270, ts=ts + 1271)
+        w.process(2, 1001, 1000, 'cmd.exe', 'cmd /c exit', ts=ts + 1280)
+        w.python_event(
+            'PythonStackSample', 'sample',
+            ts=ts + 1300, pid=1000, tid=1100, stack=[THUNKS[1] + 0x8, EVAL_FRAME + 0x20],
+        )
+        w.python_event('PythonMark', 'phase', opcode=2, ts=ts + 1400, pid=1000, tid=1100)
+        w.python_event('PythonMark', 'done', ts=ts + 1410, pid=1000, tid=1100)
+        w.python_event('PythonThread', 1100, opcode=2, ts=ts + 1500, pid=1000, tid=1100)
+        w.process(2, 1000, 900, 'python.exe', 'python.exe basic.py', ts=ts + 1600)
+
+
+def write_instrumented_trace(path, *, pointer_size=4):
+    """Writes a trace similar to running basic.py with --instrument.
+
+    Uses 32-bit pointers to match a 32-bit interpreter. <module> calls
+    outer() twice, and each outer() calls inner() once."""
+    with EtlWriter(path, pointer_size=pointer_size) as w:
+        ts = 1000
+        w.process(1, 2000, 900, 'python.exe', 'python.exe basic.py', ts=ts)
+        w.python_event('PythonThread', 2100, opcode=1, ts=ts + 10, pid=2000, tid=2100)
+        for i, (func_id, _, line, source, name) in enumerate(FUNCTIONS):
+            w.python_event(
+                'PythonFunction', func_id, 0, 0, line, source, name, 1,
+                ts=ts + 20 + i, pid=2000, tid=2100,
+            )
+        module, outer, inner = (f[0] for f in FUNCTIONS)
+        t = ts + 100
+        calls = [
+            ('push', module, 0, 0, 0),
+            ('push', outer, module, 2, 10),
+            ('push', inner, outer, 5, 20),
+            ('pop', inner, 0, 0, 30),
+            ('pop', outer, 0, 0, 10),
+            ('push', outer, module, 3, 10),
+            ('push', inner, outer, 5, 50),
+            ('pop', inner, 0, 0, 20),
+            ('pop', outer, 0, 0, 10),
+            ('pop', module, 0, 0, 10),
+        ]
+        for kind, func_id, caller, caller_line, delta in calls:
+            t += delta
+            if kind == 'push':
+                w.python_event('PythonFunctionPush', func_id, caller, caller_line, ts=t, pid=2000, tid=2100)
+            else:
+                w.python_event('PythonFunctionPop', func_id, ts=t, pid=2000, tid=2100)
+        w.python_event('PythonThread', 2100, opcode=2, ts=t + 10, pid=2000, tid=2100)
+        w.process(2, 2000, 900, 'python.exe', 'python.exe basic.py', ts=t + 20)
+
+
+if __name__ == "__main__":
+    TRACES = Path(__file__).absolute().parent / "traces"
+    TRACES.mkdir(exist_ok=True)
+    write_stack_trace(TRACES / "stack.etl")
+    write_instrumented_trace(TRACES / "instrumented.etl")
@@ -0,0 +1,46 @@
+"""Stand-ins for decoded events and tracer modules.
+
+The analyzer tests build their input from Event rather than writing a
+trace file, and the hook tests pass a Recorder where the hooks expect a
+tracer module.
+"""
+
+
+class Value:
+    def __init__(self, value):
+        self.value = value
+
+
+class Event:
+    """Looks enough like EventData for the analyzers. Properties are passed
+    as keyword arguments and read back by name."""
+
+    def __init__(self, event_name, timestamp, opcode=0, tid=1, activity=None, related=None,
+                 opcode_name=None, **props):
+        self.event_name = event_name
+        self.timestamp = timestamp
+        self.opcode = opcode
+        self.opcode_name = opcode_name
+        self.process_id = 100
+        self.thread_id = tid
+        self.activity_id = activity
+        self.related_activity_id = related
+        self.is_stack_sample = event_name == 'SampledProfile'
+        self._props = props
+
+    def __getitem__(self, key):
+        return Value(self._props[key])
+
+
+class Recorder:
+    """Records each call to a write_* function as a tuple of the rest of the
+    function name and its arguments."""
+
+    def __init__(self):
+        self.events = []
+
+    def __getattr__(self, name):
+        if not name.startswith("write_"):
+            raise AttributeError(name)
+        kind = name[len("write_"):]
+        return lambda *args: self.events.append((kind, *args))
@@ -0,0 +1,204 @@
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import uuid
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._activities import analyze
+from fakes import Event, Recorder
+
+
+A, B, C = (uuid.UUID(int=i) for i in range(1, 4))
+
+
+def start(ts, activity, name, parent=None, tid=1):
+    return Event('PythonActivity', ts, 1, tid, activity, parent, Name=name)
+
+
+def stop(ts, activity, restore=None, tid=1):
+    return Event('PythonActivity', ts, 2, tid, activity, restore)
+
+
+def resume(ts, activity, tid):
+    return Event('PythonActivity', ts, 7, tid, activity)
+
+
+def suspend(ts, activity, tid):
+    return Event('PythonActivity', ts, 8, tid, activity)
+
+
+def sample(ts, tid):
+    return Event('SampledProfile', ts, tid=tid)
+
+
+def test_analyze():
+    result = analyze([
+        start(0, A, "request"),
+        resume(10, A, tid=2),
+        sample(12, tid=2),
+        Event('PythonMark', 13, tid=2, activity=A),
+        suspend(20, A, tid=2),
+        sample(22, tid=2),
+        start(30, B, "query", parent=A),
+        sample(35, tid=1),
+        stop(40, B, restore=A),
+        stop(50, A),
+        sample(55, tid=1),
+    ])
+    request, query = result.activities
+    assert (request.name, request.latency, request.threads) == ("request", 50, {1: 40, 2: 10})
+    assert (query.name, query.latency, query.threads) == ("query", 10, {1: 10})
+    assert query.parent is request and request.children == [query]
+    assert (request.samples, query.samples, request.inclusive_samples) == (1, 1, 2)
+    assert request.inclusive_thread_time == 60
+    assert request.events == 1
+    assert result.roots() == [request]
+    assert list(result.by_name()) == ["request", "query"]
+
+
+def test_truncated():
+    result = analyze([
+        resume(5, A, tid=2),
+        stop(8, C),
+        start(10, B, "late", tid=1),
+        sample(12, tid=2),
+    ])
+    a, b = result.activities
+    assert a.name is None and a.display_name == f"<activity {A}>"
+    # Threads still working on an activity stop at the end of the trace
+    assert (a.threads, a.samples, a.end) == ({2: 7}, 1, None)
+    assert (b.threads, b.latency) == ({1: 2}, 2)
+    assert result.unmatched_stops == 1
+
+
+SCRIPT = """
+import sys, threading
+from concurrent.futures import ThreadPoolExecutor
+import etwtrace
+
+def work():
+    return sum(range(1000))
+
+def nested():
+    with etwtrace.activity("nested"):
+        work()
+
+with etwtrace.InstrumentedTracer(output=sys.argv[1]):
+    with etwtrace.activity("request"):
+        with ThreadPoolExecutor(2) as ex:
+            ex.submit(work).result()
+            ex.submit(nested).result()
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+    with ThreadPoolExecutor(1) as ex:
+        ex.submit(work).result()
+"""
+
+
+def test_traced_activities(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "activities.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        events = list(reader)
+    result = etwtrace.analyze_activities(events)
+    request, nested = result.activities
+    assert (request.name, nested.name) == ("request", "nested")
+    assert nested.parent is request
+    assert nested.latency <= request.latency
+    # The main thread, the executor worker(s) and the new thread
+    assert len(request.threads) >= 3
+    assert set(nested.threads) < set(request.threads)
+
+    # Calls to work() are tagged with the activity of the caller, wherever
+    # they ran, and the last call is outside of any activity
+    names = {}
+    for e in events:
+        if e.event_name == "PythonFunction":
+            names[e["FunctionID"].value] = e["Name"].value
+    calls = [e.activity_id for e in events if e.event_name == "PythonFunctionPush"
+             and names.get(e["FunctionID"].value) == "work"]
+    assert calls == [request.activity_id, nested.activity_id, request.activity_id, None]
+
+
+class _ActivityRecorder(Recorder):
+    def __init__(self):
+        super().__init__()
+        self.next_id = 0
+        self._local = threading.local()
+
+    def start_activity(self, name, related=None):
+        self.next_id += 1
+        activity_id = bytes([self.next_id]) * 16
+        self.events.append(("start", activity_id[0], name, related and related[0]))
+        self._local.current = activity_id
+        return activity_id
+
+    def stop_activity(self, activity_id, restore=None):
+        self.events.append(("stop", activity_id[0], restore and restore[0]))
+        self._local.current = restore
+
+    def switch_activity(self, activity_id):
+        previous = getattr(self._local, "current", None)
+        if activity_id != previous:
+            self.events.append(("switch", activity_id and activity_id[0]))
+            self._local.current = activity_id
+        return previous
+
+
+def test_hooks():
+    import asyncio
+    from asyncio import events
+    from concurrent.futures import ThreadPoolExecutor
+    from etwtrace._activitytrace import ActivityHooks, current_activity
+
+    recorder = _ActivityRecorder()
+    hooks = ActivityHooks(recorder)
+
+    async def handler(name):
+        with hooks.activity(name) as a:
+            await asyncio.sleep(0)
+            assert current_activity() is a
+            return await asyncio.get_running_loop().run_in_executor(None, current_activity)
+
+    async def main():
+        return await asyncio.gather(handler("one"), handler("two"))
+
+    originals = events.Handle._run, ThreadPoolExecutor.submit, threading.Thread.start
+    hooks.install()
+    try:
+        with hooks.activity("outer") as outer:
+            with ThreadPoolExecutor(1) as ex:
+                assert ex.submit(current_activity).result() is outer
+        assert current_activity() is None
+        one, two = asyncio.run(main())
+    finally:
+        hooks.uninstall()
+    assert (events.Handle._run, ThreadPoolExecutor.submit, threading.Thread.start) == originals
+
+    assert (one.name, two.name) == ("one", "two")
+    assert one.parent is None and one.uuid == uuid.UUID(bytes_le=bytes([2]) * 16)
+    starts = [e for e in recorder.events if e[0] == "start"]
+    assert starts == [("start", 1, "outer", None), ("start", 2, "one", None), ("start", 3, "two", None)]
+    # The worker switched to the activity and back
+    assert recorder.events[1:3] == [("switch", 1), ("switch", None)]
+    assert ("switch", 2) in recorder.events and ("switch", 3) in recorder.events
@@ -0,0 +1,114 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._allocations import analyze, AllocationAnalyzer
+from etwtrace._symbolize import Frame
+from fakes import Event
+
+
+def alloc(ts, address, weight, size=16):
+    return Event('PythonAllocation', ts, 1, Address=address, Size=size, Weight=weight, StackID=1)
+
+
+def free(ts, address):
+    return Event('PythonAllocation', ts, 2, Address=address)
+
+
+def stack(*names):
+    # Innermost first, as the symbolizer returns them
+    return [Frame('python', n, 'app.py', 1, None, 0) for n in names]
+
+
+def test_analyze():
+    a = AllocationAnalyzer()
+    for e, frames in [
+        (alloc(0, 0x10, 100), stack("load", "main")),
+        (alloc(1, 0x20, 50), stack("parse", "load", "main")),
+        (alloc(2, 0x30, 30), stack("walk", "walk", "main")),
+        (alloc(3, 0x40, 5), None),
+        (Event('PythonSample', 4), None),
+        (free(5, 0x10), None),
+        (free(6, 0x50), None),
+        (alloc(7, 0x60, 20), stack("load", "main")),
+    ]:
+        a.add(e, frames)
+    a.finish()
+
+    assert (a.samples, a.allocated, a.freed, a.live) == (5, 205, 100, 105)
+    assert a.unmatched_frees == 1
+    load, main = a.functions["load (app.py:1)"], a.functions["main (app.py:1)"]
+    assert (load.samples, load.allocated, load.freed, load.inclusive) == (2, 120, 100, 170)
+    assert (main.allocated, main.inclusive) == (0, 200)
+    # Recursion is only counted once
+    assert a.functions["walk (app.py:1)"].inclusive == 30
+    assert a.functions[None].allocated == 5
+    assert [s.key for s in a.top_functions(count=2)] == ["load (app.py:1)", "parse (app.py:1)"]
+    assert [s.key for s in a.top_functions('live', count=1)] == ["parse (app.py:1)"]
+
+    path = a.paths[("main (app.py:1)", "load (app.py:1)")]
+    assert (path.samples, path.allocated, path.live) == (2, 120, 20)
+    assert a.top_paths(count=1) == [path]
+
+    assert a.timeline[-1] == (7, 205, 100)
+    assert a.growth(buckets=2) == [(3, 185, 0), (7, 205, 100)]
+
+
+def test_unsymbolized():
+    result = analyze([alloc(0, 1, 10), free(1, 1), free(2, 1)], symbolize=False)
+    assert (result.allocated, result.freed, result.unmatched_frees) == (10, 10, 1)
+    assert list(result.functions) == [None]
+
+
+SCRIPT = """
+import sys
+import etwtrace
+
+def leak(keep):
+    for _ in range(2000):
+        keep.append(bytes(4096))
+
+def churn():
+    for _ in range(2000):
+        bytes(4096)
+
+kept = []
+with etwtrace.InstrumentedTracer(output=sys.argv[1], allocations=16384):
+    leak(kept)
+    churn()
+"""
+
+
+def test_traced_allocations(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "allocations.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        result = etwtrace.analyze_allocations(reader)
+    sites = {s.key.partition(" ")[0]: s for s in result.functions.values() if s.key}
+    leak, churn = sites["leak"], sites["churn"]
+    # About 8 MiB each, so the estimates are well within a factor of two
+    assert 4 << 20 < leak.allocated < 16 << 20
+    assert 4 << 20 < churn.allocated < 16 << 20
+    # The instrumented tracer makes small allocations of its own on calls
+    assert leak.live > leak.allocated * 0.6
+    assert churn.live < churn.allocated * 0.2
+    assert any(k[-1].startswith("leak ") for k in result.paths if k)
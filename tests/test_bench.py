@@ -0,0 +1,95 @@
+import json
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+import etwtrace._cli as CLI
+from etwtrace import _bench
+
+
+SCRIPT = """import etwtrace
+def inner(n):
+    return sum(range(n))
+def outer():
+    with etwtrace.mark_range("work"):
+        for _ in range(10):
+            inner(1000)
+outer()
+"""
+
+
+def test_describe():
+    s = _bench.describe([10, 12, 14, 16, 18])
+    assert s["n"] == 5
+    assert s["mean"] == 14
+    assert s["median"] == 14
+    assert s["p95"] == 17.6
+    lo, hi = s["ci95"]
+    # t(4) = 2.776 and stdev = sqrt(10)
+    assert abs((hi - lo) / 2 - 2.776 * 10 ** 0.5 / 5 ** 0.5) < 1e-9
+
+    s = _bench.describe([5])
+    assert s["ci95"] == [5, 5]
+
+
+def test_compare():
+    base = _bench.summarize([
+        {"wall": w, "functions": {"f": {"calls": 1, "time": w}}, "marks": {}}
+        for w in (100, 102, 98, 101, 99)
+    ])
+    new = _bench.summarize([
+        {"wall": w, "functions": {"f": {"calls": 1, "time": w}, "g": {"calls": 1, "time": 1}}, "marks": {}}
+        for w in (120, 122, 118, 121, 119)
+    ])
+    result = _bench.compare(base, new)
+    # Wall time and marks stay ahead of the functions, however large their t
+    assert [r[:2] for r in result] == [("wall", "Wall time"), ("functions", "f"), ("functions", "g")]
+    rows = {(r[0], r[1]): r for r in result}
+    _, _, b, n, change, t = rows["wall", "Wall time"]
+    assert abs(change - 0.2) < 1e-9
+    assert t > 10
+    assert rows["functions", "g"][2:] == (None, new["functions"]["g"], None, None)
+
+
+def test_cli_bench(tmp_path, capsys):
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT)
+    output = tmp_path / "results.json"
+    assert 0 == CLI.main(["bench", "-n", "3", "--warmup", "1", "--output", str(output), "--", str(script)])
+    out, err = capsys.readouterr()
+    assert err.count("complete") == 4
+    lines = out.splitlines()
+    assert lines[0] == "3 runs (1 warm-up runs discarded)"
+    assert any(line.endswith("  work") for line in lines)
+
+    results = json.loads(output.read_text())
+    assert results["runs"] == 3
+    assert len(results["results"]) == 3
+    for r in results["results"]:
+        assert r["marks"]["work"]["count"] == 1
+        inner = [v for k, v in r["functions"].items() if k.startswith("inner ")]
+        assert inner[0]["calls"] == 10
+        # Only the script's functions and the modules it imports are timed
+        assert not any("etwtrace" in k for k in r["functions"])
+    assert results["summary"]["marks"]["work"]["n"] == 3
+
+    assert 0 == CLI.main(["bench", "--compare", str(output), str(output)])
+    out, err = capsys.readouterr()
+    assert "+0.0%" in out.splitlines()[1]
+
+    assert 0 == CLI.main(["bench", "--compare", str(output), str(output), "--top", "1"])
+    out, err = capsys.readouterr()
+    names = [line.rsplit("  ", 1)[1] for line in out.splitlines()[1:-2]]
+    assert names[:2] == ["Wall time", "[work]"]
+
+    assert 1 == CLI.main(["bench", str(script)])
+    assert 1 == CLI.main(["bench", "--compare", str(output)])
@@ -0,0 +1,89 @@
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._calltree import analyze
+from fakes import Event
+
+
+def push(ts, func_id, caller=0, line=0, tid=1):
+    return Event('PythonFunctionPush', ts, tid=tid, FunctionID=func_id, Caller=caller, CallerLine=line)
+
+
+def pop(ts, func_id, tid=1):
+    return Event('PythonFunctionPop', ts, tid=tid, FunctionID=func_id)
+
+
+def test_instrumented_trace():
+    with etwtrace.open_trace(TRACES / "instrumented.etl") as trace:
+        result = analyze(trace)
+    funcs = {f.name: f for f in result.functions.values()}
+    assert {n: (f.calls, f.inclusive, f.exclusive) for n, f in funcs.items()} == {
+        '<module>': (1, 170, 30),
+        'outer': (2, 140, 90),
+        'inner': (2, 50, 50),
+    }
+    sites = {(s.caller.name, s.line, s.callee.name): (s.calls, s.inclusive) for s in result.call_sites.values()}
+    assert sites == {
+        ('<module>', 2, 'outer'): (1, 60),
+        ('<module>', 3, 'outer'): (1, 80),
+        ('outer', 5, 'inner'): (2, 50),
+    }
+    [thread] = result.threads.values()
+    tree = [(d, n.function.name, n.calls, n.inclusive) for d, n in thread.root.walk() if n.function]
+    assert tree == [(1, '<module>', 1, 170), (2, 'outer', 2, 140), (3, 'inner', 2, 50)]
+    assert result.unmatched_pops == result.unfinished_calls == 0
+
+
+def test_recursion():
+    result = analyze([
+        push(0, 1), push(10, 1, 1, 5), push(20, 1, 1, 5), pop(30, 1), pop(40, 1), pop(100, 1),
+    ])
+    f = result.functions[100, 1]
+    assert (f.calls, f.inclusive, f.exclusive) == (3, 100, 100)
+    assert result.call_sites[100, 1, 5, 1].calls == 2
+
+
+def test_truncated_start():
+    # Function 1 was already running, and called 2 and 3 before returning
+    result = analyze([
+        push(10, 2, 1, 3), pop(20, 2), push(30, 3, 1, 4), pop(60, 3), pop(100, 1),
+    ])
+    assert result.unmatched_pops == 1
+    f = result.functions[100, 1]
+    assert (f.calls, f.inclusive, f.exclusive) == (1, 90, 50)
+    [thread] = result.threads.values()
+    tree = [(d, n.function.function_id, n.inclusive, n.exclusive) for d, n in thread.root.walk() if n.function]
+    assert tree == [(1, 1, 90, 50), (2, 3, 30, 30), (2, 2, 10, 10)]
+
+
+def test_truncated_end():
+    result = analyze([
+        push(0, 1, tid=1), push(10, 2, 1, 3, tid=1), push(5, 1, tid=2), pop(50, 1, tid=2), push(20, 3, 2, 7, tid=1),
+    ])
+    assert result.unfinished_calls == 3
+    assert result.functions[100, 1].inclusive == 20 + 45
+    assert result.functions[100, 2].inclusive == 10
+    assert result.functions[100, 3].inclusive == 0
+
+
+def test_missing_pop():
+    # The pop for 2 was lost, so it ends when its caller does
+    result = analyze([push(0, 1), push(10, 2, 1, 3), pop(40, 1)])
+    assert result.functions[100, 2].inclusive == 30
+    assert result.functions[100, 1].exclusive == 10
+
+
+def test_no_tree():
+    result = analyze([push(0, 1), pop(10, 1)], tree=False)
+    assert result.functions[100, 1].inclusive == 10
+    assert all(t.root is None for t in result.threads.values())
@@ -169,3 +169,55 @@ def test_cli_init_wpr(tmp_path):
     # Very few things we can test, but at least make sure the initializer
     # doesn't fail
     CLI.Wpr(tmp_path / "file.etl")
+
+
+TRACES = Path(__file__).absolute().parent / "traces"
+
+
+def test_cli_calltree(capsys):
+    assert 0 == CLI.main(["calltree", str(TRACES / "instrumented.etl"), "--tree", "--depth", "2"])
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[1].split()[:3] == ["1", "0.017", "0.003"]
+    assert lines[1].endswith(r"<module> (C:\scripts\basic.py:1)")
+    assert any(l.endswith(r"(C:\scripts\basic.py:4):5 -> inner") for l in lines)
+    assert r"    0.014 ms 2x outer (C:\scripts\basic.py:4)" in lines
+    assert not any("x inner" in l for l in lines)
+    assert not err
+
+
+def test_cli_calltree_errors(capsys):
+    assert 1 == CLI.main(["calltree"])
+    assert 1 == CLI.main(["calltree", "--top", "x", str(TRACES / "instrumented.etl")])
+    assert 2 == CLI.main(["calltree", str(TRACES / "stack.etl")])
+    out, err = capsys.readouterr()
+    assert "one TRACE file is required" in err
+    assert "invalid value for --top: x" in err
+    assert "No function calls found" in err
+
+
+def test_cli_export(capsys, tmp_path):
+    assert 0 == CLI.main(["export", "--format", "collapsed", "--output", "-", str(TRACES / "stack.etl")])
+    out, err = capsys.readouterr()
+    assert out.splitlines()[-1] == "cmd.exe (1001);[native code] 1"
+
+    trace = tmp_path / "stack.etl"
+    trace.write_bytes((TRACES / "stack.etl").read_bytes())
+    assert 0 == CLI.main(["export", "--format:chrome", "--pid", "1001", str(trace)])
+    assert (tmp_path / "stack.json").is_file()
+    assert 0 == CLI.main(["export", "--format", "pprof", str(trace)])
+    assert (tmp_path / "stack.pb.gz").read_bytes()[:2] == b"\x1f\x8b"
+
+    assert 1 == CLI.main(["export", str(trace)])
+    out, err = capsys.readouterr()
+    assert "--format must be one of collapsed, chrome, perfetto, pprof" in err
+
+
+def test_cli_index(capsys, tmp_path):
+    trace = tmp_path / "stack.etl"
+    trace.write_bytes((TRACES / "stack.etl").read_bytes())
+    assert 0 == CLI.main(["index", str(trace)])
+    out, err = capsys.readouterr()
+    assert (tmp_path / "stack.etl.etwidx").is_file()
+    assert "3 Python functions" in out
+    assert any(l.split() == ["10", "1000", "Python", "(python.exe)"] for l in out.splitlines())
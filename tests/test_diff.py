@@ -0,0 +1,110 @@
+import io
+import math
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+import etwtrace._cli as CLI
+from etwtrace import _diff
+
+import etlwriter
+
+
+def write_samples(path, depths, *, pid=1000, func_id_base=0):
+    """Writes one sample for each depth (1 is <module> and 3 is inner).
+
+    Samples are 10 units apart, so traces with the same number of samples
+    have the same duration."""
+    tid = pid + 100
+    with etlwriter.EtlWriter(path) as w:
+        w.process(1, pid, 900, 'python.exe', 'python.exe basic.py', ts=1)
+        w.thread(1, pid, tid, ts=2)
+        for i, (func_id, thunk, line, source, name) in enumerate(etlwriter.FUNCTIONS):
+            w.python_event(
+                'PythonFunction', func_id + func_id_base, thunk, thunk + etlwriter.THUNK_SIZE,
+                line, source, name, 1, ts=10 + i, pid=pid, tid=tid,
+            )
+        for i, depth in enumerate(depths):
+            t = 100 + i * 10
+            stack = [etlwriter.EVAL_FRAME + 0x10]
+            for thunk in etlwriter.THUNKS[:depth]:
+                stack[:0] = [thunk + 0x8, etlwriter.EVAL_FRAME + 0x20]
+            w.sample(tid, stack[0], ts=t)
+            w.stackwalk(pid, tid, stack, event_ts=t, ts=t + 1)
+
+
+def _profile(path):
+    with etwtrace.open_trace(path) as trace:
+        return _diff.profile(trace)
+
+
+def test_diff_samples(tmp_path):
+    write_samples(tmp_path / "base.etl", [1] * 100 + [2] * 100 + [3] * 100)
+    write_samples(tmp_path / "new.etl", [1] * 100 + [2] * 20 + [3] * 180, pid=3000, func_id_base=0x10)
+    base = _profile(tmp_path / "base.etl")
+    new = _profile(tmp_path / "new.etl")
+    assert base.kind == new.kind == "samples"
+    assert base.samples == new.samples == 300
+
+    diffs = {d.key[1]: d for d in _diff.compare(base, new)}
+    assert set(diffs) == {"<module>", "outer", "inner"}
+    inner = diffs["inner"]
+    assert inner.change == 0.8
+    assert inner.significant
+    assert math.isclose(inner.noise * base.duration / 1e7, math.sqrt(280))
+    assert diffs["outer"].change == -0.8
+    assert not diffs["<module>"].significant
+
+    # Inclusive samples of outer only change by inner's gain minus its loss
+    diffs = {d.key[1]: d for d in _diff.compare(base, new, "inclusive")}
+    assert diffs["outer"].change == 0.0
+
+    out = io.StringIO()
+    _diff.write_diff_stacks(base, new, out)
+    assert out.getvalue().splitlines() == [
+        r"<module> (C:\scripts\basic.py:1) 100 100",
+        r"<module> (C:\scripts\basic.py:1);outer (C:\scripts\basic.py:4) 100 20",
+        r"<module> (C:\scripts\basic.py:1);outer (C:\scripts\basic.py:4);inner (C:\scripts\basic.py:8) 100 180",
+    ]
+
+
+def test_diff_instrumented():
+    base = _profile(TRACES / "instrumented.etl")
+    assert base.kind == "calls"
+    diffs = _diff.compare(base, base)
+    assert all(d.change == 0 and not d.significant for d in diffs)
+    assert {d.display_name for d in diffs} == {
+        r"<module> (C:\scripts\basic.py:1)", r"outer (C:\scripts\basic.py:4)", r"inner (C:\scripts\basic.py:8)",
+    }
+
+
+def test_cli_diff(tmp_path, capsys):
+    write_samples(tmp_path / "base.etl", [1] * 500 + [2] * 500 + [3] * 500)
+    write_samples(tmp_path / "new.etl", [1] * 500 + [2] * 400 + [3] * 600)
+    base, new = str(tmp_path / "base.etl"), str(tmp_path / "new.etl")
+    flamegraph = tmp_path / "diff.folded"
+    assert 0 == CLI.main(["diff", base, new, "--flamegraph", str(flamegraph)])
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    regressions = lines[lines.index("Regressions") + 2]
+    assert regressions.split()[0] == "+20.0%"
+    assert regressions.endswith(r"inner (C:\scripts\basic.py:8)")
+    assert flamegraph.read_text().count("\n") == 3
+
+    assert 0 == CLI.main(["diff", base, new, "--threshold", "25"])
+    assert 3 == CLI.main(["diff", base, new, "--threshold", "10"])
+    out, err = capsys.readouterr()
+    assert "1 function(s) regressed by more than 10.0%" in err
+
+    assert 1 == CLI.main(["diff", base])
+    assert 1 == CLI.main(["diff", base, new, "--metric", "total"])
+    assert 2 == CLI.main(["diff", base, str(TRACES / "instrumented.etl")])
@@ -0,0 +1,368 @@
+import pytest
+import sys
+
+from pathlib import Path
+from uuid import UUID
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._etlreader import open as etlopen, EtlFormatError
+
+import etlwriter
+
+ETWTRACE = UUID('99a10640-320d-4b37-9e26-c311d86da7ab')
+SYSTRACE = UUID('9e814aad-3204-11d2-9a82-006008a86939')
+
+
+def _python_events(path, **filters):
+    with etlopen(path, provider_names=['Python'], **filters) as etl:
+        return list(etl)
+
+
+def test_stack_trace():
+    with etlopen(TRACES / "stack.etl") as etl:
+        assert etl.header.pointer_size == 8
+        assert etl.header.number_of_processors == 2
+        events = list(etl)
+    assert [e.timestamp for e in events] == sorted(e.timestamp for e in events)
+    assert events[0].timestamp == etlwriter.START_TIME
+
+    funcs = {e['Name'].value: e for e in events if e.event_name == 'PythonFunction'}
+    assert set(funcs) == {'<module>', 'outer', 'inner'}
+    f = funcs['outer']
+    assert f.provider == ETWTRACE
+    assert f.provider_name == 'Python'
+    assert f.keyword == 0x400
+    assert (f.process_id, f.thread_id) == (1000, 1100)
+    assert f['SourceFile'].value == r'C:\scripts\basic.py'
+    assert f['BeginAddress'].value == etlwriter.THUNKS[1]
+    assert f['FunctionID'].formatted_value == '0x00000000_00000101'
+    assert list(f) == ['FunctionID', 'BeginAddress', 'EndAddress', 'LineNumber',
+                       'SourceFile', 'Name', 'IsPythonCode']
+
+    marks = [(e.opcode, e['Mark'].value) for e in events if e.event_name == 'PythonMark']
+    assert marks == [(1, 'phase'), (2, 'phase'), (0, 'done')]
+
+    sample = next(e for e in events if e.event_name == 'PythonStackSample')
+    assert list(sample.stack) == [etlwriter.THUNKS[1] + 8, etlwriter.EVAL_FRAME + 0x20]
+
+    walks = [e for e in events if e.provider == SYSTRACE and e.opcode_name == 'Stack']
+    assert len(walks) == 11
+    assert all(e.stack[-1] == etlwriter.EVAL_FRAME + 0x10 for e in walks[:10])
+    assert walks[2]['Stack1'].value == walks[2].stack[0]
+
+    samples = [e for e in events if e.is_stack_sample]
+    assert {e.process_id for e in samples} == {1000, 1001}
+
+    images = [e['FileName'].value for e in events if e.task_name == 'Image']
+    assert images == [r'C:\Python\python313.dll', r'C:\Python\Lib\etwtrace\_etwtrace.pyd']
+
+    starts = [e['ProcessId'].value for e in events if e.is_process_start]
+    assert starts == [1000, 1001]
+    assert [e['ImageFileName'].value for e in events if e.is_process_end] == ['cmd.exe', 'python.exe']
+
+
+def test_instrumented_trace():
+    events = _python_events(TRACES / "instrumented.etl")
+    calls = [(e.event_name, e['FunctionID'].value) for e in events
+             if e.event_name in ('PythonFunctionPush', 'PythonFunctionPop')]
+    assert len(calls) == 10
+    assert calls[0] == ('PythonFunctionPush', 0x100)
+    assert calls[-1] == ('PythonFunctionPop', 0x100)
+    push = next(e for e in events if e.event_name == 'PythonFunctionPush' and e['Caller'].value)
+    assert push['FunctionID'].formatted_value == '0x00000101'
+    assert push['CallerLine'].value == 2
+
+
+def test_filters():
+    path = TRACES / "stack.etl"
+    assert all(e.provider == ETWTRACE for e in _python_events(path))
+
+    events = _python_events(path, event_names=['pythonmark'])
+    assert [e['Mark'].value for e in events] == ['phase', 'phase', 'done']
+
+    events = _python_events(path, property_filters={'FunctionID': range(0x101, 0x103)})
+    assert [e['Name'].value for e in events] == ['outer', 'inner']
+
+    events = _python_events(path, property_filters={'ThreadID': {1100}})
+    assert [e.opcode for e in events] == [1, 2]
+
+    with etlopen(path, keyword_mask_any=0x800 | 0x200) as etl:
+        assert {e.event_name for e in etl} == {'PythonMark', 'PythonStackSample'}
+
+    start = etlwriter.START_TIME + 1100
+    end = etlwriter.START_TIME + 1500
+    with etlopen(path, start_time=start, end_time=end) as etl:
+        events = list(etl)
+    assert events
+    assert all(start <= e.timestamp <= end for e in events)
+
+
+def test_process_filter():
+    path = TRACES / "stack.etl"
+    with etlopen(path, process_ids=[1000]) as etl:
+        pids = {e.process_id for e in etl}
+    assert pids == {1000, 1001}
+
+    with etlopen(path, process_ids=[1000], include_child_process_ids=False) as etl:
+        pids = {e.process_id for e in etl}
+    assert pids == {1000}
+
+    # The child starts just before the window, and is still included
+    start = etlwriter.START_TIME + 2255
+    with etlopen(path, process_ids=[1000], start_time=start) as etl:
+        events = list(etl)
+    assert {e.process_id for e in events} == {1000, 1001}
+    assert all(e.timestamp >= start for e in events)
+
+
+def test_interned_stacks():
+    with etlopen(TRACES / "stack.etl", intern_stacks=True) as etl:
+        walks = [e for e in etl if e.opcode_name == 'Stack']
+        table = etl.stack_table
+    assert len(table) == 5
+    assert all(table[e.stack_id] is e.stack for e in walks)
+    assert walks[0].stack is walks[3].stack
+
+
+def test_buffers_from_many_cpus(tmp_path):
+    path = tmp_path / "cpus.etl"
+    etlwriter.write_stack_trace(path, cpus=4)
+    with etlopen(path) as etl:
+        events = list(etl)
+    assert [e.timestamp for e in events] == sorted(e.timestamp for e in events)
+    assert len([e for e in events if e.is_stack_sample]) == 11
+
+
+def test_not_an_etl(tmp_path):
+    path = tmp_path / "empty.etl"
+    path.write_bytes(b'')
+    with etlopen(path) as etl:
+        assert list(etl) == []
+    path.write_bytes(b'not an etl file')
+    with pytest.raises(EtlFormatError):
+        etlopen(path)
+
+
+def _summarize(e):
+    return e.timestamp, e.event_name, e.opcode_name, e.process_id, dict(e.items()), e.stack and list(e.stack)
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"process_ids": [1000]},
+    {"process_ids": [1000], "include_child_process_ids": False},
+    {"provider_names": ["Python"], "end_time": etlwriter.START_TIME + 1500},
+])
+def test_parallel(tmp_path, filters):
+    path = tmp_path / "cpus.etl"
+    etlwriter.write_stack_trace(path, cpus=4)
+    with etlopen(path, **filters) as etl:
+        expected = [_summarize(e) for e in etl]
+    with etwtrace.open_trace(path, workers=2, chunk_buffers=1, **filters) as etl:
+        assert len(etl._chunks) > 4
+        actual = [_summarize(e) for e in etl]
+    assert actual == expected
+
+
+def test_parallel_map(tmp_path):
+    path = tmp_path / "cpus.etl"
+    etlwriter.write_stack_trace(path, cpus=4)
+    with etwtrace.open_trace(path, workers=2, chunk_buffers=1, process_ids=[1000]) as etl:
+        results = list(etl.map(list))
+    assert len(results) > 4
+    samples = [e for events in results for e in events if e.is_stack_sample]
+    assert sorted(e.process_id for e in samples) == [1000] * 10 + [1001]
+
+
+def test_parallel_reused_ids(tmp_path):
+    path = tmp_path / "reused.etl"
+    with etlwriter.EtlWriter(path, cpus=2, buffer_size=0x200) as w:
+        ts = 1000
+        w.process(1, 1000, 900, 'python.exe', 'python.exe', ts=ts)
+        w.thread(1, 1000, 1100, ts=ts + 10)
+        w.process(1, 1001, 1000, 'cmd.exe', 'cmd /c exit', ts=ts + 100)
+        w.thread(1, 1001, 1200, ts=ts + 110)
+        w.sample(1200, 0x1000, ts=ts + 150, cpu=1)
+        w.process(2, 1001, 1000, 'cmd.exe', 'cmd /c exit', ts=ts + 200)
+        # An unrelated process reuses the child's thread ID, and then its
+        # process ID after it has ended
+        w.process(1, 2000, 900, 'other.exe', 'other.exe', ts=ts + 300)
+        w.thread(1, 2000, 1200, ts=ts + 310)
+        w.process(1, 1001, 900, 'other.exe', 'other.exe', ts=ts + 400)
+        w.thread(1, 1001, 1300, ts=ts + 410)
+        for i in range(10):
+            t = ts + 500 + i * 10
+            w.sample(1100, 0x1000, ts=t, cpu=1)
+            w.sample(1200, 0x1000, ts=t + 1, cpu=1)
+            w.sample(1300, 0x1000, ts=t + 2, cpu=1)
+
+    with etlopen(path, process_ids=[1000]) as etl:
+        expected = [_summarize(e) for e in etl]
+    with etwtrace.open_trace(path, workers=2, chunk_buffers=1, process_ids=[1000]) as etl:
+        assert len(etl._chunks) > 4
+        actual = [_summarize(e) for e in etl]
+    assert actual == expected
+    samples = [e for e in actual if e[2] == 'SampleProf']
+    assert [e[3] for e in samples] == [1001] + [1000] * 10
+
+
+def test_parallel_interned_stacks():
+    with etwtrace.open_trace(TRACES / "stack.etl", workers=2, chunk_buffers=1, intern_stacks=True) as etl:
+        walks = [e for e in etl if e.opcode_name == 'Stack']
+        table = etl.stack_table
+    assert len(table) == 5
+    assert all(table[e.stack_id] is e.stack for e in walks)
+    assert walks[0].stack is walks[3].stack
+
+
+def _layout(*fields, size=None):
+    # Each field is a hex string of little-endian bytes
+    data = bytes.fromhex("".join(fields))
+    if size:
+        assert len(data) <= size
+        data += bytes(size - len(data))
+    return data
+
+
+def test_spec_layout(tmp_path):
+    # Assembled by hand from the documented record layouts rather than by
+    # etlwriter, so that the reader and writer cannot agree on a mistake.
+    header_buffer = _layout(
+        # WMI_BUFFER_HEADER (72 bytes)
+        "00020000",             # +0 BufferSize = 512
+        "88010000",             # +4 SavedOffset = 392
+        "88010000",             # +8 CurrentOffset
+        "00000000",             # +12 ReferenceCount
+        "0000100000000000",     # +16 TimeStamp
+        "0000000000000000",     # +24 SequenceNumber
+        "0000000000000000",     # +32 ClockType/Frequency
+        "00" "00" "0000",       # +40 ETW_BUFFER_CONTEXT: ProcessorNumber, Alignment, LoggerId
+        "00000000",             # +44 State
+        "88010000",             # +48 Offset = 392
+        "0000",                 # +52 BufferFlag
+        "0000",                 # +54 BufferType
+        "00" * 16,              # +56 ReferenceTime
+        # SYSTEM_TRACE_HEADER (32 bytes)
+        "0200" "02" "c0",       # +0 Version, HeaderType = SYSTEM64, MarkerFlags
+        "4001",                 # +4 Size = 320
+        "00" "00",              # +6 Type (opcode) = 0, Group = EventTrace
+        "00000000",             # +8 ThreadId
+        "00000000",             # +12 ProcessId
+        "0000100000000000",     # +16 SystemTime = 0x100000 ticks
+        "00000000" "00000000",  # +24 KernelTime, UserTime
+        # TRACE_LOGFILE_HEADER (64-bit pointers)
+        "00020000",             # +0 BufferSize
+        "0500000a",             # +4 Version
+        "f4650000",             # +8 ProviderVersion = 26100
+        "02000000",             # +12 NumberOfProcessors = 2
+        "0000000000000000",     # +16 EndTime
+        "5a620200",             # +24 TimerResolution = 156250
+        "00000000",             # +28 MaximumFileSize
+        "00000000",             # +32 LogFileMode
+        "02000000",             # +36 BuffersWritten
+        "01000000",             # +40 StartBuffers
+        "08000000",             # +44 PointerSize = 8
+        "00000000",             # +48 EventsLost
+        "b80b0000",             # +52 CpuSpeedInMHz = 3000
+        "0000000000000000",     # +56 LoggerName
+        "0000000000000000",     # +64 LogFileName
+        "00" * 172,             # +72 TimeZone (TIME_ZONE_INFORMATION)
+        "00000000",             # +244 padding to 8 bytes
+        "0000000000000000",     # +248 BootTime
+        "c0c62d0000000000",     # +256 PerfFreq = 3000000
+        "0080209bcb82d801",     # +264 StartTime = 133000000000000000
+        "01000000",             # +272 ReservedFlags (clock type = QPC)
+        "00000000",             # +276 BuffersLost
+        "4c000000",             # +280 LoggerName = "L"
+        "66000000",             # +284 LogFileName = "f"
+        size=512,
+    )
+    event_buffer = _layout(
+        # WMI_BUFFER_HEADER
+        "00020000", "48010000", "48010000", "00000000",
+        "dc05100000000000",     # +16 TimeStamp
+        "0100000000000000",     # +24 SequenceNumber
+        "0000000000000000",
+        "01" "00" "0000",       # +40 ProcessorNumber = 1
+        "00000000",
+        "48010000",             # +48 Offset = 328
+        "0000", "0000", "00" * 16,
+        # SYSTEM_TRACE_HEADER, Process/Start
+        "0400" "02" "c0",       # +0 Version = 4, HeaderType = SYSTEM64, MarkerFlags
+        "5500",                 # +4 Size = 85
+        "01" "03",              # +6 Type = Start, Group = Process
+        "84030000",             # +8 ThreadId = 900
+        "84030000",             # +12 ProcessId = 900
+        "dc05100000000000",     # +16 SystemTime = 0x100000 + 1500 ticks
+        "00000000" "00000000",  # +24 KernelTime, UserTime
+        # Process_TypeGroup1 (version 4)
+        "0000b01234f8ffff",     # UniqueProcessKey
+        "e8030000",             # ProcessId = 1000
+        "84030000",             # ParentId = 900
+        "01000000",             # SessionId = 1
+        "03010000",             # ExitStatus = 259
+        "00a0b0c000000000",     # DirectoryTableBase
+        "00000000",             # Flags
+        "00000000",             # UserSID (null)
+        "70792e65786500",       # ImageFileName = "py.exe"
+        "700079000000",         # CommandLine = "py"
+        "000000",               # padding to 8 bytes
+        # EVENT_HEADER (80 bytes), TraceLogging
+        "a600" "13" "c0",       # +0 Size = 166, HeaderType = EVENT_HEADER64, MarkerFlags
+        "4100",                 # +4 Flags = EXTENDED_INFO | 64_BIT_HEADER
+        "0000",                 # +6 EventProperty
+        "4c040000",             # +8 ThreadId = 1100
+        "e8030000",             # +12 ProcessId = 1000
+        "b80b100000000000",     # +16 TimeStamp = 0x100000 + 3000 ticks
+        "4006a1990d32374b9e26c311d86da7ab",  # +24 ProviderId
+        "0000" "00" "0b",       # +40 Id, Version, Channel = TraceLogging
+        "05" "01" "0000",       # +44 Level, Opcode = Start, Task
+        "0008000000000000",     # +48 Keyword = 0x800
+        "0000000000000000",     # +56 ProcessorTime
+        "11111111222233334444555555555555",  # +64 ActivityId
+        # EVENT_HEADER_EXTENDED_DATA_ITEM: Reserved1, ExtType, Linkage, DataSize
+        "0000" "0100" "0100" "1000",  # RELATED_ACTIVITYID, 16 bytes
+        "aaaaaaaabbbbccccddddeeeeeeeeeeee",
+        "0000" "0b00" "0100" "1400",  # EVENT_SCHEMA_TL, 20 bytes
+        "1400" "00",            # metadata size, tags
+        "507974686f6e4d61726b00",  # event name = "PythonMark"
+        "4d61726b00" "01",      # field "Mark", InType = UNICODESTRING
+        "00000000",             # padding to 8 bytes
+        "0000" "0c00" "0000" "0900",  # PROV_TRAITS, 9 bytes, last item
+        "0900" "507974686f6e00",  # traits size, provider name = "Python"
+        "00" * 7,               # padding to 8 bytes
+        "67006f000000",         # Mark = "go"
+        size=512,
+    )
+    path = tmp_path / "spec.etl"
+    path.write_bytes(header_buffer + event_buffer)
+
+    with etlopen(path) as etl:
+        assert etl.header.pointer_size == 8
+        assert etl.header.number_of_processors == 2
+        events = list(etl)
+    start, process, mark = events
+    assert start.timestamp == 133000000000000000
+    assert process.is_process_start
+    assert process.timestamp == start.timestamp + 5000
+    assert (process.process_id, process.thread_id) == (900, 900)
+    assert process['ProcessId'].value == 1000
+    assert process['ParentId'].value == 900
+    assert process['ImageFileName'].value == 'py.exe'
+    assert process['CommandLine'].value == 'py'
+
+    assert mark.timestamp == start.timestamp + 10000
+    assert (mark.provider, mark.provider_name) == (ETWTRACE, 'Python')
+    assert (mark.event_name, mark.opcode, mark.keyword) == ('PythonMark', 1, 0x800)
+    assert (mark.process_id, mark.thread_id) == (1000, 1100)
+    assert mark.activity_id == UUID('11111111-2222-3333-4444-555555555555')
+    assert mark.related_activity_id == UUID('aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee')
+    assert list(mark.items()) == [('Mark', 'go')]
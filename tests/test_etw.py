@@ -109,6 +109,7 @@ class _TracedEvents:
         count=1,
         timeout=60,
         instrumented=False,
+        intern_stacks=False,
     ):
         self.script = script
         self.script_args = script_args
@@ -127,6 +128,7 @@ class _TracedEvents:
         self.count = count
         self.timeout = timeout
         self.instrumented = instrumented
+        self.intern_stacks = intern_stacks
 
     def _start_wpr(self):
         try:
@@ -201,6 +203,7 @@ class _TracedEvents:
             provider_names=self.provider_names,
             event_names=self.event_names,
             process_ids=[pid],
+            intern_stacks=self.intern_stacks,
         )
         return self._file
 
@@ -284,6 +287,66 @@ def test_stacks(trace_events):
             assert False
 
 
+def test_interned_stacks(trace_events):
+    from array import array
+    stack_ids = []
+    with trace_events("threaded.py", providers=['Python'], intern_stacks=True) as etl:
+        for e in etl:
+            if e.event_name == 'PythonStackSample':
+                assert isinstance(e.stack, array)
+                assert e.stack is etl.stack_table[e.stack_id]
+                stack_ids.append(e.stack_id)
+        table = etl.stack_table
+
+    assert stack_ids
+    assert len(table) == len(set(stack_ids))
+    assert len(set(map(bytes, table))) == len(table)
+
+
+def test_filter_pushdown(trace_events, tmp_path):
+    funcs = {}
+    with trace_events("basic.py", providers=['Python']) as etl:
+        events = list(etl)
+    for e in events:
+        if e.event_name == 'PythonFunction':
+            if e['SourceFile'].value and (SCRIPTS / "basic.py").match(e['SourceFile'].value):
+                funcs[e['Name'].value] = e['FunctionID'].value
+    assert {'a', 'b'} <= set(funcs)
+
+    with etlopen(tmp_path / "basic.etl", provider_names=['PYTHON'],
+                 property_filters={'FunctionID': funcs['b']}) as etl:
+        filtered = list(etl)
+    assert filtered
+    assert all(e['FunctionID'].value == funcs['b'] for e in filtered)
+
+    with etlopen(tmp_path / "basic.etl", provider_names=['Python'],
+                 property_filters={'FunctionID': {funcs['a'], funcs['b']}}) as etl:
+        filtered = list(etl)
+    assert {e['FunctionID'].value for e in filtered} == {funcs['a'], funcs['b']}
+
+    start = events[len(events) // 4].timestamp
+    end = events[len(events) // 2].timestamp
+    with etlopen(tmp_path / "basic.etl", provider_names=['Python'],
+                 start_time=start, end_time=end) as etl:
+        windowed = list(etl)
+    assert windowed
+    assert all(start <= e.timestamp <= end for e in windowed)
+
+
+def test_portable_reader(trace_events, tmp_path):
+    def summarize(e):
+        return e.event_name, e.opcode, e.thread_id, dict(e.items()), e.stack and list(e.stack)
+
+    with trace_events("basic.py", providers=['Python']) as etl:
+        events = list(etl)
+    assert events
+    pid = events[0].process_id
+
+    with etwtrace.open_trace(tmp_path / "basic.etl", provider_names=['Python'], process_ids=[pid]) as etl:
+        actual = [summarize(e) for e in etl]
+    assert actual == [summarize(e) for e in events]
+
+
 def find_test_stacks(etl, source_file):
     """Returns Python functions leading to PythonStackSample events"""
     source_file = PurePath(source_file)
@@ -0,0 +1,168 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._exceptions import analyze
+from fakes import Event
+
+
+def function(func_id, name):
+    return Event('PythonFunction', 0, FunctionID=func_id, Name=name, SourceFile='app.py', LineNumber=1)
+
+
+def exc(ts, opcode, func_id, line, type_id=1, tid=1):
+    return Event('PythonException', ts, opcode, tid, TypeID=type_id, FunctionID=func_id, Line=line)
+
+
+def test_analyze():
+    result = analyze([
+        Event('PythonExceptionType', 0, TypeID=1, Name='KeyError'),
+        Event('PythonExceptionType', 0, TypeID=2, Name='ValueError'),
+        function(1, 'lookup'),
+        function(2, 'deep'),
+        function(3, 'main'),
+        # Raised and caught in the same function
+        exc(1, 1, 1, 5),
+        exc(2, 2, 1, 6),
+        exc(3, 1, 1, 5),
+        exc(4, 2, 1, 6),
+        # Unwinds two frames through a finally block in main
+        exc(10, 1, 2, 11, 2),
+        exc(12, 11, 2, 12, 2),
+        exc(14, 11, 2, 12, 2),
+        exc(15, 2, 3, 20, 2),
+        exc(17, 10, 3, 20, 2),
+        exc(18, 2, 3, 25, 2),
+        # Another thread, never handled
+        exc(20, 1, 1, 5, tid=2),
+        exc(22, 11, 1, 5, tid=2),
+    ])
+    assert (result.raised, result.handled, result.unmatched_unwinds) == (4, 4, 0)
+    sites = {(s.type, s.location): s for s in result.sites.values()}
+    lookup = sites['KeyError', 'lookup (app.py:1) line 5']
+    assert (lookup.raised, lookup.frames, lookup.time) == (3, 1, 4)
+    assert sites['KeyError', 'lookup (app.py:1) line 6'].handled == 2
+    deep = sites['ValueError', 'deep (app.py:1) line 11']
+    # The reraise continues from the finally block, and counts against deep
+    assert (deep.raised, deep.frames, deep.time) == (1, 2, 6)
+    assert sites['ValueError', 'deep (app.py:1) line 12'].unwound == 2
+    assert sites['ValueError', 'main (app.py:1) line 20'].reraised == 1
+    assert result.top_sites(count=1) == [lookup]
+    assert [s.line for s in result.top_sites('handled')] == [6, 20, 25]
+    assert result.by_type() == {'KeyError': (3, 2, 4), 'ValueError': (1, 2, 6)}
+
+
+def test_unresolved():
+    result = analyze([
+        exc(1, 11, 0x10, -1),
+        exc(2, 1, 0x10, 3),
+        exc(4, 11, 0x10, 3),
+        # Raising again ends the previous exception at its last unwind
+        exc(9, 1, 0x10, 3),
+    ])
+    assert result.unmatched_unwinds == 1
+    site = result.sites[100, 1, 0x10, 3]
+    assert (site.type, site.location) == ('<type 1>', '<function 0x10> line 3')
+    assert (site.raised, site.frames, site.time) == (2, 1, 2)
+    assert result.sites[100, 1, 0x10, -1].location == '<function 0x10>'
+
+
+SCRIPT = """
+import sys
+import etwtrace
+
+def lookup(d, key):
+    try:
+        return d[key]
+    except KeyError:
+        return None
+
+def deep(n):
+    if not n:
+        raise ValueError(n)
+    deep(n - 1)
+
+class Lazy:
+    def __getattr__(self, name):
+        raise AttributeError(name)
+
+with etwtrace.InstrumentedTracer(output=sys.argv[1], exceptions=True):
+    for i in range(50):
+        lookup({}, i)
+    try:
+        deep(5)
+    except ValueError:
+        pass
+    # getattr() swallows the exception after __getattr__ unwinds
+    for i in range(20):
+        getattr(Lazy(), "x", None)
+"""
+
+
+def test_traced_exceptions(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "exceptions.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        result = etwtrace.analyze_exceptions(reader)
+    raised = {(s.type, s.function.partition(" ")[0], s.line): s for s in result.top_sites()}
+    assert raised['KeyError', 'lookup', 7].raised == 50
+    deep = raised['ValueError', 'deep', 13]
+    assert (deep.raised, deep.frames) == (1, 6)
+    # Functions are named by co_qualname where there is one (3.11 and later)
+    lazy_getattr = 'Lazy.__getattr__' if sys.version_info >= (3, 11) else '__getattr__'
+    assert raised['AttributeError', lazy_getattr, 18].raised == 20
+    if sys.version_info >= (3, 12):
+        handlers = {(s.type, s.function.partition(" ")[0], s.line): s.handled for s in result.top_sites('handled')}
+        assert handlers == {('KeyError', 'lookup', 8): 50, ('ValueError', '<module>', 25): 1}
+
+
+SESSIONS_SCRIPT = """
+import sys
+import etwtrace
+
+for output in sys.argv[1:]:
+    with etwtrace.SamplingTracer(output=output, exceptions=True):
+        try:
+            {}[0]
+        except KeyError:
+            pass
+"""
+
+
+def test_types_written_per_session(tmp_path):
+    if sys.version_info < (3, 12):
+        pytest.skip("SamplingTracer requires Python 3.12 for exception events")
+    try:
+        from etwtrace import _etwsample
+    except ImportError:
+        pytest.skip("_etwsample has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SESSIONS_SCRIPT, encoding="utf-8")
+    outputs = [tmp_path / "first.pytrace", tmp_path / "second.pytrace"]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), *map(str, outputs)], env=env)
+
+    for output in outputs:
+        with etwtrace.open_trace(output) as reader:
+            result = etwtrace.analyze_exceptions(reader)
+        sites = {(s.type, s.function.partition(" ")[0], s.line) for s in result.top_sites()}
+        assert ('KeyError', '<module>', 8) in sites
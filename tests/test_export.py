@@ -0,0 +1,73 @@
+import io
+import json
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+
+
+def _export(name, format, **kwargs):
+    out = io.StringIO()
+    with etwtrace.open_trace(TRACES / name) as etl:
+        etwtrace.export(etl, out, format, **kwargs)
+    return out.getvalue()
+
+
+def test_collapsed_samples():
+    lines = _export("stack.etl", "collapsed").splitlines()
+    assert lines == [
+        r"python.exe (1000);<module> (C:\scripts\basic.py:1) 4",
+        r"python.exe (1000);<module> (C:\scripts\basic.py:1);outer (C:\scripts\basic.py:4) 3",
+        r"python.exe (1000);<module> (C:\scripts\basic.py:1);outer (C:\scripts\basic.py:4);inner (C:\scripts\basic.py:8) 3",
+        "cmd.exe (1001);[native code] 1",
+    ]
+
+
+def test_collapsed_native():
+    lines = _export("stack.etl", "collapsed", native=True).splitlines()
+    # Consecutive frames in the same module are merged
+    assert lines[1] == (
+        r"python.exe (1000);python313.dll;<module> (C:\scripts\basic.py:1);python313.dll;outer (C:\scripts\basic.py:4) 3"
+    )
+    assert lines[-1] == "cmd.exe (1001);[unknown] 1"
+
+
+def test_collapsed_instrumented():
+    # Weights are exclusive time in microseconds
+    lines = _export("instrumented.etl", "collapsed").splitlines()
+    assert [l.rpartition(" ")[2] for l in lines] == ["3", "9", "5"]
+    assert lines[2].count(";") == 3
+
+
+def test_chrome_samples():
+    trace = json.loads(_export("stack.etl", "chrome"))
+    events = trace["traceEvents"]
+    samples = [e for e in events if e["ph"] == "P"]
+    assert len(samples) == 10
+    assert {e["sf"] for e in samples} == {1, 2, 3}
+    frames = trace["stackFrames"]
+    assert frames["3"]["parent"] == 2
+    assert frames["3"]["name"] == r"inner (C:\scripts\basic.py:8)"
+    assert [(e["ph"], e["name"]) for e in events if e.get("cat") == "mark"] == [
+        ("b", "phase"), ("e", "phase"), ("i", "done"),
+    ]
+    assert events[0]["args"]["name"] == "python.exe"
+
+
+def test_chrome_instrumented():
+    trace = json.loads(_export("instrumented.etl", "perfetto"))
+    calls = [e for e in trace["traceEvents"] if e.get("cat") == "function"]
+    assert [e["ph"] for e in calls] == list("BBBEEBBEEE")
+    assert calls[1]["name"] == r"outer (C:\scripts\basic.py:4)"
+    # Timestamps are in microseconds from the first event
+    assert [e["ts"] for e in calls[:3]] == [9.0, 10.0, 12.0]
+    assert trace["stackFrames"] == {}
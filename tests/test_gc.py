@@ -0,0 +1,124 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._gc import analyze, GCAnalyzer
+from etwtrace._symbolize import Frame
+from fakes import Event
+
+
+def gc_start(ts, generation, tid=1):
+    return Event('PythonGC', ts, 1, tid, Generation=generation)
+
+
+def gc_stop(ts, generation, collected=0, uncollectable=0, duration=0, tid=1):
+    return Event('PythonGC', ts, 2, tid, Generation=generation, Collected=collected,
+                  Uncollectable=uncollectable, Duration=duration)
+
+
+def mark(ts, opcode, name, tid=1):
+    return Event('PythonMark', ts, opcode, tid, Mark=name)
+
+
+def python_frame(name):
+    return Frame('python', name, 'app.py', 1, None, 0)
+
+
+def test_analyze():
+    a = GCAnalyzer()
+    for e, frames in [
+        (mark(0, 1, "request"), None),
+        (mark(1, 1, "query", tid=2), None),
+        (gc_start(10, 0), None),
+        (Event('SampledProfile', 12), None),
+        (Event('StackWalk', 12, opcode_name='Stack'), [Frame('native', None, None, None, 'x.dll', 1), python_frame("alloc")]),
+        # Another thread is not collecting
+        (Event('SampledProfile', 13, tid=2), None),
+        (gc_stop(15, 0, collected=5, duration=4), None),
+        (mark(20, 2, "query", tid=2), None),
+        (gc_start(30, 2), None),
+        (Event('PythonSample', 31, ThreadID=1), [python_frame("alloc")]),
+        (gc_stop(40, 2, collected=7, uncollectable=1), None),
+        (mark(50, 2, "request"), None),
+        (mark(60, 1, "request"), None),
+        (mark(70, 2, "request"), None),
+    ]:
+        a.add(e, frames)
+    a.finish()
+
+    first, second = a.pauses
+    assert (first.generation, first.duration, first.collected, first.samples) == (0, 4, 5, 1)
+    assert first.marks == ["request", "query"]
+    assert first.functions == {"alloc (app.py:1)": 1}
+    # Without a measured duration, the time between the events is used
+    assert (second.generation, second.duration, second.uncollectable) == (2, 10, 1)
+    assert second.marks == ["request"]
+    assert a.functions() == [("alloc (app.py:1)", 2)]
+
+    g0, g2 = a.generations[0], a.generations[2]
+    assert (g0.count, g0.total, g0.collected) == (1, 4, 5)
+    assert (g2.count, g2.longest, g2.uncollectable) == (1, 10, 1)
+    assert a.total == 14
+    assert a.longest_pauses(1) == [second]
+
+    request, query = a.marks["request"], a.marks["query"]
+    assert (request.count, request.affected, request.pauses, request.pause_time) == (2, 1, 2, 14)
+    assert (query.count, query.affected, query.pauses, query.pause_time) == (1, 1, 1, 4)
+
+
+def test_truncated():
+    result = analyze([
+        gc_stop(1, 0),
+        gc_start(2, 1),
+        mark(3, 2, "never started"),
+    ], symbolize=False)
+    assert not result.pauses
+    assert result.unmatched_stops == 1
+    assert not result.marks
+
+
+SCRIPT = """
+import gc, sys
+import etwtrace
+
+tracer = etwtrace.InstrumentedTracer(output=sys.argv[1], gc=True)
+with tracer:
+    assert tracer._module.gc_callback in gc.callbacks
+    with etwtrace.mark_range("collect"):
+        cycle = [[]]
+        cycle[0].append(cycle)
+        del cycle
+        gc.collect()
+assert tracer._module.gc_callback not in gc.callbacks
+"""
+
+
+def test_traced_gc(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "gc.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        result = etwtrace.analyze_gc(reader)
+    full = [p for p in result.pauses if p.generation == 2 and "collect" in p.marks]
+    assert full
+    assert sum(p.collected for p in full) >= 2
+    assert all(p.duration > 0 for p in full)
+    assert result.marks["collect"].affected == 1
@@ -0,0 +1,137 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._imports import analyze
+from fakes import Event, Recorder
+
+
+def start(ts, name, importer="__main__", tid=1):
+    return Event('PythonImport', ts, 1, tid, Name=name, Parent=importer)
+
+
+def stop(ts, name, origin="bytecode", tid=1):
+    return Event('PythonImport', ts, 2, tid, Name=name, Origin=origin)
+
+
+def sample(ts, tid=1):
+    return Event('SampledProfile', ts, tid=tid)
+
+
+def test_tree():
+    result = analyze([
+        start(0, "app"),
+        sample(1),
+        start(2, "json", "app"),
+        start(3, "json.decoder", "json"),
+        sample(4),
+        stop(6, "json.decoder"),
+        stop(7, "json"),
+        start(8, "_speedups", "app"),
+        stop(10, "_speedups", "extension"),
+        # Another thread importing at the same time
+        start(11, "late", "worker", tid=2),
+        sample(12, tid=2),
+        stop(20, "app", "source"),
+        Event('PythonSample', 21, ThreadID=2),
+        stop(22, "late", "error", tid=2),
+    ])
+    app, json, decoder, speedups, late = result.imports
+    assert result.roots() == [app, late]
+    assert app.children == [json, speedups] and json.children == [decoder]
+    assert decoder.parent is json and json.importer == "app"
+    assert (app.cumulative, app.self_time, app.origin) == (20, 13, "source")
+    assert (json.cumulative, json.self_time) == (5, 2)
+    assert (speedups.cumulative, speedups.origin) == (2, "extension")
+    assert (app.samples, app.inclusive_samples, decoder.samples) == (1, 2, 1)
+    assert (late.cumulative, late.samples, late.origin) == (11, 2, "error")
+    assert result.top_imports(count=1) == [app]
+    assert result.by_origin() == {"source": (1, 13), "bytecode": (2, 5), "extension": (1, 2), "error": (1, 11)}
+
+
+def test_truncated():
+    result = analyze([
+        stop(1, "early"),
+        start(2, "outer"),
+        start(3, "inner", "outer"),
+        # inner never stopped, so it ends with outer
+        stop(5, "outer"),
+        start(6, "open"),
+        sample(8),
+    ])
+    outer, inner, still_open = result.imports
+    assert result.unmatched_stops == 1
+    assert (inner.cumulative, inner.origin) == (2, None)
+    assert (outer.cumulative, outer.self_time) == (3, 1)
+    assert (still_open.cumulative, still_open.samples) == (2, 1)
+
+
+def test_hooks(tmp_path, monkeypatch):
+    from importlib import _bootstrap
+    from etwtrace._importtrace import ImportHooks
+
+    package = tmp_path / "etwtrace_test_pkg"
+    package.mkdir()
+    (package / "__init__.py").write_text("from . import child\n", encoding="utf-8")
+    (package / "child.py").write_text("VALUE = 1\n", encoding="utf-8")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, "dont_write_bytecode", True)
+
+    find_and_load = _bootstrap._find_and_load
+    recorder = Recorder()
+    hooks = ImportHooks(recorder)
+    hooks.install()
+    try:
+        import etwtrace_test_pkg
+        with pytest.raises(ImportError):
+            import etwtrace_test_missing
+    finally:
+        hooks.uninstall()
+        sys.modules.pop("etwtrace_test_pkg", None)
+        sys.modules.pop("etwtrace_test_pkg.child", None)
+    assert _bootstrap._find_and_load is find_and_load
+
+    assert recorder.events == [
+        ("import", "etwtrace_test_pkg", 1, __name__),
+        ("import", "etwtrace_test_pkg.child", 1, "etwtrace_test_pkg"),
+        ("import", "etwtrace_test_pkg.child", 2, "source"),
+        ("import", "etwtrace_test_pkg", 2, "source"),
+        ("import", "etwtrace_test_missing", 1, __name__),
+        ("import", "etwtrace_test_missing", 2, "error"),
+    ]
+
+
+SCRIPT = """
+import etwtrace
+etwtrace.enable_if(None, "ETWTRACE_TEST_TYPE")
+import xml.dom.minidom
+etwtrace._tracer.disable()
+"""
+
+
+def test_enable_if(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    env["ETWTRACE_TEST_TYPE"] = "instrument,imports"
+    subprocess.check_call([sys.executable, str(script)], env=env)
+
+    env["ETWTRACE_TEST_TYPE"] = "instrument,unknown"
+    p = subprocess.run([sys.executable, str(script)], env=env, stderr=subprocess.PIPE, encoding="utf-8")
+    assert p.returncode
+    assert "'unknown' is not a supported trace option" in p.stderr
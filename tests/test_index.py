@@ -0,0 +1,110 @@
+import os
+import pytest
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace import _index
+from etwtrace._etlreader import open as etlopen
+
+import etlwriter
+
+
+def _summarize(e):
+    return e.timestamp, e.event_name, e.opcode_name, e.process_id, dict(e.items()), e.stack and list(e.stack)
+
+
+@pytest.fixture
+def trace(tmp_path):
+    path = tmp_path / "cpus.etl"
+    etlwriter.write_stack_trace(path, cpus=4)
+    return path
+
+
+def test_index_summary(trace):
+    with etwtrace.index_trace(trace) as index:
+        assert Path(index.path).name == "cpus.etl.etwidx"
+        assert not index.has_columns
+        counts = {(pid, name): count for pid, name, count, _, _ in index.counts()}
+        assert counts[1000, ("Python", "PythonMark", "")] == 3
+        assert counts[1001, ("MSNT_SystemTrace", "StackWalk", "Stack")] == 1
+        first, last = index.time_range()
+        assert first == etlwriter.START_TIME
+        assert sorted(f[2] for f in index.functions) == ["<module>", "inner", "outer"]
+        assert {p["process_id"]: p["image"] for p in index.processes}[1001] == "cmd.exe"
+        assert index.thread_pids[1200] == 1001
+
+
+def test_index_columns(trace):
+    with etlopen(trace) as etl:
+        events = list(etl)
+    with etwtrace.index_trace(trace, columns=True) as index:
+        assert list(index.column("timestamp")) == [e.timestamp for e in events]
+        assert list(index.column("process_id")) == [e.process_id for e in events]
+        names = [index.names[i] for i in index.column("event")]
+        assert [n[1] for n in names if n[0] == "Python"] == [
+            e.event_name for e in events if e.provider_name == "Python"
+        ]
+
+
+@pytest.mark.parametrize("filters, skipped", [
+    ({}, False),
+    ({"process_ids": [1001], "include_child_process_ids": False}, True),
+    ({"process_ids": [1000]}, False),
+    ({"provider_names": ["Python"], "event_names": ["PythonThread"]}, True),
+    ({"provider_names": ["Python"], "end_time": etlwriter.START_TIME + 1150}, True),
+])
+def test_indexed_reader(trace, filters, skipped):
+    with etlopen(trace, **filters) as etl:
+        expected = [_summarize(e) for e in etl]
+    assert expected
+    etwtrace.index_trace(trace).close()
+    with etwtrace.open_trace(trace, **filters) as etl:
+        assert (etl._buffer_offsets is not None) == bool(filters)
+        if skipped:
+            assert len(etl._buffer_offsets) < len(_index.R._read_buffers(etl._data))
+        actual = [_summarize(e) for e in etl]
+    assert actual == expected
+
+
+def test_indexed_child_before_window(tmp_path):
+    # The child starts in a buffer that ends before the window
+    path = tmp_path / "child.etl"
+    with etlwriter.EtlWriter(path, buffer_size=0x200) as w:
+        w.process(1, 1000, 900, 'python.exe', 'python.exe app.py', ts=1000)
+        w.process(1, 1001, 1000, 'cmd.exe', 'cmd /c exit', ts=1010)
+        for i in range(20):
+            w.python_event('PythonMark', 'parent', opcode=1, ts=1100 + i, pid=1000, tid=1100)
+        w.python_event('PythonMark', 'child', opcode=1, ts=2000, pid=1001, tid=1200)
+    filters = {"process_ids": [1000], "start_time": etlwriter.START_TIME + 1500}
+    etwtrace.index_trace(path).close()
+    with etwtrace.open_trace(path, **filters) as etl:
+        assert etl._buffer_offsets is not None
+        assert len(etl._buffer_offsets) < len(_index.R._read_buffers(etl._data))
+        assert [e['Mark'].value for e in etl] == ['child']
+
+
+def test_stale_index(trace):
+    etwtrace.index_trace(trace).close()
+    index = _index.load(trace)
+    assert index is not None
+    index.close()
+
+    # Modifying the trace invalidates the index
+    data = trace.read_bytes()
+    trace.write_bytes(data[:-1] + b"\xff")
+    assert _index.load(trace) is None
+    with etwtrace.open_trace(trace, process_ids=[1001]) as etl:
+        assert etl._buffer_offsets is None
+
+    Path(_index.index_path(trace)).write_bytes(b"not an index")
+    assert _index.load(trace) is None
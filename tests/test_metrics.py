@@ -0,0 +1,122 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._metrics import analyze, bucket_range, COUNTER, GAUGE, HISTOGRAM
+from fakes import Event
+
+
+def info(metric_id, kind, name):
+    return Event('PythonMetricInfo', 0, MetricID=metric_id, Kind=kind, Name=name)
+
+
+def summary(ts, metric_id, count, total, low, high, value=0.0, buckets=()):
+    return Event('PythonMetric', ts, MetricID=metric_id, Count=count, Sum=total,
+                  Min=low, Max=high, Value=value, Buckets=list(buckets))
+
+
+def test_bucket_range():
+    low, high = bucket_range(0)
+    assert low == 2 ** -64
+    # 1.0 is the first value of the bucket after every exponent below it
+    index = (1 - -63) * 16
+    assert bucket_range(index) == (1.0, 1.0625)
+    assert bucket_range(index - 1)[1] == 1.0
+    assert bucket_range(index + 16)[0] == 2.0
+
+
+def test_analyze():
+    one = (1 - -63) * 16
+    two = one + 16
+    result = analyze([
+        info(1, COUNTER, 'requests'),
+        info(2, GAUGE, 'queue'),
+        info(3, HISTOGRAM, 'latency'),
+        summary(10, 1, 3, 3.0, 1.0, 1.0),
+        summary(10, 2, 4, 6.0, 1.0, 3.0, 2.0),
+        summary(10, 3, 4, 5.0, 1.0, 2.0, buckets=[one, 3, two, 1]),
+        summary(20, 1, 2, 5.0, 1.0, 4.0),
+        summary(20, 3, 2, 4.0, 2.0, 2.0, buckets=[two, 2]),
+        # No info event was seen
+        summary(20, 4, 1, 1.0, 1.0, 1.0),
+    ])
+    requests, queue, latency, unknown = result.metrics
+    assert (requests.kind_name, requests.count, requests.sum) == ('counter', 5, 8.0)
+    assert requests.series() == [(10, 3.0), (20, 8.0)]
+    assert (requests.min, requests.max) == (1.0, 4.0)
+    assert queue.series() == [(10, 2.0)]
+    assert latency.buckets == {one: 3, two: 3}
+    assert latency.mean == 1.5
+    assert latency.percentile(50) == pytest.approx(1.03125)
+    # Estimates are clamped to the values seen
+    assert latency.percentile(99) == 2.0
+    assert [v for _, v in latency.series()] == [pytest.approx(1.03125), 2.0]
+    assert unknown.name == '<metric 4>'
+    assert result.find('queue') is queue
+    assert result.find('queue', process_id=1) is None
+
+
+def test_no_tracer():
+    counter = etwtrace.counter("test_metrics.no_tracer")
+    assert etwtrace.counter("test_metrics.no_tracer") is counter
+    counter.add()
+    counter.add(5)
+    etwtrace.histogram("test_metrics.histogram").record(1.5)
+    with pytest.raises(ValueError):
+        etwtrace.gauge("test_metrics.no_tracer")
+
+
+SCRIPT = """
+import sys
+import time
+import etwtrace
+
+requests = etwtrace.counter("requests")
+tracer = etwtrace.InstrumentedTracer(output=sys.argv[1])
+tracer.metrics_interval = 0.05
+with tracer:
+    queue = etwtrace.gauge("queue")
+    latency = etwtrace.histogram("latency")
+    for i in range(100):
+        requests.add()
+        queue.set(i)
+        latency.record(i % 10)
+        if i == 50:
+            time.sleep(0.2)
+requests.add()
+"""
+
+
+def test_traced_metrics(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "metrics.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        result = etwtrace.analyze_metrics(reader)
+    requests = result.find("requests")
+    assert (requests.kind_name, requests.count, requests.sum) == ("counter", 100, 100)
+    # Summaries were written during the sleep and when disabled
+    assert len(requests.points) >= 2
+    queue = result.find("queue")
+    assert (queue.min, queue.max, queue.value) == (0, 99, 99)
+    latency = result.find("latency")
+    assert (latency.count, latency.min, latency.max) == (100, 0, 9)
+    assert 4 <= latency.percentile(50) <= 5
@@ -0,0 +1,115 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+
+if sys.platform == "win32":
+    pytest.skip("perf maps are only written on Linux", allow_module_level=True)
+
+try:
+    from etwtrace import _etwtrace
+except ImportError:
+    pytest.skip("_etwtrace has not been built", allow_module_level=True)
+
+
+SCRIPT = """
+import etwtrace
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+def gen():
+    yield from range(3)
+
+def fail():
+    raise ValueError("expected")
+
+class Überklasse:
+    def méthode(self):
+        return 42
+
+with etwtrace.StackSamplingTracer() as tracer:
+    print(tracer._get_technical_info()[5])
+    print(fib(15), list(gen()), Überklasse().méthode())
+    try:
+        fail()
+    except ValueError as ex:
+        print(ex)
+"""
+
+
+SUBSCRIBED_SCRIPT = """
+import etwtrace
+
+events = []
+etwtrace.subscribe(events.extend)
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+with etwtrace.StackSamplingTracer() as tracer:
+    print(tracer._get_technical_info()[5])
+    fib(10)
+print(sum(e.event_name == "PythonFunction" for e in events))
+"""
+
+
+def run_traced(tmp_path, source):
+    script = tmp_path / "perfmap_script.py"
+    script.write_text(source, encoding="utf-8")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    p = subprocess.Popen([sys.executable, str(script)], env=env, stdout=subprocess.PIPE, encoding="utf-8")
+    output, _ = p.communicate()
+    assert p.returncode == 0
+    perf_map = Path(f"/tmp/perf-{p.pid}.map")
+    try:
+        entries = perf_map.read_text(encoding="utf-8").splitlines()
+    finally:
+        perf_map.unlink()
+    return script, output.splitlines(), entries
+
+
+@pytest.fixture
+def traced(tmp_path):
+    return run_traced(tmp_path, SCRIPT)
+
+
+def test_thunk_dispatch(traced):
+    _, output, _ = traced
+    assert output[1:] == ["610 [0, 1, 2] 42", "expected"]
+
+
+def test_perf_map(traced):
+    script, output, entries = traced
+    thunk_size = int(output[0])
+    names = set()
+    starts = set()
+    for line in entries:
+        start, size, name = line.split(" ", 2)
+        assert int(size, 16) == thunk_size
+        names.add(name)
+        starts.add(int(start, 16))
+    # Functions are named by co_qualname where there is one (3.11 and later)
+    méthode = "Überklasse.méthode" if sys.version_info >= (3, 11) else "méthode"
+    for func in ["fib", "gen", "fail", méthode]:
+        assert f"py::{func}:{script}" in names
+    # Each function has its own thunk, even where names are repeated
+    assert len(starts) == len(entries)
+
+
+def test_perf_map_while_subscribed(tmp_path):
+    # Subscribers receive events in addition to the default sink
+    script, output, entries = run_traced(tmp_path, SUBSCRIBED_SCRIPT)
+    assert int(output[1]) > 0
+    assert any(e.endswith(f"py::fib:{script}") for e in entries)
@@ -0,0 +1,179 @@
+import gzip
+import io
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._pprof import ProfileBuilder
+
+
+# Field numbers from profile.proto that hold messages or packed integers
+MESSAGES = {
+    'Profile': {1: 'ValueType', 2: 'Sample', 3: 'Mapping', 4: 'Location', 5: 'Function', 11: 'ValueType'},
+    'Sample': {3: 'Label'},
+    'Location': {4: 'Line'},
+}
+PACKED = {'Sample': {1, 2}}
+STRINGS = {'Profile': {6}}
+
+
+def _read_varint(data, i):
+    value = shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        value |= (b & 0x7F) << shift
+        shift += 7
+        if b < 0x80:
+            return value, i
+
+
+def decode(data, kind='Profile'):
+    """Decodes a message into a dict mapping field numbers to value lists."""
+    fields = {}
+    i = 0
+    while i < len(data):
+        key, i = _read_varint(data, i)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = _read_varint(data, i)
+            if value >= 1 << 63:
+                value -= 1 << 64
+            fields.setdefault(field, []).append(value)
+            continue
+        assert wire == 2, f"unexpected wire type {wire}"
+        n, i = _read_varint(data, i)
+        chunk, i = data[i:i + n], i + n
+        if field in MESSAGES.get(kind, {}):
+            fields.setdefault(field, []).append(decode(chunk, MESSAGES[kind][field]))
+        elif field in PACKED.get(kind, ()):
+            j = 0
+            while j < len(chunk):
+                value, j = _read_varint(chunk, j)
+                if value >= 1 << 63:
+                    value -= 1 << 64
+                fields.setdefault(field, []).append(value)
+        else:
+            assert field in STRINGS.get(kind, ()), f"unexpected bytes in {kind}.{field}"
+            fields.setdefault(field, []).append(chunk.decode('utf-8'))
+    return fields
+
+
+def _one(m, field, default=0):
+    return m.get(field, [default])[0]
+
+
+class Profile:
+    """Resolves a decoded profile into readable samples."""
+    def __init__(self, data):
+        p = decode(gzip.decompress(data))
+        strings = p[6]
+        self.strings = strings
+        self.sample_types = [(strings[_one(v, 1)], strings[_one(v, 2)]) for v in p[1]]
+        self.functions = {
+            _one(f, 1): (strings[_one(f, 2)], strings[_one(f, 4)], _one(f, 5)) for f in p.get(5, ())
+        }
+        self.mappings = {_one(m, 1): strings[_one(m, 5)] for m in p.get(3, ())}
+        self.locations = {}
+        for loc in p.get(4, ()):
+            if 4 in loc:
+                line = loc[4][0]
+                name = self.functions[_one(line, 1)][0]
+                self.locations[_one(loc, 1)] = f"{name}:{_one(line, 2)}"
+            else:
+                self.locations[_one(loc, 1)] = self.mappings.get(_one(loc, 2), '?')
+        self.samples = []
+        for s in p.get(2, ()):
+            labels = {
+                strings[_one(l, 1)]: strings[_one(l, 2)] if 2 in l else _one(l, 3)
+                for l in s.get(3, ())
+            }
+            stack = tuple(self.locations[i] for i in s[1])
+            self.samples.append((stack, s[2], labels))
+        self.time_nanos = _one(p, 9)
+        self.duration_nanos = _one(p, 10)
+        self.period = _one(p, 12)
+
+    def totals(self, index=0):
+        result = {}
+        for stack, values, _ in self.samples:
+            result[stack] = result.get(stack, 0) + values[index]
+        return result
+
+
+def _export(name, **kwargs):
+    out = io.BytesIO()
+    with etwtrace.open_trace(TRACES / name) as etl:
+        etwtrace.export(etl, out, "pprof", **kwargs)
+    return Profile(out.getvalue())
+
+
+def test_builder_roundtrip():
+    b = ProfileBuilder([('samples', 'count')])
+    m = b.mapping('python313.dll')
+    f = b.function('spam', 'spam.py', 10)
+    spam = b.location(f, 12)
+    assert b.location(f, 12) == spam
+    native = b.location(mapping_id=m, address=0x1234)
+    b.add_sample([spam, native], [1], [('pid', 1), ('mark', 'x')])
+    b.add_sample([spam, native], [2], [('pid', 1), ('mark', 'x')])
+    b.add_sample([native], [-5])
+    b.time_nanos = 1 << 62
+
+    p = Profile(gzip.compress(b.encode()))
+    assert p.sample_types == [('samples', 'count')]
+    assert p.samples == [
+        (('spam:12', 'python313.dll'), [3], {'pid': 1, 'mark': 'x'}),
+        (('python313.dll',), [-5], {}),
+    ]
+    assert p.functions == {1: ('spam', 'spam.py', 10)}
+    assert p.time_nanos == 1 << 62
+    assert len(p.strings) == len(set(p.strings))
+
+
+def test_pprof_samples():
+    p = _export("stack.etl")
+    assert p.sample_types == [('samples', 'count'), ('cpu', 'nanoseconds')]
+    assert p.period == 1_000_000
+    assert p.totals() == {
+        ('<module>:1',): 4,
+        ('outer:4', '<module>:1'): 3,
+        ('inner:8', 'outer:4', '<module>:1'): 3,
+    }
+    assert all(labels['pid'] == 1000 and labels['tid'] == 1100 for _, _, labels in p.samples)
+    assert {labels.get('mark') for _, _, labels in p.samples} == {'phase'}
+    assert p.duration_nanos > 0
+
+
+def test_pprof_native():
+    p = _export("stack.etl", native=True)
+    stacks = set(p.totals())
+    assert ('inner:8', 'python313.dll', 'outer:4', 'python313.dll',
+            '<module>:1', 'python313.dll', 'python313.dll') in stacks
+    # The child process has no modules or Python functions
+    assert ('?',) in stacks
+
+
+def test_pprof_instrumented():
+    p = _export("instrumented.etl")
+    assert p.sample_types == [('calls', 'count'), ('wall', 'nanoseconds')]
+    wall = p.totals(1)
+    calls = p.totals(0)
+    # Exclusive time per function matches the call tree
+    by_function = {}
+    for stack, value in wall.items():
+        name = stack[0].partition(':')[0]
+        by_function[name] = by_function.get(name, 0) + value
+    assert by_function == {'<module>': 3000, 'outer': 9000, 'inner': 5000}
+    assert sum(v for s, v in calls.items() if s[0].startswith('outer')) == 2
+    # Callers are attributed to the line of the call
+    assert all(s[-1] != '<module>:1' for s in wall if len(s) > 1)
@@ -0,0 +1,144 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+
+try:
+    from etwtrace import _etwsample
+except ImportError:
+    pytest.skip("_etwsample has not been built", allow_module_level=True)
+
+
+# Spends three times as long in heavy() as in light(), on the main thread,
+# while another thread waits
+SCRIPT = """
+import sys, threading, time
+import etwtrace
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    n = 0
+    while time.perf_counter() < end:
+        n += 1
+    return n
+
+def heavy():
+    return spin(0.3)
+
+def light():
+    return spin(0.1)
+
+def waiter(event):
+    event.wait()
+
+tracer = etwtrace.SamplingTracer(rate=int(sys.argv[2]), output=sys.argv[1])
+event = threading.Event()
+t = threading.Thread(target=waiter, args=(event,))
+t.start()
+with tracer:
+    for _ in range(2):
+        heavy()
+        light()
+event.set()
+t.join()
+print(tracer.samples)
+"""
+
+
+def _sample(tmp_path, rate):
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "samples.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    p = subprocess.run([sys.executable, str(script), str(output), str(rate)],
+                       env=env, stdout=subprocess.PIPE, encoding="utf-8", check=True)
+    samples = {}
+    with etwtrace.open_trace(output) as reader:
+        for event, frames in etwtrace.symbolize(reader, native=False):
+            if event.event_name == "PythonSample":
+                names = tuple(f.name for f in reversed(frames) if f.file == str(script))
+                key = event.get("ThreadID"), names
+                samples[key] = samples.get(key, 0) + 1
+    return int(p.stdout), samples
+
+
+def test_distribution(tmp_path):
+    count, samples = _sample(tmp_path, 1000)
+    assert sum(samples.values()) == count
+    main = {names: n for (tid, names), n in samples.items() if names[:1] == ("<module>",)}
+    heavy = main.get(("<module>", "heavy", "spin"), 0)
+    light = main.get(("<module>", "light", "spin"), 0)
+    # 0.8s of work at 1kHz, allowing for the sampler falling behind
+    assert heavy + light > 200
+    assert 0.6 < heavy / (heavy + light) < 0.9
+
+    # The waiting thread is sampled too
+    waiting = [n for (tid, names), n in samples.items() if "waiter" in names]
+    assert sum(waiting) > 100
+
+
+def test_rate(tmp_path):
+    slow, _ = _sample(tmp_path, 100)
+    fast, _ = _sample(tmp_path, 1000)
+    assert slow < fast
+
+
+def test_reenable():
+    tracer = etwtrace.SamplingTracer(rate=500)
+    interval = sys.getswitchinterval()
+    for _ in range(2):
+        with tracer:
+            assert sys.getswitchinterval() == pytest.approx(0.002)
+        assert sys.getswitchinterval() == interval
+
+
+# Runs the metric writer and a subscriber's listener alongside the main thread
+INTERNAL_SCRIPT = """
+import sys, threading, time
+import etwtrace
+
+requests = etwtrace.counter("requests")
+subscription = etwtrace.subscribe(lambda events: None)
+tracer = etwtrace.SamplingTracer(rate=1000, output=sys.argv[1])
+tracer.metrics_interval = tracer.listener_interval = 0.005
+with tracer:
+    internal = [t.native_id for t in threading.enumerate() if t.name.startswith("etwtrace")]
+    end = time.perf_counter() + 0.3
+    while time.perf_counter() < end:
+        requests.add(1)
+subscription.close()
+print(*internal)
+"""
+
+
+def test_internal_threads(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(INTERNAL_SCRIPT, encoding="utf-8")
+    output = tmp_path / "samples.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    p = subprocess.run([sys.executable, str(script), str(output)],
+                       env=env, stdout=subprocess.PIPE, encoding="utf-8", check=True)
+    internal = set(map(int, p.stdout.split()))
+    assert len(internal) == 2
+
+    import threading
+    threads = set()
+    files = set()
+    with etwtrace.open_trace(output) as reader:
+        for event, frames in etwtrace.symbolize(reader, native=False):
+            if event.event_name == "PythonSample":
+                threads.add(event.get("ThreadID"))
+                files.update(f.file for f in frames)
+    assert threads and not threads & internal
+    assert threading.__file__ not in files
@@ -0,0 +1,112 @@
+import sqlite3
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace import _cli
+
+
+def _load(path, name, **kwargs):
+    with etwtrace.open_trace(TRACES / name) as etl:
+        return etwtrace.export(etl, path, "sqlite", **kwargs)
+
+
+def test_stack_tables(tmp_path):
+    db = tmp_path / "trace.db"
+    exporter = _load(db, "stack.etl")
+    assert exporter.trace_id == 1
+    con = sqlite3.connect(db)
+    assert con.execute("SELECT COUNT(*) FROM events").fetchone() == (exporter.events,)
+    assert con.execute("SELECT events FROM traces").fetchall() == [(exporter.events,)]
+
+    # The innermost Python frame of the deepest stack
+    row = con.execute("""
+        SELECT n.value, f.value, sf.line FROM stack_frames sf
+        JOIN strings n ON n.id = sf.name_id JOIN strings f ON f.id = sf.file_id
+        WHERE sf.kind = 'python'
+        ORDER BY (SELECT depth FROM stacks s WHERE s.stack_id = sf.stack_id) DESC, sf.position
+        LIMIT 1
+    """).fetchone()
+    assert row == ("inner", r"C:\scripts\basic.py", 8)
+
+    marks = con.execute("""
+        SELECT s.value, m.instant, m.end - m.start FROM marks m JOIN strings s ON s.id = m.name_id
+        ORDER BY m.start
+    """).fetchall()
+    assert [m[1] for m in marks] == [0, 1]
+    assert marks[0][2] > 0 and marks[1][2] == 0
+
+    processes = con.execute("""
+        SELECT p.process_id, s.value FROM processes p JOIN strings s ON s.id = p.image_id
+        WHERE p.process_id IN (1000, 1001) ORDER BY p.process_id
+    """).fetchall()
+    assert processes == [(1000, "python.exe"), (1001, "cmd.exe")]
+
+    indexes = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"events_time", "stack_frames_id"} <= indexes
+    con.close()
+
+
+def test_instrumented_calls(tmp_path):
+    db = tmp_path / "trace.db"
+    _load(db, "instrumented.etl")
+    con = sqlite3.connect(db)
+    calls = con.execute("""
+        SELECT s.value, COUNT(*) FROM events e
+        JOIN strings en ON en.id = e.name_id AND en.value = 'PythonFunctionPush'
+        JOIN functions f ON f.function_id = e.function_id AND f.process_id = e.process_id
+        JOIN strings s ON s.id = f.name_id
+        GROUP BY s.value ORDER BY s.value
+    """).fetchall()
+    assert calls == [("<module>", 1), ("inner", 2), ("outer", 2)]
+    # Push and pop events store their values in columns, not properties
+    assert con.execute("""
+        SELECT COUNT(*) FROM events e JOIN strings s ON s.id = e.name_id
+        WHERE s.value LIKE 'PythonFunctionP%' AND e.properties IS NOT NULL
+    """).fetchone() == (0,)
+    con.close()
+
+
+def test_append(tmp_path):
+    db = tmp_path / "trace.db"
+    first = _load(db, "stack.etl")
+    second = _load(db, "instrumented.etl", append=True)
+    assert (first.trace_id, second.trace_id) == (1, 2)
+    con = sqlite3.connect(db)
+    counts = con.execute("SELECT trace_id, COUNT(*) FROM events GROUP BY trace_id").fetchall()
+    assert counts == [(1, first.events), (2, second.events)]
+    # Strings are shared between traces
+    values = [r[0] for r in con.execute("SELECT value FROM strings")]
+    assert len(values) == len(set(values))
+    con.close()
+
+    try:
+        _load(db, "stack.etl", append=True, trace_id=1)
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+    # Without append, the database is replaced
+    assert _load(db, "instrumented.etl").trace_id == 1
+
+
+def test_cli_export_sqlite(tmp_path, capsys):
+    db = tmp_path / "out.db"
+    assert _cli.main(["export", "--format", "sqlite", str(TRACES / "stack.etl"), str(db)]) == 0
+    assert _cli.main(["export", "--format", "sqlite", "--append", str(TRACES / "stack.etl"), str(db)]) == 0
+    err = capsys.readouterr().err
+    assert "as trace 2 into" in err and "events/s" in err
+    con = sqlite3.connect(db)
+    assert con.execute("SELECT COUNT(*) FROM traces").fetchone() == (2,)
+    con.close()
+    assert _cli.main(["export", "--format", "sqlite", "--output", "-", str(TRACES / "stack.etl")]) == 1
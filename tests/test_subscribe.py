@@ -0,0 +1,179 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._listener import Subscription
+from etwtrace._tracefile import CHUNK_HEADER, CHUNK_STRINGS, CHUNK_THREAD, RECORD_MARK, TraceChunkDecoder
+
+
+class _Event:
+    def __init__(self, keyword):
+        self.keyword = keyword
+
+
+def test_batches():
+    batches = []
+    s = Subscription(batches.append, 0x20000, 2)
+    s._deliver([_Event(0x20000), _Event(0x400), _Event(0x20000), _Event(0x20000)])
+    assert [len(b) for b in batches] == [2, 1]
+    assert all(e.keyword == 0x20000 for b in batches for e in b)
+    assert s.delivered == 3
+    with pytest.raises(ValueError):
+        Subscription(batches.append, 0, 0)
+
+
+def test_callback_raises(monkeypatch):
+    reported = []
+    monkeypatch.setattr(sys, "excepthook", lambda *exc_info: reported.append(exc_info[0]))
+    calls = []
+    def callback(events):
+        calls.append(events)
+        raise RuntimeError()
+    s = etwtrace.subscribe(callback, batch_size=1)
+    s._deliver([_Event(1), _Event(2)])
+    assert len(calls) == 1
+    assert reported == [RuntimeError]
+    assert s.closed and s.delivered == 0
+    from etwtrace import _listener
+    assert s not in _listener._subscriptions
+
+
+def _chunk(kind, tid, body):
+    return CHUNK_HEADER.pack(kind, len(body), tid, 1000) + body
+
+
+def test_decode_batches():
+    decoder = TraceChunkDecoder(123)
+    # The string is only written before its first use
+    first = _chunk(CHUNK_STRINGS, 0, bytes([1, 4]) + b"mark") + _chunk(CHUNK_THREAD, 7, bytes([RECORD_MARK, 0, 1, 1]))
+    second = _chunk(CHUNK_THREAD, 7, bytes([RECORD_MARK, 5, 2, 1]))
+    events = decoder.decode(first) + decoder.decode(second)
+    assert [(e.event_name, e.opcode, e.timestamp, e.thread_id, e.process_id) for e in events] == [
+        ('PythonMark', 1, 1000, 7, 123),
+        ('PythonMark', 2, 1005, 7, 123),
+    ]
+    assert [e['Mark'].value for e in events] == ['mark', 'mark']
+    decoder.select(keyword_mask_any=0x400)
+    assert decoder.decode(second) == []
+
+
+SCRIPT = """
+import gc
+import json
+import sys
+import threading
+import etwtrace
+
+everything = []
+gcs = []
+threads = set()
+def on_events(events):
+    threads.add(threading.current_thread().name)
+    everything.extend(events)
+
+s1 = etwtrace.subscribe(on_events, batch_size=100)
+s2 = etwtrace.subscribe(gcs.extend, keywords=0x20000)
+
+def work(n):
+    return n
+
+tracer = etwtrace.InstrumentedTracer(output=sys.argv[1], gc=True)
+tracer.listener_interval = 0.01
+if sys.argv[2] == "small":
+    tracer.listener_buffer_size = 0
+with tracer:
+    with etwtrace.activity("request"):
+        for i in range(1000):
+            work(i)
+        gc.collect()
+
+json.dump({
+    "delivered": s1.delivered,
+    "dropped": s1.dropped,
+    "events": len(everything),
+    "names": sorted({e.event_name for e in everything}),
+    "pushes": sum(1 for e in everything if e.event_name == "PythonFunctionPush" and e.activity_id),
+    "gc": sorted({e.event_name for e in gcs}),
+    "gc_count": len(gcs),
+    "threads": sorted(threads),
+}, sys.stdout)
+"""
+
+
+def _run(tmp_path, mode):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "subscribe.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    result = json.loads(subprocess.check_output([sys.executable, str(script), str(output), mode], env=env))
+    return result, output
+
+
+def test_subscribe(tmp_path):
+    result, output = _run(tmp_path, "default")
+    with etwtrace.open_trace(output) as reader:
+        recorded = sum(1 for _ in reader)
+    # Subscribers receive the same events as the file
+    assert result["delivered"] == result["events"] == recorded
+    assert result["dropped"] == 0
+    assert {"PythonFunction", "PythonFunctionPush", "PythonGC"} <= set(result["names"])
+    assert result["pushes"] >= 1000
+    assert result["gc"] == ["PythonGC"]
+    assert result["gc_count"] >= 2
+    assert "etwtrace listener" in result["threads"]
+
+
+def test_dropped(tmp_path):
+    result, _ = _run(tmp_path, "small")
+    assert result["delivered"] == 0
+    assert result["dropped"] > 1000
+
+
+ALLOCATIONS_SCRIPT = """
+import sys, threading
+import etwtrace
+
+received = []
+subscription = etwtrace.subscribe(received.extend)
+tracer = etwtrace.SamplingTracer(rate=1000, output=sys.argv[1], allocations=4096)
+tracer.listener_interval = 0.005
+with tracer:
+    listener = next(t.native_id for t in threading.enumerate() if t.name == "etwtrace listener")
+    data = [str(i) for i in range(200000)]
+subscription.close()
+print(listener, len(received))
+"""
+
+
+def test_listener_not_traced(tmp_path):
+    try:
+        from etwtrace import _etwsample
+    except ImportError:
+        pytest.skip("_etwsample has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(ALLOCATIONS_SCRIPT, encoding="utf-8")
+    output = tmp_path / "allocations.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    listener, received = map(int, subprocess.check_output(
+        [sys.executable, str(script), str(output)], env=env).split())
+    assert received
+    with etwtrace.open_trace(output) as reader:
+        threads = [e.thread_id for e in reader if e.event_name == "PythonAllocation"]
+    assert threads
+    assert listener not in threads
@@ -0,0 +1,136 @@
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+TRACES = ROOT / "traces"
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._symbolize import IntervalIndex, Symbolizer
+
+import etlwriter
+
+
+def test_interval_index():
+    index = IntervalIndex()
+    index.add(0x100, 0x140, 'a', 10)
+    index.add(0x140, 0x180, 'b', 11)
+    index.add(0x200, 0x240, 'c', 12)
+    assert index.generations == 1
+    assert index.lookup(0x100) == 'a'
+    assert index.lookup(0x17F) == 'b'
+    assert index.lookup(0x180) is None
+    assert index.lookup(0xFF) is None
+    assert index.lookup_many([0x210, 0x0, 0x108, 0x148, 0x1000]) == {
+        0x0: None, 0x108: 'a', 0x148: 'b', 0x210: 'c', 0x1000: None,
+    }
+
+    # Redefining the same range is not a new generation
+    index.add(0x100, 0x140, 'a', 13)
+    assert index.generations == 1
+
+    # Reusing a range makes the old definitions historical
+    index.add(0x100, 0x140, 'd', 20)
+    assert index.generations == 2
+    assert index.lookup(0x108) == 'd'
+    assert index.lookup(0x108, 15) == 'a'
+    assert index.lookup(0x108, 25) == 'd'
+    assert index.lookup(0x148, 15) == 'b'
+    assert index.lookup(0x148, 25) == 'b'
+    assert index.lookup_many([0x108, 0x208], 15) == {0x108: 'a', 0x208: 'c'}
+
+    index.remove(0x200, 30)
+    assert index.lookup(0x208, 25) == 'c'
+    assert index.lookup(0x208, 35) is None
+
+
+def test_interval_index_reenabled():
+    # Re-registering every function after re-enabling tracing replaces the
+    # old thunks in one generation, rather than starting one per function
+    index = IntervalIndex()
+    for i in range(1000):
+        index.add(i * 0x10, i * 0x10 + 0x10, ('old', i), i)
+    for i in range(1000):
+        index.add(i * 0x10, i * 0x10 + 0x10, ('new', i), 2000 + i)
+    assert index.generations == 2
+    assert index.lookup(0x1008, 1500) == ('old', 0x100)
+    assert index.lookup(0x1008, 3500) == ('new', 0x100)
+    assert index.lookup(0x1008) == ('new', 0x100)
+
+    # A range replaced again in the same generation starts a new one
+    index.add(0x1000, 0x1010, 'newer', 4000)
+    assert index.generations == 3
+    assert index.lookup(0x1008, 3500) == ('new', 0x100)
+    assert index.lookup(0x1008, 4500) == 'newer'
+
+
+def _frame_names(frames):
+    return [f.name if f.kind == 'python' else f.module if f.kind == 'native' else None for f in frames]
+
+
+def test_symbolize_trace():
+    with etwtrace.open_trace(TRACES / "stack.etl") as etl:
+        results = list(Symbolizer().symbolize_events(etl))
+    walks = [(e, frames) for e, frames in results if e.opcode_name == 'Stack']
+    assert len(walks) == 11
+
+    e, frames = walks[2]
+    assert _frame_names(frames) == [
+        'inner', 'python313.dll', 'outer', 'python313.dll', '<module>', 'python313.dll', 'python313.dll',
+    ]
+    inner = frames[0]
+    assert (inner.file, inner.line) == (r'C:\scripts\basic.py', 8)
+    assert str(inner) == r'inner (C:\scripts\basic.py:8)'
+    assert str(frames[1]) == 'python313.dll!0x12360'
+
+    # The child process has no definitions
+    e, frames = walks[10]
+    assert e.process_id == 1001
+    assert [f.kind for f in frames] == ['unknown']
+
+    sample = next(frames for e, frames in results if e.event_name == 'PythonStackSample')
+    assert _frame_names(sample) == ['outer', 'python313.dll']
+
+
+def test_symbolize_python_only():
+    with etwtrace.open_trace(TRACES / "stack.etl", process_ids=[1000]) as etl:
+        results = list(Symbolizer(native=False).symbolize_events(etl))
+    frames = results[0][1]
+    assert [f.kind for f in frames] == ['python', 'unknown', 'unknown']
+
+
+def test_symbolize_reused_thunks(tmp_path):
+    path = tmp_path / "reuse.etl"
+    thunk = etlwriter.THUNKS[0]
+    with etlwriter.EtlWriter(path) as w:
+        for ts, func_id, name in [(100, 1, 'first'), (300, 2, 'second')]:
+            w.python_event(
+                'PythonFunction', func_id, thunk, thunk + etlwriter.THUNK_SIZE, 1, 'x.py', name, 1,
+                ts=ts, pid=1000, tid=1100,
+            )
+            w.stackwalk(1000, 1100, [thunk + 8], event_ts=ts + 50, ts=ts + 50)
+
+    with etwtrace.open_trace(path) as etl:
+        events = list(etl)
+
+    s = Symbolizer()
+    single_pass = [_frame_names(frames) for _, frames in s.symbolize_events(events)]
+    assert single_pass == [['first'], ['second']]
+
+    # After reading everything, timestamps still select the right function
+    samples = [(e.process_id, e.timestamp, e.stack) for e in events if e.stack]
+    assert [_frame_names(f) for f in s.symbolize_many(samples)] == [['first'], ['second']]
+    assert _frame_names(s.symbolize(1000, [thunk + 8])) == ['second']
+
+
+def test_symbolize_many_shares_frames():
+    s = Symbolizer()
+    stacks = [(1, None, [0x10, 0x20])] * 1000
+    results = s.symbolize_many(stacks)
+    assert len(results) == 1000
+    assert all(r is results[0] for r in results)
@@ -0,0 +1,182 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace._tasks import analyze, RUNNING, WAITING, READY
+from fakes import Event, Recorder
+
+
+def create(ts, task_id, name, parent=0):
+    return Event('PythonTaskCreate', ts, TaskID=task_id, ParentTaskID=parent, Name=name)
+
+
+def start(ts, task_id, tid=1):
+    return Event('PythonTaskStep', ts, 1, tid, TaskID=task_id)
+
+
+def stop(ts, task_id, awaiting=0, done=0, tid=1):
+    return Event('PythonTaskStep', ts, 2, tid, TaskID=task_id, AwaitingID=awaiting, Done=done)
+
+
+def callback(ts, opcode, name):
+    return Event('PythonCallback', ts, opcode, Name=name)
+
+
+def test_timeline():
+    result = analyze([
+        create(0, 1, "main"),
+        start(10, 1),
+        create(12, 2, "child", parent=1),
+        stop(15, 1, awaiting=2),
+        start(20, 2),
+        stop(30, 2, awaiting=99),
+        callback(40, 1, "on_done"),
+        callback(45, 2, "on_done"),
+        start(50, 2),
+        stop(55, 2, done=1),
+        start(60, 1),
+        stop(62, 1, done=1),
+    ])
+    main, child = result.tasks
+    assert (main.name, main.steps, main.cpu, main.wall) == ("main", 2, 7, 62)
+    assert (child.name, child.steps, child.cpu, child.wall) == ("child", 2, 15, 43)
+    assert child.parent is main and main.children == [child]
+    assert child.awaiters == [main]
+    assert [t.name for t in child.logical_stack()] == ["main", "child"]
+    assert main.inclusive_cpu == 22
+    assert result.roots() == [main]
+    assert main.segments == [
+        (0, 10, READY, None),
+        (10, 15, RUNNING, 1),
+        (15, 60, WAITING, child),
+        (60, 62, RUNNING, 1),
+    ]
+    assert [s[2:] for s in child.segments] == [(READY, None), (RUNNING, 1), (WAITING, None), (RUNNING, 1)]
+    [cb] = result.callbacks.values()
+    assert (cb.name, cb.calls, cb.total, cb.longest) == ("on_done", 1, 5, 5)
+
+
+def test_reused_id():
+    result = analyze([
+        create(0, 1, "first"),
+        start(1, 1),
+        stop(2, 1, done=1),
+        create(3, 1, "second"),
+        start(4, 1),
+        stop(6, 1, done=1),
+    ])
+    assert [(t.name, t.cpu) for t in result.tasks] == [("first", 1), ("second", 2)]
+
+
+def test_renamed():
+    result = analyze([
+        create(0, 1, "Task-1 (f)", parent=0),
+        create(0, 1, "named (f)", parent=0),
+        start(1, 1),
+        stop(2, 1),
+    ])
+    assert [t.name for t in result.tasks] == ["named (f)"]
+
+
+def test_truncated():
+    result = analyze([
+        stop(1, 5),
+        start(2, 5),
+        stop(3, 5, awaiting=7),
+        start(8, 5),
+        callback(9, 1, "x"),
+    ])
+    [t] = result.tasks
+    assert t.name is None and t.display_name == "<task 0x5>"
+    # The open step ends with the trace
+    assert (t.steps, t.cpu, t.finished) == (2, 2, None)
+    assert result.unmatched_stops == 1
+    assert not result.callbacks
+
+
+SCRIPT = """
+import asyncio, sys
+import etwtrace
+
+async def leaf(i):
+    await asyncio.sleep(0.001)
+    return i
+
+async def handler(i):
+    await asyncio.gather(leaf(i), leaf(i + 1))
+    return await asyncio.get_running_loop().create_task(leaf(0), name="direct")
+
+async def main():
+    asyncio.get_running_loop().call_soon(print, "callback")
+    await asyncio.gather(handler(1), handler(2))
+
+with etwtrace.InstrumentedTracer(output=sys.argv[1], tasks=True):
+    asyncio.run(main())
+"""
+
+
+def test_traced_tasks(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "tasks.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        result = etwtrace.analyze_tasks(reader)
+    main = next(t for t in result.tasks if t.name == "Task-1 (main)")
+    handlers = [t for t in main.children if "(handler)" in t.name]
+    assert len(handlers) == 2
+    for h in handlers:
+        assert len(h.children) == 3
+        assert all(c.name.endswith("(leaf)") for c in h.children)
+        direct = next(c for c in h.children if c.name == "direct (leaf)")
+        assert direct.awaiters == [h]
+        assert all(c.finished is not None for c in h.children)
+    assert main.inclusive_cpu > sum(h.cpu for h in handlers)
+    assert any(c.name == "print" for c in result.callbacks.values())
+
+
+def test_hooks():
+    import asyncio
+    from asyncio import base_events, events
+    from etwtrace._asynctrace import TaskHooks
+
+    async def child():
+        await asyncio.sleep(0)
+
+    async def main():
+        await asyncio.create_task(child(), name="child")
+
+    run, create_task = events.Handle._run, base_events.BaseEventLoop.create_task
+    recorder = Recorder()
+    hooks = TaskHooks(recorder)
+    hooks.install()
+    try:
+        asyncio.run(main())
+    finally:
+        hooks.uninstall()
+    assert (events.Handle._run, base_events.BaseEventLoop.create_task) == (run, create_task)
+
+    creates = [e for e in recorder.events if e[0] == "task_create"]
+    [(_, main_id, _, _)] = [e for e in creates if e[3].endswith(".main)")]
+    [(_, child_id, parent_id, _)] = [e for e in creates if e[3].startswith("child (")]
+    assert parent_id == main_id
+    steps = [e for e in recorder.events if e[0] == "task_step" and e[1] == child_id]
+    # A bare yield, then done
+    assert [e[2:] for e in steps] == [(1,), (2, 0, False), (1,), (2, 0, True)]
@@ -0,0 +1,255 @@
+import io
+import os
+import pytest
+import struct
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent
+
+try:
+    import etwtrace
+except ImportError:
+    sys.path.append(str(ROOT.parent / "src"))
+
+import etwtrace
+from etwtrace import _tracefile as T
+
+
+def varint(v):
+    b = bytearray()
+    while v >= 0x80:
+        b.append((v & 0x7F) | 0x80)
+        v >>= 7
+    b.append(v)
+    return bytes(b)
+
+
+def zigzag(v):
+    return (v << 1) ^ (v >> 63)
+
+
+class Writer:
+    """Writes files in the same layout as _filesink.c."""
+
+    def __init__(self, pid=100, start=1000):
+        self.data = bytearray(T.FILE_HEADER.pack(T.MAGIC, T.VERSION, pid, start))
+        self.strings = {}
+        self.pending = bytearray()
+
+    def string(self, s):
+        if s not in self.strings:
+            self.strings[s] = sid = len(self.strings) + 1
+            utf8 = s.encode()
+            self.pending += varint(sid) + varint(len(utf8)) + utf8
+        return self.strings[s]
+
+    def chunk(self, kind, tid, base, payload):
+        self.data += T.CHUNK_HEADER.pack(kind, len(payload), tid, base) + payload
+
+    def thread(self, tid, base, records):
+        # records are (timestamp, type, fields) with func IDs delta encoded
+        payload = bytearray()
+        last = base
+        last_func_id = 0
+        for ts, kind, fields in records:
+            payload += bytes([kind]) + varint(ts - last)
+            last = ts
+            if kind == T.RECORD_FUNCTION:
+                func_id, name, file, line = fields
+                payload += varint(func_id) + varint(0) + varint(0) + varint(zigzag(line))
+                payload += varint(self.string(file)) + varint(self.string(name)) + b"\1"
+            elif kind in (T.RECORD_PUSH, T.RECORD_POP):
+                payload += varint(zigzag(fields[0] - last_func_id))
+                last_func_id = fields[0]
+                if kind == T.RECORD_PUSH:
+                    payload += varint(fields[1]) + varint(fields[2])
+            elif kind == T.RECORD_MARK:
+                payload += bytes([fields[1]]) + varint(self.string(fields[0]))
+            elif kind == T.RECORD_STACK:
+                stack_id, frames = fields
+                payload += varint(stack_id) + varint(len(frames))
+                prev = 0
+                for f in frames:
+                    payload += varint(zigzag(f - prev))
+                    prev = f
+            elif kind == T.RECORD_SAMPLE:
+                payload += varint(fields[0]) + varint(fields[1])
+            else:
+                payload += varint(fields[0])
+        if self.pending:
+            self.chunk(T.CHUNK_STRINGS, 0, 0, bytes(self.pending))
+            self.pending.clear()
+        self.chunk(T.CHUNK_THREAD, tid, base, bytes(payload))
+
+    def save(self, path):
+        path.write_bytes(self.data)
+        return path
+
+
+@pytest.fixture
+def trace(tmp_path):
+    w = Writer()
+    w.thread(1, 2000, [
+        (2000, T.RECORD_BEGIN_THREAD, (1,)),
+        (2001, T.RECORD_FUNCTION, (1, "outer", "x.py", 1)),
+        (2001, T.RECORD_PUSH, (1, 0, 0)),
+        (2002, T.RECORD_FUNCTION, (2, "inner", "x.py", 5)),
+        (2005, T.RECORD_PUSH, (2, 1, 3)),
+        (2025, T.RECORD_POP, (2,)),
+        (2030, T.RECORD_MARK, ("sample", 3)),
+    ])
+    w.thread(2, 2010, [
+        (2010, T.RECORD_PUSH, (1, 0, 0)),
+        (2020, T.RECORD_MARK, ("range", 1)),
+        (2040, T.RECORD_POP, (1,)),
+    ])
+    # A second chunk for the first thread, which resets the func ID deltas
+    w.thread(1, 2035, [
+        (2035, T.RECORD_POP, (1,)),
+        (2050, T.RECORD_END_THREAD, (1,)),
+    ])
+    return w.save(tmp_path / "test.pytrace")
+
+
+def test_is_trace_file(trace):
+    assert T.is_trace_file(trace)
+    assert not T.is_trace_file(ROOT / "traces" / "stack.etl")
+    assert not T.is_trace_file(trace.parent / "missing")
+
+
+def test_read_events(trace):
+    with etwtrace.open_trace(trace) as reader:
+        events = list(reader)
+    assert [(e.timestamp, e.thread_id, e.event_name, e.opcode) for e in events] == [
+        (2000, 1, "PythonThread", 1),
+        (2001, 1, "PythonFunction", 0),
+        (2001, 1, "PythonFunctionPush", 0),
+        (2002, 1, "PythonFunction", 0),
+        (2005, 1, "PythonFunctionPush", 0),
+        (2010, 2, "PythonFunctionPush", 0),
+        (2020, 2, "PythonMark", 1),
+        (2025, 1, "PythonFunctionPop", 0),
+        (2030, 1, "PythonStackSample", 0),
+        (2035, 1, "PythonFunctionPop", 0),
+        (2040, 2, "PythonFunctionPop", 0),
+        (2050, 1, "PythonThread", 2),
+    ]
+    assert all(e.process_id == 100 and e.provider == T.PYTHON_GUID for e in events)
+    assert dict(events[3].items()) == {
+        "FunctionID": 2, "BeginAddress": 0, "EndAddress": 0, "LineNumber": 5,
+        "SourceFile": "x.py", "Name": "inner", "IsPythonCode": 1,
+    }
+    assert dict(events[4].items()) == {"FunctionID": 2, "Caller": 1, "CallerLine": 3}
+    assert [e.get("FunctionID") for e in events if e.event_name == "PythonFunctionPop"] == [2, 1, 1]
+    assert events[6].get("Mark") == "range"
+
+
+def test_filters(trace):
+    def read(**filters):
+        with etwtrace.open_trace(trace, **filters) as reader:
+            return [(e.timestamp, e.event_name) for e in reader]
+
+    assert read(event_names=["PythonMark", "pythonstacksample"]) == [
+        (2020, "PythonMark"), (2030, "PythonStackSample"),
+    ]
+    assert read(keyword_mask_any=0x2000) == [(2025, "PythonFunctionPop"), (2035, "PythonFunctionPop"), (2040, "PythonFunctionPop")]
+    assert read(start_time=2030, end_time=2035) == [(2030, "PythonStackSample"), (2035, "PythonFunctionPop")]
+    assert read(event_names=["PythonFunctionPop"], property_filters={"FunctionID": 2}) == [(2025, "PythonFunctionPop")]
+    assert read(process_ids=[101]) == []
+    assert read(provider_names=["Microsoft-Windows-Kernel-Process"]) == []
+
+
+def test_calls(trace):
+    with etwtrace.open_trace(trace) as reader:
+        result = etwtrace.analyze_calls(reader)
+    funcs = {f.name: (f.calls, f.inclusive, f.exclusive) for f in result.functions.values()}
+    assert funcs == {"outer": (2, 64, 44), "inner": (1, 20, 20)}
+
+
+def test_truncated(trace):
+    data = trace.read_bytes()
+    # The final chunk is incomplete, as if the process had been killed
+    trace.write_bytes(data[:-3])
+    with etwtrace.open_trace(trace) as reader:
+        events = list(reader)
+    assert len(events) == 10
+    assert events[-1].timestamp == 2040
+
+
+def test_bad_version(tmp_path):
+    path = tmp_path / "test.pytrace"
+    path.write_bytes(T.FILE_HEADER.pack(T.MAGIC, 99, 1, 0))
+    with pytest.raises(T.TraceFileFormatError):
+        etwtrace.open_trace(path)
+
+
+def test_sampled_stacks(tmp_path):
+    w = Writer()
+    # Samples are written by the sampler thread (3) for the sampled threads
+    w.thread(3, 2000, [
+        (2000, T.RECORD_FUNCTION, (1, "main", "x.py", 1)),
+        (2000, T.RECORD_FUNCTION, (2, "work", "x.py", 5)),
+        (2001, T.RECORD_STACK, (1, [2, 1])),
+        (2001, T.RECORD_SAMPLE, (1, 1)),
+        (2002, T.RECORD_STACK, (2, [1])),
+        (2002, T.RECORD_SAMPLE, (2, 2)),
+        (2003, T.RECORD_SAMPLE, (1, 1)),
+    ])
+    trace = w.save(tmp_path / "test.pytrace")
+    with etwtrace.open_trace(trace, event_names=["PythonSampledStack"]) as reader:
+        assert [dict(e.items()) for e in reader] == [
+            {"StackID": 1, "FunctionIDs": [2, 1]},
+            {"StackID": 2, "FunctionIDs": [1]},
+        ]
+
+    out = io.StringIO()
+    with etwtrace.open_trace(trace) as reader:
+        exporter = etwtrace.export(reader, out, "collapsed", processes=False)
+    assert exporter.stacks() == {
+        "main (x.py:1);work (x.py:5)": 2,
+        "main (x.py:1)": 1,
+    }
+
+
+SCRIPT = """
+import sys, threading
+import etwtrace
+
+def leaf(x):
+    return x + 1
+
+def outer():
+    for i in range(3):
+        leaf(i)
+
+with etwtrace.InstrumentedTracer(output=sys.argv[1]) as tracer:
+    tracer.mark("hello")
+    t = threading.Thread(target=outer)
+    t.start()
+    t.join()
+    outer()
+"""
+
+
+def test_instrumented_output(tmp_path):
+    try:
+        from etwtrace import _etwinstrument
+    except ImportError:
+        pytest.skip("_etwinstrument has not been built")
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT, encoding="utf-8")
+    output = tmp_path / "out.pytrace"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(map(str, sys.path))}
+    subprocess.check_call([sys.executable, str(script), str(output)], env=env)
+
+    with etwtrace.open_trace(output) as reader:
+        events = list(reader)
+    assert [e.get("Mark") for e in events if e.event_name == "PythonMark"] == ["hello"]
+    assert len({e.thread_id for e in events}) == 2
+    result = etwtrace.analyze_calls(events)
+    calls = {f.name: f.calls for f in result.functions.values() if f.source_file == str(script)}
+    assert calls["outer"] == 2
+    assert calls["leaf"] == 6